@@ -17,8 +17,12 @@
 
 """Command line tool for generating ProtoRPC definitions from descriptors."""
 
+import StringIO
 import errno
+import hashlib
+import json
 import logging
+import multiprocessing
 import optparse
 import os
 import sys
@@ -75,8 +79,109 @@ def open_input_file(filename):
       fatal_error(str(err))
 
 
+def load_manifest(manifest_file_name):
+  """Load manifest of previously generated files.
+
+  The manifest maps the name of each generated file, relative to the
+  destination directory, to a list [input hash, output hash].  The input hash
+  identifies the file descriptor, generator and generator options that the
+  file was generated from and the output hash identifies its content.
+
+  Args:
+    manifest_file_name: Name of manifest file.
+
+  Returns:
+    Manifest dictionary.  Empty if the manifest file does not exist or can not
+    be read.
+  """
+  try:
+    with open(manifest_file_name, 'rb') as manifest_file:
+      manifest = json.load(manifest_file)
+  except (IOError, ValueError), err:
+    if not isinstance(err, IOError) or err.errno != errno.ENOENT:
+      logging.warn('Ignoring unreadable manifest %s: %s',
+                   manifest_file_name, err)
+    return {}
+  if not isinstance(manifest, dict):
+    logging.warn('Ignoring malformed manifest %s', manifest_file_name)
+    return {}
+  return manifest
+
+
+def save_manifest(manifest_file_name, manifest):
+  """Save manifest of generated files.
+
+  The manifest is written to a temporary file that is then renamed, so that
+  an interrupted run never leaves a truncated manifest behind.
+
+  Args:
+    manifest_file_name: Name of manifest file.
+    manifest: Manifest dictionary as returned by load_manifest.
+  """
+  try:
+    os.makedirs(os.path.dirname(manifest_file_name))
+  except OSError, err:
+    if err.errno != errno.EEXIST:
+      raise
+
+  temporary_file_name = manifest_file_name + '.tmp'
+  with open(temporary_file_name, 'wb') as manifest_file:
+    json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+  os.rename(temporary_file_name, manifest_file_name)
+
+
+def _hash_file(file_name):
+  """Get hash of a file's content or None if it can not be read."""
+  try:
+    with open(file_name, 'rb') as hashed_file:
+      return hashlib.sha1(hashed_file.read()).hexdigest()
+  except IOError:
+    return None
+
+
+def _package_file_name(package):
+  """Get name of file a package is generated to.
+
+  Args:
+    package: Package name.
+
+  Returns:
+    File name relative to the destination directory.
+  """
+  package_path = package.split('.')
+  return os.path.join(*(package_path[:-1] + ['%s.py' % package_path[-1]]))
+
+
+_generator_hash = None
+
+
+def _input_hash(encoded_file_descriptor, compiled_codecs):
+  """Get hash identifying everything a generated file depends on.
+
+  Args:
+    encoded_file_descriptor: Protobuf encoded FileDescriptor.
+    compiled_codecs: Whether compiled codecs are generated.
+
+  Returns:
+    Hex digest that changes when the descriptor, the generator or the
+    generator options change.
+  """
+  global _generator_hash
+  if _generator_hash is None:
+    generator_file_name = generate_python.__file__
+    if generator_file_name.endswith(('.pyc', '.pyo')):
+      generator_file_name = generator_file_name[:-1]
+    _generator_hash = _hash_file(generator_file_name) or ''
+
+  input_hash = hashlib.sha1(_generator_hash)
+  input_hash.update(compiled_codecs and 'compiled' or 'reflective')
+  input_hash.update(encoded_file_descriptor)
+  return input_hash.hexdigest()
+
+
 @util.positional(1)
-def generate_file_descriptor(dest_dir, file_descriptor, force_overwrite):
+def generate_file_descriptor(dest_dir, file_descriptor, force_overwrite,
+                             compiled_codecs=False, manifest=None):
   """Generate a single file descriptor to destination directory.
 
   Will generate a single Python file from a file descriptor under dest_dir.
@@ -87,10 +192,18 @@ def generate_file_descriptor(dest_dir, file_descriptor, force_overwrite):
 
   Descriptors that are part of the ProtoRPC distribution will not be generated.
 
+  Files whose content would not change are not rewritten, so that their
+  modification times and any byte code compiled from them stay valid.  When
+  a manifest is provided, files that the manifest shows were generated from
+  the same input and that were not modified since are not even generated.
+
   Args:
     dest_dir: Directory under which to generate files.
     file_descriptor: FileDescriptor instance to generate source code from.
     force_overwrite: If True, existing files will be overwritten.
+    compiled_codecs: If True, also generate compiled codecs for messages.
+    manifest: Manifest dictionary as returned by load_manifest.  Updated with
+      the generated file.
   """
   package = file_descriptor.package
   if not package:
@@ -102,12 +215,18 @@ def generate_file_descriptor(dest_dir, file_descriptor, force_overwrite):
     logging.warn('Will not generate main ProtoRPC class %s' % package)
     return
 
-  package_path = package.split('.')
-  directory = package_path[:-1]
-  package_file_name = package_path[-1]
-  directory_name = os.path.join(dest_dir, *directory)
-  output_file_name = os.path.join(directory_name,
-                                  '%s.py' % (package_file_name,))
+  relative_file_name = _package_file_name(package)
+  output_file_name = os.path.join(dest_dir, relative_file_name)
+  directory_name = os.path.dirname(output_file_name)
+
+  if manifest is not None:
+    input_hash = _input_hash(protobuf.encode_message(file_descriptor),
+                             compiled_codecs)
+    entry = manifest.get(relative_file_name)
+    if (entry and entry[0] == input_hash and
+        _hash_file(output_file_name) == entry[1]):
+      logging.info('Package %s is up to date', package)
+      return
 
   try:
     os.makedirs(directory_name)
@@ -120,11 +239,114 @@ def generate_file_descriptor(dest_dir, file_descriptor, force_overwrite):
                  output_file_name, package)
     return
 
-  output_file = open(output_file_name, 'w')
+  output = StringIO.StringIO()
+  generate_python.format_python_file(file_descriptor, output,
+                                     compiled_codecs=compiled_codecs)
+  content = output.getvalue()
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  output_hash = hashlib.sha1(content).hexdigest()
+
+  if _hash_file(output_file_name) == output_hash:
+    logging.info('Package %s is unchanged', package)
+  else:
+    logging.info('Writing package %s to %s',
+                 file_descriptor.package, output_file_name)
+    with open(output_file_name, 'w') as output_file:
+      output_file.write(content)
+
+  if manifest is not None:
+    manifest[relative_file_name] = [input_hash, output_hash]
+
+
+def _generate_encoded_file_descriptor(arguments):
+  """Generate a protobuf encoded file descriptor in a worker process.
+
+  Args:
+    arguments: Tuple (dest_dir, encoded_file_descriptor, force_overwrite,
+      compiled_codecs, manifest) where manifest is None or the manifest
+      entries for the file.
+
+  Returns:
+    Manifest entries for the file.
+  """
+  (dest_dir, encoded_file_descriptor, force_overwrite, compiled_codecs,
+   manifest) = arguments
+  file_descriptor = protobuf.decode_message(descriptor.FileDescriptor,
+                                            encoded_file_descriptor)
+  generate_file_descriptor(dest_dir, file_descriptor=file_descriptor,
+                           force_overwrite=force_overwrite,
+                           compiled_codecs=compiled_codecs,
+                           manifest=manifest)
+  return manifest
 
-  logging.info('Writing package %s to %s',
-               file_descriptor.package, output_file_name)
-  generate_python.format_python_file(file_descriptor, output_file)
+
+def generate_file_set(dest_dir, file_set, options):
+  """Generate all file descriptors of a file set to destination directory.
+
+  Only one file descriptor per package can end up in the destination
+  directory: the last one when overwriting, else the first one.  The others
+  are not generated at all.  The remaining files are independent of one
+  another and are generated by a pool of options.jobs processes when more
+  than one job is requested.
+
+  Args:
+    dest_dir: Directory under which to generate files.
+    file_set: FileSet instance to generate source code from.
+    options: Parsed command line options.
+  """
+  if options.manifest:
+    manifest_file_name = os.path.join(dest_dir, options.manifest)
+    manifest = load_manifest(manifest_file_name)
+  else:
+    manifest = None
+
+  file_descriptors = list(file_set.files)
+  if options.force:
+    file_descriptors.reverse()
+  packages = set()
+  unique_file_descriptors = []
+  for file_descriptor in file_descriptors:
+    if file_descriptor.package not in packages:
+      packages.add(file_descriptor.package)
+      unique_file_descriptors.append(file_descriptor)
+  if options.force:
+    unique_file_descriptors.reverse()
+
+  if options.jobs <= 1:
+    for file_descriptor in unique_file_descriptors:
+      generate_file_descriptor(dest_dir, file_descriptor=file_descriptor,
+                               force_overwrite=options.force,
+                               compiled_codecs=options.compiled_codecs,
+                               manifest=manifest)
+  else:
+    tasks = []
+    for file_descriptor in unique_file_descriptors:
+      if manifest is None:
+        file_manifest = None
+      else:
+        file_manifest = {}
+        if file_descriptor.package:
+          file_name = _package_file_name(file_descriptor.package)
+          if file_name in manifest:
+            file_manifest[file_name] = manifest[file_name]
+      tasks.append((dest_dir, protobuf.encode_message(file_descriptor),
+                    options.force, options.compiled_codecs, file_manifest))
+
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+      file_manifests = pool.map(_generate_encoded_file_descriptor, tasks,
+                                chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+    if manifest is not None:
+      for file_manifest in file_manifests:
+        manifest.update(file_manifest)
+
+  if manifest is not None:
+    save_manifest(manifest_file_name, manifest)
 
 
 @util.positional(1)
@@ -185,7 +407,8 @@ def file_command(options, input_filename=None, output_filename=None):
 
   file_descriptor = protobuf.decode_message(descriptor.FileDescriptor,
                                             descriptor_content)
-  generate_python.format_python_file(file_descriptor, output_file)
+  generate_python.format_python_file(file_descriptor, output_file,
+                                     compiled_codecs=options.compiled_codecs)
 
 
 @command('fileset', optional=['filename'])
@@ -208,9 +431,7 @@ def fileset_command(options, input_filename=None):
   file_set = protobuf.decode_message(descriptor.FileSet,
                                      descriptor_content)
 
-  for file_descriptor in file_set.files:
-    generate_file_descriptor(dest_dir, file_descriptor=file_descriptor,
-                             force_overwrite=options.force)
+  generate_file_set(dest_dir, file_set, options)
 
 
 @command('registry',
@@ -243,9 +464,7 @@ def registry_command(options,
 
   file_set = reg.get_file_set(names=service_names).file_set
 
-  for file_descriptor in file_set.files:
-    generate_file_descriptor(dest_dir, file_descriptor=file_descriptor,
-                             force_overwrite=options.force)
+  generate_file_set(dest_dir, file_set, options)
 
 
 def make_opt_parser():
@@ -273,6 +492,24 @@ def make_opt_parser():
                     dest='force',
                     default=False,
                     help='Force overwrite of existing files')
+  parser.add_option('-c', '--compiled_codecs',
+                    action='store_true',
+                    dest='compiled_codecs',
+                    default=False,
+                    help='Generate compiled protobuf and JSON codecs')
+  parser.add_option('-j', '--jobs',
+                    type='int',
+                    dest='jobs',
+                    default=1,
+                    help='Generate file sets using N processes',
+                    metavar='N')
+  parser.add_option('-m', '--manifest',
+                    dest='manifest',
+                    default=None,
+                    help=('Skip generating files that are unchanged since '
+                          'they were recorded in FILE, relative to the '
+                          'destination directory'),
+                    metavar='FILE')
   return parser
 
 parser = make_opt_parser()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for gen_protorpc."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gen_protorpc
+from protorpc import descriptor
+from protorpc import generate_python
+from protorpc import protobuf
+from protorpc import test_util
+
+
+class TempDirTestCase(test_util.TestCase):
+  """Test case with a temporary directory."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def WriteFile(self, file_name, content):
+    with open(file_name, 'wb') as output_file:
+      output_file.write(content)
+
+
+class ManifestTest(TempDirTestCase):
+
+  def setUp(self):
+    super(ManifestTest, self).setUp()
+    self.manifest_file_name = os.path.join(self.temp_dir, 'manifest.json')
+
+  def testLoadMissing(self):
+    self.assertEquals({}, gen_protorpc.load_manifest(self.manifest_file_name))
+
+  def testLoadCorrupt(self):
+    self.WriteFile(self.manifest_file_name, '{"truncated": ')
+    self.assertEquals({}, gen_protorpc.load_manifest(self.manifest_file_name))
+
+  def testLoadMalformed(self):
+    self.WriteFile(self.manifest_file_name, '["not", "a", "dict"]')
+    self.assertEquals({}, gen_protorpc.load_manifest(self.manifest_file_name))
+
+  def testSaveAndLoad(self):
+    manifest_file_name = os.path.join(self.temp_dir, 'sub', 'manifest.json')
+    manifest = {'a/b.py': ['input', 'output']}
+    gen_protorpc.save_manifest(manifest_file_name, manifest)
+    self.assertEquals(manifest, gen_protorpc.load_manifest(manifest_file_name))
+    self.assertEquals(['manifest.json'],
+                      os.listdir(os.path.dirname(manifest_file_name)))
+
+
+class InputHashTest(test_util.TestCase):
+
+  def testInputHash(self):
+    encoded = protobuf.encode_message(
+      descriptor.FileDescriptor(package=u'my.package'))
+    other_encoded = protobuf.encode_message(
+      descriptor.FileDescriptor(package=u'my.other_package'))
+
+    input_hash = gen_protorpc._input_hash(encoded, False)
+    self.assertEquals(input_hash, gen_protorpc._input_hash(encoded, False))
+    self.assertNotEquals(input_hash,
+                         gen_protorpc._input_hash(other_encoded, False))
+    self.assertNotEquals(input_hash, gen_protorpc._input_hash(encoded, True))
+
+
+class GenerateFileSetTest(TempDirTestCase):
+
+  def setUp(self):
+    super(GenerateFileSetTest, self).setUp()
+    self.file_set = descriptor.FileSet(files=[
+      descriptor.FileDescriptor(
+        package=u'my.package',
+        message_types=[descriptor.MessageDescriptor(name=u'First')])])
+    self.output_file_name = os.path.join(self.temp_dir, 'my', 'package.py')
+    self.manifest_file_name = os.path.join(self.temp_dir, 'manifest.json')
+
+    # Record which packages are generated.
+    self.generated = []
+    self.original_format_python_file = generate_python.format_python_file
+    def format_python_file(file_descriptor, output, **kwargs):
+      self.generated.append(file_descriptor.package)
+      self.original_format_python_file(file_descriptor, output, **kwargs)
+    generate_python.format_python_file = format_python_file
+
+  def tearDown(self):
+    generate_python.format_python_file = self.original_format_python_file
+    super(GenerateFileSetTest, self).tearDown()
+
+  def Generate(self, *args):
+    options, unused_positional = gen_protorpc.parser.parse_args(
+      ['--force', '--manifest', 'manifest.json'] + list(args))
+    gen_protorpc.generate_file_set(self.temp_dir, self.file_set, options)
+
+  def ReadOutput(self):
+    with open(self.output_file_name) as output_file:
+      return output_file.read()
+
+  def testUnchangedInputSkipped(self):
+    self.Generate()
+    self.assertEquals(['my.package'], self.generated)
+    manifest = gen_protorpc.load_manifest(self.manifest_file_name)
+    self.assertEquals([os.path.join('my', 'package.py')], list(manifest))
+
+    self.Generate()
+    self.assertEquals(['my.package'], self.generated)
+    self.assertEquals(manifest,
+                      gen_protorpc.load_manifest(self.manifest_file_name))
+
+  def testChangedInputRegenerated(self):
+    self.Generate()
+    self.file_set.files[0].message_types.append(
+      descriptor.MessageDescriptor(name=u'Second'))
+    self.Generate()
+    self.assertEquals(['my.package', 'my.package'], self.generated)
+    self.assertTrue('class Second(' in self.ReadOutput())
+
+  def testChangedOptionsRegenerated(self):
+    self.Generate()
+    self.Generate('--compiled_codecs')
+    self.assertEquals(['my.package', 'my.package'], self.generated)
+
+  def testModifiedOutputRegenerated(self):
+    self.Generate()
+    content = self.ReadOutput()
+    self.WriteFile(self.output_file_name, 'modified')
+    self.Generate()
+    self.assertEquals(['my.package', 'my.package'], self.generated)
+    self.assertEquals(content, self.ReadOutput())
+
+  def testCorruptManifest(self):
+    self.Generate()
+    manifest = gen_protorpc.load_manifest(self.manifest_file_name)
+    self.WriteFile(self.manifest_file_name, '{"truncated": ')
+    self.Generate()
+    self.assertEquals(['my.package', 'my.package'], self.generated)
+    self.assertEquals(manifest,
+                      gen_protorpc.load_manifest(self.manifest_file_name))
+
+  def testMissingManifest(self):
+    self.Generate()
+    manifest = gen_protorpc.load_manifest(self.manifest_file_name)
+    os.remove(self.manifest_file_name)
+    self.Generate()
+    self.assertEquals(['my.package', 'my.package'], self.generated)
+    self.assertEquals(manifest,
+                      gen_protorpc.load_manifest(self.manifest_file_name))
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
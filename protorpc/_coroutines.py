@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Native coroutine support for remote methods.
+
+This module uses syntax that is only valid on Python 3.5 and later.  It must
+only be imported conditionally by modules that also support Python 2.
+"""
+
+import functools
+import inspect
+
+
+def is_coroutine_function(function):
+  """Determine whether function was declared with 'async def'.
+
+  Args:
+    function: Function to check.
+
+  Returns:
+    True if function is a native coroutine function, else False.
+  """
+  return inspect.iscoroutinefunction(function)
+
+
+def new_coroutine_remote_method(method, check_request, check_response):
+  """Create the invocation function for a coroutine remote method.
+
+  Args:
+    method: Original 'async def' method being wrapped.
+    check_request: Function (service_instance, request) that raises
+      remote.RequestError when request is of the wrong type.
+    check_response: Function (service_instance, response) that raises
+      remote.ServerError when response is of the wrong type.
+
+  Returns:
+    Coroutine function that checks the request, awaits method and checks
+    its response.
+  """
+  @functools.wraps(method)
+  async def invoke_remote_method(service_instance, request):
+    """Coroutine used to replace original method."""
+    check_request(service_instance, request)
+    response = await method(service_instance, request)
+    check_response(service_instance, response)
+    return response
+
+  return invoke_remote_method
+
+
+def new_coroutine_stub_method(async_method):
+  """Create coroutine method for a CoroutineStub.
+
+  Args:
+    async_method: Asynchronous stub method to delegate calls to.  It returns
+      the Rpc started by the stub's transport.
+
+  Returns:
+    Coroutine function that starts the RPC and returns its response message.
+    Awaitable RPCs are awaited, others are waited on synchronously.
+  """
+  async def coroutine_method(self, *args, **kwargs):
+    """Coroutine remote method.
+
+    Args:
+      self: Instance of StubBase.CoroutineStub subclass.
+      args: Tuple (request,):
+        request: Request object.
+      kwargs: Field values for request.  Must be empty if request object
+        is provided.
+
+    Returns:
+      Response message from RPC.
+    """
+    rpc = async_method(self, *args, **kwargs)
+    if inspect.isawaitable(rpc):
+      return await rpc
+    return rpc.response
+  coroutine_method.__name__ = async_method.__name__
+  coroutine_method.remote = async_method.remote
+  return coroutine_method
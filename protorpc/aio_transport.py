@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""asyncio transport library for ProtoRPC.
+
+RPCs started by transports in this module do their I/O on an asyncio event
+loop and may be awaited.  Together with the CoroutineStub of a service many
+RPCs can be in flight at once without a thread per call:
+
+  stub = MyService.CoroutineStub(AsyncioHttpTransport('<my service URL>'))
+  responses = await asyncio.gather(stub.do_something(request1),
+                                   stub.do_something(request2))
+
+This module requires Python 3.5 or later.
+"""
+
+import asyncio
+import http.client
+import io
+import ssl
+import threading
+from urllib import parse as urlparse
+
+from . import protobuf
+from . import remote
+from . import transport
+from . import util
+
+__all__ = [
+  'AsyncioHttpTransport',
+  'AsyncioRpc',
+]
+
+
+class AsyncioRpc(transport.Rpc):
+  """Client side RPC that completes on an asyncio event loop.
+
+  Await the RPC from a coroutine to get its response message.  Errors are
+  raised exactly as when accessing the response property.  Outside of a
+  running event loop the RPC may also be used like any other Rpc, in which
+  case waiting runs the event loop until the RPC completes.
+  """
+
+  def __init__(self, request, complete, loop=None):
+    """Constructor.
+
+    Args:
+      request: Request associated with this RPC.
+      complete: Coroutine function which is passed this RPC and must set its
+        response or status.  It is scheduled on loop immediately.
+      loop: Event loop to run the RPC on.  Defaults to the current event loop.
+    """
+    super(AsyncioRpc, self).__init__(request)
+    self.__loop = loop or asyncio.get_event_loop()
+    self.__task = self.__loop.create_task(complete(self))
+
+  @property
+  def task(self):
+    """asyncio.Task completing this RPC."""
+    return self.__task
+
+  def __await__(self):
+    return self.__wait_for_response().__await__()
+
+  async def __wait_for_response(self):
+    """Wait for task to complete and get the response."""
+    await self.__task
+    return self.response
+
+  def wait(self):
+    """Wait for an RPC to finish by running its event loop.
+
+    Raises:
+      RpcStateError: When called from within the running event loop before
+        the RPC is complete.
+    """
+    if self.__loop.is_running() and not self.__task.done():
+      raise transport.RpcStateError(
+        'Can not block on RPC from within a running event loop.  '
+        'Await the RPC instead.')
+    super(AsyncioRpc, self).wait()
+
+  def _wait_impl(self):
+    """Implementation for wait()."""
+    if self.__task.done():
+      self.__task.result()
+    else:
+      self.__loop.run_until_complete(self.__task)
+
+  @staticmethod
+  def __run_loop(loop, rpcs, notify):
+    """Run loop until all RPCs are complete, notifying as each completes.
+
+    The loop is stopped while notifying, so the RPC that completes last is
+    only notified once the loop is no longer in use.
+    """
+    rpcs_by_task = dict((rpc.__task, rpc) for rpc in rpcs)
+    pending = set(rpcs_by_task)
+    while pending:
+      done, pending = loop.run_until_complete(
+        asyncio.wait(pending, loop=loop, return_when=asyncio.FIRST_COMPLETED))
+      for task in done:
+        transport._wait_and_notify(rpcs_by_task[task], notify)
+
+  @classmethod
+  def _wait_in_background(cls, rpcs, notify):
+    """Wait for RPCs on their event loops instead of a thread per RPC.
+
+    The RPCs of each event loop are waited for together, by running the loop
+    on one daemon thread until all of their tasks are done.  The loop must not
+    be run elsewhere until then.
+
+    Raises:
+      RpcStateError: When the event loop of an RPC is already running.
+    """
+    by_loop = {}
+    for rpc in rpcs:
+      loop = rpc.__loop
+      if loop.is_running():
+        raise transport.RpcStateError(
+          'Can not block on RPCs from within a running event loop.  '
+          'Await the RPCs instead.')
+      if rpc.__task.done():
+        transport._wait_and_notify(rpc, notify)
+      else:
+        by_loop.setdefault(loop, []).append(rpc)
+
+    for loop, loop_rpcs in by_loop.items():
+      thread = threading.Thread(target=cls.__run_loop,
+                                args=(loop, loop_rpcs, notify))
+      thread.daemon = True
+      thread.start()
+
+
+class _BufferedSocket(object):
+  """Socket-like wrapper allowing http.client to parse a buffered response."""
+
+  def __init__(self, data):
+    self.__data = data
+
+  def makefile(self, *args, **kwargs):
+    return io.BytesIO(self.__data)
+
+
+class AsyncioHttpTransport(transport.HttpTransport):
+  """Transport for communicating with HTTP servers using asyncio.
+
+  Every RPC opens its own connection which is closed once the response has
+  been read.  Network errors are raised when the RPC is awaited rather than
+  when it is started.
+  """
+
+  @util.positional(2)
+  def __init__(self,
+               service_url,
+               protocol=protobuf,
+               loop=None):
+    """Constructor.
+
+    Args:
+      service_url: URL where the service is located.  All communication via
+        the transport will go to this URL.
+      protocol: The protocol implementation.  Must implement encode_message and
+        decode_message.  Can also be an instance of remote.ProtocolConfig.
+      loop: Event loop to run RPCs on.  Defaults to the current event loop
+        at the time each RPC is started.
+    """
+    super(AsyncioHttpTransport, self).__init__(service_url, protocol=protocol)
+    self.__loop = loop
+
+  async def __send_http_request(self, url, encoded_request, headers):
+    """Send HTTP request and read the complete response.
+
+    Args:
+      url: Parsed URL of remote method.
+      encoded_request: Encoded request message as bytes.
+      headers: Dictionary of HTTP headers to send with request.
+
+    Returns:
+      Tuple (response, content):
+        response: http.client.HTTPResponse that has been fully read.
+        content: Content of response.
+    """
+    if url.scheme == 'https':
+      port = url.port or http.client.HTTPS_PORT
+      ssl_context = ssl.create_default_context()
+    else:
+      port = url.port or http.client.HTTP_PORT
+      ssl_context = None
+
+    reader, writer = await asyncio.open_connection(url.hostname, port,
+                                                   ssl=ssl_context)
+    try:
+      request_head = ['POST %s HTTP/1.1' % url.path,
+                      'Host: %s' % url.netloc,
+                      'Connection: close']
+      request_head.extend('%s: %s' % (name, value)
+                          for name, value in sorted(headers.items()))
+      writer.write(('\r\n'.join(request_head) + '\r\n\r\n').encode('latin-1'))
+      writer.write(encoded_request)
+      await writer.drain()
+      raw_response = await reader.read()
+    finally:
+      writer.close()
+
+    response = http.client.HTTPResponse(_BufferedSocket(raw_response),
+                                        method='POST')
+    response.begin()
+    return response, self._read_content(response)
+
+  def __set_response(self, remote_info, response, content, rpc):
+    """Set response on RPC.
+
+    Args:
+      remote_info: Remote info for invoked RPC.
+      response: HTTPResponse that was received.
+      content: Content read from HTTP response.
+      rpc: Rpc instance.
+    """
+    if response.status == http.client.OK:
+      response = self.protocol.decode_message(remote_info.response_type,
+                                              content)
+      rpc.set_response(response)
+    else:
+      rpc.set_status(self._get_rpc_status(response, content))
+
+  def _start_rpc(self, remote_info, request):
+    """Start a remote procedure call.
+
+    Args:
+      remote_info: A RemoteInfo instance for this RPC.
+      request: The request message for this RPC.
+
+    Returns:
+      An AsyncioRpc instance initialized with a Request.
+    """
+    method_url = '%s.%s' % (self.service_url, remote_info.method.__name__)
+    encoded_request, headers = self._encode_request(request)
+    url = urlparse.urlparse(method_url)
+
+    async def complete(rpc):
+      """Send request and set response on rpc."""
+      try:
+        response, content = await self.__send_http_request(url,
+                                                           encoded_request,
+                                                           headers)
+      except remote.RpcError:
+        # Pass through all ProtoRPC errors
+        raise
+      except OSError as err:
+        raise remote.NetworkError('Socket error: %s %r' % (type(err).__name__,
+                                                           err.args),
+                                  err)
+      except Exception as err:
+        raise remote.NetworkError('Error communicating with HTTP server',
+                                  err)
+      self.__set_response(remote_info, response, content, rpc)
+
+    return AsyncioRpc(request, complete, loop=self.__loop)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for protorpc.aio_transport."""
+
+import asyncio
+import unittest
+
+from protorpc import aio_transport
+from protorpc import compression
+from protorpc import messages
+from protorpc import protojson
+from protorpc import remote
+from protorpc import test_util
+from protorpc import transport
+
+
+class Greeting(messages.Message):
+
+  text = messages.StringField(1)
+
+
+class GreetingService(remote.Service):
+
+  @remote.method(Greeting, Greeting)
+  def greet(self, request):
+    raise NotImplementedError()
+
+
+class ModuleInterfaceTest(test_util.ModuleInterfaceTest,
+                          test_util.TestCase):
+
+  MODULE = aio_transport
+
+
+class AsyncioHttpTransportTest(test_util.TestCase):
+
+  def setUp(self):
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.requests = []
+    self.response_delay = 0
+    self.set_response(200, 'application/json', b'{"text": "hello"}')
+    self.server = self.loop.run_until_complete(
+      asyncio.start_server(self.handle_connection, 'localhost', 0))
+    port = self.server.sockets[0].getsockname()[1]
+    self.transport = aio_transport.AsyncioHttpTransport(
+      'http://localhost:%d/greeting' % port, protocol=protojson)
+
+  def tearDown(self):
+    self.server.close()
+    self.loop.run_until_complete(self.server.wait_closed())
+    self.loop.close()
+    asyncio.set_event_loop(None)
+
+  def set_response(self, status, content_type, content, chunked=False,
+                   content_encoding=None):
+    headers = ['HTTP/1.1 %d Whatever' % status,
+               'Content-type: %s' % content_type,
+               'Connection: close']
+    if content_encoding:
+      headers.append('Content-encoding: %s' % content_encoding)
+      content = compression.compress(content, content_encoding)
+    if chunked:
+      headers.append('Transfer-encoding: chunked')
+      content = b''.join(b'%x\r\n%s\r\n' % (len(c), c)
+                         for c in (content[:3], content[3:], b''))
+    else:
+      headers.append('Content-length: %d' % len(content))
+    self.response = ('\r\n'.join(headers) + '\r\n\r\n').encode() + content
+
+  async def handle_connection(self, reader, writer):
+    request_line = await reader.readline()
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line == b'\r\n':
+        break
+      name, value = line.decode().split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    self.requests.append((request_line, headers, body))
+    await asyncio.sleep(self.response_delay)
+    writer.write(self.response)
+    await writer.drain()
+    writer.close()
+
+  def send_rpc(self, text='hi'):
+    return self.transport.send_rpc(GreetingService.greet.remote,
+                                   Greeting(text=text))
+
+  def testAwaitRpc(self):
+    rpc = self.send_rpc()
+    self.assertTrue(isinstance(rpc, transport.Rpc))
+    self.assertEquals(remote.RpcState.RUNNING, rpc.state)
+
+    response = self.loop.run_until_complete(rpc)
+    self.assertEquals(Greeting(text='hello'), response)
+    self.assertEquals(remote.RpcState.OK, rpc.state)
+
+    [(request_line, headers, body)] = self.requests
+    self.assertEquals(b'POST /greeting.greet HTTP/1.1\r\n', request_line)
+    self.assertEquals('application/json', headers['content-type'])
+    self.assertEquals(Greeting(text='hi'),
+                      protojson.decode_message(Greeting, body))
+
+  def testBlockingWait(self):
+    rpc = self.send_rpc()
+    self.assertEquals(Greeting(text='hello'), rpc.response)
+
+  def testBlockingWaitInRunningLoop(self):
+    async def wait_inside_loop():
+      rpc = self.send_rpc()
+      self.assertRaises(transport.RpcStateError, rpc.wait)
+      return await rpc
+
+    self.assertEquals(Greeting(text='hello'),
+                      self.loop.run_until_complete(wait_inside_loop()))
+
+  def testAsCompleted(self):
+    self.response_delay = 0.1
+    rpcs = [self.send_rpc() for _ in range(3)]
+    completed = list(transport.as_completed(rpcs, timeout=10))
+    self.assertEquals(sorted(rpcs, key=id), sorted(completed, key=id))
+    self.assertEquals([remote.RpcState.OK] * 3,
+                      [rpc.state for rpc in completed])
+    self.assertEquals(Greeting(text='hello'), completed[0].response)
+    # The loop is free again once all RPCs are complete.
+    self.assertEquals(Greeting(text='hello'),
+                      self.loop.run_until_complete(self.send_rpc()))
+
+  def testWaitAllNetworkError(self):
+    self.transport = aio_transport.AsyncioHttpTransport(
+      'http://localhost:%d/greeting' % test_util.pick_unused_port(),
+      protocol=protojson)
+    [rpc] = transport.wait_all([self.send_rpc()], timeout=10)
+    self.assertEquals(remote.RpcState.RUNNING, rpc.state)
+    self.assertRaises(remote.NetworkError, getattr, rpc, 'response')
+
+  def testAsCompletedInRunningLoop(self):
+    async def wait_inside_loop():
+      rpc = self.send_rpc()
+      self.assertRaises(transport.RpcStateError,
+                        transport.wait_all, [rpc], timeout=1)
+      return await rpc
+
+    self.assertEquals(Greeting(text='hello'),
+                      self.loop.run_until_complete(wait_inside_loop()))
+
+  def testCoroutineStub(self):
+    self.response_delay = 0.1
+    stub = GreetingService.CoroutineStub(self.transport)
+
+    async def fan_out():
+      return await asyncio.gather(*[stub.greet(text=str(i))
+                                    for i in range(10)])
+
+    start = self.loop.time()
+    responses = self.loop.run_until_complete(fan_out())
+    # All requests are in flight at the same time.
+    self.assertLess(self.loop.time() - start, 0.9)
+    self.assertEquals([Greeting(text='hello')] * 10, responses)
+    self.assertEquals(set(str(i) for i in range(10)),
+                      set(protojson.decode_message(Greeting, body).text
+                          for _, _, body in self.requests))
+
+  def testChunkedResponse(self):
+    self.set_response(200, 'application/json', b'{"text": "chunked"}',
+                      chunked=True)
+    self.assertEquals(Greeting(text='chunked'),
+                      self.loop.run_until_complete(self.send_rpc()))
+
+  def testCompressedResponse(self):
+    self.set_response(200, 'application/json', b'{"text": "compressed"}',
+                      content_encoding='gzip')
+    self.assertEquals(Greeting(text='compressed'),
+                      self.loop.run_until_complete(self.send_rpc()))
+    [(unused_request_line, headers, unused_body)] = self.requests
+    self.assertEquals('gzip, deflate', headers['accept-encoding'])
+
+  def testCompressedRequest(self):
+    self.transport = aio_transport.AsyncioHttpTransport(
+      self.transport.service_url,
+      protocol=remote.ProtocolConfig(protojson, 'json',
+                                     compression_threshold=0,
+                                     request_encoding='deflate'))
+    self.loop.run_until_complete(self.send_rpc())
+    [(unused_request_line, headers, body)] = self.requests
+    self.assertEquals('deflate', headers['content-encoding'])
+    self.assertEquals(Greeting(text='hi'),
+                      protojson.decode_message(
+                        Greeting, compression.decompress(body, 'deflate')))
+
+  def testApplicationError(self):
+    self.set_response(400, 'application/json',
+                      protojson.encode_message(remote.RpcStatus(
+                        state=remote.RpcState.APPLICATION_ERROR,
+                        error_message='a bad thing',
+                        error_name='BAD_THING')).encode())
+    rpc = self.send_rpc()
+    try:
+      self.loop.run_until_complete(rpc)
+    except remote.ApplicationError as err:
+      self.assertEquals('a bad thing', str(err))
+      self.assertEquals('BAD_THING', err.error_name)
+    else:
+      self.fail('Expected ApplicationError')
+    self.assertEquals(remote.RpcState.APPLICATION_ERROR, rpc.state)
+
+  def testHttpError(self):
+    self.set_response(500, 'text/plain', b'')
+    self.assertRaisesWithRegexpMatch(
+      remote.ServerError,
+      'HTTP Error 500: Internal Server Error',
+      self.loop.run_until_complete, self.send_rpc())
+
+  def testNetworkError(self):
+    self.transport = aio_transport.AsyncioHttpTransport(
+      'http://localhost:%d/greeting' % test_util.pick_unused_port(),
+      protocol=protojson)
+    rpc = self.send_rpc()
+    self.assertRaises(remote.NetworkError, self.loop.run_until_complete, rpc)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
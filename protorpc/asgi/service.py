@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""ProtoRPC ASGI service applications.
+
+Use functions in this module to configure ProtoRPC services for use with
+ASGI servers.  They are the asynchronous equivalents of the functions found
+in protorpc.wsgi.service.  For more information about ASGI, please see:
+
+  https://asgi.readthedocs.io/
+
+Remote methods declared with 'async def' are awaited directly on the event
+loop.  All other remote methods are run on a bounded thread pool so that a
+slow synchronous method does not block the processing of other requests.
+
+This module requires Python 3.5 or later.
+"""
+
+import asyncio
+import cgi
+import logging
+import re
+from concurrent import futures
+
+import six
+from six.moves import http_client
+
+from .. import batch
+from .. import compression
+from .. import messages
+from .. import registry
+from .. import remote
+from .. import util
+
+__all__ = [
+  'DEFAULT_MAX_WORKERS',
+  'DEFAULT_REGISTRY_PATH',
+  'service_mapping',
+  'service_mappings',
+]
+
+_METHOD_PATTERN = r'(?:\.([^?]+))'
+_REQUEST_PATH_PATTERN = r'^(%%s)%s$' % _METHOD_PATTERN
+
+DEFAULT_REGISTRY_PATH = '/protorpc'
+
+# Default size of the thread pool used for synchronous remote methods.
+DEFAULT_MAX_WORKERS = 32
+
+
+async def _read_body(receive, content_encoding=compression.IDENTITY,
+                     max_size=None):
+  """Read the complete body of an HTTP request.
+
+  Compressed bodies are decompressed chunk by chunk as they are received.
+
+  Args:
+    receive: ASGI receive channel.
+    content_encoding: Content coding of the request body.
+    max_size: Maximum size in bytes of a decompressed request body, or None
+      for no limit.
+
+  Returns:
+    Request body as bytes, or None if the client disconnected.
+
+  Raises:
+    compression.DecompressionError if the body can not be decompressed.
+    compression.ContentTooLargeError if the decompressed body exceeds
+      max_size.
+  """
+  decompressor = None
+  if content_encoding != compression.IDENTITY:
+    decompressor = compression.new_decompressor(content_encoding,
+                                                max_size=max_size)
+  chunks = []
+  while True:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      return None
+    chunk = message.get('body', b'')
+    if decompressor is not None:
+      chunk = decompressor.decompress(chunk)
+    chunks.append(chunk)
+    if not message.get('more_body', False):
+      if decompressor is not None:
+        chunks.append(decompressor.flush())
+      return b''.join(chunks)
+
+
+async def _send_response(send, status_code, content, content_type,
+                         headers=()):
+  """Send a complete HTTP response.
+
+  Args:
+    send: ASGI send channel.
+    status_code: Integer HTTP status code.
+    content: Content of response.  Unicode strings are encoded as UTF-8.
+    content_type: Value of the content-type header.
+    headers: Additional (name, value) headers as strings.
+  """
+  if isinstance(content, six.text_type):
+    content = content.encode('utf-8')
+  headers = [('content-type', content_type),
+             ('content-length', str(len(content))),
+            ] + list(headers)
+  await send({
+    'type': 'http.response.start',
+    'status': status_code,
+    'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers],
+  })
+  await send({'type': 'http.response.body', 'body': content})
+
+
+async def _send_compressed_response(send, content, content_type, encoding):
+  """Send a successful response whose content is compressed in chunks.
+
+  Args:
+    send: ASGI send channel.
+    content: Uncompressed content of response.
+    content_type: Value of the content-type header.
+    encoding: Content coding to compress content with.
+  """
+  headers = [('content-type', content_type),
+             ('content-encoding', encoding),
+             ('vary', 'accept-encoding'),
+            ]
+  await send({
+    'type': 'http.response.start',
+    'status': http_client.OK,
+    'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers],
+  })
+  for chunk in compression.compress_chunks(content, encoding):
+    await send({'type': 'http.response.body', 'body': chunk,
+                'more_body': True})
+  await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _send_error(send, status_code, content=None,
+                      content_type='text/plain; charset=utf-8'):
+  """Send an error response padded as done by wsgi.util.error.
+
+  Args:
+    send: ASGI send channel.
+    status_code: Integer HTTP status code of error.
+    content: Content of error response.  Defaults to the standard HTTP
+      status message.
+    content_type: Value of the content-type header.
+  """
+  if content is None:
+    content = http_client.responses.get(status_code, 'Unknown Error')
+  await _send_response(send, status_code, util.pad_string(content),
+                       content_type)
+
+
+async def _handle_lifespan(receive, send, executor):
+  """Acknowledge ASGI lifespan events.
+
+  Args:
+    receive: ASGI receive channel.
+    send: ASGI send channel.
+    executor: Executor owned by the application that is shut down with it,
+      else None.
+  """
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      if executor is not None:
+        executor.shutdown(wait=False)
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+
+def _get_header(scope, name):
+  """Get the value of a request header from an ASGI scope.
+
+  Args:
+    scope: ASGI connection scope.
+    name: Lower case name of header as bytes.
+
+  Returns:
+    Header value decoded as latin-1, else None if header is not present.
+  """
+  for header_name, value in scope.get('headers', ()):
+    if header_name.lower() == name:
+      return value.decode('latin-1')
+  return None
+
+
+class _AsyncioBatchService(batch.BatchService):
+  """BatchService awaiting coroutine remote methods on the event loop.
+
+  Synchronous remote methods of the calls are run on the executor of the
+  application, so up to max_workers calls of a batch are executed
+  concurrently whatever kind of remote method they call.
+  """
+
+  @util.positional(3)
+  def __init__(self, services, executor, max_workers=1, protocols=None):
+    """Constructor.
+
+    Args:
+      services: Map of service path to service factory or class.
+      executor: concurrent.futures.Executor used for synchronous remote
+        methods.
+      max_workers: Maximum number of calls of a batch executed concurrently.
+      protocols: remote.Protocols instance used to look up the protocol of
+        batch requests.  Defaults to the global default Protocols.
+    """
+    batch.BatchService.__init__(self, services, max_workers=max_workers,
+                                protocols=protocols)
+    self.__executor = executor
+
+  async def __execute_call(self, protocol, call, semaphore):
+    """Execute a single call once fewer than max_workers calls are running.
+
+    Args:
+      protocol: Protocol to decode request and encode response with.
+      call: BatchRequest.Call to execute.
+      semaphore: asyncio.Semaphore limiting the number of running calls.
+
+    Returns:
+      BatchResponse.Result of call.
+    """
+    async with semaphore:
+      method, instance, request, error_result = self._prepare_call(protocol,
+                                                                   call)
+      if error_result is not None:
+        return error_result
+      try:
+        if method.remote.is_coroutine:
+          response = await method(instance, request)
+        else:
+          loop = asyncio.get_event_loop()
+          response = await loop.run_in_executor(self.__executor, method,
+                                                instance, request)
+        return self._response_result(protocol, response)
+      except Exception as err:
+        return self._exception_result(err)
+
+  async def execute(self, request):
+    """Execute all calls of a batch."""
+    protocol = self._get_protocol()
+    semaphore = asyncio.Semaphore(max(self.max_workers, 1))
+    results = await asyncio.gather(*[
+      self.__execute_call(protocol, call, semaphore)
+      for call in request.calls or ()])
+    return batch.BatchResponse(results=list(results))
+
+
+def _new_service_handler(service_factory, service_path, protocols, executor):
+  """Create handler for a single service mapping.
+
+  Args:
+    service_factory: Service factory or class.
+    service_path: Regular expression for matching requests against.
+    protocols: remote.Protocols instance, or None for the default.
+    executor: concurrent.futures.Executor used for synchronous remote
+      methods.
+
+  Returns:
+    Coroutine function (scope, receive, send) which returns False without
+    sending anything when the request path does not match service_path,
+    else handles the request and returns True.
+  """
+  service_class = getattr(service_factory, 'service_class', service_factory)
+  remote_methods = service_class.all_remote_methods()
+  path_matcher = re.compile(_REQUEST_PATH_PATTERN % service_path)
+
+  async def handle(scope, receive, send):
+    """Handle a single HTTP request."""
+    path_match = path_matcher.match(scope['path'])
+    if not path_match:
+      return False
+    service_path = path_match.group(1)
+    method_name = path_match.group(2)
+
+    content_type = _get_header(scope, b'content-type')
+    if not content_type:
+      await _send_error(send, http_client.BAD_REQUEST)
+      return True
+
+    content_type = cgi.parse_header(content_type)[0]
+
+    request_method = scope['method']
+    if request_method != 'POST':
+      content = ('%s.%s is a ProtoRPC method.\n\n'
+                 'Service %s\n\n'
+                 'More about ProtoRPC: '
+                 '%s\n' %
+                 (service_path,
+                  method_name,
+                  service_class.definition_name(),
+                  util.PROTORPC_PROJECT_URL))
+      await _send_error(send, http_client.METHOD_NOT_ALLOWED, content)
+      return True
+
+    local_protocols = protocols or remote.Protocols.get_default()
+    try:
+      protocol = local_protocols.lookup_by_content_type(content_type)
+    except KeyError:
+      await _send_error(send, http_client.UNSUPPORTED_MEDIA_TYPE)
+      return True
+
+    content_encoding = (_get_header(scope, b'content-encoding') or
+                        compression.IDENTITY).strip().lower()
+    if (content_encoding != compression.IDENTITY and
+        content_encoding not in protocol.content_encodings):
+      await _send_error(send, http_client.UNSUPPORTED_MEDIA_TYPE)
+      return True
+
+    async def send_rpc_error(status_code, state, message, error_name=None):
+      """Helper function to send an RpcStatus message as response.
+
+      Args:
+        status_code: HTTP integer status code.
+        state: remote.RpcState enum value to send as response.
+        message: Helpful message to send in response.
+        error_name: Error name if applicable.
+      """
+      status = remote.RpcStatus(state=state,
+                                error_message=message,
+                                error_name=error_name)
+      await _send_error(send, status_code,
+                        content=protocol.encode_message(status),
+                        content_type=protocol.default_content_type)
+
+    method = remote_methods.get(method_name)
+    if not method:
+      await send_rpc_error(http_client.BAD_REQUEST,
+                           remote.RpcState.METHOD_NOT_FOUND_ERROR,
+                           'Unrecognized RPC method: %s' % method_name)
+      return True
+
+    remote_info = method.remote
+    try:
+      body = await _read_body(receive, content_encoding,
+                              max_size=protocol.max_decompressed_size)
+      if body is None:
+        return True
+      request = protocol.decode_message(remote_info.request_type, body)
+    except compression.ContentTooLargeError as err:
+      await send_rpc_error(http_client.REQUEST_ENTITY_TOO_LARGE,
+                           remote.RpcState.REQUEST_ERROR,
+                           'Error parsing ProtoRPC request (%s)' % err)
+      return True
+    except (messages.ValidationError,
+            messages.DecodeError,
+            compression.DecompressionError) as err:
+      await send_rpc_error(http_client.BAD_REQUEST,
+                           remote.RpcState.REQUEST_ERROR,
+                           'Error parsing ProtoRPC request '
+                           '(Unable to parse request content: %s)' % err)
+      return True
+
+    instance = service_factory()
+
+    initialize_request_state = getattr(
+      instance, 'initialize_request_state', None)
+    if initialize_request_state:
+      client = scope.get('client') or (None, None)
+      server = scope.get('server') or (None, None)
+      headers = [(name.decode('latin-1').lower(), value.decode('latin-1'))
+                 for name, value in scope.get('headers', ())]
+      request_state = remote.HttpRequestState(
+        remote_address=client[0],
+        server_host=server[0],
+        server_port=server[1],
+        http_method=request_method,
+        service_path=service_path,
+        headers=headers)
+
+      initialize_request_state(request_state)
+
+    try:
+      if remote_info.is_coroutine:
+        response = await method(instance, request)
+      else:
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(executor, method, instance,
+                                              request)
+      encoded_response = protocol.encode_message(response)
+    except remote.ApplicationError as err:
+      await send_rpc_error(http_client.BAD_REQUEST,
+                           remote.RpcState.APPLICATION_ERROR,
+                           six.text_type(err),
+                           err.error_name)
+      return True
+    except Exception as err:
+      logging.exception('Encountered unexpected error from ProtoRPC '
+                        'method implementation: %s (%s)' %
+                        (err.__class__.__name__, err))
+      await send_rpc_error(http_client.INTERNAL_SERVER_ERROR,
+                           remote.RpcState.SERVER_ERROR,
+                           'Internal Server Error')
+      return True
+
+    if isinstance(encoded_response, six.text_type):
+      encoded_response = encoded_response.encode('utf-8')
+    response_headers = []
+    if protocol.content_encodings:
+      response_headers.append(('vary', 'accept-encoding'))
+      response_encoding = compression.select_encoding(
+        _get_header(scope, b'accept-encoding'), protocol.content_encodings)
+      if (response_encoding and
+          len(encoded_response) >= protocol.compression_threshold):
+        if len(encoded_response) >= compression.DEFAULT_STREAMING_THRESHOLD:
+          await _send_compressed_response(send, encoded_response,
+                                          content_type, response_encoding)
+          return True
+        encoded_response = compression.compress(encoded_response,
+                                                response_encoding)
+        response_headers.append(('content-encoding', response_encoding))
+
+    await _send_response(send, http_client.OK, encoded_response, content_type,
+                         response_headers)
+    return True
+
+  return handle
+
+
+def _new_application(handlers, executor):
+  """Create ASGI application serving the first matching handler.
+
+  Args:
+    handlers: List of handlers as created by _new_service_handler.
+    executor: Executor to shut down with the application, else None.
+
+  Returns:
+    ASGI application.
+  """
+  handlers = tuple(handlers)
+
+  async def protorpc_service_app(scope, receive, send):
+    """Actual ASGI application function."""
+    if scope['type'] == 'lifespan':
+      await _handle_lifespan(receive, send, executor)
+      return
+
+    if scope['type'] != 'http':
+      raise ValueError('ProtoRPC does not support ASGI scope type %r' %
+                       scope['type'])
+
+    for handle in handlers:
+      if await handle(scope, receive, send):
+        return
+
+    await _send_error(send, http_client.NOT_FOUND)
+
+  return protorpc_service_app
+
+
+@util.positional(2)
+def service_mapping(service_factory, service_path=r'.*', protocols=None,
+                    executor=None):
+  """ASGI application that handles a single ProtoRPC service mapping.
+
+  Args:
+    service_factory: Service factory for creating instances of service request
+      handlers.  Either callable that takes no parameters and returns a service
+      instance or a service class whose constructor requires no parameters.
+    service_path: Regular expression for matching requests against.  Requests
+      that do not have matching paths will cause a 404 (Not Found) response.
+    protocols: remote.Protocols instance that configures supported protocols
+      on server.
+    executor: concurrent.futures.Executor used to run synchronous remote
+      methods.  If None, a thread pool of DEFAULT_MAX_WORKERS threads is
+      created and shut down with the application.
+
+  Returns:
+    ASGI application.
+  """
+  owned_executor = None
+  if executor is None:
+    executor = owned_executor = futures.ThreadPoolExecutor(DEFAULT_MAX_WORKERS)
+
+  handler = _new_service_handler(service_factory, service_path, protocols,
+                                 executor)
+  return _new_application([handler], owned_executor)
+
+
+@util.positional(1)
+def service_mappings(services, registry_path=DEFAULT_REGISTRY_PATH,
+                     batch_path=None, batch_max_workers=1, executor=None):
+  """Create multiple service mappings with optional RegistryService.
+
+  Use this function to create single ASGI application that maps to
+  multiple ProtoRPC services plus an optional RegistryService.
+
+  Example:
+    services = service.service_mappings(
+        [(r'/time', TimeService),
+         (r'/weather', WeatherService)
+        ])
+
+  Args:
+    services: If a dictionary is provided instead of a list of tuples, the
+      dictionary item pairs are used as the mappings instead.
+      Otherwise, a list of tuples (service_path, service_factory):
+      service_path: The path to mount service on.
+      service_factory: A service class or service instance factory.
+    registry_path: A string to change where the registry is mapped (the default
+      location is '/protorpc').  When None, no registry is created or mounted.
+    batch_path: A string where a batch.BatchService able to call all services
+      is mapped, for example '/protorpc/batch'.  Coroutine remote methods of
+      its calls are awaited and synchronous ones run on executor.  When None
+      (the default), no batch service is created or mounted.
+    batch_max_workers: Maximum number of calls of a batch that the batch
+      service executes concurrently.
+    executor: concurrent.futures.Executor shared by all services to run
+      synchronous remote methods.  If None, a thread pool of
+      DEFAULT_MAX_WORKERS threads is created and shut down with the
+      application.
+
+  Returns:
+    ASGI application that serves ProtoRPC services on their respective URLs
+    plus optional RegistryService and BatchService.
+  """
+  if isinstance(services, dict):
+    services = six.iteritems(services)
+
+  owned_executor = None
+  if executor is None:
+    executor = owned_executor = futures.ThreadPoolExecutor(DEFAULT_MAX_WORKERS)
+
+  handlers = []
+  paths = set()
+  registry_map = {} if registry_path else None
+  batch_map = {} if batch_path else None
+
+  for service_path, service_factory in services:
+    try:
+      service_class = service_factory.service_class
+    except AttributeError:
+      service_class = service_factory
+
+    if service_path not in paths:
+      paths.add(service_path)
+    else:
+      raise remote.ServiceConfigurationError(
+        'Path %r is already defined in service mapping' % service_path)
+
+    if registry_map is not None:
+      registry_map[service_path] = service_class
+
+    if batch_map is not None:
+      batch_map[service_path] = service_factory
+
+    handlers.append(
+      _new_service_handler(service_factory, service_path, None, executor))
+
+  if registry_map is not None:
+    handlers.append(_new_service_handler(
+      registry.RegistryService.new_factory(registry_map), registry_path,
+      None, executor))
+
+  if batch_map is not None:
+    handlers.append(_new_service_handler(
+      _AsyncioBatchService.new_factory(batch_map, executor,
+                                       max_workers=batch_max_workers),
+      batch_path, None, executor))
+
+  return _new_application(handlers, owned_executor)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""ASGI application tests."""
+
+import asyncio
+import json
+import threading
+import unittest
+
+from protorpc import batch
+from protorpc import compression
+from protorpc import messages
+from protorpc import protojson
+from protorpc import remote
+from protorpc import test_util
+from protorpc.asgi import service
+
+
+class Greeting(messages.Message):
+
+  text = messages.StringField(1)
+
+
+class GreetingService(remote.Service):
+
+  @remote.method(Greeting, Greeting)
+  def sync_greet(self, request):
+    return Greeting(text='sync %s %s' % (
+      request.text, threading.current_thread() is threading.main_thread()))
+
+  @remote.method(Greeting, Greeting)
+  async def async_greet(self, request):
+    await asyncio.sleep(0)
+    return Greeting(text='async %s %s' % (
+      request.text, threading.current_thread() is threading.main_thread()))
+
+  @remote.method(Greeting, Greeting)
+  def remote_address(self, request):
+    return Greeting(text=self.request_state.remote_address)
+
+  @remote.method(Greeting, Greeting)
+  async def raise_application_error(self, request):
+    raise remote.ApplicationError('Application error', 'ERROR_NAME')
+
+  @remote.method(Greeting, Greeting)
+  def raise_unexpected_error(self, request):
+    raise TypeError('Unexpected error')
+
+  @remote.method(Greeting, test_util.OptionalMessage)
+  async def return_wrong_type(self, request):
+    return Greeting()
+
+
+class BrokenService(remote.Service):
+
+  def __init__(self):
+    raise TypeError('Broken service')
+
+  @remote.method(Greeting, Greeting)
+  async def async_greet(self, request):
+    return request
+
+
+class ModuleInterfaceTest(test_util.ModuleInterfaceTest,
+                          test_util.TestCase):
+
+  MODULE = service
+
+
+class ServiceMappingTest(test_util.TestCase):
+
+  def setUp(self):
+    remote.Protocols.set_default(remote.Protocols.new_default())
+    self.loop = asyncio.new_event_loop()
+    self.application = service.service_mappings(
+      [('/greeting', GreetingService)])
+
+  def tearDown(self):
+    self.loop.run_until_complete(self.run_lifespan())
+    self.loop.close()
+
+  async def run_lifespan(self):
+    events = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+      return events.pop(0)
+
+    async def send(message):
+      sent.append(message['type'])
+
+    await self.application({'type': 'lifespan'}, receive, send)
+    self.assertEquals(['lifespan.startup.complete',
+                       'lifespan.shutdown.complete'], sent)
+
+  def do_request(self, path, content=b'', method='POST',
+                 content_type='application/json', headers=None):
+    """Run a single request through the ASGI application.
+
+    Returns:
+      Tuple (status, headers, body) where headers is a dict and body is the
+      content of all body messages.
+    """
+    headers = [(name.encode('latin-1'), value.encode('latin-1'))
+               for name, value in (headers or {}).items()]
+    if content_type:
+      headers.append((b'content-type', content_type.encode('latin-1')))
+    scope = {'type': 'http',
+             'method': method,
+             'path': path,
+             'headers': headers,
+             'client': ('127.0.0.1', 5000),
+             'server': ('localhost', 8080),
+            }
+    # Deliver the body in two chunks to exercise reassembly.
+    chunks = [{'type': 'http.request', 'body': content[:1],
+               'more_body': True},
+              {'type': 'http.request', 'body': content[1:],
+               'more_body': False}]
+    sent = []
+
+    async def receive():
+      return chunks.pop(0)
+
+    async def send(message):
+      sent.append(message)
+
+    self.loop.run_until_complete(self.application(scope, receive, send))
+    start, bodies = sent[0], sent[1:]
+    self.assertEquals('http.response.start', start['type'])
+    self.assertEquals(['http.response.body'] * len(bodies),
+                      [body['type'] for body in bodies])
+    self.assertFalse(bodies[-1].get('more_body', False))
+    return (start['status'],
+            dict((name.decode('latin-1'), value.decode('latin-1'))
+                 for name, value in start['headers']),
+            b''.join(body['body'] for body in bodies))
+
+  def assertRpcError(self, status, state, path, content=b'{}'):
+    actual_status, headers, body = self.do_request(path, content)
+    self.assertEquals(status, actual_status)
+    self.assertEquals('application/json', headers['content-type'])
+    rpc_status = protojson.decode_message(remote.RpcStatus, body)
+    self.assertEquals(state, rpc_status.state)
+    return rpc_status
+
+  def testSyncMethod(self):
+    status, headers, body = self.do_request('/greeting.sync_greet',
+                                            b'{"text": "hi"}')
+    self.assertEquals(200, status)
+    self.assertEquals('application/json', headers['content-type'])
+    self.assertEquals(str(len(body)), headers['content-length'])
+    # Synchronous methods are run outside of the event loop thread.
+    self.assertEquals({'text': 'sync hi False'}, json.loads(body.decode()))
+
+  def testAsyncMethod(self):
+    status, headers, body = self.do_request('/greeting.async_greet',
+                                            b'{"text": "hi"}')
+    self.assertEquals(200, status)
+    self.assertEquals({'text': 'async hi True'}, json.loads(body.decode()))
+
+  def testRequestState(self):
+    status, unused_headers, body = self.do_request('/greeting.remote_address',
+                                                   b'{}')
+    self.assertEquals(200, status)
+    self.assertEquals({'text': '127.0.0.1'}, json.loads(body.decode()))
+
+  def testNotFound(self):
+    status, unused_headers, body = self.do_request('/unknown.sync_greet')
+    self.assertEquals(404, status)
+    self.assertTrue(body.startswith(b'Not Found'))
+
+  def testMissingContentType(self):
+    status, unused_headers, unused_body = self.do_request(
+      '/greeting.sync_greet', content_type=None)
+    self.assertEquals(400, status)
+
+  def testGet(self):
+    status, unused_headers, body = self.do_request('/greeting.sync_greet',
+                                                   method='GET')
+    self.assertEquals(405, status)
+    self.assertTrue(body.startswith(b'/greeting.sync_greet is a ProtoRPC '
+                                    b'method.'))
+
+  def testUnsupportedContentType(self):
+    status, unused_headers, unused_body = self.do_request(
+      '/greeting.sync_greet', content_type='image/png')
+    self.assertEquals(415, status)
+
+  def testMethodNotFound(self):
+    rpc_status = self.assertRpcError(400,
+                                     remote.RpcState.METHOD_NOT_FOUND_ERROR,
+                                     '/greeting.does_not_exist')
+    self.assertEquals('Unrecognized RPC method: does_not_exist',
+                      rpc_status.error_message)
+
+  def testRequestError(self):
+    self.assertRpcError(400, remote.RpcState.REQUEST_ERROR,
+                        '/greeting.sync_greet', b'{"text": 10}')
+
+  def testApplicationError(self):
+    rpc_status = self.assertRpcError(400, remote.RpcState.APPLICATION_ERROR,
+                                     '/greeting.raise_application_error')
+    self.assertEquals('Application error', rpc_status.error_message)
+    self.assertEquals('ERROR_NAME', rpc_status.error_name)
+
+  def testUnexpectedError(self):
+    self.assertRpcError(500, remote.RpcState.SERVER_ERROR,
+                        '/greeting.raise_unexpected_error')
+
+  def testCoroutineResponseChecked(self):
+    self.assertRpcError(500, remote.RpcState.SERVER_ERROR,
+                        '/greeting.return_wrong_type')
+
+  def testRegistry(self):
+    rpc_status = self.assertRpcError(400,
+                                     remote.RpcState.METHOD_NOT_FOUND_ERROR,
+                                     '/protorpc.does_not_exist')
+    self.assertEquals('Unrecognized RPC method: does_not_exist',
+                      rpc_status.error_message)
+
+  def testNoRegistry(self):
+    self.application = service.service_mappings(
+      [('/greeting', GreetingService)], registry_path=None)
+    status, unused_headers, unused_body = self.do_request(
+      '/protorpc.services')
+    self.assertEquals(404, status)
+
+  def testDuplicatePaths(self):
+    self.assertRaises(remote.ServiceConfigurationError,
+                      service.service_mappings,
+                      [('/greeting', GreetingService),
+                       ('/greeting', GreetingService)])
+
+  def testBatch(self):
+    self.application = service.service_mappings(
+      [('/greeting', GreetingService)], batch_path='/batch',
+      batch_max_workers=2)
+    calls = [batch.BatchRequest.Call(service_path=u'/greeting',
+                                     method=method,
+                                     request=b'{"text": "hi"}')
+             for method in (u'async_greet', u'sync_greet',
+                            u'raise_application_error')]
+    status, unused_headers, body = self.do_request(
+      '/batch.execute',
+      protojson.encode_message(batch.BatchRequest(calls=calls)).encode())
+    self.assertEquals(200, status)
+    results = protojson.decode_message(batch.BatchResponse, body).results
+    self.assertEquals([remote.RpcState.OK,
+                       remote.RpcState.OK,
+                       remote.RpcState.APPLICATION_ERROR],
+                      [result.status.state for result in results])
+    # Coroutine methods are awaited on the event loop, synchronous methods
+    # run on the executor.
+    self.assertEquals({'text': 'async hi True'},
+                      json.loads(results[0].response.decode()))
+    self.assertEquals({'text': 'sync hi False'},
+                      json.loads(results[1].response.decode()))
+    self.assertEquals('ERROR_NAME', results[2].status.error_name)
+
+  def testBatchServiceFactoryError(self):
+    self.application = service.service_mappings(
+      [('/greeting', GreetingService), ('/broken', BrokenService)],
+      batch_path='/batch', batch_max_workers=2)
+    calls = [batch.BatchRequest.Call(service_path=service_path,
+                                     method=u'async_greet',
+                                     request=b'{"text": "hi"}')
+             for service_path in (u'/greeting', u'/broken', u'/greeting')]
+    status, unused_headers, body = self.do_request(
+      '/batch.execute',
+      protojson.encode_message(batch.BatchRequest(calls=calls)).encode())
+    self.assertEquals(200, status)
+    results = protojson.decode_message(batch.BatchResponse, body).results
+    self.assertEquals([remote.RpcState.OK,
+                       remote.RpcState.SERVER_ERROR,
+                       remote.RpcState.OK],
+                      [result.status.state for result in results])
+
+  def testSmallResponseNotCompressed(self):
+    status, headers, body = self.do_request(
+      '/greeting.async_greet', b'{"text": "hi"}',
+      headers={'accept-encoding': 'gzip'})
+    self.assertEquals(200, status)
+    self.assertEquals('accept-encoding', headers['vary'])
+    self.assertFalse('content-encoding' in headers)
+    self.assertEquals({'text': 'async hi True'}, json.loads(body.decode()))
+
+  def testCompressedResponse(self):
+    text = 'x' * 10000
+    status, headers, body = self.do_request(
+      '/greeting.async_greet',
+      protojson.encode_message(Greeting(text=text)).encode(),
+      headers={'accept-encoding': 'deflate'})
+    self.assertEquals(200, status)
+    self.assertEquals('deflate', headers['content-encoding'])
+    self.assertEquals(str(len(body)), headers['content-length'])
+    self.assertEquals({'text': 'async %s True' % text},
+                      json.loads(compression.decompress(body, 'deflate')))
+
+  def testStreamedResponse(self):
+    text = 'x' * compression.DEFAULT_STREAMING_THRESHOLD
+    status, headers, body = self.do_request(
+      '/greeting.async_greet',
+      protojson.encode_message(Greeting(text=text)).encode(),
+      headers={'accept-encoding': 'gzip'})
+    self.assertEquals(200, status)
+    self.assertEquals('gzip', headers['content-encoding'])
+    self.assertFalse('content-length' in headers)
+    self.assertEquals({'text': 'async %s True' % text},
+                      json.loads(compression.decompress(body, 'gzip')))
+
+  def testCompressedRequest(self):
+    status, unused_headers, body = self.do_request(
+      '/greeting.async_greet',
+      compression.compress(b'{"text": "hi"}', 'gzip'),
+      headers={'content-encoding': 'gzip'})
+    self.assertEquals(200, status)
+    self.assertEquals({'text': 'async hi True'}, json.loads(body.decode()))
+
+  def testUnsupportedContentEncoding(self):
+    status, unused_headers, unused_body = self.do_request(
+      '/greeting.async_greet', b'{}', headers={'content-encoding': 'br'})
+    self.assertEquals(415, status)
+
+  def testInvalidCompressedRequest(self):
+    status, unused_headers, body = self.do_request(
+      '/greeting.async_greet', b'{}', headers={'content-encoding': 'gzip'})
+    self.assertEquals(400, status)
+    self.assertEquals(remote.RpcState.REQUEST_ERROR,
+                      protojson.decode_message(remote.RpcStatus, body).state)
+
+  def testDecompressedRequestTooLarge(self):
+    protocols = remote.Protocols()
+    protocols.add_protocol(protojson, 'protojson', max_decompressed_size=100)
+    self.application = service.service_mapping(GreetingService, '/greeting',
+                                                protocols=protocols)
+    status, unused_headers, body = self.do_request(
+      '/greeting.async_greet',
+      compression.compress(b' ' * 50 + b'{"text": "hi"}', 'gzip'),
+      headers={'content-encoding': 'gzip'})
+    self.assertEquals(200, status)
+    self.assertEquals({'text': 'async hi True'}, json.loads(body.decode()))
+
+    status, unused_headers, body = self.do_request(
+      '/greeting.async_greet',
+      compression.compress(b' ' * 1000 + b'{"text": "hi"}', 'gzip'),
+      headers={'content-encoding': 'gzip'})
+    self.assertEquals(413, status)
+    rpc_status = protojson.decode_message(remote.RpcStatus, body)
+    self.assertEquals(remote.RpcState.REQUEST_ERROR, rpc_status.state)
+    self.assertEquals('Error parsing ProtoRPC request '
+                      '(Decompressed gzip content exceeds 100 bytes)',
+                      rpc_status.error_message)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
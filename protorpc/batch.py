@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Batch RPC support.
+
+Sends many remote method calls in a single HTTP round trip.
+
+On the server side a BatchService executes the calls of a BatchRequest on the
+services it is configured with.  It is normally mounted by passing batch_path
+to wsgi.service.service_mappings:
+
+  application = service.service_mappings(
+      [('/my/service', MyService),
+       ('/my/other_service', MyOtherService),
+      ],
+      batch_path='/protorpc/batch')
+
+On the client side a Batcher collects calls made through BatchTransport
+instances and sends them to the BatchService together.  Calls made within a
+short window of each other are sent in the same batch.  A batch is also sent
+as soon as one of its RPCs is waited on or the batch is full:
+
+  batcher = batch.Batcher(transport.HttpTransport(
+      'http://myserver/protorpc/batch', protocol=protojson))
+  my_service = MyService.Stub(batch.BatchTransport(batcher, '/my/service'))
+  my_other_service = MyOtherService.Stub(
+      batch.BatchTransport(batcher, '/my/other_service'))
+
+  rpc1 = my_service.async.do_something(request)
+  rpc2 = my_other_service.async.do_something_else(other_request)
+  # Both calls are sent in one HTTP request.
+  response1 = rpc1.response
+
+Requests and responses of the individual calls are encoded with the protocol
+of the batch request itself.
+"""
+
+import cgi
+import logging
+import threading
+
+import six
+
+from . import messages
+from . import protobuf
+from . import remote
+from . import transport
+from . import util
+
+
+__all__ = [
+  'DEFAULT_MAX_BATCH_SIZE',
+  'DEFAULT_WINDOW',
+
+  'BatchRequest',
+  'BatchResponse',
+  'BatchService',
+  'BatchTransport',
+  'Batcher',
+]
+
+
+# Seconds a Batcher waits for further calls before sending a batch.
+DEFAULT_WINDOW = 0.01
+
+# Maximum number of calls a Batcher sends in a single batch.
+DEFAULT_MAX_BATCH_SIZE = 100
+
+
+class BatchRequest(messages.Message):
+  """Envelope for several remote method calls.
+
+  Fields:
+    calls: Calls to execute.
+  """
+
+  class Call(messages.Message):
+    """A single remote method call.
+
+    Fields:
+      service_path: Path service is mapped to, for example '/my/service'.
+      method: Name of remote method to call.
+      request: Request message encoded with the protocol of the batch.
+    """
+
+    service_path = messages.StringField(1, required=True)
+    method = messages.StringField(2, required=True)
+    request = messages.BytesField(3)
+
+  calls = messages.MessageField(Call, 1, repeated=True)
+
+
+class BatchResponse(messages.Message):
+  """Envelope for the results of a BatchRequest.
+
+  Fields:
+    results: Result for each call of the batch request, in the same order.
+  """
+
+  class Result(messages.Message):
+    """Result of a single remote method call.
+
+    Fields:
+      status: Status of call.  State is OK when the call succeeded.
+      response: Response message encoded with the protocol of the batch.  Only
+        set when the call succeeded.
+    """
+
+    status = messages.MessageField(remote.RpcStatus, 1, required=True)
+    response = messages.BytesField(2)
+
+  results = messages.MessageField(Result, 1, repeated=True)
+
+
+def _error_result(state, message, error_name=None):
+  """Create result of a call that failed with an RPC error."""
+  if error_name is not None:
+    error_name = six.text_type(error_name)
+  return BatchResponse.Result(status=remote.RpcStatus(
+    state=state,
+    error_message=six.text_type(message),
+    error_name=error_name))
+
+
+def _encode_message(protocol, message):
+  """Encode message as bytes for use in a BytesField."""
+  encoded_message = protocol.encode_message(message)
+  if isinstance(encoded_message, six.text_type):
+    encoded_message = encoded_message.encode('utf-8')
+  return encoded_message
+
+
+class BatchService(remote.Service):
+  """Service that executes batches of remote method calls.
+
+  Each call is executed on a new service instance, exactly as if it had been
+  sent in its own HTTP request.  Calls are executed in order unless the
+  service is configured with more than one worker, in which case up to that
+  many calls are executed concurrently on separate threads.
+  """
+
+  @util.positional(2)
+  def __init__(self, services, max_workers=1, protocols=None):
+    """Constructor.
+
+    Args:
+      services: Map of service path to service factory or class.  This map is
+        not copied and may be modified after the batch service has been
+        configured.
+      max_workers: Maximum number of calls of a batch executed concurrently.
+      protocols: remote.Protocols instance used to look up the protocol of
+        batch requests.  Defaults to the global default Protocols.
+    """
+    self.__services = services
+    self.__max_workers = max_workers
+    self.__protocols = protocols
+
+  @property
+  def services(self):
+    """Map of service path to service factory."""
+    return self.__services
+
+  @property
+  def max_workers(self):
+    """Maximum number of calls of a batch executed concurrently."""
+    return self.__max_workers
+
+  def _get_protocol(self):
+    """Get protocol that the batch request was sent with.
+
+    Returns:
+      The protocol matching the content-type of the HTTP request.  When the
+      request was not sent over HTTP, the protobuf protocol.
+    """
+    protocols = self.__protocols or remote.Protocols.get_default()
+    content_type = None
+    headers = getattr(self.request_state, 'headers', None)
+    if headers is not None:
+      content_type = headers.get('content-type')
+    if not content_type:
+      return protobuf
+    return protocols.lookup_by_content_type(
+      cgi.parse_header(content_type)[0]).protocol
+
+  def __new_request_state(self, service_path):
+    """Create request state for a single call.
+
+    Args:
+      service_path: Service path of call.
+
+    Returns:
+      Copy of the batch request state with the service path of the call, or
+      the batch request state itself when it is not an HttpRequestState.
+    """
+    request_state = self.request_state
+    if not isinstance(request_state, remote.HttpRequestState):
+      return request_state
+    return remote.HttpRequestState(
+      remote_host=request_state.remote_host,
+      remote_address=request_state.remote_address,
+      server_host=request_state.server_host,
+      server_port=request_state.server_port,
+      http_method=request_state.http_method,
+      service_path=service_path,
+      headers=list(request_state.headers.items()))
+
+  def _prepare_call(self, protocol, call):
+    """Look up the remote method of a call and decode its request.
+
+    Args:
+      protocol: Protocol to decode request with.
+      call: BatchRequest.Call to prepare.
+
+    Returns:
+      Tuple (method, instance, request, error_result):
+        method: Remote method to call, else None.
+        instance: New service instance to call method on, else None.
+        request: Decoded request message, else None.
+        error_result: BatchResponse.Result when the call can not be made,
+          including when creating or initializing the service instance
+          fails, else None.
+    """
+    service_factory = self.__services.get(call.service_path)
+    method = None
+    if service_factory is not None:
+      service_class = getattr(service_factory, 'service_class',
+                              service_factory)
+      method = service_class.all_remote_methods().get(call.method)
+    if method is None:
+      return None, None, None, _error_result(
+        remote.RpcState.METHOD_NOT_FOUND_ERROR,
+        'Unrecognized RPC method: %s.%s' % (call.service_path, call.method))
+
+    remote_info = method.remote
+    try:
+      request = protocol.decode_message(remote_info.request_type,
+                                        call.request or b'')
+    except (messages.ValidationError, messages.DecodeError) as err:
+      return None, None, None, _error_result(
+        remote.RpcState.REQUEST_ERROR,
+        'Error parsing ProtoRPC request '
+        '(Unable to parse request content: %s)' % err)
+
+    try:
+      instance = service_factory()
+      initialize_request_state = getattr(
+        instance, 'initialize_request_state', None)
+      if initialize_request_state:
+        initialize_request_state(self.__new_request_state(call.service_path))
+    except Exception as err:
+      return None, None, None, self._exception_result(err)
+    return method, instance, request, None
+
+  @staticmethod
+  def _response_result(protocol, response):
+    """Create result of a call that returned response."""
+    return BatchResponse.Result(status=remote.RpcStatus(
+                                  state=remote.RpcState.OK),
+                                response=_encode_message(protocol, response))
+
+  @staticmethod
+  def _exception_result(error):
+    """Create result of a call that raised error.
+
+    Must be called while handling error, so that unexpected errors are
+    logged with their traceback.
+    """
+    if isinstance(error, remote.ApplicationError):
+      return _error_result(remote.RpcState.APPLICATION_ERROR,
+                           six.text_type(error),
+                           error.error_name)
+    logging.exception('Encountered unexpected error from ProtoRPC '
+                      'method implementation: %s (%s)' %
+                      (error.__class__.__name__, error))
+    return _error_result(remote.RpcState.SERVER_ERROR,
+                         'Internal Server Error')
+
+  def __execute_call(self, protocol, call):
+    """Execute a single call.
+
+    Args:
+      protocol: Protocol to decode request and encode response with.
+      call: BatchRequest.Call to execute.
+
+    Returns:
+      BatchResponse.Result of call.
+    """
+    method, instance, request, error_result = self._prepare_call(protocol,
+                                                                 call)
+    if error_result is not None:
+      return error_result
+    if method.remote.is_coroutine:
+      return _error_result(remote.RpcState.SERVER_ERROR,
+                           'Coroutine remote method %s.%s can only be called '
+                           'in batches served by asgi.service' %
+                           (call.service_path, call.method))
+    try:
+      return self._response_result(protocol, method(instance, request))
+    except Exception as err:
+      return self._exception_result(err)
+
+  @remote.method(BatchRequest, BatchResponse)
+  def execute(self, request):
+    """Execute all calls of a batch."""
+    protocol = self._get_protocol()
+    calls = list(request.calls or ())
+    results = [None] * len(calls)
+
+    remaining = six.moves.queue.Queue()
+    for index in range(len(calls)):
+      remaining.put(index)
+
+    def execute_remaining():
+      """Execute calls until there are none left."""
+      while True:
+        try:
+          index = remaining.get_nowait()
+        except six.moves.queue.Empty:
+          return
+        results[index] = self.__execute_call(protocol, calls[index])
+
+    worker_count = min(self.__max_workers, len(calls))
+    if worker_count <= 1:
+      execute_remaining()
+    else:
+      workers = [threading.Thread(target=execute_remaining)
+                 for _ in range(worker_count)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+
+    return BatchResponse(results=results)
+
+
+class _Batch(object):
+  """Calls that are sent to the BatchService in a single request."""
+
+  def __init__(self, stub, protocol):
+    """Constructor.
+
+    Args:
+      stub: BatchService.Stub to send batch with.
+      protocol: Protocol to encode requests and decode responses of calls.
+    """
+    self.__stub = stub
+    self.__protocol = protocol
+    self.__calls = []
+    self.__rpcs = []
+    self.__batch_rpc = None
+    self.__send_error = None
+    self.__completed = False
+    self.__lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.__calls)
+
+  def add(self, service_path, remote_info, request, rpc):
+    """Add call to batch.
+
+    Args:
+      service_path: Path of service to call.
+      remote_info: RemoteInfo of remote method to call.
+      request: Request message.
+      rpc: Rpc to set the result of the call on.
+    """
+    self.__calls.append(BatchRequest.Call(
+      service_path=six.text_type(service_path),
+      method=six.text_type(remote_info.method.__name__),
+      request=_encode_message(self.__protocol, request)))
+    self.__rpcs.append((remote_info, rpc))
+
+  def send(self):
+    """Send batch to the BatchService unless it was already sent."""
+    with self.__lock:
+      if self.__batch_rpc is not None or self.__send_error is not None:
+        return
+      try:
+        self.__batch_rpc = self.__stub.async.execute(
+          BatchRequest(calls=self.__calls))
+      except remote.RpcError as err:
+        self.__send_error = err
+
+  def __set_error(self, error):
+    """Set error status on all RPCs of the batch."""
+    for unused_remote_info, rpc in self.__rpcs:
+      rpc.set_status(remote.RpcStatus(
+        state=getattr(error, 'STATE', remote.RpcState.SERVER_ERROR),
+        error_message=six.text_type(error)))
+
+  def complete(self):
+    """Send batch if necessary and set the results on all of its RPCs."""
+    self.send()
+    with self.__lock:
+      if self.__completed:
+        return
+      self.__completed = True
+
+      if self.__send_error is not None:
+        self.__set_error(self.__send_error)
+        return
+
+      try:
+        results = self.__batch_rpc.response.results or []
+      except remote.RpcError as err:
+        self.__set_error(err)
+        return
+
+      if len(results) != len(self.__rpcs):
+        self.__set_error(remote.ServerError(
+          'Batch response has %d results for %d calls' %
+          (len(results), len(self.__rpcs))))
+        return
+
+      for (remote_info, rpc), result in zip(self.__rpcs, results):
+        if result.status.state != remote.RpcState.OK:
+          rpc.set_status(result.status)
+          continue
+        try:
+          response = self.__protocol.decode_message(remote_info.response_type,
+                                                    result.response or b'')
+        except (messages.ValidationError, messages.DecodeError) as err:
+          rpc.set_status(remote.RpcStatus(
+            state=remote.RpcState.SERVER_ERROR,
+            error_message='Unable to parse response: %s' % err))
+        else:
+          rpc.set_response(response)
+
+
+class Batcher(object):
+  """Coalesces RPCs in to batches sent to a BatchService.
+
+  The first call made after a batch was sent starts a new batch.  The batch is
+  sent once the window has passed, once it holds max_batch_size calls, once
+  one of its RPCs is waited on or when flush is called, whichever comes
+  first.  Batchers are thread-safe.
+  """
+
+  @util.positional(2)
+  def __init__(self,
+               batch_transport,
+               window=DEFAULT_WINDOW,
+               max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+    """Constructor.
+
+    Args:
+      batch_transport: Transport to the BatchService.  Its protocol is also
+        used to encode the requests and decode the responses of calls.
+      window: Number of seconds to wait for further calls before sending a
+        batch.  When None or 0, batches are only sent once full, waited on or
+        flushed.
+      max_batch_size: Maximum number of calls sent in a single batch.
+    """
+    self.__transport = batch_transport
+    self.__stub = BatchService.Stub(batch_transport)
+    self.__window = window
+    self.__max_batch_size = max_batch_size
+    self.__batch = None
+    self.__timer = None
+    self.__lock = threading.Lock()
+
+  @property
+  def transport(self):
+    """Transport to the BatchService."""
+    return self.__transport
+
+  @property
+  def window(self):
+    """Number of seconds to wait for further calls before sending a batch."""
+    return self.__window
+
+  @property
+  def max_batch_size(self):
+    """Maximum number of calls sent in a single batch."""
+    return self.__max_batch_size
+
+  def __take_batch(self, batch=None):
+    """Stop adding calls to the current batch.
+
+    Args:
+      batch: Only take current batch if it is this batch.  If None, take any
+        current batch.
+
+    Returns:
+      Batch that was taken, else None.
+    """
+    with self.__lock:
+      current_batch = self.__batch
+      if current_batch is None or batch not in (None, current_batch):
+        return None
+      self.__batch = None
+      if self.__timer is not None:
+        self.__timer.cancel()
+        self.__timer = None
+      return current_batch
+
+  def __send_batch(self, batch=None):
+    """Take batch and send it."""
+    batch = self.__take_batch(batch)
+    if batch is not None:
+      batch.send()
+
+  def __complete_batch(self, batch):
+    """Take batch, send it if necessary and wait for its results."""
+    self.__take_batch(batch)
+    batch.complete()
+
+  def add(self, service_path, remote_info, request):
+    """Add call to current batch.
+
+    Args:
+      service_path: Path of service to call.
+      remote_info: RemoteInfo of remote method to call.
+      request: Request message.
+
+    Returns:
+      Rpc whose result is set once the batch has completed.
+    """
+    rpc = transport.Rpc(request)
+    with self.__lock:
+      batch = self.__batch
+      if batch is None:
+        batch = self.__batch = _Batch(self.__stub, self.__transport.protocol)
+        if self.__window:
+          self.__timer = threading.Timer(self.__window, self.__send_batch,
+                                         (batch,))
+          self.__timer.daemon = True
+          self.__timer.start()
+      batch.add(service_path, remote_info, request, rpc)
+      batch_full = len(batch) >= self.__max_batch_size
+
+    rpc._wait_impl = lambda: self.__complete_batch(batch)
+    if batch_full:
+      self.__send_batch(batch)
+    return rpc
+
+  def flush(self):
+    """Send the current batch without waiting for the window to pass."""
+    self.__send_batch()
+
+
+class BatchTransport(transport.Transport):
+  """Transport that sends RPCs for a single service through a Batcher."""
+
+  @util.positional(3)
+  def __init__(self, batcher, service_path):
+    """Constructor.
+
+    Args:
+      batcher: Batcher to send RPCs through.
+      service_path: Path the service is mapped to on the server.
+    """
+    super(BatchTransport, self).__init__(
+      protocol=batcher.transport.protocol_config)
+    self.__batcher = batcher
+    self.__service_path = service_path
+
+  @property
+  def batcher(self):
+    """Batcher that RPCs are sent through."""
+    return self.__batcher
+
+  @property
+  def service_path(self):
+    """Path the service is mapped to on the server."""
+    return self.__service_path
+
+  def _start_rpc(self, remote_info, request):
+    """Start a remote procedure call.
+
+    Args:
+      remote_info: RemoteInfo instance describing remote method.
+      request: Request message to send to service.
+
+    Returns:
+      An Rpc instance that completes with its batch.
+    """
+    return self.__batcher.add(self.__service_path, remote_info, request)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for protorpc.batch."""
+
+import time
+import unittest
+
+from protorpc import batch
+from protorpc import messages
+from protorpc import protojson
+from protorpc import remote
+from protorpc import test_util
+from protorpc import transport
+from protorpc import webapp_test_util
+from protorpc.wsgi import service
+
+
+class ModuleInterfaceTest(test_util.ModuleInterfaceTest,
+                          test_util.TestCase):
+
+  MODULE = batch
+
+
+class Greeting(messages.Message):
+
+  text = messages.StringField(1)
+
+
+class GreetingService(remote.Service):
+
+  @remote.method(Greeting, Greeting)
+  def greet(self, request):
+    return Greeting(text=u'Hello %s' % request.text)
+
+  @remote.method(Greeting, Greeting)
+  def service_path(self, request):
+    return Greeting(text=self.request_state.service_path)
+
+  @remote.method(Greeting, Greeting)
+  def sleep(self, request):
+    time.sleep(0.2)
+    return request
+
+  @remote.method(Greeting, Greeting)
+  def raise_application_error(self, request):
+    raise remote.ApplicationError('Go away', 'GO_AWAY')
+
+  @remote.method(Greeting, Greeting)
+  def raise_unexpected_error(self, request):
+    raise TypeError('Unexpected error')
+
+
+class FarewellService(remote.Service):
+
+  @remote.method(Greeting, Greeting)
+  def farewell(self, request):
+    return Greeting(text=u'Bye %s' % request.text)
+
+
+class BrokenService(remote.Service):
+
+  def __init__(self):
+    raise TypeError('Broken service')
+
+  @remote.method(Greeting, Greeting)
+  def greet(self, request):
+    return request
+
+
+class RecordingTransport(transport.LocalTransport):
+  """Local transport recording the size of every batch it sends."""
+
+  def __init__(self, service_factory):
+    super(RecordingTransport, self).__init__(service_factory)
+    self.batch_sizes = []
+
+  def _start_rpc(self, remote_info, request):
+    self.batch_sizes.append(len(request.calls or ()))
+    return super(RecordingTransport, self)._start_rpc(remote_info, request)
+
+
+SERVICES = {u'/greeting': GreetingService,
+            u'/farewell': FarewellService,
+            u'/broken': BrokenService,
+           }
+
+
+class BatchServiceTest(test_util.TestCase):
+
+  def setUp(self):
+    self.ResetService()
+
+  def ResetService(self, **kwargs):
+    self.service = batch.BatchService(SERVICES, **kwargs)
+    self.service.initialize_request_state(remote.HttpRequestState(
+      http_method='POST',
+      service_path='/batch',
+      headers={'content-type': 'application/json; charset=utf-8'}))
+
+  def new_call(self, service_path, method, request=None):
+    return batch.BatchRequest.Call(
+      service_path=service_path,
+      method=method,
+      request=protojson.encode_message(request or Greeting()))
+
+  def execute(self, *calls):
+    return self.service.execute(batch.BatchRequest(calls=list(calls))).results
+
+  def assertStatus(self, state, result, error_message=None, error_name=None):
+    self.assertEquals(remote.RpcStatus(state=state,
+                                       error_message=error_message,
+                                       error_name=error_name),
+                      result.status)
+    self.assertEquals(None, result.response)
+
+  def testExecute(self):
+    results = self.execute(
+      self.new_call(u'/greeting', u'greet', Greeting(text=u'Bob')),
+      self.new_call(u'/farewell', u'farewell', Greeting(text=u'Alice')))
+
+    self.assertEquals(2, len(results))
+    self.assertEquals(remote.RpcState.OK, results[0].status.state)
+    self.assertEquals(Greeting(text=u'Hello Bob'),
+                      protojson.decode_message(Greeting, results[0].response))
+    self.assertEquals(remote.RpcState.OK, results[1].status.state)
+    self.assertEquals(Greeting(text=u'Bye Alice'),
+                      protojson.decode_message(Greeting, results[1].response))
+
+  def testEmpty(self):
+    self.assertEquals([], self.execute())
+
+  def testRequestState(self):
+    [result] = self.execute(self.new_call(u'/greeting', u'service_path'))
+    self.assertEquals(Greeting(text=u'/greeting'),
+                      protojson.decode_message(Greeting, result.response))
+
+  def testMethodNotFound(self):
+    results = self.execute(self.new_call(u'/greeting', u'farewell'),
+                           self.new_call(u'/unknown', u'greet'))
+    self.assertStatus(remote.RpcState.METHOD_NOT_FOUND_ERROR, results[0],
+                      u'Unrecognized RPC method: /greeting.farewell')
+    self.assertStatus(remote.RpcState.METHOD_NOT_FOUND_ERROR, results[1],
+                      u'Unrecognized RPC method: /unknown.greet')
+
+  def testRequestError(self):
+    call = batch.BatchRequest.Call(service_path=u'/greeting',
+                                   method=u'greet',
+                                   request=b'{"text": 10}')
+    [result] = self.execute(call)
+    self.assertEquals(remote.RpcState.REQUEST_ERROR, result.status.state)
+
+  def testApplicationError(self):
+    [result] = self.execute(self.new_call(u'/greeting',
+                                          u'raise_application_error'))
+    self.assertStatus(remote.RpcState.APPLICATION_ERROR, result,
+                      u'Go away', u'GO_AWAY')
+
+  def testUnexpectedError(self):
+    [result] = self.execute(self.new_call(u'/greeting',
+                                          u'raise_unexpected_error'))
+    self.assertStatus(remote.RpcState.SERVER_ERROR, result,
+                      u'Internal Server Error')
+
+  def testServiceFactoryError(self):
+    for max_workers in (1, 4):
+      self.ResetService(max_workers=max_workers)
+      results = self.execute(
+        self.new_call(u'/greeting', u'greet', Greeting(text=u'Bob')),
+        self.new_call(u'/broken', u'greet'),
+        self.new_call(u'/farewell', u'farewell', Greeting(text=u'Alice')))
+      self.assertEquals(remote.RpcState.OK, results[0].status.state)
+      self.assertStatus(remote.RpcState.SERVER_ERROR, results[1],
+                        u'Internal Server Error')
+      self.assertEquals(remote.RpcState.OK, results[2].status.state)
+
+  def testConcurrentExecution(self):
+    self.ResetService(max_workers=4)
+    calls = [self.new_call(u'/greeting', u'sleep', Greeting(text=six_text(i)))
+             for i in range(4)]
+    start = time.time()
+    results = self.execute(*calls)
+    self.assertLess(time.time() - start, 0.6)
+    self.assertEquals([six_text(i) for i in range(4)],
+                      [protojson.decode_message(Greeting, r.response).text
+                       for r in results])
+
+
+def six_text(value):
+  return u'%s' % value
+
+
+class BatcherTest(test_util.TestCase):
+
+  def setUp(self):
+    self.batch_transport = RecordingTransport(
+      batch.BatchService.new_factory(SERVICES))
+    self.ResetBatcher()
+
+  def ResetBatcher(self, **kwargs):
+    self.batcher = batch.Batcher(self.batch_transport, **kwargs)
+    self.greeting = GreetingService.Stub(
+      batch.BatchTransport(self.batcher, u'/greeting'))
+    self.farewell = FarewellService.Stub(
+      batch.BatchTransport(self.batcher, u'/farewell'))
+
+  def testCoalesce(self):
+    self.ResetBatcher(window=None)
+    rpc1 = self.greeting.async.greet(text=u'Bob')
+    rpc2 = self.farewell.async.farewell(text=u'Alice')
+    rpc3 = self.greeting.async.greet(text=u'Eve')
+
+    self.assertEquals(Greeting(text=u'Hello Bob'), rpc1.response)
+    self.assertEquals(Greeting(text=u'Bye Alice'), rpc2.response)
+    self.assertEquals(Greeting(text=u'Hello Eve'), rpc3.response)
+    self.assertEquals([3], self.batch_transport.batch_sizes)
+
+  def testSynchronousCalls(self):
+    self.assertEquals(Greeting(text=u'Hello Bob'),
+                      self.greeting.greet(text=u'Bob'))
+    self.assertEquals(Greeting(text=u'Bye Bob'),
+                      self.farewell.farewell(text=u'Bob'))
+    self.assertEquals([1, 1], self.batch_transport.batch_sizes)
+
+  def testWindow(self):
+    self.ResetBatcher(window=0.05)
+    rpc1 = self.greeting.async.greet(text=u'Bob')
+    rpc2 = self.greeting.async.greet(text=u'Alice')
+    time.sleep(0.2)
+    rpc3 = self.greeting.async.greet(text=u'Eve')
+
+    transport.wait_all([rpc1, rpc2, rpc3])
+    self.assertEquals([2, 1], sorted(self.batch_transport.batch_sizes,
+                                     reverse=True))
+
+  def testMaxBatchSize(self):
+    self.ResetBatcher(window=None, max_batch_size=2)
+    rpcs = [self.greeting.async.greet(text=six_text(i)) for i in range(3)]
+    self.assertEquals([u'Hello 0', u'Hello 1', u'Hello 2'],
+                      [rpc.response.text for rpc in rpcs])
+    self.assertEquals([2, 1], self.batch_transport.batch_sizes)
+
+  def testFlush(self):
+    self.ResetBatcher(window=None)
+    rpc1 = self.greeting.async.greet(text=u'Bob')
+    self.batcher.flush()
+    rpc2 = self.greeting.async.greet(text=u'Alice')
+    transport.wait_all([rpc1, rpc2])
+    self.assertEquals([1, 1], sorted(self.batch_transport.batch_sizes))
+
+  def testCallErrors(self):
+    self.ResetBatcher(window=None)
+    rpc1 = self.greeting.async.raise_application_error()
+    rpc2 = self.greeting.async.greet(text=u'Bob')
+
+    self.assertRaisesWithRegexpMatch(remote.ApplicationError,
+                                     'Go away',
+                                     getattr, rpc1, 'response')
+    self.assertEquals('GO_AWAY', rpc1.error_name)
+    self.assertEquals(Greeting(text=u'Hello Bob'), rpc2.response)
+
+  def testBatchError(self):
+    self.batch_transport = transport.HttpTransport(
+      'http://localhost:%d/batch' % test_util.pick_unused_port())
+    self.ResetBatcher(window=None)
+    rpc1 = self.greeting.async.greet(text=u'Bob')
+    rpc2 = self.farewell.async.farewell(text=u'Alice')
+
+    self.assertRaises(remote.NetworkError, getattr, rpc1, 'response')
+    self.assertRaises(remote.NetworkError, getattr, rpc2, 'response')
+
+
+class BatchServiceMappingTest(webapp_test_util.WebServerTestBase):
+
+  def setUp(self):
+    super(BatchServiceMappingTest, self).setUp()
+    batch_transport = transport.HttpTransport(
+      self.make_service_url('/protorpc/batch'), protocol=protojson)
+    self.batcher = batch.Batcher(batch_transport, window=None)
+
+  def CreateWsgiApplication(self):
+    return service.service_mappings(
+      [('/greeting', GreetingService),
+       ('/farewell', FarewellService),
+      ],
+      batch_path='/protorpc/batch',
+      batch_max_workers=2)
+
+  def testBatch(self):
+    greeting = GreetingService.Stub(
+      batch.BatchTransport(self.batcher, '/greeting'))
+    farewell = FarewellService.Stub(
+      batch.BatchTransport(self.batcher, '/farewell'))
+
+    rpc1 = greeting.async.greet(text=u'Bob')
+    rpc2 = farewell.async.farewell(text=u'Alice')
+    rpc3 = greeting.async.service_path()
+
+    self.assertEquals(Greeting(text=u'Hello Bob'), rpc1.response)
+    self.assertEquals(Greeting(text=u'Bye Alice'), rpc2.response)
+    self.assertEquals(Greeting(text=u'/greeting'), rpc3.response)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""HTTP content-encoding support.
+
+Compresses and decompresses HTTP bodies with the gzip and deflate content
+codings and negotiates which coding to use from an Accept-Encoding header.
+Used by the ProtoRPC servers and HTTP transports, which are configured
+through remote.ProtocolConfig.
+
+Large bodies can be processed incrementally in chunks so that compressed
+output is produced while it is being sent and compressed input while it is
+being received.  Decompressed content is limited in size so that small
+compressed bodies can not expand into unbounded amounts of memory.
+"""
+
+import zlib
+
+import six
+
+__all__ = [
+  'DEFAULT_CHUNK_SIZE',
+  'DEFAULT_COMPRESSION_THRESHOLD',
+  'DEFAULT_MAX_DECOMPRESSED_SIZE',
+  'DEFAULT_STREAMING_THRESHOLD',
+  'DEFLATE',
+  'GZIP',
+  'IDENTITY',
+  'SUPPORTED_ENCODINGS',
+
+  'ContentTooLargeError',
+  'DecompressionError',
+  'Error',
+  'UnsupportedEncodingError',
+
+  'compress',
+  'compress_chunks',
+  'decompress',
+  'decompress_stream',
+  'new_compressor',
+  'new_decompressor',
+  'select_encoding',
+]
+
+
+IDENTITY = 'identity'
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+
+# Supported content codings in order of preference.
+SUPPORTED_ENCODINGS = (GZIP, DEFLATE)
+
+# Bodies smaller than this many bytes are not worth compressing.
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# Bodies of at least this many bytes are compressed in chunks as they are
+# sent rather than all at once.
+DEFAULT_STREAMING_THRESHOLD = 256 * 1024
+
+# Number of bytes processed at a time by the streaming functions.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of bytes decompressed content may expand to.
+DEFAULT_MAX_DECOMPRESSED_SIZE = 32 * 1024 * 1024
+
+_WBITS = {
+  GZIP: zlib.MAX_WBITS | 16,
+  DEFLATE: zlib.MAX_WBITS,
+}
+
+
+class Error(Exception):
+  """Base class for content-encoding errors."""
+
+
+class UnsupportedEncodingError(Error):
+  """Raised when a content coding is not supported."""
+
+
+class DecompressionError(Error):
+  """Raised when content can not be decompressed."""
+
+
+class ContentTooLargeError(DecompressionError):
+  """Raised when decompressed content exceeds its maximum size."""
+
+
+def _get_wbits(encoding):
+  """Get zlib window bits parameter for a content coding.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+  """
+  try:
+    return _WBITS[encoding]
+  except KeyError:
+    raise UnsupportedEncodingError('Unsupported content encoding: %s' %
+                                   encoding)
+
+
+def _to_bytes(content):
+  """Encode unicode content as UTF-8."""
+  if isinstance(content, six.text_type):
+    return content.encode('utf-8')
+  return content
+
+
+def new_compressor(encoding, level=zlib.Z_DEFAULT_COMPRESSION):
+  """Create a zlib compression object producing a content coding.
+
+  Args:
+    encoding: Content coding to produce, GZIP or DEFLATE.
+    level: zlib compression level.
+
+  Returns:
+    zlib compression object.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+  """
+  return zlib.compressobj(level, zlib.DEFLATED, _get_wbits(encoding))
+
+
+class _Decompressor(object):
+  """Incremental decompressor for a content coding.
+
+  Some clients send raw deflate data without the zlib header for the deflate
+  coding.  Both forms are accepted.
+  """
+
+  def __init__(self, encoding, max_size=None):
+    self.__encoding = encoding
+    self.__decompressor = zlib.decompressobj(_get_wbits(encoding))
+    self.__started = False
+    self.__max_size = max_size
+    self.__size = 0
+
+  def __check_size(self, result):
+    """Count decompressed bytes against the maximum size.
+
+    Raises:
+      ContentTooLargeError if the maximum size is exceeded.
+    """
+    self.__size += len(result)
+    if self.__max_size is not None and (
+        self.__size > self.__max_size or self.__decompressor.unconsumed_tail):
+      raise ContentTooLargeError(
+        'Decompressed %s content exceeds %d bytes' %
+        (self.__encoding, self.__max_size))
+    return result
+
+  def __decompress(self, data):
+    """Decompress data producing at most one byte over the maximum size."""
+    if self.__max_size is None:
+      return self.__decompressor.decompress(data)
+    return self.__decompressor.decompress(
+      data, self.__max_size - self.__size + 1)
+
+  def decompress(self, data):
+    """Decompress a chunk of data.
+
+    Raises:
+      DecompressionError if data is not valid for the content coding.
+      ContentTooLargeError if the decompressed content exceeds the maximum
+        size.
+    """
+    try:
+      try:
+        result = self.__decompress(data)
+      except zlib.error:
+        if self.__started or self.__encoding != DEFLATE:
+          raise
+        self.__decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        result = self.__decompress(data)
+    except zlib.error as err:
+      raise DecompressionError('Invalid %s content: %s' %
+                               (self.__encoding, err))
+    if data:
+      self.__started = True
+    return self.__check_size(result)
+
+  def flush(self):
+    """Get remaining decompressed data.
+
+    Raises:
+      DecompressionError if the compressed data is incomplete.
+      ContentTooLargeError if the decompressed content exceeds the maximum
+        size.
+    """
+    try:
+      result = self.__check_size(self.__decompressor.flush())
+    except zlib.error as err:
+      raise DecompressionError('Invalid %s content: %s' %
+                               (self.__encoding, err))
+    # Python 2 decompression objects can not tell whether the end of the
+    # compressed data was reached.
+    if self.__started and not getattr(self.__decompressor, 'eof', True):
+      raise DecompressionError('Truncated %s content' % self.__encoding)
+    return result
+
+
+def new_decompressor(encoding, max_size=None):
+  """Create an incremental decompressor for a content coding.
+
+  Args:
+    encoding: Content coding to decompress, GZIP or DEFLATE.
+    max_size: Maximum number of bytes of decompressed content, or None for
+      no limit.
+
+  Returns:
+    Object with decompress(data) and flush() methods like zlib decompression
+    objects, raising DecompressionError for invalid content and
+    ContentTooLargeError once more than max_size bytes are decompressed.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+  """
+  return _Decompressor(encoding, max_size=max_size)
+
+
+def compress(content, encoding):
+  """Compress content.
+
+  Args:
+    content: Content to compress.  Unicode content is encoded as UTF-8.
+    encoding: Content coding to produce, GZIP or DEFLATE.
+
+  Returns:
+    Compressed content as bytes.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+  """
+  compressor = new_compressor(encoding)
+  return compressor.compress(_to_bytes(content)) + compressor.flush()
+
+
+def compress_chunks(content, encoding, chunk_size=DEFAULT_CHUNK_SIZE):
+  """Compress content in chunks.
+
+  Args:
+    content: Content to compress.  Unicode content is encoded as UTF-8.
+    encoding: Content coding to produce, GZIP or DEFLATE.
+    chunk_size: Number of bytes of content to compress at a time.
+
+  Returns:
+    Iterator over non-empty chunks of compressed content.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+  """
+  compressor = new_compressor(encoding)
+  content = _to_bytes(content)
+
+  def chunks():
+    for start in range(0, len(content), chunk_size):
+      compressed = compressor.compress(content[start:start + chunk_size])
+      if compressed:
+        yield compressed
+    yield compressor.flush()
+  return chunks()
+
+
+def decompress(content, encoding, max_size=None):
+  """Decompress content.
+
+  Args:
+    content: Compressed content as bytes.
+    encoding: Content coding of content, GZIP or DEFLATE.
+    max_size: Maximum number of bytes of decompressed content, or None for
+      no limit.
+
+  Returns:
+    Decompressed content as bytes.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+    DecompressionError if content is not valid for the content coding.
+    ContentTooLargeError if the decompressed content exceeds max_size.
+  """
+  decompressor = new_decompressor(encoding, max_size=max_size)
+  return decompressor.decompress(content) + decompressor.flush()
+
+
+def decompress_stream(stream, encoding, length=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE, max_size=None):
+  """Read and decompress content from a file-like object.
+
+  Content is read and decompressed in chunks so that the complete compressed
+  content is never held in memory.
+
+  Args:
+    stream: File-like object to read compressed content from.
+    encoding: Content coding of content, GZIP or DEFLATE.
+    length: Number of bytes to read from stream.  When None, read until the
+      end of the stream.
+    chunk_size: Number of bytes to read at a time.
+    max_size: Maximum number of bytes of decompressed content, or None for
+      no limit.
+
+  Returns:
+    Decompressed content as bytes.
+
+  Raises:
+    UnsupportedEncodingError when encoding is not supported.
+    DecompressionError if content is not valid for the content coding.
+    ContentTooLargeError if the decompressed content exceeds max_size.  No
+      more than max_size bytes are held in memory when it is raised.
+  """
+  decompressor = new_decompressor(encoding, max_size=max_size)
+  chunks = []
+  remaining = length
+  while remaining is None or remaining > 0:
+    size = chunk_size if remaining is None else min(chunk_size, remaining)
+    data = stream.read(size)
+    if not data:
+      break
+    if remaining is not None:
+      remaining -= len(data)
+    chunks.append(decompressor.decompress(data))
+  chunks.append(decompressor.flush())
+  return b''.join(chunks)
+
+
+def select_encoding(accept_encoding, encodings=SUPPORTED_ENCODINGS):
+  """Select content coding to respond with.
+
+  Args:
+    accept_encoding: Value of Accept-Encoding header, or None if the header
+      was not sent.
+    encodings: Content codings the server is willing to use in order of
+      preference.
+
+  Returns:
+    The acceptable coding from encodings with the highest quality value, ties
+    going to the first in encodings.  None if the content should not be
+    compressed.
+  """
+  if not accept_encoding or not encodings:
+    return None
+
+  qualities = {}
+  for item in accept_encoding.split(','):
+    parameters = item.split(';')
+    coding = parameters[0].strip().lower()
+    if not coding:
+      continue
+    q = 1.0
+    for parameter in parameters[1:]:
+      name, _, value = parameter.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    qualities[coding] = q
+
+  best_encoding = None
+  best_q = 0.0
+  for encoding in encodings:
+    q = qualities.get(encoding, qualities.get('*', 0.0))
+    if q > best_q:
+      best_encoding, best_q = encoding, q
+  if best_encoding is not None and qualities.get(IDENTITY, 0.0) > best_q:
+    return None
+  return best_encoding
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for protorpc.compression."""
+
+import gzip
+import io
+import unittest
+import zlib
+
+from protorpc import compression
+from protorpc import test_util
+
+
+CONTENT = b'{"values": [' + b', '.join([b'"a value"'] * 1000) + b']}'
+
+
+class ModuleInterfaceTest(test_util.ModuleInterfaceTest,
+                          test_util.TestCase):
+
+  MODULE = compression
+
+
+class CompressTest(test_util.TestCase):
+
+  def testGzip(self):
+    compressed = compression.compress(CONTENT, compression.GZIP)
+    self.assertLess(len(compressed), len(CONTENT) / 10)
+    self.assertEquals(CONTENT,
+                      gzip.GzipFile(fileobj=io.BytesIO(compressed)).read())
+    self.assertEquals(CONTENT,
+                      compression.decompress(compressed, compression.GZIP))
+
+  def testDeflate(self):
+    compressed = compression.compress(CONTENT, compression.DEFLATE)
+    self.assertEquals(CONTENT, zlib.decompress(compressed))
+    self.assertEquals(CONTENT,
+                      compression.decompress(compressed, compression.DEFLATE))
+
+  def testRawDeflate(self):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(CONTENT) + compressor.flush()
+    self.assertEquals(CONTENT,
+                      compression.decompress(compressed, compression.DEFLATE))
+
+  def testUnicode(self):
+    compressed = compression.compress(u'\xe9t\xe9', compression.GZIP)
+    self.assertEquals(u'\xe9t\xe9'.encode('utf-8'),
+                      compression.decompress(compressed, compression.GZIP))
+
+  def testCompressChunks(self):
+    chunks = list(compression.compress_chunks(CONTENT, compression.GZIP,
+                                              chunk_size=100))
+    self.assertTrue(all(chunks[:-1]))
+    self.assertEquals(CONTENT, compression.decompress(b''.join(chunks),
+                                                      compression.GZIP))
+
+  def testDecompressStream(self):
+    compressed = compression.compress(CONTENT, compression.GZIP)
+    stream = io.BytesIO(compressed + b'trailing')
+    self.assertEquals(CONTENT,
+                      compression.decompress_stream(stream, compression.GZIP,
+                                                    length=len(compressed),
+                                                    chunk_size=10))
+    self.assertEquals(b'trailing', stream.read())
+
+  def testDecompressStreamToEnd(self):
+    compressed = compression.compress(CONTENT, compression.DEFLATE)
+    self.assertEquals(CONTENT,
+                      compression.decompress_stream(io.BytesIO(compressed),
+                                                    compression.DEFLATE,
+                                                    chunk_size=10))
+
+  def testMaxSize(self):
+    compressed = compression.compress(CONTENT, compression.GZIP)
+    self.assertEquals(CONTENT,
+                      compression.decompress(compressed, compression.GZIP,
+                                             max_size=len(CONTENT)))
+    self.assertRaisesWithRegexpMatch(
+      compression.ContentTooLargeError,
+      'Decompressed gzip content exceeds %d bytes' % (len(CONTENT) - 1),
+      compression.decompress, compressed, compression.GZIP,
+      max_size=len(CONTENT) - 1)
+
+  def testDecompressStreamMaxSize(self):
+    bomb = compression.compress(b'\0' * (10 * 1024 * 1024),
+                                compression.DEFLATE)
+    decompressor = compression.new_decompressor(compression.DEFLATE,
+                                                max_size=1000)
+    self.assertRaises(compression.ContentTooLargeError,
+                      decompressor.decompress, bomb)
+    self.assertRaises(compression.ContentTooLargeError,
+                      compression.decompress_stream, io.BytesIO(bomb),
+                      compression.DEFLATE, chunk_size=10, max_size=1000)
+
+  def testInvalidContent(self):
+    self.assertRaises(compression.DecompressionError,
+                      compression.decompress, b'not compressed',
+                      compression.GZIP)
+    self.assertRaises(compression.DecompressionError,
+                      compression.decompress, b'not compressed',
+                      compression.DEFLATE)
+
+  def testUnsupportedEncoding(self):
+    self.assertRaisesWithRegexpMatch(
+      compression.UnsupportedEncodingError,
+      'Unsupported content encoding: br',
+      compression.compress, CONTENT, 'br')
+    self.assertRaises(compression.UnsupportedEncodingError,
+                      compression.decompress, CONTENT, 'br')
+
+
+class SelectEncodingTest(test_util.TestCase):
+
+  def testNoHeader(self):
+    self.assertEquals(None, compression.select_encoding(None))
+    self.assertEquals(None, compression.select_encoding(''))
+
+  def testServerPreference(self):
+    self.assertEquals('gzip', compression.select_encoding('deflate, gzip'))
+    self.assertEquals('deflate',
+                      compression.select_encoding('deflate, gzip',
+                                                  ('deflate', 'gzip')))
+
+  def testQuality(self):
+    self.assertEquals('deflate',
+                      compression.select_encoding('gzip;q=0.5, deflate'))
+    self.assertEquals('deflate',
+                      compression.select_encoding('gzip; q=0, deflate'))
+    self.assertEquals(None, compression.select_encoding('gzip;q=0'))
+    self.assertEquals(None, compression.select_encoding('gzip;q=bad'))
+
+  def testWildcard(self):
+    self.assertEquals('gzip', compression.select_encoding('*'))
+    self.assertEquals('deflate',
+                      compression.select_encoding('gzip;q=0, *;q=0.1'))
+
+  def testIdentityPreferred(self):
+    self.assertEquals(None,
+                      compression.select_encoding('identity, gzip;q=0.5'))
+
+  def testUnknownEncodings(self):
+    self.assertEquals(None, compression.select_encoding('br, compress'))
+
+  def testNoEncodings(self):
+    self.assertEquals(None, compression.select_encoding('gzip', ()))
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
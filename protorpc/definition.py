@@ -20,7 +20,10 @@ import six
 
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
+import mmap
+import os
 import sys
+import threading
 import types
 
 from . import descriptor
@@ -38,6 +41,7 @@ __all__ = [
     'define_service',
     'import_file',
     'import_file_set',
+    'MappedFileSet',
 ]
 
 
@@ -63,12 +67,85 @@ _MESSAGE_TYPE_MAP = {
 }
 
 
-def _get_or_define_module(full_name, modules):
+# Guards definition of classes in lazily imported modules.  Re-entrant because
+# defining a service may define message classes of other lazy modules.
+_lazy_definition_lock = threading.RLock()
+
+
+class _LazyModule(types.ModuleType):
+  """Module that defines its contents on first access.
+
+  File descriptors added to the module are not decoded and no classes are
+  defined until an attribute that is not yet present is requested.  Only the
+  requested enum, message or service class is then defined.  Services and
+  string-typed fields find their dependencies through attribute access, so
+  they are defined on demand as well.
+  """
+
+  def __init__(self, name):
+    super(_LazyModule, self).__init__(name)
+    self.__file_loaders = []
+    self.__definitions = {}
+
+  def add_file(self, load_file_descriptor):
+    """Add file whose definitions belong to this module.
+
+    Args:
+      load_file_descriptor: Function taking no arguments that returns the
+        FileDescriptor to define classes from.
+    """
+    with _lazy_definition_lock:
+      self.__file_loaders.append(load_file_descriptor)
+
+  def __load_definitions(self):
+    """Map definition names of pending files to their descriptors."""
+    while self.__file_loaders:
+      file_descriptor = self.__file_loaders.pop(0)()
+      for enum_descriptor in file_descriptor.enum_types or []:
+        self.__definitions[enum_descriptor.name] = (
+          define_enum, enum_descriptor, self.__name__)
+      for message_descriptor in file_descriptor.message_types or []:
+        self.__definitions[message_descriptor.name] = (
+          define_message, message_descriptor, self.__name__)
+      for service_descriptor in file_descriptor.service_types or []:
+        self.__definitions[service_descriptor.name] = (
+          define_service, service_descriptor, self)
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+
+    with _lazy_definition_lock:
+      # Another thread may have defined it while waiting for the lock.
+      try:
+        return self.__dict__[name]
+      except KeyError:
+        pass
+
+      self.__load_definitions()
+      try:
+        define, definition_descriptor, context = self.__definitions.pop(name)
+      except KeyError:
+        raise AttributeError('Module %s has no attribute %s' %
+                             (self.__name__, name))
+
+      definition = define(definition_descriptor, context)
+      setattr(self, name, definition)
+      return definition
+
+  def __dir__(self):
+    with _lazy_definition_lock:
+      self.__load_definitions()
+      return sorted(set(self.__dict__) | set(self.__definitions))
+
+
+def _get_or_define_module(full_name, modules, module_type=types.ModuleType):
   """Helper method for defining new modules.
 
   Args:
     full_name: Fully qualified name of module to create or return.
     modules: Dictionary of all modules.  Defaults to sys.modules.
+    module_type: Class of newly created modules.
 
   Returns:
     Named module if found in 'modules', else creates new module and inserts in
@@ -76,13 +153,14 @@ def _get_or_define_module(full_name, modules):
   """
   module = modules.get(full_name)
   if not module:
-    module = types.ModuleType(full_name)
+    module = module_type(full_name)
     modules[full_name] = module
 
     split_name = full_name.rsplit('.', 1)
     if len(split_name) > 1:
       parent_module_name, sub_module_name = split_name
-      parent_module = _get_or_define_module(parent_module_name, modules)
+      parent_module = _get_or_define_module(parent_module_name, modules,
+                                            module_type)
       setattr(parent_module, sub_module_name, module)
 
   return module
@@ -123,6 +201,8 @@ def define_field(field_descriptor):
     params['required'] = True
   elif field_descriptor.label == descriptor.FieldDescriptor.Label.REPEATED:
     params['repeated'] = True
+    if field_descriptor.packed:
+      params['packed'] = True
 
   message_type_field = _MESSAGE_TYPE_MAP.get(field_descriptor.type_name)
   if message_type_field:
@@ -262,10 +342,179 @@ def import_file(file_descriptor, modules=None):
   return define_file(file_descriptor, module)
 
 
+def _read_varint(buffer, position):
+  """Read unsigned varint from buffer.
+
+  Args:
+    buffer: Bytes or memory map to read from.
+    position: Offset of varint in buffer.
+
+  Returns:
+    Tuple (value, position after varint).
+
+  Raises:
+    messages.DecodeError if buffer ends before the varint does.
+  """
+  value = 0
+  shift = 0
+  while True:
+    if position >= len(buffer):
+      raise messages.DecodeError('Truncated varint')
+    byte = six.indexbytes(buffer, position)
+    position += 1
+    value |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return value, position
+    shift += 7
+
+
+def _read_fields(buffer, start, end):
+  """Iterate over the top level fields of an encoded message.
+
+  Args:
+    buffer: Bytes or memory map containing encoded message.
+    start: Offset of message in buffer.
+    end: Offset of end of message in buffer.
+
+  Yields:
+    Tuple (field number, start, end) for each length delimited field, where
+    start and end delimit the field content.  Other fields are skipped.
+
+  Raises:
+    messages.DecodeError if message is truncated or malformed.
+  """
+  position = start
+  while position < end:
+    tag, position = _read_varint(buffer, position)
+    number = tag >> protobuf._WIRE_TYPE_BITS
+    wire_type = tag & protobuf._WIRE_TYPE_MASK
+    if wire_type == protobuf._Encoder.NUMERIC:
+      _, position = _read_varint(buffer, position)
+    elif wire_type == protobuf._Encoder.DOUBLE:
+      position += 8
+    elif wire_type == protobuf._Encoder.FLOAT:
+      position += 4
+    elif wire_type == protobuf._Encoder.STRING:
+      length, position = _read_varint(buffer, position)
+      if position + length <= end:
+        yield number, position, position + length
+      position += length
+    else:
+      raise messages.DecodeError('No such wire type %d' % wire_type)
+
+    if position > end:
+      raise messages.DecodeError('Truncated message')
+
+
+class MappedFileSet(object):
+  """Serialized FileSet read through a memory map.
+
+  Opening a mapped file set only scans the package name of each contained
+  file.  Pages of the file are read by the operating system as they are
+  touched, and a FileDescriptor is only decoded when it is loaded, so
+  processes using a few packages of a large file set pay for little more
+  than those packages.
+
+  Usage:
+    file_set = MappedFileSet('api.fileset')
+    for package, load_file_descriptor in file_set.file_loaders():
+      if package == 'my.package':
+        file_descriptor = load_file_descriptor()
+  """
+
+  def __init__(self, file_name):
+    """Constructor.
+
+    Args:
+      file_name: Name of file containing a protobuf encoded FileSet.
+
+    Raises:
+      messages.DecodeError if the file is not a well formed FileSet.
+    """
+    encoded_file = open(file_name, 'rb')
+    try:
+      if os.fstat(encoded_file.fileno()).st_size:
+        self.__buffer = mmap.mmap(encoded_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+      else:
+        # Empty files can not be mapped.
+        self.__buffer = b''
+    finally:
+      encoded_file.close()
+
+    self.__files = []
+    package_number = descriptor.FileDescriptor.package.number
+    files_number = descriptor.FileSet.files.number
+    for number, start, end in _read_fields(self.__buffer, 0,
+                                           len(self.__buffer)):
+      if number == files_number:
+        package = None
+        for number, package_start, package_end in _read_fields(self.__buffer,
+                                                               start, end):
+          if number == package_number:
+            package = self.__buffer[package_start:package_end].decode('utf-8')
+        self.__files.append((package, start, end))
+
+  def __len__(self):
+    return len(self.__files)
+
+  @property
+  def packages(self):
+    """Package names of all files in the order they appear."""
+    return [package for package, _, _ in self.__files]
+
+  def load_file_descriptor(self, index):
+    """Decode a single file of the file set.
+
+    Args:
+      index: Position of file in file set.
+
+    Returns:
+      Decoded FileDescriptor instance.
+    """
+    _, start, end = self.__files[index]
+    return protobuf.decode_message(descriptor.FileDescriptor,
+                                   self.__buffer[start:end])
+
+  def file_loaders(self):
+    """Get loaders for all files in the file set.
+
+    Returns:
+      List of tuples (package, load_file_descriptor) where
+      load_file_descriptor is a function taking no arguments that decodes
+      and returns the FileDescriptor of the file.
+    """
+    def loader(index):
+      return lambda: self.load_file_descriptor(index)
+    return [(package, loader(index))
+            for index, package in enumerate(self.packages)]
+
+  def decode(self):
+    """Decode the whole file set.
+
+    Returns:
+      FileSet instance containing all files.
+    """
+    return descriptor.FileSet(
+      files=[self.load_file_descriptor(index) for index in range(len(self))])
+
+
 @util.positional(1)
-def import_file_set(file_set, modules=None, _open=open):
+def import_file_set(file_set, modules=None, lazy=False, _open=open):
   """Import FileSet in to module space.
 
+  When importing lazily, modules are created up front but the files
+  describing them are neither decoded nor defined until an attribute of the
+  module is accessed, and then only the accessed definition and the
+  definitions it depends on are created.  A lazily imported file set that is
+  given by file name is read through a memory map (see MappedFileSet).
+  Definitions for modules that already exist in modules and were not created
+  by a lazy import are defined immediately.
+
+  When importing immediately into sys.modules, the types of all message and
+  enum fields are resolved once every file of the set has been imported, see
+  messages.resolve_definitions.
+
   Args:
     file_set: If string, open file and read serialized FileSet.  Otherwise,
       a FileSet instance to import definitions from.
@@ -273,8 +522,37 @@ def import_file_set(file_set, modules=None, _open=open):
       do not exist will be created.  If an existing module is found that
       matches file_descriptor.package, that module is updated with the
       FileDescriptor contents.
+    lazy: Define classes on first access rather than immediately.
     _open: Used for dependency injection during tests.
+
+  Raises:
+    messages.DefinitionNotFoundError if a type referred to by a field of an
+      immediately imported file set can not be found.
   """
+  if lazy:
+    if isinstance(file_set, six.string_types):
+      file_loaders = MappedFileSet(file_set).file_loaders()
+    else:
+      file_loaders = [(file_descriptor.package,
+                       lambda file_descriptor=file_descriptor: file_descriptor)
+                      for file_descriptor in file_set.files]
+
+    if modules is None:
+      modules = sys.modules
+
+    for package, load_file_descriptor in file_loaders:
+      if not package:
+        raise ValueError('File descriptor must have package name')
+      # Do not reload built in protorpc classes.
+      if not package.startswith('protorpc.'):
+        module = _get_or_define_module(package.encode('utf-8'), modules,
+                                       _LazyModule)
+        if isinstance(module, _LazyModule):
+          module.add_file(load_file_descriptor)
+        else:
+          define_file(load_file_descriptor(), module)
+    return
+
   if isinstance(file_set, six.string_types):
     encoded_file = _open(file_set, 'rb')
     try:
@@ -284,7 +562,14 @@ def import_file_set(file_set, modules=None, _open=open):
 
     file_set = protobuf.decode_message(descriptor.FileSet, encoded_file_set)
 
+  imported_modules = []
   for file_descriptor in file_set.files:
     # Do not reload built in protorpc classes.
     if not file_descriptor.package.startswith('protorpc.'):
-      import_file(file_descriptor, modules=modules)
+      imported_modules.append(import_file(file_descriptor, modules=modules))
+
+  # Types are found through sys.modules, so they can only be resolved up
+  # front once all files of the set have been imported there.
+  if modules is None or modules is sys.modules:
+    for module in imported_modules:
+      messages.resolve_definitions(module)
@@ -21,7 +21,10 @@ __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
 import StringIO
+import os
+import shutil
 import sys
+import tempfile
 import types
 import unittest
 
@@ -145,6 +148,22 @@ class DefineFieldTest(test_util.TestCase):
     self.assertFalse(field.required)
     self.assertTrue(field.repeated)
 
+  def testDefineField_Packed(self):
+    """Test defining a packed field instance from a method descriptor."""
+    field_descriptor = descriptor.FieldDescriptor()
+
+    field_descriptor.name = 'a_field'
+    field_descriptor.number = 1
+    field_descriptor.variant = descriptor.FieldDescriptor.Variant.INT64
+    field_descriptor.label = descriptor.FieldDescriptor.Label.REPEATED
+    field_descriptor.packed = True
+
+    field = definition.define_field(field_descriptor)
+
+    self.assertTrue(isinstance(field, messages.IntegerField))
+    self.assertTrue(field.repeated)
+    self.assertTrue(field.packed)
+
   def testDefineField_Message(self):
     """Test defining a message field."""
     field_descriptor = descriptor.FieldDescriptor()
@@ -653,5 +672,161 @@ class ModuleTest(test_util.TestCase):
                           ]))
 
 
+
+def make_stocks_file_set():
+  """Make FileSet describing a small stocks service and an unrelated file."""
+  symbols = descriptor.FieldDescriptor(
+    name=u'symbols', number=1,
+    label=descriptor.FieldDescriptor.Label.REPEATED,
+    variant=messages.Variant.STRING)
+  request = descriptor.MessageDescriptor(name=u'GetQuoteRequest',
+                                         fields=[symbols])
+
+  quote = descriptor.FieldDescriptor(
+    name=u'quote', number=1,
+    label=descriptor.FieldDescriptor.Label.OPTIONAL,
+    variant=messages.Variant.MESSAGE,
+    type_name=u'Quote')
+  response = descriptor.MessageDescriptor(name=u'GetQuoteResponse',
+                                          fields=[quote])
+
+  price = descriptor.FieldDescriptor(
+    name=u'price', number=1,
+    label=descriptor.FieldDescriptor.Label.OPTIONAL,
+    variant=messages.Variant.INT64)
+  quote_message = descriptor.MessageDescriptor(name=u'Quote', fields=[price])
+
+  exchange = descriptor.EnumDescriptor(
+    name=u'Exchange',
+    values=[descriptor.EnumValueDescriptor(name=u'NYSE', number=1)])
+
+  method = descriptor.MethodDescriptor(name=u'get_quote',
+                                       request_type=u'GetQuoteRequest',
+                                       response_type=u'GetQuoteResponse')
+  service = descriptor.ServiceDescriptor(name=u'Stocks', methods=[method])
+
+  stocks = descriptor.FileDescriptor(
+    package=u'lazy.stocks',
+    enum_types=[exchange],
+    message_types=[request, response, quote_message],
+    service_types=[service])
+  other = descriptor.FileDescriptor(
+    package=u'lazy.other',
+    message_types=[descriptor.MessageDescriptor(name=u'Other')])
+  return descriptor.FileSet(files=[stocks, other])
+
+
+class LazyImportFileSetTest(test_util.TestCase):
+  """Test lazy importation of file sets."""
+
+  def setUp(self):
+    self.file_set = make_stocks_file_set()
+    self.temp_dir = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.temp_dir, 'stocks.fileset')
+    with open(self.file_name, 'wb') as encoded_file:
+      encoded_file.write(protobuf.encode_message(self.file_set))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+    for name in ('lazy', 'lazy.stocks', 'lazy.other'):
+      sys.modules.pop(name, None)
+
+  def CheckLazyImport(self, modules):
+    stocks = modules['lazy.stocks']
+    self.assertEquals(stocks, modules['lazy'].stocks)
+    self.assertFalse('Quote' in stocks.__dict__)
+    self.assertFalse('Stocks' in stocks.__dict__)
+
+    service_class = stocks.Stocks
+    self.assertTrue(issubclass(service_class, remote.Service))
+    self.assertEquals(stocks.GetQuoteRequest,
+                      service_class.get_quote.remote.request_type)
+    self.assertFalse('Quote' in stocks.__dict__)
+    self.assertFalse('Other' in modules['lazy.other'].__dict__)
+
+    response = stocks.GetQuoteResponse(quote=stocks.Quote(price=10))
+    self.assertEquals('lazy.stocks', stocks.Quote.__module__)
+    self.assertEquals(10, response.quote.price)
+    self.assertEquals(1, stocks.Exchange.NYSE.number)
+    self.assertTrue(stocks.Quote is stocks.Quote)
+
+  def testImportFileSet(self):
+    definition.import_file_set(self.file_set, lazy=True)
+    self.CheckLazyImport(sys.modules)
+
+  def testImportFileSetFromFile(self):
+    definition.import_file_set(self.file_name, lazy=True)
+    self.CheckLazyImport(sys.modules)
+
+  def testDir(self):
+    modules = {}
+    definition.import_file_set(self.file_set, modules=modules, lazy=True)
+    names = dir(modules['lazy.stocks'])
+    for name in ('Exchange', 'GetQuoteRequest', 'Quote', 'Stocks'):
+      self.assertTrue(name in names)
+    self.assertFalse('Quote' in modules['lazy.stocks'].__dict__)
+
+  def testNoSuchAttribute(self):
+    modules = {}
+    definition.import_file_set(self.file_set, modules=modules, lazy=True)
+    self.assertRaises(AttributeError, getattr, modules['lazy.stocks'],
+                      'Unknown')
+    self.assertFalse(hasattr(modules['lazy.stocks'], '__path__'))
+
+  def testImportInToExisting(self):
+    """Existing modules are not lazy and get their definitions right away."""
+    stocks = types.ModuleType('lazy.stocks')
+    modules = {'lazy.stocks': stocks}
+    definition.import_file_set(self.file_set, modules=modules, lazy=True)
+    self.assertTrue('Quote' in stocks.__dict__)
+    self.assertFalse('Other' in modules['lazy.other'].__dict__)
+
+  def testNoPackage(self):
+    self.file_set.files[1].package = None
+    self.assertRaises(ValueError, definition.import_file_set, self.file_set,
+                      modules={}, lazy=True)
+
+
+class MappedFileSetTest(test_util.TestCase):
+  """Test reading file sets through a memory map."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.temp_dir, 'my.fileset')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def WriteFile(self, content):
+    with open(self.file_name, 'wb') as encoded_file:
+      encoded_file.write(content)
+
+  def testMappedFileSet(self):
+    file_set = make_stocks_file_set()
+    self.WriteFile(protobuf.encode_message(file_set))
+    mapped_file_set = definition.MappedFileSet(self.file_name)
+    self.assertEquals(2, len(mapped_file_set))
+    self.assertEquals([u'lazy.stocks', u'lazy.other'],
+                      mapped_file_set.packages)
+    self.assertEquals(file_set.files[1],
+                      mapped_file_set.load_file_descriptor(1))
+    self.assertEquals(file_set, mapped_file_set.decode())
+    [(package, load_file_descriptor), _] = mapped_file_set.file_loaders()
+    self.assertEquals(u'lazy.stocks', package)
+    self.assertEquals(file_set.files[0], load_file_descriptor())
+
+  def testEmptyFile(self):
+    self.WriteFile(b'')
+    mapped_file_set = definition.MappedFileSet(self.file_name)
+    self.assertEquals(0, len(mapped_file_set))
+    self.assertEquals(descriptor.FileSet(), mapped_file_set.decode())
+
+  def testTruncated(self):
+    encoded_file_set = protobuf.encode_message(make_stocks_file_set())
+    self.WriteFile(encoded_file_set[:-3])
+    self.assertRaises(messages.DecodeError,
+                      definition.MappedFileSet, self.file_name)
+
+
 if __name__ == '__main__':
   unittest.main()
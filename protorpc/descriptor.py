@@ -96,19 +96,33 @@ Public Functions:
   describe_message: Describe a Message definition.
   describe_method: Describe a Method definition.
   describe_service: Describe a Service definition.
+
+Descriptors of Enum, Message and Service classes and of modules are cached
+for the whole process, because classes do not change after they are defined.
+The cached descriptors are shared by all callers and must not be modified.
+A module is described again when its definitions change, for example when it
+is reloaded.
 """
 import six
 
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 import codecs
+import collections
+import sys
+import threading
+import time
 import types
+import weakref
 
 from . import messages
 from . import util
 
 
-__all__ = ['EnumDescriptor',
+__all__ = ['DEFAULT_MAX_LIBRARY_SIZE',
+           'DEFAULT_NEGATIVE_CACHE_TTL',
+
+           'EnumDescriptor',
            'EnumValueDescriptor',
            'FieldDescriptor',
            'MessageDescriptor',
@@ -131,6 +145,13 @@ __all__ = ['EnumDescriptor',
           ]
 
 
+# Maximum number of loaded descriptors kept by a DescriptorLibrary.
+DEFAULT_MAX_LIBRARY_SIZE = 1000
+
+# Seconds a DescriptorLibrary remembers that a definition name was not found.
+DEFAULT_NEGATIVE_CACHE_TTL = 60
+
+
 # NOTE: MessageField is missing because message fields cannot have
 # a default value at this time.
 # TODO(rafek): Support default message values.
@@ -157,6 +178,58 @@ _DEFAULT_FROM_STRING_MAP = {
 }
 
 
+class _DescriptorCache(object):
+  """Thread-safe cache of descriptors weakly keyed by the described class."""
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__descriptors = weakref.WeakKeyDictionary()
+
+  def get(self, definition):
+    with self.__lock:
+      return self.__descriptors.get(definition)
+
+  def put(self, definition, descriptor):
+    with self.__lock:
+      self.__descriptors[definition] = descriptor
+
+  def clear(self):
+    with self.__lock:
+      self.__descriptors.clear()
+
+
+_enum_descriptors = _DescriptorCache()
+_message_descriptors = _DescriptorCache()
+_service_descriptors = _DescriptorCache()
+
+# Python 2 modules can not be weakly referenced, so file descriptors are kept
+# by module name as tuples (module id, package, definition refs, descriptor),
+# where definition refs are weak references to the definitions the descriptor
+# was built from.  Entries do not keep modules or definitions alive and are
+# dropped once a definition is collected or the module is replaced in
+# sys.modules.
+_file_descriptors_lock = threading.Lock()
+_file_descriptors = {}
+
+
+def _file_descriptor_stale(name, entry):
+  """Determine whether a cached file descriptor entry is stale.
+
+  Args:
+    name: Name of module the entry is cached under.
+    entry: Cached (module id, package, definition refs, descriptor) tuple.
+
+  Returns:
+    True if a definition the entry was built from has been collected or a
+    different module of the same name has replaced it in sys.modules.
+  """
+  module_id, unused_package, definition_refs, unused_descriptor = entry
+  current = sys.modules.get(name)
+  if current is not None and id(current) != module_id:
+    return True
+  return any(ref() is None for ref in definition_refs)
+
+
 class EnumValueDescriptor(messages.Message):
   """Enum value descriptor.
 
@@ -198,6 +271,7 @@ class FieldDescriptor(messages.Message):
     variant: Variant of field.
     type_name: Type name for message and enum fields.
     default_value: String representation of default value.
+    packed: Whether values of repeated numeric field are packed.
   """
 
   Variant = messages.Variant
@@ -223,6 +297,7 @@ class FieldDescriptor(messages.Message):
   # For bytes, contains the C escaped value.  All bytes < 128 are that are
   #   traditionally considered unprintable are also escaped.
   default_value = messages.StringField(7)
+  packed = messages.BooleanField(8)
 
 
 class MessageDescriptor(messages.Message):
@@ -322,8 +397,13 @@ def describe_enum(enum_definition):
     enum_definition: Enum class to provide descriptor for.
 
   Returns:
-    Initialized EnumDescriptor instance describing the Enum class.
+    Initialized EnumDescriptor instance describing the Enum class.  The
+    descriptor is cached and must not be modified.
   """
+  enum_descriptor = _enum_descriptors.get(enum_definition)
+  if enum_descriptor is not None:
+    return enum_descriptor
+
   enum_descriptor = EnumDescriptor()
   enum_descriptor.name = enum_definition.definition_name().split('.')[-1]
 
@@ -335,6 +415,7 @@ def describe_enum(enum_definition):
   if values:
     enum_descriptor.values = values
 
+  _enum_descriptors.put(enum_definition, enum_descriptor)
   return enum_descriptor
 
 
@@ -365,6 +446,8 @@ def describe_field(field_definition):
   # Set label.
   if field_definition.repeated:
     field_descriptor.label = FieldDescriptor.Label.REPEATED
+    if field_definition.packed:
+      field_descriptor.packed = True
   elif field_definition.required:
     field_descriptor.label = FieldDescriptor.Label.REQUIRED
   else:
@@ -380,8 +463,13 @@ def describe_message(message_definition):
     message_definition: Message class to provide descriptor for.
 
   Returns:
-    Initialized MessageDescriptor instance describing the Message class.
+    Initialized MessageDescriptor instance describing the Message class.  The
+    descriptor is cached and must not be modified.
   """
+  message_descriptor = _message_descriptors.get(message_definition)
+  if message_descriptor is not None:
+    return message_descriptor
+
   message_descriptor = MessageDescriptor()
   message_descriptor.name = message_definition.definition_name().split('.')[-1]
 
@@ -414,6 +502,7 @@ def describe_message(message_definition):
 
     message_descriptor.enum_types = enum_descriptors
 
+  _message_descriptors.put(message_definition, message_descriptor)
   return message_descriptor
 
 
@@ -442,8 +531,13 @@ def describe_service(service_class):
     service_class: Service class to describe.
 
   Returns:
-    Initialized ServiceDescriptor instance describing the service.
+    Initialized ServiceDescriptor instance describing the service.  The
+    descriptor is cached and must not be modified.
   """
+  descriptor = _service_descriptors.get(service_class)
+  if descriptor is not None:
+    return descriptor
+
   descriptor = ServiceDescriptor()
   descriptor.name = service_class.__name__
   methods = []
@@ -457,6 +551,7 @@ def describe_service(service_class):
   if methods:
     descriptor.methods = methods
 
+  _service_descriptors.put(service_class, descriptor)
   return descriptor
 
 
@@ -467,7 +562,8 @@ def describe_file(module):
     module: Python module to describe.
 
   Returns:
-    Initialized FileDescriptor instance describing the module.
+    Initialized FileDescriptor instance describing the module.  The
+    descriptor is cached and must not be modified.
   """
   # May not import remote at top of file because remote depends on this
   # file
@@ -475,31 +571,47 @@ def describe_file(module):
   # from descriptor to their own module.
   from . import remote
 
-  descriptor = FileDescriptor()
-  descriptor.package = util.get_package_for_module(module)
-
-  if not descriptor.package:
-    descriptor.package = None
-
-  message_descriptors = []
-  enum_descriptors = []
-  service_descriptors = []
+  package = util.get_package_for_module(module) or None
 
   # Need to iterate over all top level attributes of the module looking for
   # message, enum and service definitions.  Each definition must be itself
   # described.
+  definitions = []
   for name in sorted(dir(module)):
     value = getattr(module, name)
 
-    if isinstance(value, type):
-      if issubclass(value, messages.Message):
-        message_descriptors.append(describe_message(value))
+    if isinstance(value, type) and issubclass(value, (messages.Message,
+                                                      messages.Enum,
+                                                      remote.Service)):
+      definitions.append(value)
+
+  with _file_descriptors_lock:
+    cached = _file_descriptors.get(module.__name__)
+  if cached is not None:
+    cached_module_id, cached_package, cached_refs, descriptor = cached
+    if (cached_module_id == id(module) and
+        cached_package == package and
+        len(cached_refs) == len(definitions) and
+        all(ref() is current for ref, current
+            in zip(cached_refs, definitions))):
+      return descriptor
+
+  descriptor = FileDescriptor()
+  descriptor.package = package
+
+  message_descriptors = []
+  enum_descriptors = []
+  service_descriptors = []
+
+  for value in definitions:
+    if issubclass(value, messages.Message):
+      message_descriptors.append(describe_message(value))
 
-      elif issubclass(value, messages.Enum):
-        enum_descriptors.append(describe_enum(value))
+    elif issubclass(value, messages.Enum):
+      enum_descriptors.append(describe_enum(value))
 
-      elif issubclass(value, remote.Service):
-        service_descriptors.append(describe_service(value))
+    else:
+      service_descriptors.append(describe_service(value))
 
   if message_descriptors:
     descriptor.message_types = message_descriptors
@@ -510,6 +622,13 @@ def describe_file(module):
   if service_descriptors:
     descriptor.service_types = service_descriptors
 
+  definition_refs = [weakref.ref(value) for value in definitions]
+  with _file_descriptors_lock:
+    for name, entry in list(_file_descriptors.items()):
+      if _file_descriptor_stale(name, entry):
+        del _file_descriptors[name]
+    _file_descriptors[module.__name__] = (id(module), package, definition_refs,
+                                          descriptor)
   return descriptor
 
 
@@ -645,23 +764,53 @@ class DescriptorLibrary(object):
   When a definition name is requested that the library does not know about
   it can be provided with a descriptor loader which attempt to resolve the
   missing descriptor.
+
+  Loaded descriptors are kept in a cache of bounded size from which the least
+  recently used descriptors are discarded first.  Names the loader could not
+  resolve are remembered for a limited time so that they are not loaded
+  again on every lookup.  Libraries are thread-safe.
   """
 
   @util.positional(1)
   def __init__(self,
                descriptors=None,
-               descriptor_loader=import_descriptor_loader):
+               descriptor_loader=import_descriptor_loader,
+               max_size=DEFAULT_MAX_LIBRARY_SIZE,
+               negative_cache_ttl=DEFAULT_NEGATIVE_CACHE_TTL,
+               clock=time.time):
     """Constructor.
 
     Args:
-      descriptors: A dictionary or dictionary-like object that can be used
-        to store and cache descriptors by definition name.
+      descriptors: A dictionary or dictionary-like object of descriptors by
+        definition name that are always known to the library.  These are
+        never discarded.
       definition_loader: A function used for resolving missing descriptors.
         The function takes a definition name as its parameter and returns
         an appropriate descriptor.  It may raise DefinitionNotFoundError.
+      max_size: Maximum number of loaded descriptors to keep.  If None, all
+        loaded descriptors are kept.
+      negative_cache_ttl: Seconds to remember that the loader could not
+        resolve a definition name.  If None or 0, unresolved names are not
+        remembered.
+      clock: Function returning the current time in seconds.
     """
     self.__descriptor_loader = descriptor_loader
     self.__descriptors = descriptors or {}
+    self.__max_size = max_size
+    self.__negative_cache_ttl = negative_cache_ttl
+    self.__clock = clock
+    self.__lock = threading.Lock()
+    # Loaded descriptors by definition name, least recently used first.
+    self.__loaded = collections.OrderedDict()
+    # Tuples (expiration_time, error_message) by unresolved definition name,
+    # oldest first.
+    self.__not_found = collections.OrderedDict()
+
+  def __trim(self, cache):
+    """Discard oldest entries of a cache exceeding the maximum size."""
+    if self.__max_size is not None:
+      while len(cache) > self.__max_size:
+        cache.popitem(last=False)
 
   def lookup_descriptor(self, definition_name):
     """Lookup descriptor by name.
@@ -683,14 +832,38 @@ class DescriptorLibrary(object):
     except KeyError:
       pass
 
-    if self.__descriptor_loader:
-      definition = self.__descriptor_loader(definition_name)
-      self.__descriptors[definition_name] = definition
-      return definition
-    else:  
+    if not self.__descriptor_loader:
       raise messages.DefinitionNotFoundError(
         'Could not find definition for %s' % definition_name)
 
+    with self.__lock:
+      if definition_name in self.__loaded:
+        definition = self.__loaded.pop(definition_name)
+        self.__loaded[definition_name] = definition
+        return definition
+
+      not_found = self.__not_found.get(definition_name)
+      if not_found is not None:
+        expiration_time, error_message = not_found
+        if self.__clock() < expiration_time:
+          raise messages.DefinitionNotFoundError(error_message)
+        del self.__not_found[definition_name]
+
+    try:
+      definition = self.__descriptor_loader(definition_name)
+    except messages.DefinitionNotFoundError as err:
+      if self.__negative_cache_ttl:
+        with self.__lock:
+          self.__not_found[definition_name] = (
+            self.__clock() + self.__negative_cache_ttl, str(err))
+          self.__trim(self.__not_found)
+      raise
+
+    with self.__lock:
+      self.__loaded[definition_name] = definition
+      self.__trim(self.__loaded)
+    return definition
+
   def lookup_package(self, definition_name):
     """Determines the package name for any definition.
 
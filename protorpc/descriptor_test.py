@@ -20,8 +20,11 @@
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
+import gc
+import sys
 import types
 import unittest
+import weakref
 
 from protorpc import descriptor
 from protorpc import message_types
@@ -128,6 +131,21 @@ class DescribeFieldTest(test_util.TestCase):
       described.check_initialized()
       self.assertEquals(expected, described)
 
+  def testPacked(self):
+    field = messages.IntegerField(10, repeated=True, packed=True)
+    field.name = u'a_field'
+
+    expected = descriptor.FieldDescriptor()
+    expected.name = u'a_field'
+    expected.number = 10
+    expected.label = descriptor.FieldDescriptor.Label.REPEATED
+    expected.variant = descriptor.FieldDescriptor.Variant.INT64
+    expected.packed = True
+
+    described = descriptor.describe_field(field)
+    described.check_initialized()
+    self.assertEquals(expected, described)
+
   def testDefault(self):
     for field_class, default, expected_default in (
         (messages.IntegerField, 200, '200'),
@@ -485,6 +503,113 @@ class DescribeFileSetTest(test_util.TestCase):
     self.assertEquals(expected, described)
 
 
+class DescriptorCacheTest(test_util.TestCase):
+  """Test caching of descriptors."""
+
+  def testMessage(self):
+    class MyMessage(messages.Message):
+      field = messages.IntegerField(1)
+
+    described = descriptor.describe_message(MyMessage)
+    self.assertTrue(described is descriptor.describe_message(MyMessage))
+
+  def testEnum(self):
+    class MyEnum(messages.Enum):
+      VAL = 1
+
+    described = descriptor.describe_enum(MyEnum)
+    self.assertTrue(described is descriptor.describe_enum(MyEnum))
+
+  def testService(self):
+    class MyService(remote.Service):
+
+      @remote.method(message_types.VoidMessage, message_types.VoidMessage)
+      def my_method(self, request):
+        pass
+
+    described = descriptor.describe_service(MyService)
+    self.assertTrue(described is descriptor.describe_service(MyService))
+
+  def testDefinitionNotKeptAlive(self):
+    class MyMessage(messages.Message):
+      field = messages.IntegerField(1)
+
+    descriptor.describe_message(MyMessage)
+    message_ref = weakref.ref(MyMessage)
+    del MyMessage
+    gc.collect()
+    self.assertEquals(None, message_ref())
+
+  def testFile(self):
+    module = types.ModuleType('my.cached.module')
+    class MyMessage(messages.Message):
+      field = messages.IntegerField(1)
+    module.MyMessage = MyMessage
+
+    described = descriptor.describe_file(module)
+    self.assertTrue(described is descriptor.describe_file(module))
+
+  def testFileDefinitionChanged(self):
+    """Test that reloading a module is noticed."""
+    module = types.ModuleType('my.cached.module')
+    class MyMessage(messages.Message):
+      field = messages.IntegerField(1)
+    module.MyMessage = MyMessage
+    described = descriptor.describe_file(module)
+
+    class MyMessage(messages.Message):
+      field = messages.IntegerField(2)
+    module.MyMessage = MyMessage
+    reloaded = descriptor.describe_file(module)
+    self.assertNotEquals(described, reloaded)
+    self.assertEquals([2], [field.number
+                            for field in reloaded.message_types[0].fields])
+
+    class MyEnum(messages.Enum):
+      VAL = 1
+    module.MyEnum = MyEnum
+    self.assertEquals(1, len(descriptor.describe_file(module).enum_types))
+
+  def testFilePackageChanged(self):
+    module = types.ModuleType('my.cached.module')
+    descriptor.describe_file(module)
+    module.package = 'my.package'
+    self.assertEquals('my.package', descriptor.describe_file(module).package)
+
+  def testFileNewModule(self):
+    module = types.ModuleType('my.cached.module')
+    described = descriptor.describe_file(module)
+    other_module = types.ModuleType('my.cached.module')
+    self.assertFalse(described is descriptor.describe_file(other_module))
+
+  def testFileDefinitionsNotKeptAlive(self):
+    module = types.ModuleType('my.cached.module')
+    class MyMessage(messages.Message):
+      field = messages.IntegerField(1)
+    module.MyMessage = MyMessage
+    descriptor.describe_file(module)
+
+    message_ref = weakref.ref(MyMessage)
+    del module, MyMessage
+    gc.collect()
+    self.assertEquals(None, message_ref())
+
+  def testFileReplacedInModules(self):
+    module = types.ModuleType('my.cached.module')
+    original_modules = sys.modules
+    try:
+      sys.modules = dict(sys.modules)
+      sys.modules['my.cached.module'] = module
+      descriptor.describe_file(module)
+      self.assertTrue('my.cached.module' in descriptor._file_descriptors)
+
+      sys.modules['my.cached.module'] = types.ModuleType('my.cached.module')
+      descriptor.describe_file(types.ModuleType('my.other.module'))
+      self.assertFalse('my.cached.module' in descriptor._file_descriptors)
+    finally:
+      sys.modules = original_modules
+
+
 class DescribeTest(test_util.TestCase):
 
   def testModule(self):
@@ -641,6 +766,98 @@ class DescriptorLibraryTest(test_util.TestCase):
     self.assertEquals(None, self.library.lookup_package('Packageless'))
 
 
+class FakeLoader(object):
+  """Descriptor loader counting its calls."""
+
+  def __init__(self, *known_names):
+    self.known_names = known_names
+    self.calls = []
+
+  def __call__(self, definition_name):
+    self.calls.append(definition_name)
+    if definition_name not in self.known_names:
+      raise messages.DefinitionNotFoundError(
+        'Could not find definition for %s' % definition_name)
+    return descriptor.MessageDescriptor()
+
+
+class DescriptorLibraryCacheTest(test_util.TestCase):
+
+  def setUp(self):
+    self.now = 1000.0
+    self.loader = FakeLoader('a', 'b', 'c')
+
+  def CreateLibrary(self, **kwargs):
+    return descriptor.DescriptorLibrary(descriptor_loader=self.loader,
+                                        clock=lambda: self.now,
+                                        **kwargs)
+
+  def testLoadedOnce(self):
+    library = self.CreateLibrary()
+    first = library.lookup_descriptor('a')
+    self.assertTrue(first is library.lookup_descriptor('a'))
+    self.assertEquals(['a'], self.loader.calls)
+
+  def testLeastRecentlyUsedDiscarded(self):
+    library = self.CreateLibrary(max_size=2)
+    library.lookup_descriptor('a')
+    library.lookup_descriptor('b')
+    library.lookup_descriptor('a')
+    library.lookup_descriptor('c')
+    del self.loader.calls[:]
+
+    library.lookup_descriptor('a')
+    library.lookup_descriptor('c')
+    self.assertEquals([], self.loader.calls)
+    library.lookup_descriptor('b')
+    self.assertEquals(['b'], self.loader.calls)
+
+  def testUnbounded(self):
+    library = self.CreateLibrary(max_size=None)
+    for name in ('a', 'b', 'c', 'a', 'b', 'c'):
+      library.lookup_descriptor(name)
+    self.assertEquals(['a', 'b', 'c'], self.loader.calls)
+
+  def testInitialDescriptorsNotDiscarded(self):
+    initial = descriptor.MessageDescriptor()
+    library = self.CreateLibrary(descriptors={'initial': initial},
+                                 max_size=1)
+    library.lookup_descriptor('a')
+    library.lookup_descriptor('b')
+    self.assertTrue(initial is library.lookup_descriptor('initial'))
+
+  def testNegativeCache(self):
+    library = self.CreateLibrary()
+    for unused_index in range(3):
+      self.assertRaisesWithRegexpMatch(
+        messages.DefinitionNotFoundError,
+        'Could not find definition for x',
+        library.lookup_descriptor, 'x')
+    self.assertEquals(['x'], self.loader.calls)
+
+    self.now += descriptor.DEFAULT_NEGATIVE_CACHE_TTL
+    self.loader.known_names = ('x',)
+    library.lookup_descriptor('x')
+    self.assertEquals(['x', 'x'], self.loader.calls)
+
+  def testNoNegativeCache(self):
+    library = self.CreateLibrary(negative_cache_ttl=None)
+    for unused_index in range(2):
+      self.assertRaises(messages.DefinitionNotFoundError,
+                        library.lookup_descriptor, 'x')
+    self.assertEquals(['x', 'x'], self.loader.calls)
+
+  def testNegativeCacheBounded(self):
+    library = self.CreateLibrary(max_size=1)
+    self.assertRaises(messages.DefinitionNotFoundError,
+                      library.lookup_descriptor, 'x')
+    self.assertRaises(messages.DefinitionNotFoundError,
+                      library.lookup_descriptor, 'y')
+    self.assertRaises(messages.DefinitionNotFoundError,
+                      library.lookup_descriptor, 'x')
+    self.assertEquals(['x', 'y', 'x'], self.loader.calls)
+
+
 def main():
   unittest.main()
 
@@ -68,7 +68,7 @@ def format_proto_file(file_descriptor, output, indent_space=2):
         fields.
     """
     for field in field_descriptors or []:
-      default_format = ''
+      options = []
       if field.default_value is not None:
         if field.label == descriptor.FieldDescriptor.Label.REPEATED:
           logging.warning('Default value for repeated field %s is not being '
@@ -87,18 +87,26 @@ def format_proto_file(file_descriptor, output, indent_space=2):
             default = str(field.default_value)
 
           if default is not None:
-            default_format = ' [default=%s]' % default
+            options.append('default=%s' % default)
+
+      if field.packed:
+        options.append('packed=true')
 
       if field.variant in (messages.Variant.MESSAGE, messages.Variant.ENUM):
         field_type = field.type_name
       else:
         field_type = str(field.variant).lower()
-            
+
+      if options:
+        options_format = ' [%s]' % ', '.join(options)
+      else:
+        options_format = ''
+
       out << '%s %s %s = %s%s;' % (str(field.label).lower(),
                                    field_type,
                                    field.name,
                                    field.number,
-                                   default_format)
+                                   options_format)
 
   def write_messages(message_descriptors):
     """Write nested and non-nested Message types.
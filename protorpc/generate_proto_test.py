@@ -116,6 +116,23 @@ class FormatProtoFileTest(test_util.TestCase):
                       '}\n',
                       self.result)
 
+  def testRepeatedFieldPacked(self):
+    field = descriptor.FieldDescriptor()
+    field.name = u'integer_field'
+    field.number = 1
+    field.label = descriptor.FieldDescriptor.Label.REPEATED
+    field.variant = descriptor.FieldDescriptor.Variant.INT64
+    field.packed = True
+
+    self.MakeMessage(fields=[field])
+
+    generate_proto.format_proto_file(self.file_descriptor, self.output)
+    self.assertEquals('\n\n'
+                      'message MyMessage {\n'
+                      '  repeated int64 integer_field = 1 [packed=true];\n'
+                      '}\n',
+                      self.result)
+
   def testSingleFieldWithDefaultString(self):
     field = descriptor.FieldDescriptor()
     field.name = 'string_field'
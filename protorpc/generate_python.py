@@ -32,6 +32,24 @@ _MESSAGE_FIELD_MAP = {
     message_types.DateTimeMessage.definition_name(): message_types.DateTimeField,
 }
 
+_Variant = descriptor.FieldDescriptor.Variant
+
+# Maps variants to protocol buffer wire type, encoder method and decoder
+# method used by compiled codecs.  Must agree with the tables in protobuf.
+# Variants that protobuf can not encode are absent.
+_PROTOBUF_VARIANT_MAP = {
+    _Variant.DOUBLE: (1, 'putDouble', 'getDouble'),
+    _Variant.FLOAT: (5, 'putFloat', 'getFloat'),
+    _Variant.INT64: (0, 'putVarInt64', 'getVarInt64'),
+    _Variant.UINT64: (0, 'putVarUint64', 'getVarUint64'),
+    _Variant.INT32: (0, 'putVarInt32', 'getVarInt32'),
+    _Variant.BOOL: (0, 'putBoolean', 'decode_boolean'),
+    _Variant.STRING: (2, 'encode_unicode_string', 'decode_string'),
+    _Variant.MESSAGE: (2, 'encode_message', 'getPrefixedString'),
+    _Variant.BYTES: (2, 'encode_unicode_string', 'getPrefixedString'),
+    _Variant.ENUM: (0, 'encode_enum', 'getVarInt32'),
+}
+
 
 def _write_enums(enum_descriptors, out):
   """Write nested and non-nested Enum types.
@@ -85,6 +103,8 @@ def _write_fields(field_descriptors, out):
 
     elif field.label == descriptor.FieldDescriptor.Label.REPEATED:
       label_format = ', repeated=True'
+      if field.packed:
+        label_format += ', packed=True'
 
     if field_type.DEFAULT_VARIANT != field.variant:
       variant_format = ', variant=messages.Variant.%s' % field.variant
@@ -182,14 +202,294 @@ def _write_services(service_descriptors, out):
         out << 'pass'
 
 
+def _iterate_messages(message_descriptors, prefix=''):
+  """Iterate over nested and non-nested Message types.
+
+  Args:
+    message_descriptors: List of MessageDescriptor objects to iterate over.
+    prefix: Python path of the class containing the messages, ending in a
+      period.
+
+  Yields:
+    Tuple (python path, MessageDescriptor) for every message.
+  """
+  for message in message_descriptors or []:
+    path = prefix + message.name
+    yield path, message
+    for nested in _iterate_messages(message.message_types, path + '.'):
+      yield nested
+
+
+def _field_type(field):
+  """Get field class of field descriptor."""
+  message_field = _MESSAGE_FIELD_MAP.get(field.type_name)
+  if message_field:
+    return message_field
+  return messages.Field.lookup_field_type_by_variant(field.variant)
+
+
+def _write_protobuf_codec(path, message, out):
+  """Write compiled protocol buffer codec of a Message type.
+
+  Args:
+    path: Python path of the message class.
+    message: MessageDescriptor of the message.
+    out: Indent writer used for generating text.
+
+  Returns:
+    Tuple (encoder name, decoder name), or None if the message has fields
+    that the protobuf module can not encode.
+  """
+  fields = sorted(message.fields or [], key=lambda field: field.number)
+  if [field for field in fields
+      if field.variant not in _PROTOBUF_VARIANT_MAP]:
+    return None
+
+  function_suffix = path.replace('.', '_')
+  encoder_name = '_encode_protobuf_%s' % function_suffix
+  decoder_name = '_decode_protobuf_%s' % function_suffix
+
+  out << ''
+  out << ''
+  out << 'def %s(message, encoder):' % encoder_name
+  with out.indent():
+    out << 'if message.all_unrecognized_fields():'
+    with out.indent():
+      out << 'return False'
+    for field in fields:
+      wire_type, encoder_method, _ = _PROTOBUF_VARIANT_MAP[field.variant]
+      out << "value = message.get_assigned_value('%s')" % field.name
+      if field.packed:
+        out << 'if value:'
+        with out.indent():
+          out << 'encoder.putVarInt32(%d)' % ((field.number << 3) | 2)
+          out << 'encoder.encode_packed(messages.Variant.%s, value)' % (
+            field.variant,)
+        continue
+      out << 'if value is not None:'
+      with out.indent():
+        if field.label == descriptor.FieldDescriptor.Label.REPEATED:
+          out << 'for item in value:'
+          out.begin_indent()
+          value_name = 'item'
+        else:
+          value_name = 'value'
+        out << 'encoder.putVarInt32(%d)' % ((field.number << 3) | wire_type)
+        if field.variant == _Variant.MESSAGE:
+          out << '%s = %s.%s.value_to_message(%s)' % (
+            value_name, path, field.name, value_name)
+        out << 'encoder.%s(%s)' % (encoder_method, value_name)
+        if field.label == descriptor.FieldDescriptor.Label.REPEATED:
+          out.end_indent()
+    out << 'return True'
+
+  repeated_fields = [field for field in fields
+                     if field.label == descriptor.FieldDescriptor.Label.REPEATED]
+  out << ''
+  out << ''
+  out << 'def %s(decoder):' % decoder_name
+  with out.indent():
+    out << 'message = %s()' % path
+    for field in repeated_fields:
+      out << 'repeated_%s = []' % field.name
+    out << 'while decoder.avail() > 0:'
+    with out.indent():
+      out << 'tag = decoder.getVarInt32()'
+      keyword = 'if'
+      for field in fields:
+        wire_type, _, decoder_method = _PROTOBUF_VARIANT_MAP[field.variant]
+        out << '%s tag == %d:' % (keyword,
+                                   (field.number << 3) | wire_type)
+        keyword = 'elif'
+        with out.indent():
+          out << 'value = decoder.%s()' % decoder_method
+          if field.variant == _Variant.ENUM:
+            out << 'try:'
+            with out.indent():
+              out << 'value = %s.%s.type(value)' % (path, field.name)
+            out << 'except TypeError:'
+            with out.indent():
+              out << ("raise messages.DecodeError("
+                      "'Invalid enum value %s' % value)")
+          elif field.variant == _Variant.MESSAGE:
+            out << 'field = %s.%s' % (path, field.name)
+            out << 'value = field.value_from_message('
+            with out.indent():
+              out << 'protobuf.decode_message(field.message_type, value))'
+          if field.label == descriptor.FieldDescriptor.Label.REPEATED:
+            out << 'repeated_%s.append(value)' % field.name
+          else:
+            out << 'message.%s = value' % field.name
+        if (field.label == descriptor.FieldDescriptor.Label.REPEATED and
+            wire_type != 2):
+          # Packed values are accepted for all repeated numeric fields.
+          out << 'elif tag == %d:' % ((field.number << 3) | 2)
+          with out.indent():
+            out << 'values = decoder.decode_packed(messages.Variant.%s)' % (
+              field.variant,)
+            if field.variant == _Variant.ENUM:
+              out << 'try:'
+              with out.indent():
+                out << 'values = [%s.%s.type(value) for value in values]' % (
+                  path, field.name)
+              out << 'except TypeError:'
+              with out.indent():
+                out << ("raise messages.DecodeError("
+                        "'Invalid enum value in %s' % values)")
+            out << 'repeated_%s.extend(values)' % field.name
+      if fields:
+        out << 'else:'
+        with out.indent():
+          out << 'return None'
+      else:
+        out << 'return None'
+    for field in repeated_fields:
+      out << 'if repeated_%s:' % field.name
+      with out.indent():
+        out << 'message.%s = repeated_%s' % (field.name, field.name)
+    out << 'return message'
+
+  return encoder_name, decoder_name
+
+
+def _write_json_codec(path, message, out):
+  """Write compiled JSON codec of a Message type.
+
+  Args:
+    path: Python path of the message class.
+    message: MessageDescriptor of the message.
+    out: Indent writer used for generating text.
+
+  Returns:
+    Tuple (encoder name, decoder name).
+  """
+  fields = message.fields or []
+  function_suffix = path.replace('.', '_')
+  encoder_name = '_encode_json_%s' % function_suffix
+  decoder_name = '_decode_json_%s' % function_suffix
+
+  out << ''
+  out << ''
+  out << 'def %s(protocol, message):' % encoder_name
+  with out.indent():
+    out << 'if message.all_unrecognized_fields():'
+    with out.indent():
+      out << 'return None'
+    out << 'result = {}'
+    for field in fields:
+      out << "value = message.get_assigned_value('%s')" % field.name
+      out << 'if value not in (None, [], ()):'
+      with out.indent():
+        if _field_type(field) in (messages.BytesField,
+                                  message_types.DateTimeField):
+          out << "result['%s'] = protocol.encode_field(%s.%s, value)" % (
+            field.name, path, field.name)
+        else:
+          out << "result['%s'] = value" % field.name
+    out << 'return result'
+
+  out << ''
+  out << ''
+  out << 'def %s(protocol, dictionary):' % decoder_name
+  with out.indent():
+    out << 'message = %s()' % path
+    out << 'for key, value in dictionary.items():'
+    with out.indent():
+      out << 'if value is None:'
+      with out.indent():
+        out << 'try:'
+        with out.indent():
+          out << 'message.reset(key)'
+        out << 'except AttributeError:'
+        with out.indent():
+          out << 'pass'
+        out << 'continue'
+      keyword = 'if'
+      for field in fields:
+        out << "%s key == '%s':" % (keyword, field.name)
+        keyword = 'elif'
+        with out.indent():
+          out << 'if not isinstance(value, list):'
+          with out.indent():
+            out << 'value = [value]'
+          out << 'elif not value:'
+          with out.indent():
+            out << 'continue'
+
+          field_type = _field_type(field)
+          if field_type in (messages.StringField, messages.BooleanField):
+            item_format = 'item'
+          elif field_type is messages.IntegerField:
+            item_format = ('item if type(item) is int '
+                           'else protocol.decode_field(%s.%s, item)')
+          elif field_type is messages.FloatField:
+            item_format = ('item if type(item) is float '
+                           'else protocol.decode_field(%s.%s, item)')
+          else:
+            item_format = 'protocol.decode_field(%s.%s, item)'
+          if '%s' in item_format:
+            item_format %= (path, field.name)
+
+          if item_format == 'item':
+            values_format = 'value'
+          else:
+            values_format = '[%s for item in value]' % item_format
+          if field.label == descriptor.FieldDescriptor.Label.REPEATED:
+            out << 'message.%s = %s' % (field.name, values_format)
+          else:
+            out << 'message.%s = %s[-1]' % (field.name, values_format)
+      if fields:
+        out << 'else:'
+        with out.indent():
+          out << 'return None'
+      else:
+        out << 'return None'
+    out << 'return message'
+
+  return encoder_name, decoder_name
+
+
+def _write_codecs(message_descriptors, out):
+  """Write and register compiled codecs of all Message types.
+
+  Args:
+    message_descriptors: List of MessageDescriptor objects from which to
+      generate codecs.
+    out: Indent writer used for generating text.
+  """
+  registrations = []
+  for path, message in _iterate_messages(message_descriptors):
+    protobuf_codec = _write_protobuf_codec(path, message, out)
+    if protobuf_codec:
+      registrations.append('protobuf.register_codec(%s, %s, %s)' %
+                           ((path,) + protobuf_codec))
+    registrations.append('protojson.register_codec(%s, %s, %s)' %
+                         ((path,) + _write_json_codec(path, message, out)))
+
+  if registrations:
+    out << ''
+    out << ''
+    for registration in registrations:
+      out << registration
+
+
 @util.positional(2)
-def format_python_file(file_descriptor, output, indent_space=2):
+def format_python_file(file_descriptor, output, indent_space=2,
+                       compiled_codecs=False):
   """Format FileDescriptor object as a single Python module.
 
   Services generated by this function will raise NotImplementedError.
 
+  When compiled_codecs is set, the module also contains a protocol buffer
+  and a JSON encoder and decoder for every message.  These handle the fields
+  of their message with precomputed tags and names and are registered with
+  the protobuf and protojson modules, which use them instead of their
+  reflective implementations.
+
   All Python classes generated by this function use delayed binding for all
-  message fields, enum fields and method parameter types.  For example a
+  message fields, enum fields and method parameter types.  The types of all
+  message and enum fields are resolved together once the module has been
+  loaded, see messages.resolve_definitions.  For example a
   service method might be generated like so:
 
     class MyService(remote.Service):
@@ -202,11 +502,18 @@ def format_python_file(file_descriptor, output, indent_space=2):
     file_descriptor: FileDescriptor instance to format as python module.
     output: File-like object to write module source code to.
     indent_space: Number of spaces for each level of Python indentation.
+    compiled_codecs: Also generate and register compiled codecs.
   """
   out = generate.IndentWriter(output, indent_space=indent_space)
 
+  if file_descriptor.message_types:
+    out << 'import sys'
+    out << ''
   out << 'from protorpc import message_types'
   out << 'from protorpc import messages'
+  if compiled_codecs:
+    out << 'from protorpc import protobuf'
+    out << 'from protorpc import protojson'
   if file_descriptor.service_types:
     out << 'from protorpc import remote'
 
@@ -216,3 +523,9 @@ def format_python_file(file_descriptor, output, indent_space=2):
   _write_enums(file_descriptor.enum_types, out)
   _write_messages(file_descriptor.message_types, out)
   _write_services(file_descriptor.service_types, out)
+  if compiled_codecs:
+    _write_codecs(file_descriptor.message_types, out)
+  if file_descriptor.message_types:
+    out << ''
+    out << ''
+    out << 'messages.resolve_definitions(sys.modules[__name__])'
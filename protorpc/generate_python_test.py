@@ -20,6 +20,8 @@
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
+import datetime
+import json
 import os
 import shutil
 import sys
@@ -28,6 +30,9 @@ import unittest
 
 from protorpc import descriptor
 from protorpc import generate_python
+from protorpc import messages
+from protorpc import protobuf
+from protorpc import protojson
 from protorpc import test_util
 from protorpc import util
 
@@ -174,6 +179,29 @@ class FormatPythonFileTest(test_util.TestCase):
 
     self.DoMessageTest([field])
 
+  def testMessageField_ResolvedOnImport(self):
+    field = descriptor.FieldDescriptor()
+    field.name = u'message_field'
+    field.number = 1
+    field.label = descriptor.FieldDescriptor.Label.OPTIONAL
+    field.variant = descriptor.FieldDescriptor.Variant.MESSAGE
+    field.type_name = u'my_package.Missing'
+
+    message_descriptor = descriptor.MessageDescriptor()
+    message_descriptor.name = u'MyMessage'
+    message_descriptor.fields = [field]
+
+    file_descriptor = descriptor.FileDescriptor()
+    file_descriptor.package = u'my_package'
+    file_descriptor.message_types = [message_descriptor]
+
+    file_name = os.path.join(self.temp_dir, 'my_package.py')
+    with open(file_name, 'wt') as source_file:
+      generate_python.format_python_file(file_descriptor, source_file)
+
+    self.assertRaises(messages.DefinitionNotFoundError,
+                      __import__, 'my_package')
+
   def testEnumField_InternalReference(self):
     enum = descriptor.EnumDescriptor()
     enum.name = 'Color'
@@ -352,7 +380,96 @@ class FormatPythonFileTest(test_util.TestCase):
                                      'Method method1 is not implemented',
                                      service_instance.method1,
                                      descriptor.FileDescriptor())
-  
+
+  def testCompiledCodecs(self):
+    Label = descriptor.FieldDescriptor.Label
+    Variant = messages.Variant
+    def Field(name, number, variant, label=Label.OPTIONAL, type_name=None,
+              packed=None):
+      return descriptor.FieldDescriptor(name=name, number=number,
+                                        variant=variant, label=label,
+                                        type_name=type_name, packed=packed)
+
+    inner = descriptor.MessageDescriptor(
+      name=u'Inner', fields=[Field(u'x', 1, Variant.INT64)])
+    color = descriptor.EnumDescriptor(
+      name=u'Color',
+      values=[descriptor.EnumValueDescriptor(name=u'RED', number=1)])
+    outer = descriptor.MessageDescriptor(
+      name=u'Outer',
+      message_types=[inner],
+      enum_types=[color],
+      fields=[Field(u'string', 1, Variant.STRING),
+              Field(u'integers', 2, Variant.INT32, Label.REPEATED),
+              Field(u'inner', 3, Variant.MESSAGE, type_name=u'Outer.Inner'),
+              Field(u'color', 4, Variant.ENUM, type_name=u'Outer.Color'),
+              Field(u'bytes', 5, Variant.BYTES),
+              Field(u'floats', 6, Variant.DOUBLE, Label.REPEATED,
+                    packed=True),
+              Field(u'time', 7, Variant.MESSAGE,
+                    type_name=u'protorpc.message_types.DateTimeMessage'),
+             ])
+    file_descriptor = descriptor.FileDescriptor(package=u'compiled',
+                                                message_types=[outer])
+
+    source_file = open(os.path.join(self.temp_dir, 'compiled.py'), 'wt')
+    try:
+      generate_python.format_python_file(file_descriptor, source_file,
+                                         compiled_codecs=True)
+    finally:
+      source_file.close()
+    import compiled
+
+    message = compiled.Outer(string=u'a string',
+                             integers=[1, 2],
+                             inner=compiled.Outer.Inner(x=3),
+                             color=compiled.Outer.Color.RED,
+                             bytes=b'\x00\x01',
+                             floats=[1.5, 2.0],
+                             time=datetime.datetime(2010, 1, 1))
+    try:
+      for codecs in protobuf._codecs, protojson._codecs:
+        self.assertTrue(compiled.Outer in codecs)
+        self.assertTrue(compiled.Outer.Inner in codecs)
+
+      compiled_protobuf = protobuf.encode_message(message)
+      self.assertEquals(message,
+                        protobuf.decode_message(compiled.Outer,
+                                                compiled_protobuf))
+      compiled_json = protojson.encode_message(message)
+      self.assertEquals(message,
+                        protojson.decode_message(compiled.Outer,
+                                                 compiled_json))
+
+      # Packed values are written for packed fields and accepted for all
+      # repeated numeric fields.
+      self.assertTrue(compiled.Outer.floats.packed)
+      self.assertTrue(b'\x32\x10' in compiled_protobuf)
+      self.assertEquals(compiled.Outer(integers=[1, 2]),
+                        protobuf.decode_message(compiled.Outer,
+                                                b'\x12\x02\x01\x02'))
+
+      # Unrecognized fields are left to the reflective codecs.
+      unrecognized = protobuf.decode_message(compiled.Outer.Inner,
+                                             b'\x08\x01\x10\x02')
+      self.assertEquals([2], unrecognized.all_unrecognized_fields())
+      self.assertEquals(b'\x08\x01\x10\x02',
+                        protobuf.encode_message(unrecognized))
+      unrecognized = protojson.decode_message(compiled.Outer.Inner,
+                                              '{"x": 1, "y": 2}')
+      self.assertEquals(['y'], unrecognized.all_unrecognized_fields())
+      self.assertEquals({'x': 1, 'y': 2},
+                        json.loads(protojson.encode_message(unrecognized)))
+    finally:
+      for codecs in protobuf._codecs, protojson._codecs:
+        codecs.pop(compiled.Outer, None)
+        codecs.pop(compiled.Outer.Inner, None)
+
+    # Compiled codecs agree with reflective ones.
+    self.assertEquals(compiled_protobuf, protobuf.encode_message(message))
+    self.assertEquals(json.loads(compiled_json),
+                      json.loads(protojson.encode_message(message)))
+
 
 def main():
   unittest.main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Server side instrumentation of remote method calls.
+
+ProtoRPC servers time every phase of handling a remote method call and report
+the timings together with the sizes and outcome of the call to an
+Instrumentation.  Pass an instrumentation when configuring services:
+
+  stats = instrumentation.HistogramInstrumentation()
+  application = service.service_mappings(
+      [('/my/service', MyService)],
+      instrumentation=stats,
+      instrumentation_path='/protorpc/stats')
+
+The HistogramInstrumentation keeps latency and size histograms per remote
+method in memory.  A text dump of them is served at instrumentation_path.
+
+Calls are handled in the following phases, each of which is timed separately:
+
+  ROUTE: Finding the remote method and protocol of the request.
+  DECODE: Reading and decoding the request message.
+  INITIALIZE_REQUEST_STATE: Providing request state to the service instance.
+  METHOD: Executing the remote method.
+  ENCODE: Encoding the response message.
+  WRITE: Sending the response to the client.
+
+Phases that are not reached, for example because a request could not be
+decoded, do not appear in the timings of a call.
+"""
+
+import bisect
+import logging
+import threading
+import timeit
+
+import six
+
+from . import remote
+from . import util
+
+__all__ = [
+  'DECODE',
+  'ENCODE',
+  'INITIALIZE_REQUEST_STATE',
+  'METHOD',
+  'PHASES',
+  'ROUTE',
+  'WRITE',
+
+  'Histogram',
+  'HistogramInstrumentation',
+  'Instrumentation',
+  'RpcRecord',
+  'RpcTimer',
+  'dump_application',
+]
+
+
+ROUTE = 'route'
+DECODE = 'decode'
+INITIALIZE_REQUEST_STATE = 'initialize_request_state'
+METHOD = 'method'
+ENCODE = 'encode'
+WRITE = 'write'
+
+# All phases in the order in which they occur.
+PHASES = (ROUTE, DECODE, INITIALIZE_REQUEST_STATE, METHOD, ENCODE, WRITE)
+
+
+class RpcRecord(object):
+  """Measurements of a single remote method call.
+
+  Attributes:
+    service_path: Path of service that was called.
+    method_name: Name of remote method that was called.
+    protocol: Name of protocol of the request, else None when the protocol
+      could not be determined.
+    state: remote.RpcState of the outcome of the call.
+    request_size: Size of the request body in bytes as received.
+    response_size: Size of the response body in bytes as sent.
+    timings: Dictionary mapping phase to the number of seconds it took.
+    total_time: Number of seconds it took to handle the call.
+  """
+
+  def __init__(self, service_path, method_name):
+    """Constructor.
+
+    Args:
+      service_path: Path of service that was called.
+      method_name: Name of remote method that was called.
+    """
+    self.service_path = service_path
+    self.method_name = method_name
+    self.protocol = None
+    self.state = None
+    self.request_size = 0
+    self.response_size = 0
+    self.timings = {}
+    self.total_time = 0.0
+
+  def __repr__(self):
+    return '<RpcRecord %s.%s %s>' % (self.service_path,
+                                     self.method_name,
+                                     self.state)
+
+
+class Instrumentation(object):
+  """Interface for receiving measurements of remote method calls.
+
+  Servers call record once for every call they handle, after the response
+  has been sent, on the thread that handled the call.  Implementations must
+  therefore be thread-safe and should be fast.
+  """
+
+  def record(self, rpc_record):
+    """Record measurements of a remote method call.
+
+    Args:
+      rpc_record: RpcRecord of the call.
+    """
+    raise NotImplementedError()
+
+
+class RpcTimer(object):
+  """Times the phases of a single remote method call.
+
+  Phases are timed back to back: lap ends the phase that began when the
+  previous phase ended, or when the timer was created.  Other measurements
+  are set directly on the record of the timer.
+  """
+
+  @util.positional(4)
+  def __init__(self, instrumentation, service_path, method_name, clock=None):
+    """Constructor.
+
+    Args:
+      instrumentation: Instrumentation to report the call to.  If None,
+        phases are not timed and nothing is reported.
+      service_path: Path of service that is called.
+      method_name: Name of remote method that is called.
+      clock: Function returning the current time in seconds.  Defaults to
+        timeit.default_timer.
+    """
+    self.__instrumentation = instrumentation
+    self.__clock = clock or timeit.default_timer
+    self.__record = RpcRecord(service_path, method_name)
+    if instrumentation is not None:
+      self.__start = self.__last = self.__clock()
+    self.__finished = False
+
+  @property
+  def record(self):
+    """RpcRecord being filled in."""
+    return self.__record
+
+  def lap(self, phase):
+    """End a phase.
+
+    Args:
+      phase: Phase that ended now.
+    """
+    if self.__instrumentation is None:
+      return
+    now = self.__clock()
+    timings = self.__record.timings
+    timings[phase] = timings.get(phase, 0.0) + (now - self.__last)
+    self.__last = now
+
+  def set_http_status(self, status_code):
+    """Set the outcome of the call from an HTTP status unless already set.
+
+    Args:
+      status_code: Integer HTTP status code of the response.
+    """
+    if self.__record.state is None:
+      if status_code < 400:
+        self.__record.state = remote.RpcState.OK
+      elif status_code < 500:
+        self.__record.state = remote.RpcState.REQUEST_ERROR
+      else:
+        self.__record.state = remote.RpcState.SERVER_ERROR
+
+  def finish(self, phase=None):
+    """End the call and report it to the instrumentation.
+
+    Errors raised by the instrumentation are logged and otherwise ignored so
+    that they do not affect the response.  Calling finish more than once has
+    no effect.
+
+    Args:
+      phase: Phase that ended now, if any.
+    """
+    if self.__finished or self.__instrumentation is None:
+      return
+    self.__finished = True
+    if phase is not None:
+      self.lap(phase)
+    self.__record.total_time = self.__last - self.__start
+    try:
+      self.__instrumentation.record(self.__record)
+    except Exception:
+      logging.exception('Error recording RPC %r', self.__record)
+
+
+class Histogram(object):
+  """Histogram of values counted in buckets with fixed upper bounds.
+
+  Histograms are not thread-safe.
+  """
+
+  def __init__(self, bounds):
+    """Constructor.
+
+    Args:
+      bounds: Ascending upper bounds of buckets.  Values greater than the
+        last bound are counted in an additional overflow bucket.
+    """
+    self.__bounds = tuple(bounds)
+    self.__counts = [0] * (len(self.__bounds) + 1)
+    self.__count = 0
+    self.__sum = 0
+    self.__min = None
+    self.__max = None
+
+  @classmethod
+  def exponential(cls, start, factor, count):
+    """Create histogram whose bucket bounds grow exponentially.
+
+    Args:
+      start: Upper bound of the first bucket.
+      factor: Factor by which each bound is larger than the previous one.
+      count: Number of buckets, not counting the overflow bucket.
+
+    Returns:
+      New Histogram.
+    """
+    return cls([start * factor ** index for index in range(count)])
+
+  @property
+  def bounds(self):
+    return self.__bounds
+
+  @property
+  def count(self):
+    return self.__count
+
+  @property
+  def sum(self):
+    return self.__sum
+
+  @property
+  def min(self):
+    return self.__min
+
+  @property
+  def max(self):
+    return self.__max
+
+  @property
+  def mean(self):
+    if not self.__count:
+      return None
+    return self.__sum / float(self.__count)
+
+  def add(self, value):
+    """Count a value."""
+    self.__counts[bisect.bisect_left(self.__bounds, value)] += 1
+    self.__count += 1
+    self.__sum += value
+    if self.__min is None or value < self.__min:
+      self.__min = value
+    if self.__max is None or value > self.__max:
+      self.__max = value
+
+  def buckets(self):
+    """Get counts of all buckets.
+
+    Returns:
+      List of tuples (upper_bound, count), where upper_bound of the overflow
+      bucket is None.
+    """
+    return list(zip(self.__bounds + (None,), self.__counts))
+
+  def percentile(self, percent):
+    """Estimate a percentile.
+
+    Args:
+      percent: Percentile to estimate, between 0 and 100.
+
+    Returns:
+      Upper bound of the bucket holding the percentile, limited to the
+      largest value counted.  None when no values were counted.
+    """
+    if not self.__count:
+      return None
+    rank = percent / 100.0 * self.__count
+    seen = 0
+    for bound, count in zip(self.__bounds, self.__counts):
+      seen += count
+      if seen >= rank and seen:
+        return min(bound, self.__max)
+    return self.__max
+
+
+def _new_time_histogram():
+  """Create histogram for times from 10 microseconds to about 3 minutes."""
+  return Histogram.exponential(0.00001, 2, 25)
+
+
+def _new_size_histogram():
+  """Create histogram for sizes from 16 bytes to 256 megabytes."""
+  return Histogram.exponential(16, 2, 25)
+
+
+class _MethodStats(object):
+  """Histograms and counters of a single remote method."""
+
+  def __init__(self):
+    self.phases = dict((phase, _new_time_histogram()) for phase in PHASES)
+    self.total = _new_time_histogram()
+    self.request_size = _new_size_histogram()
+    self.response_size = _new_size_histogram()
+    self.states = {}
+    self.protocols = {}
+
+  def add(self, rpc_record):
+    for phase, seconds in six.iteritems(rpc_record.timings):
+      histogram = self.phases.get(phase)
+      if histogram is None:
+        histogram = self.phases[phase] = _new_time_histogram()
+      histogram.add(seconds)
+    self.total.add(rpc_record.total_time)
+    self.request_size.add(rpc_record.request_size)
+    self.response_size.add(rpc_record.response_size)
+    state = str(rpc_record.state)
+    self.states[state] = self.states.get(state, 0) + 1
+    protocol = str(rpc_record.protocol)
+    self.protocols[protocol] = self.protocols.get(protocol, 0) + 1
+
+
+def _format_counts(counts):
+  return ' '.join('%s=%d' % item for item in sorted(six.iteritems(counts)))
+
+
+class HistogramInstrumentation(Instrumentation):
+  """Instrumentation keeping histograms of every remote method in memory.
+
+  For each remote method, identified by service path and method name, a
+  latency histogram is kept for every phase and for the call as a whole, as
+  well as histograms of request and response sizes and counts of outcomes
+  and protocols.
+  """
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__stats = {}
+
+  def record(self, rpc_record):
+    """Add measurements of a remote method call to histograms."""
+    key = (rpc_record.service_path, rpc_record.method_name)
+    with self.__lock:
+      stats = self.__stats.get(key)
+      if stats is None:
+        stats = self.__stats[key] = _MethodStats()
+      stats.add(rpc_record)
+
+  def reset(self):
+    """Discard all measurements."""
+    with self.__lock:
+      self.__stats = {}
+
+  def get_histogram(self, service_path, method_name, phase=None):
+    """Get latency histogram of a remote method.
+
+    Args:
+      service_path: Path of service.
+      method_name: Name of remote method.
+      phase: Phase to get histogram of.  If None, gets histogram of the time
+        taken by the call as a whole.
+
+    Returns:
+      Histogram, else None if the method was never called.  The histogram
+      is live and must not be modified.
+    """
+    with self.__lock:
+      stats = self.__stats.get((service_path, method_name))
+      if stats is None:
+        return None
+      if phase is None:
+        return stats.total
+      return stats.phases.get(phase)
+
+  def dump(self):
+    """Dump all histograms as text.
+
+    Returns:
+      Text with a summary of the calls of each remote method, one table per
+      method, sorted by service path and method name.
+    """
+    lines = []
+    with self.__lock:
+      for (service_path, method_name), stats in sorted(
+          six.iteritems(self.__stats)):
+        lines.append('%s.%s' % (service_path, method_name))
+        lines.append('  calls: %d' % stats.total.count)
+        lines.append('  states: %s' % _format_counts(stats.states))
+        lines.append('  protocols: %s' % _format_counts(stats.protocols))
+        lines.append('  %-26s %8s %10s %10s %10s %10s %10s' %
+                     ('(milliseconds)', 'count', 'mean', 'p50', 'p90',
+                      'p99', 'max'))
+        phases = [(phase, stats.phases[phase]) for phase in PHASES]
+        phases.extend(sorted((phase, histogram)
+                             for phase, histogram in six.iteritems(stats.phases)
+                             if phase not in PHASES))
+        phases.append(('total', stats.total))
+        for name, histogram in phases:
+          if histogram.count:
+            lines.append('  %-26s %8d %10.3f %10.3f %10.3f %10.3f %10.3f' %
+                         (name, histogram.count,
+                          histogram.mean * 1000,
+                          histogram.percentile(50) * 1000,
+                          histogram.percentile(90) * 1000,
+                          histogram.percentile(99) * 1000,
+                          histogram.max * 1000))
+        lines.append('  %-26s %8s %10s %10s %10s %10s %10s' %
+                     ('(bytes)', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+        for name, histogram in (('request_size', stats.request_size),
+                                ('response_size', stats.response_size)):
+          lines.append('  %-26s %8d %10d %10d %10d %10d %10d' %
+                       (name, histogram.count,
+                        histogram.mean,
+                        histogram.percentile(50),
+                        histogram.percentile(90),
+                        histogram.percentile(99),
+                        histogram.max))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def dump_application(instrumentation):
+  """WSGI application serving the text dump of an instrumentation.
+
+  Args:
+    instrumentation: Instrumentation with a dump method, such as a
+      HistogramInstrumentation.
+
+  Returns:
+    WSGI application responding to every request with the dump as plain
+    text.
+  """
+  def instrumentation_dump_app(environ, start_response):
+    """Actual WSGI application function."""
+    content = instrumentation.dump()
+    if isinstance(content, six.text_type):
+      content = content.encode('utf-8')
+    start_response('200 OK', [('content-type', 'text/plain; charset=utf-8'),
+                              ('content-length', str(len(content))),
+                              ('cache-control', 'no-cache'),
+                             ])
+    return [content]
+  return instrumentation_dump_app
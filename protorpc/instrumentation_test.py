@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for protorpc.instrumentation."""
+
+import unittest
+
+from protorpc import instrumentation
+from protorpc import remote
+from protorpc import test_util
+
+
+class ModuleInterfaceTest(test_util.ModuleInterfaceTest,
+                          test_util.TestCase):
+
+  MODULE = instrumentation
+
+
+class FakeClock(object):
+  """Clock advancing only when told to."""
+
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+class ListInstrumentation(instrumentation.Instrumentation):
+  """Instrumentation keeping all records in a list."""
+
+  def __init__(self):
+    self.records = []
+
+  def record(self, rpc_record):
+    self.records.append(rpc_record)
+
+
+class RpcTimerTest(test_util.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.instrumentation = ListInstrumentation()
+    self.timer = instrumentation.RpcTimer(self.instrumentation,
+                                          '/my/service', 'method',
+                                          clock=self.clock)
+
+  def testTimings(self):
+    self.clock.now += 1
+    self.timer.lap(instrumentation.ROUTE)
+    self.clock.now += 2
+    self.timer.lap(instrumentation.DECODE)
+    self.clock.now += 4
+    self.timer.finish(instrumentation.WRITE)
+
+    [record] = self.instrumentation.records
+    self.assertEquals('/my/service', record.service_path)
+    self.assertEquals('method', record.method_name)
+    self.assertEquals({instrumentation.ROUTE: 1,
+                       instrumentation.DECODE: 2,
+                       instrumentation.WRITE: 4,
+                      },
+                      record.timings)
+    self.assertEquals(7, record.total_time)
+
+  def testRepeatedPhase(self):
+    self.clock.now += 1
+    self.timer.lap(instrumentation.ENCODE)
+    self.clock.now += 2
+    self.timer.lap(instrumentation.ENCODE)
+    self.timer.finish()
+    self.assertEquals({instrumentation.ENCODE: 3},
+                      self.instrumentation.records[0].timings)
+
+  def testFinishOnce(self):
+    self.timer.finish()
+    self.timer.finish()
+    self.assertEquals(1, len(self.instrumentation.records))
+
+  def testSetHttpStatus(self):
+    for status_code, state in ((200, remote.RpcState.OK),
+                               (400, remote.RpcState.REQUEST_ERROR),
+                               (404, remote.RpcState.REQUEST_ERROR),
+                               (500, remote.RpcState.SERVER_ERROR),
+                              ):
+      timer = instrumentation.RpcTimer(None, '/my/service', 'method')
+      timer.set_http_status(status_code)
+      self.assertEquals(state, timer.record.state)
+
+  def testSetHttpStatusKeepsState(self):
+    self.timer.record.state = remote.RpcState.APPLICATION_ERROR
+    self.timer.set_http_status(400)
+    self.assertEquals(remote.RpcState.APPLICATION_ERROR,
+                      self.timer.record.state)
+
+  def testNoInstrumentation(self):
+    timer = instrumentation.RpcTimer(None, '/my/service', 'method',
+                                     clock=self.clock)
+    timer.lap(instrumentation.ROUTE)
+    timer.finish()
+    self.assertEquals({}, timer.record.timings)
+
+  def testInstrumentationError(self):
+    class BrokenInstrumentation(instrumentation.Instrumentation):
+      def record(self, rpc_record):
+        raise ValueError('broken')
+    timer = instrumentation.RpcTimer(BrokenInstrumentation(),
+                                     '/my/service', 'method')
+    timer.finish()
+
+
+class HistogramTest(test_util.TestCase):
+
+  def setUp(self):
+    self.histogram = instrumentation.Histogram([1, 2, 4, 8])
+
+  def testEmpty(self):
+    self.assertEquals(0, self.histogram.count)
+    self.assertEquals(None, self.histogram.mean)
+    self.assertEquals(None, self.histogram.percentile(50))
+
+  def testAdd(self):
+    for value in (0.5, 1, 3, 3, 20):
+      self.histogram.add(value)
+    self.assertEquals(5, self.histogram.count)
+    self.assertEquals(27.5, self.histogram.sum)
+    self.assertEquals(5.5, self.histogram.mean)
+    self.assertEquals(0.5, self.histogram.min)
+    self.assertEquals(20, self.histogram.max)
+    self.assertEquals([(1, 2), (2, 0), (4, 2), (8, 0), (None, 1)],
+                      self.histogram.buckets())
+
+  def testPercentile(self):
+    for value in range(1, 11):
+      self.histogram.add(value * 0.5)
+    self.assertEquals(1, self.histogram.percentile(20))
+    self.assertEquals(4, self.histogram.percentile(50))
+    self.assertEquals(5, self.histogram.percentile(100))
+
+  def testPercentileOverflow(self):
+    self.histogram.add(1)
+    self.histogram.add(100)
+    self.assertEquals(100, self.histogram.percentile(99))
+
+  def testExponential(self):
+    histogram = instrumentation.Histogram.exponential(1, 10, 3)
+    self.assertEquals((1, 10, 100), histogram.bounds)
+
+
+class HistogramInstrumentationTest(test_util.TestCase):
+
+  def setUp(self):
+    self.instrumentation = instrumentation.HistogramInstrumentation()
+
+  def Record(self, method_name='method', state=remote.RpcState.OK,
+             seconds=0.002):
+    record = instrumentation.RpcRecord('/my/service', method_name)
+    record.protocol = 'protojson'
+    record.state = state
+    record.request_size = 100
+    record.response_size = 1000
+    record.timings = {instrumentation.METHOD: seconds}
+    record.total_time = seconds
+    self.instrumentation.record(record)
+
+  def testGetHistogram(self):
+    self.Record()
+    self.Record(seconds=0.004)
+    histogram = self.instrumentation.get_histogram('/my/service', 'method')
+    self.assertEquals(2, histogram.count)
+    self.assertEquals(0.004, histogram.max)
+    histogram = self.instrumentation.get_histogram('/my/service', 'method',
+                                                   instrumentation.METHOD)
+    self.assertEquals(2, histogram.count)
+    self.assertEquals(0, self.instrumentation.get_histogram(
+      '/my/service', 'method', instrumentation.DECODE).count)
+    self.assertEquals(None,
+                      self.instrumentation.get_histogram('/my/service',
+                                                         'other'))
+
+  def testDump(self):
+    self.Record()
+    self.Record(state=remote.RpcState.APPLICATION_ERROR)
+    self.Record('other')
+    dump = self.instrumentation.dump()
+    self.assertTrue(dump.index('/my/service.method') <
+                    dump.index('/my/service.other'))
+    self.assertTrue('calls: 2' in dump)
+    self.assertTrue('states: APPLICATION_ERROR=1 OK=1' in dump)
+    self.assertTrue('protocols: protojson=2' in dump)
+    self.assertTrue('  method ' in dump)
+    self.assertTrue('  total ' in dump)
+    self.assertFalse('  decode ' in dump)
+    self.assertTrue('  response_size ' in dump)
+
+  def testReset(self):
+    self.Record()
+    self.instrumentation.reset()
+    self.assertEquals('', self.instrumentation.dump())
+    self.assertEquals(None,
+                      self.instrumentation.get_histogram('/my/service',
+                                                         'method'))
+
+  def testDumpApplication(self):
+    self.Record()
+    application = instrumentation.dump_application(self.instrumentation)
+    statuses = []
+    def start_response(status, headers):
+      statuses.append((status, dict(headers)))
+    content = b''.join(application({}, start_response))
+    [(status, headers)] = statuses
+    self.assertEquals('200 OK', status)
+    self.assertEquals('text/plain; charset=utf-8', headers['content-type'])
+    self.assertEquals(self.instrumentation.dump().encode('utf-8'), content)
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
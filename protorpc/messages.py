@@ -45,6 +45,10 @@ import six
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
+import array
+import collections
+import sys
+import threading
 import types
 import weakref
 
@@ -54,10 +58,14 @@ __all__ = ['MAX_ENUM_VALUE',
            'MAX_FIELD_NUMBER',
            'FIRST_RESERVED_FIELD_NUMBER',
            'LAST_RESERVED_FIELD_NUMBER',
+           'MAX_INTERNED_STRINGS',
+           'MAX_INTERNED_STRING_LENGTH',
 
            'Enum',
            'Field',
            'FieldList',
+           'FieldArray',
+           'MessageBatch',
            'Variant',
            'Message',
            'IntegerField',
@@ -67,7 +75,14 @@ __all__ = ['MAX_ENUM_VALUE',
            'StringField',
            'MessageField',
            'EnumField',
+           'FieldMask',
+           'apply_diff',
+           'cached_encoding',
+           'clear_definition_cache',
+           'diff_messages',
+           'diff_type',
            'find_definition',
+           'resolve_definitions',
 
            'Error',
            'DecodeError',
@@ -80,6 +95,7 @@ __all__ = ['MAX_ENUM_VALUE',
            'MessageDefinitionError',
            'DuplicateNumberError',
            'ValidationError',
+           'FrozenMessageError',
            'DefinitionNotFoundError',
           ]
 
@@ -143,6 +159,10 @@ class ValidationError(Error):
       return message
 
 
+class FrozenMessageError(Error):
+  """Attempted to modify a frozen message."""
+
+
 # Attributes that are reserved by a class definition that
 # may not be used by either Enum or Message class definitions.
 _RESERVED_ATTRIBUTE_NAMES = frozenset(
@@ -156,7 +176,8 @@ _POST_INIT_FIELD_ATTRIBUTE_NAMES = frozenset(
      '_EnumField__resolved_default'])
 
 _POST_INIT_ATTRIBUTE_NAMES = frozenset(
-    ['_message_definition'])
+    ['_message_definition',
+     '_check_initialized_plan'])
 
 # Maximum enumeration value as defined by the protocol buffers standard.
 # All enum values must be less than or equal to this value.
@@ -171,6 +192,75 @@ MAX_FIELD_NUMBER = (2 ** 29) - 1
 FIRST_RESERVED_FIELD_NUMBER = 19000
 LAST_RESERVED_FIELD_NUMBER = 19999
 
+# Maximum number of decoded values interned per string field defined with
+# interned=True.  Least recently used values are discarded first.
+MAX_INTERNED_STRINGS = 1000
+
+# Decoded values longer than this are never interned.
+MAX_INTERNED_STRING_LENGTH = 64
+
+# Maximum number of definitions kept by find_definition.  The cache holds
+# the definitions and the relative_to objects they were found from.
+_MAX_CACHED_DEFINITIONS = 10000
+
+# Definitions found by find_definition keyed by (name, relative_to), and the
+# keys of the cache indexed by each dotted component of their names.
+_definition_cache_lock = threading.Lock()
+_definition_cache = {}
+_definition_cache_index = {}
+
+
+def clear_definition_cache():
+  """Forget all definitions found by find_definition.
+
+  Definitions found by a name that mentions a newly defined Enum or Message
+  class are forgotten automatically, which covers defining and reloading
+  modules.  Clear the cache explicitly after changing module-space in other
+  ways, for example when removing definitions from a module.
+  """
+  with _definition_cache_lock:
+    _definition_cache.clear()
+    _definition_cache_index.clear()
+
+
+def _cache_definition(key, definition):
+  """Keep a definition found by find_definition.
+
+  The cache is cleared when it is full.
+
+  Args:
+    key: Tuple (name, relative_to) that definition was found by.
+    definition: Enum or Message class found.
+  """
+  with _definition_cache_lock:
+    if key not in _definition_cache:
+      if len(_definition_cache) >= _MAX_CACHED_DEFINITIONS:
+        _definition_cache.clear()
+        _definition_cache_index.clear()
+      for component in key[0].split('.'):
+        _definition_cache_index.setdefault(component, set()).add(key)
+    _definition_cache[key] = definition
+
+
+def _forget_definitions(name):
+  """Forget definitions found by names that a new definition may change.
+
+  Only the cached names with name as a dotted component are looked at.
+
+  Args:
+    name: Name of the newly defined Enum or Message class.  Cached names with
+      it as any dotted component are forgotten.
+  """
+  with _definition_cache_lock:
+    for key in _definition_cache_index.pop(name, ()):
+      del _definition_cache[key]
+      for component in key[0].split('.'):
+        keys = _definition_cache_index.get(component)
+        if keys is not None:
+          keys.discard(key)
+          if not keys:
+            del _definition_cache_index[component]
+
 
 class _DefinitionClass(type):
   """Base meta-class used for definition meta-classes.
@@ -190,6 +280,8 @@ class _DefinitionClass(type):
     # Base classes may never be initialized.
     if cls.__bases__ != (object,):
       cls.__initialized = True
+    # The new definition may change what names mentioning it resolve to.
+    _forget_definitions(name)
 
   def message_definition(cls):
     """Get outer Message definition that contains this definition.
@@ -277,6 +369,11 @@ class _DefinitionClass(type):
       return outer_definition.definition_package()
 
 
+# Types of values that Enum classes cast by looking them up in their table of
+# numbers and names.  Other values go through Enum.__new__.
+_ENUM_CAST_TYPES = frozenset(six.integer_types + (bool, str, six.text_type))
+
+
 class _EnumClass(_DefinitionClass):
   """Meta-class used for defining the Enum base class.
 
@@ -303,6 +400,7 @@ class _EnumClass(_DefinitionClass):
 
     cls.__by_number = {}
     cls.__by_name = {}
+    cls.__cast = {}
 
     # Enum base class does not need to be initialized or locked.
     if bases != (object,):
@@ -341,10 +439,36 @@ class _EnumClass(_DefinitionClass):
         cls.__init__(instance, attribute, value)
         cls.__by_name[instance.name] = instance
         cls.__by_number[instance.number] = instance
+        cls.__cast[instance.name] = instance
+        cls.__cast[instance.number] = instance
         setattr(cls, attribute, instance)
 
     _DefinitionClass.__init__(cls, name, bases, dct)
 
+  def __call__(cls, index):
+    """Cast name, number or enum value to enum value.
+
+    Names and numbers are looked up directly in a table of the class so that
+    the common case does not have to go through Enum.__new__ and __init__.
+
+    Args:
+      index: Name or number to look up.
+
+    Returns:
+      Enum sub-class instance of that value.
+
+    Raises:
+      TypeError: When an inappropriate index value is passed provided.
+    """
+    if type(index) is cls:
+      return index
+    if type(index) in _ENUM_CAST_TYPES:
+      try:
+        return cls.__cast[index]
+      except KeyError:
+        pass
+    return _DefinitionClass.__call__(cls, index)
+
   def __iter__(cls):
     """Iterate over all values of enum.
 
@@ -491,12 +615,17 @@ class Enum(six.with_metaclass(_EnumClass, object)):
 
   def __eq__(self, other):
     """Order is by number."""
+    # Enum values are singletons, so equal values are usually identical.
+    if self is other:
+      return True
     if isinstance(other, type(self)):
       return self.number == other.number
     return NotImplemented
 
   def __ne__(self, other):
     """Order is by number."""
+    if self is other:
+      return False
     if isinstance(other, type(self)):
       return self.number != other.number
     return NotImplemented
@@ -515,7 +644,8 @@ class Enum(six.with_metaclass(_EnumClass, object)):
 
   def __hash__(self):
     """Hash by number."""
-    return hash(self.number)
+    # Enum numbers are non-negative ints, which hash to themselves.
+    return self.number
 
   @classmethod
   def to_dict(cls):
@@ -581,6 +711,55 @@ class Variant(Enum):
   SINT64   = 18
 
 
+# Variants of numeric values that may be packed by repeated fields.
+_PACKABLE_VARIANTS = frozenset([
+    Variant.DOUBLE,
+    Variant.FLOAT,
+    Variant.INT64,
+    Variant.UINT64,
+    Variant.INT32,
+    Variant.BOOL,
+    Variant.UINT32,
+    Variant.ENUM,
+    Variant.SINT32,
+    Variant.SINT64,
+])
+
+
+def _find_typecode(typecodes, size):
+  """Find array type code of a given item size.
+
+  Args:
+    typecodes: Candidate type codes in order of preference.
+    size: Item size in bytes.
+
+  Returns:
+    First type code of typecodes with items of size bytes, or None.
+  """
+  for typecode in typecodes:
+    try:
+      if array.array(typecode).itemsize == size:
+        return typecode
+    except ValueError:
+      pass
+  return None
+
+
+# Maps variants of fields that may be stored in arrays to array type codes.
+# Both float variants are stored as doubles so values do not lose precision.
+_ARRAY_TYPECODES = dict(
+  (variant, typecode) for variant, typecode in [
+    (Variant.DOUBLE, 'd'),
+    (Variant.FLOAT, 'd'),
+    (Variant.INT64, _find_typecode('ql', 8)),
+    (Variant.UINT64, _find_typecode('QL', 8)),
+    (Variant.INT32, _find_typecode('il', 4)),
+    (Variant.UINT32, _find_typecode('IL', 4)),
+    (Variant.SINT32, _find_typecode('il', 4)),
+    (Variant.SINT64, _find_typecode('ql', 8)),
+  ] if typecode is not None)
+
+
 class _MessageClass(_DefinitionClass):
   """Meta-class used for defining the Message base class.
 
@@ -681,6 +860,74 @@ class _MessageClass(_DefinitionClass):
     _DefinitionClass.__init__(cls, name, bases, dct)
 
 
+def _get_check_initialized_plan(message_type):
+  """Get plan used by Message.check_initialized.
+
+  Plans are computed the first time a message type is checked, for it and
+  all message types reachable through its message fields, and are stored on
+  the message classes.
+
+  Args:
+    message_type: Message class to get plan for.
+
+  Returns:
+    Tuple (required_names, message_fields) where required_names are the
+    names of required fields of message_type and message_fields are tuples
+    (name, field) of message fields whose message types contain required
+    fields.  None if a message field refers to a definition that can not be
+    found yet.
+  """
+  plan = message_type.__dict__.get('_check_initialized_plan')
+  if plan is not None:
+    return plan
+
+  # Map every reachable message type to its message fields and their types.
+  nested_types = {}
+  pending = [message_type]
+  while pending:
+    current = pending.pop()
+    if current in nested_types:
+      continue
+    message_fields = []
+    for field in current.all_fields():
+      if isinstance(field, MessageField):
+        try:
+          field_type = field.message_type
+        except DefinitionNotFoundError:
+          return None
+        if issubclass(field_type, Message):
+          message_fields.append((field, field_type))
+          pending.append(field_type)
+    nested_types[current] = message_fields
+
+  # Types with required fields and types referring to them must be checked.
+  checked = set(current for current in nested_types
+                if [field for field in current.all_fields()
+                    if field.required])
+  changed = True
+  while changed:
+    changed = False
+    for current, message_fields in six.iteritems(nested_types):
+      if current not in checked:
+        for _, field_type in message_fields:
+          if field_type in checked:
+            checked.add(current)
+            changed = True
+            break
+
+  for current, message_fields in six.iteritems(nested_types):
+    if '_check_initialized_plan' not in current.__dict__:
+      required_names = tuple(sorted(field.name
+                                    for field in current.all_fields()
+                                    if field.required))
+      checked_fields = tuple(sorted(((field.name, field)
+                                     for field, field_type in message_fields
+                                     if field_type in checked),
+                                    key=lambda item: item[0]))
+      current._check_initialized_plan = required_names, checked_fields
+  return message_type._check_initialized_plan
+
+
 class Message(six.with_metaclass(_MessageClass, object)):
   """Base class for user defined message objects.
 
@@ -746,8 +993,17 @@ class Message(six.with_metaclass(_MessageClass, object)):
 
     # Now object is initialized!
     order.check_initialized()
+
+  Frozen messages:
+
+    Calling 'freeze' makes a message and all of its sub-messages immutable.
+    Frozen messages are hashable, so they can be used as dictionary keys, and
+    may be shared between threads without making copies.  Protocols cache
+    the encoded form of frozen messages, see cached_encoding.
   """
 
+  __frozen = False
+
   def __init__(self, **kwargs):
     """Initialize internal messages state.
 
@@ -791,20 +1047,39 @@ class Message(six.with_metaclass(_MessageClass, object)):
 
     Check that all required fields are initialized
 
+    Only required fields and message fields whose message types contain
+    required fields, directly or through their own message fields, are
+    visited.  Messages without any required fields in their tree are not
+    traversed at all.
+
     Raises:
       ValidationError: If message is not initialized.
     """
-    for name, field in self.__by_name.items():
+    plan = _get_check_initialized_plan(type(self))
+    if plan is None:
+      # Some message types can not be resolved yet.
+      required_names = None
+      message_fields = self.__by_name.items()
+    else:
+      required_names, message_fields = plan
+      for name in required_names:
+        if getattr(self, name) is None:
+          raise ValidationError("Message %s is missing required field %s" %
+                                (type(self).__name__, name))
+
+    for name, field in message_fields:
       value = getattr(self, name)
       if value is None:
-        if field.required:
+        if required_names is None and field.required:
           raise ValidationError("Message %s is missing required field %s" %
                                 (type(self).__name__, name))
       else:
         try:
           if (isinstance(field, MessageField) and
               issubclass(field.message_type, Message)):
-            if field.repeated:
+            if isinstance(value, MessageBatch):
+              value.check_initialized()
+            elif field.repeated:
               for item in value:
                 item_message_value = field.value_to_message(item)
                 item_message_value.check_initialized()
@@ -829,6 +1104,38 @@ class Message(six.with_metaclass(_MessageClass, object)):
     else:
       return True
 
+  def freeze(self):
+    """Make message immutable.
+
+    Freezes the message and all of its sub-messages in place.  Assigning or
+    resetting fields of a frozen message, changing its repeated fields or
+    setting unrecognized fields raises FrozenMessageError.  Sub-messages that
+    are shared with other messages are frozen for those messages as well.
+
+    Returns:
+      The message itself, so a message can be frozen as it is decoded:
+
+        config = protojson.decode_message(Config, content).freeze()
+    """
+    if self.__frozen:
+      return self
+
+    for number, value in list(self.__tags.items()):
+      self.__tags[number] = _freeze_value(value)
+    self.__hash = None
+    self.__encodings = {}
+    self.__masked_encodings = {}
+    self.__frozen = True
+    return self
+
+  def is_frozen(self):
+    """Get frozen status of message.
+
+    Returns:
+      True if freeze has been called on message, else False.
+    """
+    return self.__frozen
+
   @classmethod
   def all_fields(cls):
     """Get all field definition objects.
@@ -892,6 +1199,9 @@ class Message(six.with_metaclass(_MessageClass, object)):
     Args:
       name: Name of field to reset.
     """
+    if self.__frozen:
+      raise FrozenMessageError('May not reset field %s of frozen message %s' %
+                               (name, type(self).__name__))
     message_type = type(self)
     try:
       field = message_type.field_by_name(name)
@@ -900,7 +1210,7 @@ class Message(six.with_metaclass(_MessageClass, object)):
         raise AttributeError('Message %s has no field %s' % (
             message_type.__name__, name))
     if field.repeated:
-      self.__tags[field.number] = FieldList(field, [])
+      field.__set__(self, [])
     else:
       self.__tags.pop(field.number, None)
 
@@ -937,6 +1247,10 @@ class Message(six.with_metaclass(_MessageClass, object)):
     Raises:
       TypeError: If the variant is not an instance of messages.Variant.
     """
+    if self.__frozen:
+      raise FrozenMessageError(
+          'May not set unrecognized field %s of frozen message %s' %
+          (key, type(self).__name__))
     if not isinstance(variant, Variant):
       raise TypeError('Variant type %s is not valid.' % variant)
     self.__unrecognized_fields[key] = value, variant
@@ -954,8 +1268,14 @@ class Message(six.with_metaclass(_MessageClass, object)):
 
     Raises:
       AttributeError when trying to assign value that is not a field.
+      FrozenMessageError when trying to assign field of a frozen message.
     """
-    if name in self.__by_name or name.startswith('_Message__'):
+    if name in self.__by_name:
+      if self.__frozen:
+        raise FrozenMessageError('May not assign %s of frozen message %s' %
+                                 (name, type(self).__name__))
+      object.__setattr__(self, name, value)
+    elif name.startswith('_Message__'):
       object.__setattr__(self, name, value)
     else:
       raise AttributeError("May not assign arbitrary value %s "
@@ -1044,6 +1364,30 @@ class Message(six.with_metaclass(_MessageClass, object)):
     """
     return not self.__eq__(other)
 
+  def __hash__(self):
+    """Hash of frozen message.
+
+    The hash of a frozen message is computed over the values of all assigned
+    fields the first time it is needed and then reused.  Messages that are not
+    frozen keep the identity hash they always had on Python 2, so their hash
+    changes when they are frozen.  On Python 3 they are not hashable.
+
+    Raises:
+      TypeError if message is not frozen on Python 3.
+    """
+    if not self.__frozen:
+      if six.PY2:
+        return object.__hash__(self)
+      raise TypeError('Message %s must be frozen to be hashable' %
+                      type(self).__name__)
+    if self.__hash is None:
+      self.__hash = hash((type(self),
+                          frozenset((number, tuple(value)
+                                     if isinstance(value, (list, array.array))
+                                     else value)
+                                    for number, value in self.__tags.items())))
+    return self.__hash
+
 
 class FieldList(list):
   """List implementation that validates field values.
@@ -1134,6 +1478,500 @@ class FieldList(list):
     return list.insert(self, index, value)
 
 
+class _FrozenFieldList(FieldList):
+  """FieldList of a frozen message.
+
+  All methods that change the list raise FrozenMessageError.
+  """
+
+  def __init__(self, field_instance, sequence):
+    """Constructor.
+
+    Args:
+      field_instance: Instance of field that validated the list.
+      sequence: Validated list or tuple to construct list from.
+    """
+    self._FieldList__field = field_instance
+    list.__init__(self, sequence)
+
+  def __reduce__(self):
+    """Enable pickling without changing the list once it is frozen."""
+    return _FrozenFieldList, (None, list(self)), self.__getstate__()
+
+  def __readonly(self, *args, **kwargs):
+    raise FrozenMessageError('May not change repeated field %s of frozen '
+                             'message' % self.field.name)
+
+  __setitem__ = __delitem__ = __readonly
+  __setslice__ = __delslice__ = __readonly
+  __iadd__ = __imul__ = __readonly
+  append = extend = insert = pop = remove = __readonly
+  reverse = sort = clear = __readonly
+
+
+class FieldArray(array.array):
+  """Array implementation of values of repeated numeric fields.
+
+  Repeated integer and float fields defined with array=True store their values
+  unboxed in a FieldArray instead of a FieldList.  Values are validated by
+  their conversion to the item type of the array, so adding values of the
+  wrong type or integers out of the range of the field variant raises
+  ValidationError.  Sequences, arrays and NumPy arrays are converted as a
+  whole rather than element by element.
+
+  FieldArrays compare equal to lists and tuples of the same values.
+  """
+
+  def __new__(cls, field_instance, sequence=()):
+    """Constructor.
+
+    Args:
+      field_instance: Instance of field that validates the array.
+      sequence: List, tuple, array or NumPy array to construct array from.
+    """
+    if not field_instance.array:
+      raise FieldDefinitionError('FieldArray may only accept array fields')
+    values = array.array.__new__(cls, _ARRAY_TYPECODES[field_instance.variant])
+    values.__field = field_instance
+    FieldArray.extend(values, sequence)
+    return values
+
+  def __init__(self, field_instance, sequence=()):
+    """Array is initialized by __new__."""
+
+  def __reduce__(self):
+    """Enable pickling.
+
+    The assigned field instance can't be pickled if it belongs to a Message
+    definition (message_definition uses a weakref), so the Message class and
+    field number are pickled in that case.
+    """
+    message_class = self.__field.message_definition()
+    if message_class is None:
+      return type(self), (self.__field, self.tolist())
+    return _restore_field_array, (type(self), message_class,
+                                  self.__field.number, self.tolist())
+
+  def __reduce_ex__(self, protocol):
+    return self.__reduce__()
+
+  def __copy__(self):
+    return type(self)(self.__field, self)
+
+  def __deepcopy__(self, memo):
+    return type(self)(self.__field, self)
+
+  @property
+  def field(self):
+    """Field that validates array."""
+    return self.__field
+
+  def __field_name(self):
+    return getattr(self.__field, 'name', type(self.__field).__name__)
+
+  def __convert(self, sequence):
+    """Convert sequence to an array of the item type of the field.
+
+    Args:
+      sequence: List, tuple, array or NumPy array to convert.
+
+    Returns:
+      array.array of the values of sequence.
+
+    Raises:
+      ValidationError if sequence or any of its values can not be converted.
+    """
+    if isinstance(sequence, array.array):
+      if sequence.typecode == self.typecode:
+        return sequence
+      sequence = sequence.tolist()
+    elif hasattr(sequence, 'dtype'):
+      return self.__convert_ndarray(sequence)
+    elif sequence is None or isinstance(sequence, (six.string_types, bytes)):
+      raise ValidationError('Field %s is repeated. Found: %s' %
+                            (self.__field_name(), sequence))
+    try:
+      return array.array(self.typecode, sequence)
+    except (TypeError, OverflowError) as err:
+      raise ValidationError('Invalid value for field %s: %s' %
+                            (self.__field_name(), err))
+
+  def __convert_ndarray(self, values):
+    """Convert NumPy array, validating all of its values at once.
+
+    Args:
+      values: One dimensional NumPy array.
+
+    Returns:
+      array.array of the values of values.
+
+    Raises:
+      ValidationError if values is not of a numeric type compatible with the
+      field or has values out of the range of the field variant.
+    """
+    if self.typecode == 'd':
+      kinds = 'biuf'
+    else:
+      kinds = 'biu'
+    if values.dtype.kind not in kinds or values.ndim != 1:
+      raise ValidationError('Invalid array of type %s for field %s' %
+                            (values.dtype, self.__field_name()))
+
+    if self.typecode != 'd' and len(values):
+      bits = 8 * self.itemsize
+      if self.typecode.isupper():
+        minimum, maximum = 0, 2 ** bits - 1
+      else:
+        minimum, maximum = -2 ** (bits - 1), 2 ** (bits - 1) - 1
+      if int(values.min()) < minimum or int(values.max()) > maximum:
+        raise ValidationError('Values out of range for field %s' %
+                              self.__field_name())
+
+    converted = array.array(self.typecode)
+    getattr(converted, 'frombytes', converted.fromstring)(
+      values.astype(self.typecode).tobytes())
+    return converted
+
+  def __eq__(self, other):
+    if isinstance(other, (list, tuple)):
+      return self.tolist() == list(other)
+    return array.array.__eq__(self, other)
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  __hash__ = None
+
+  def __setslice__(self, i, j, sequence):
+    """Validate slice assignment to array."""
+    array.array.__setitem__(self, slice(i, j), self.__convert(sequence))
+
+  def __setitem__(self, index, value):
+    """Validate item assignment to array."""
+    if isinstance(index, slice):
+      value = self.__convert(value)
+    try:
+      array.array.__setitem__(self, index, value)
+    except (TypeError, OverflowError) as err:
+      raise ValidationError('Invalid value for field %s: %s' %
+                            (self.__field_name(), err))
+
+  def __iadd__(self, sequence):
+    """Validate extension of array."""
+    self.extend(sequence)
+    return self
+
+  def append(self, value):
+    """Validate item appending to array."""
+    try:
+      array.array.append(self, value)
+    except (TypeError, OverflowError) as err:
+      raise ValidationError('Invalid value for field %s: %s' %
+                            (self.__field_name(), err))
+
+  def extend(self, sequence):
+    """Validate extension of array."""
+    array.array.extend(self, self.__convert(sequence))
+
+  fromlist = extend
+
+  def insert(self, index, value):
+    """Validate item insertion to array."""
+    try:
+      array.array.insert(self, index, value)
+    except (TypeError, OverflowError) as err:
+      raise ValidationError('Invalid value for field %s: %s' %
+                            (self.__field_name(), err))
+
+
+class _FrozenFieldArray(FieldArray):
+  """FieldArray of a frozen message.
+
+  All methods that change the array raise FrozenMessageError.
+  """
+
+  def __readonly(self, *args, **kwargs):
+    raise FrozenMessageError('May not change repeated field %s of frozen '
+                             'message' % self.field.name)
+
+  __setitem__ = __delitem__ = __readonly
+  __setslice__ = __delslice__ = __readonly
+  __iadd__ = __imul__ = __readonly
+  append = extend = insert = pop = remove = __readonly
+  reverse = byteswap = fromlist = fromfile = __readonly
+  fromstring = frombytes = fromunicode = __readonly
+
+
+def _restore_field_array(array_type, message_class, number, values):
+  """Unpickle FieldArray of a field of a Message class."""
+  return array_type(message_class.field_by_number(number), values)
+
+
+def _freeze_value(value):
+  """Make field value immutable for a frozen message.
+
+  Args:
+    value: Value of a field as stored on a message.
+
+  Returns:
+    Value to store in place of value.  Messages are frozen in place, repeated
+    values are copied in to their read-only counterparts.
+  """
+  if isinstance(value, Message):
+    value.freeze()
+  elif isinstance(value, FieldList):
+    if not isinstance(value, _FrozenFieldList):
+      for item in value:
+        if isinstance(item, Message):
+          item.freeze()
+      value = _FrozenFieldList(value.field, value)
+  elif isinstance(value, FieldArray):
+    if not isinstance(value, _FrozenFieldArray):
+      value = _FrozenFieldArray(value.field, value)
+  return value
+
+
+class MessageBatch(object):
+  """Read-only sequence of messages stored by column.
+
+  A MessageBatch holds the values of many messages of the same type as one
+  tuple per field instead of one message per value, so that large repeated
+  message fields use neither a dictionary nor a message instance per element.
+  Repeated message fields defined with batch=True store their values in a
+  MessageBatch, and the protocols encode and decode them straight from and in
+  to columns.
+
+  Indexing and iterating a batch creates frozen messages from the columns on
+  demand.  Sub-messages and repeated values stored in a batch are frozen, and
+  unrecognized fields of messages put in a batch are dropped.
+
+  MessageBatches compare equal to lists and tuples of equal messages.
+  Changing the values of a repeated field stored in a batch is done by
+  assigning a new list or batch to the field.
+  """
+
+  def __init__(self, message_type, sequence=()):
+    """Constructor.
+
+    Args:
+      message_type: Message class of messages in batch.
+      sequence: Messages of message_type, or dictionaries of their field
+        values, to construct batch from.
+
+    Raises:
+      ValidationError when a value is neither an instance of message_type nor
+        a dictionary.
+    """
+    rows = []
+    for value in sequence:
+      if isinstance(value, dict):
+        value = message_type(**value)
+      elif not isinstance(value, message_type):
+        raise ValidationError('Expected type %s for batch, found %s (type %s)'
+                              % (message_type.__name__, value, type(value)))
+      rows.append(value._Message__tags)
+
+    columns = {}
+    for field in message_type.all_fields():
+      number = field.number
+      columns[field.name] = tuple(_freeze_value(tags.get(number))
+                                  for tags in rows)
+    self.__message_type = message_type
+    self.__columns = columns
+    self.__length = len(rows)
+    self.__hash = None
+
+  @classmethod
+  def __from_frozen_columns(cls, message_type, columns, length):
+    """Create batch from frozen, validated columns."""
+    batch = object.__new__(cls)
+    batch.__message_type = message_type
+    batch.__columns = columns
+    batch.__length = length
+    batch.__hash = None
+    return batch
+
+  @classmethod
+  def from_columns(cls, message_type, columns, length=None):
+    """Create batch from the values of each of its fields.
+
+    Args:
+      message_type: Message class of messages in batch.
+      columns: Dictionary mapping field names to sequences of values of the
+        field for each message of the batch.  Values are validated as if
+        assigned to the field of a message.  None in a column of a repeated
+        field is the same as an empty list.  Fields without a column are
+        unset in all messages.
+      length: Number of messages in batch.  Only required when columns is
+        empty.
+
+    Returns:
+      New MessageBatch instance.
+
+    Raises:
+      AttributeError when a column name is not the name of a field of
+        message_type.
+      ValidationError when columns are not of the same length or contain
+        invalid values.
+    """
+    scratch = message_type()
+    frozen_columns = {}
+    for name, column in six.iteritems(columns):
+      try:
+        field = message_type.field_by_name(name)
+      except KeyError:
+        raise AttributeError('Message %s has no field %s' % (
+            message_type.__name__, name))
+      values = []
+      for value in column:
+        if value is None and field.repeated:
+          value = []
+        field.__set__(scratch, value)
+        values.append(_freeze_value(scratch._Message__tags.get(field.number)))
+      if length is None:
+        length = len(values)
+      elif length != len(values):
+        raise ValidationError(
+            'Column %s of batch of %s has %d values, expected %d' %
+            (name, message_type.__name__, len(values), length))
+      frozen_columns[name] = tuple(values)
+
+    if length is None:
+      length = 0
+    for field in message_type.all_fields():
+      if field.name not in frozen_columns:
+        if field.repeated:
+          field.__set__(scratch, [])
+          empty = _freeze_value(scratch._Message__tags[field.number])
+        else:
+          empty = None
+        frozen_columns[field.name] = (empty,) * length
+    return cls.__from_frozen_columns(message_type, frozen_columns, length)
+
+  @property
+  def message_type(self):
+    """Message class of messages in batch."""
+    return self.__message_type
+
+  def column(self, name):
+    """Get values of a field of all messages in batch.
+
+    Args:
+      name: Name of field.
+
+    Returns:
+      Tuple of values of field, None for messages where it is not set.
+
+    Raises:
+      KeyError when name is not the name of a field of the message type.
+    """
+    return self.__columns[name]
+
+  def __message(self, index):
+    message = object.__new__(self.__message_type)
+    tags = {}
+    for field in self.__message_type.all_fields():
+      value = self.__columns[field.name][index]
+      if value is not None:
+        tags[field.number] = value
+    message._Message__tags = tags
+    message._Message__unrecognized_fields = {}
+    return message.freeze()
+
+  def __len__(self):
+    return self.__length
+
+  def __getitem__(self, index):
+    """Get message or slice of batch.
+
+    Args:
+      index: Integer index of message or slice.
+
+    Returns:
+      Frozen message at index, or new MessageBatch for slices.
+    """
+    if isinstance(index, slice):
+      columns = dict((name, column[index])
+                     for name, column in six.iteritems(self.__columns))
+      length = len(range(*index.indices(self.__length)))
+      return self.__from_frozen_columns(self.__message_type, columns, length)
+    if index < 0:
+      index += self.__length
+    if not 0 <= index < self.__length:
+      raise IndexError('MessageBatch index out of range')
+    return self.__message(index)
+
+  def __iter__(self):
+    for index in range(self.__length):
+      yield self.__message(index)
+
+  def check_initialized(self):
+    """Check that all messages of batch are initialized.
+
+    Raises:
+      ValidationError when a message of batch is not initialized.
+    """
+    plan = _get_check_initialized_plan(self.__message_type)
+    if plan is None:
+      for message in self:
+        message.check_initialized()
+      return
+
+    required_names, message_fields = plan
+    for name in required_names:
+      if None in self.__columns[name]:
+        raise ValidationError("Message %s is missing required field %s" %
+                              (self.__message_type.__name__, name))
+    for name, field in message_fields:
+      for value in self.__columns[name]:
+        if value is None:
+          continue
+        try:
+          if isinstance(value, MessageBatch):
+            value.check_initialized()
+          elif field.repeated:
+            for item in value:
+              field.value_to_message(item).check_initialized()
+          else:
+            field.value_to_message(value).check_initialized()
+        except ValidationError as err:
+          if not hasattr(err, 'message_name'):
+            err.message_name = self.__message_type.__name__
+          raise
+
+  def __eq__(self, other):
+    """Compare batch with other batch, list or tuple of messages."""
+    if self is other:
+      return True
+    if isinstance(other, MessageBatch):
+      return (self.__message_type is other.__message_type and
+              self.__length == other.__length and
+              self.__columns == other.__columns)
+    if isinstance(other, (list, tuple)):
+      return (self.__length == len(other) and
+              all(message == item for message, item in zip(self, other)))
+    return NotImplemented
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
+  def __hash__(self):
+    """Hash batch like a tuple of its messages."""
+    if self.__hash is None:
+      self.__hash = hash(tuple(self))
+    return self.__hash
+
+  def __repr__(self):
+    return 'MessageBatch(%s, %r)' % (self.__message_type.__name__,
+                                     list(self))
+
+
 class _FieldMeta(type):
 
   def __init__(cls, name, bases, dct):
@@ -1154,7 +1992,9 @@ class Field(six.with_metaclass(_FieldMeta, object)):
                required=False,
                repeated=False,
                variant=None,
-               default=None):
+               default=None,
+               packed=False,
+               array=False):
     """Constructor.
 
     The required and repeated parameters are mutually exclusive.  Setting both
@@ -1173,12 +2013,18 @@ class Field(six.with_metaclass(_FieldMeta, object)):
         'required'.
       variant: Wire-format variant hint.
       default: Default value for field if not found in stream.
+      packed: Whether values of a repeated numeric field are encoded together
+        in to a single length delimited value where the wire format allows it,
+        like the [packed=true] option of protocol buffers.
+      array: Whether values of a repeated integer or float field are stored in
+        a FieldArray instead of a FieldList.
 
     Raises:
       InvalidVariantError when invalid variant for field is provided.
       InvalidDefaultError when invalid default for field is provided.
       FieldDefinitionError when invalid number provided or mutually exclusive
-        fields are used.
+        fields are used, or when a field that is not a repeated numeric field
+        is packed or stored in an array.
       InvalidNumberError when the field number is out of range or reserved.
     """
     if not isinstance(number, int) or not 1 <= number <= MAX_FIELD_NUMBER:
@@ -1206,10 +2052,27 @@ class Field(six.with_metaclass(_FieldMeta, object)):
           'Invalid variant: %s\nValid variants for %s are %r' %
           (variant, type(self).__name__, sorted(self.VARIANTS)))
 
+    if packed:
+      if not repeated:
+        raise FieldDefinitionError('Only repeated fields may be packed')
+      if variant not in _PACKABLE_VARIANTS:
+        raise FieldDefinitionError('Fields of variant %s may not be packed' %
+                                   variant)
+
+    if array:
+      if not repeated:
+        raise FieldDefinitionError(
+            'Only repeated fields may be stored in arrays')
+      if variant not in _ARRAY_TYPECODES:
+        raise FieldDefinitionError(
+            'Fields of variant %s may not be stored in arrays' % variant)
+
     self.number = number
     self.required = required
     self.repeated = repeated
     self.variant = variant
+    self.packed = packed
+    self.array = array
 
     if default is not None:
       try:
@@ -1263,7 +2126,10 @@ class Field(six.with_metaclass(_FieldMeta, object)):
         message_instance._Message__tags.pop(self.number, None)
     else:
       if self.repeated:
-        value = FieldList(self, value)
+        if self.array:
+          value = FieldArray(self, value)
+        else:
+          value = FieldList(self, value)
       else:
         value = self.validate(value)
       message_instance._Message__tags[self.number] = value
@@ -1330,8 +2196,8 @@ class Field(six.with_metaclass(_FieldMeta, object)):
     if not self.repeated:
       return validate_element(value)
     else:
-      # Must be a list or tuple, may not be a string.
-      if isinstance(value, (list, tuple)):
+      # Must be a list, tuple or array, may not be a string.
+      if isinstance(value, (list, tuple, array.array)):
         result = []
         for element in value:
           if element is None:
@@ -1482,6 +2348,59 @@ class StringField(Field):
 
   type = six.text_type
 
+  @util.positional(2)
+  def __init__(self, number, interned=False, **kwargs):
+    """Constructor.
+
+    Args:
+      number: Number of field.  Must be unique per message class.
+      required: Whether or not field is required.  Mutually exclusive to
+        'repeated'.
+      repeated: Whether or not field is repeated.  Mutually exclusive to
+        'required'.
+      variant: Wire-format variant hint.
+      default: Default value for field if not found in stream.
+      interned: Whether decoded values are shared between all messages that
+        have the same value for field, rather than each decoded message
+        keeping its own copy.  Meant for fields with few distinct short
+        values, such as country codes or status names.  At most the
+        MAX_INTERNED_STRINGS most recently used values of up to
+        MAX_INTERNED_STRING_LENGTH characters are kept per field.
+    """
+    self.interned = interned
+    if interned:
+      self.__intern_lock = threading.Lock()
+      self.__intern_table = collections.OrderedDict()
+    else:
+      self.__intern_table = None
+    super(StringField, self).__init__(number, **kwargs)
+
+  def intern_value(self, value):
+    """Get the shared copy of a decoded value of field.
+
+    Protocols call this with the values they decode for fields defined with
+    interned=True.  Values longer than MAX_INTERNED_STRING_LENGTH are not
+    interned.  Once MAX_INTERNED_STRINGS values are kept for field, the least
+    recently used value is discarded to make room for a new one.
+
+    Args:
+      value: Value decoded for field.
+
+    Returns:
+      Value equal to value, shared with other decoded messages if field is
+      interned.
+    """
+    table = self.__intern_table
+    if (table is None or not isinstance(value, six.text_type) or
+        len(value) > MAX_INTERNED_STRING_LENGTH):
+      return value
+    with self.__intern_lock:
+      interned = table.pop(value, value)
+      table[interned] = interned
+      if len(table) > MAX_INTERNED_STRINGS:
+        table.popitem(last=False)
+    return interned
+
   def validate_element(self, value):
     """Validate StringField allowing for str and unicode.
 
@@ -1551,6 +2470,10 @@ class MessageField(Field):
 
       class Sibling(Message):
         ...
+
+  Repeated message fields defined with batch=True store their values in a
+  MessageBatch.  Lists and tuples assigned to them are converted in to a
+  batch, freezing their messages.
   """
 
   VARIANTS = frozenset([Variant.MESSAGE])
@@ -1563,7 +2486,8 @@ class MessageField(Field):
                number,
                required=False,
                repeated=False,
-               variant=None):
+               variant=None,
+               batch=False):
     """Constructor.
 
     Args:
@@ -1574,9 +2498,13 @@ class MessageField(Field):
       repeated: Whether or not field is repeated.  Mutually exclusive to
         'required'.
       variant: Wire-format variant hint.
+      batch: Whether values of a repeated field are stored in a MessageBatch
+        instead of a FieldList.
 
     Raises:
-      FieldDefinitionError when invalid message_type is provided.
+      FieldDefinitionError when invalid message_type is provided, or when a
+        field that is not repeated or that maps messages to other values is
+        batched.
     """
     valid_type = (isinstance(message_type, six.string_types) or
                   (message_type is not Message and
@@ -1592,6 +2520,15 @@ class MessageField(Field):
     else:
       self.__type = message_type
 
+    if batch:
+      if not repeated:
+        raise FieldDefinitionError('Only repeated fields may be batched')
+      if (type(self).value_from_message != MessageField.value_from_message or
+          type(self).value_to_message != MessageField.value_to_message):
+        raise FieldDefinitionError(
+            'Fields of type %s may not be batched' % type(self).__name__)
+    self.batch = batch
+
     super(MessageField, self).__init__(number,
                                        required=required,
                                        repeated=repeated,
@@ -1605,6 +2542,19 @@ class MessageField(Field):
       value: Value to set on message.
     """
     message_type = self.type
+    if self.batch:
+      if not isinstance(value, MessageBatch):
+        if not isinstance(value, (list, tuple)):
+          raise ValidationError('Field %s is repeated. Found: %s' %
+                                (self.name, value))
+        value = MessageBatch(message_type, value)
+      elif value.message_type is not message_type:
+        raise ValidationError('Expected batch of %s for field %s, found '
+                              'batch of %s' % (message_type.__name__,
+                                               self.name,
+                                               value.message_type.__name__))
+      message_instance._Message__tags[self.number] = value
+      return
     if isinstance(message_type, type) and issubclass(message_type, Message):
       if self.repeated:
         if value and isinstance(value, (list, tuple)):
@@ -1723,6 +2673,7 @@ class EnumField(Field):
         'required'.
       variant: Wire-format variant hint.
       default: Default value for field if not found in stream.
+      packed: Whether values of repeated field are packed.
 
     Raises:
       FieldDefinitionError when invalid enum_type is provided.
@@ -1841,6 +2792,9 @@ def find_definition(name, relative_to=None, importer=__import__):
 
     http://code.google.com/apis/protocolbuffers/docs/proto.html#packages
 
+  Definitions found using the default importer are cached by name and
+  relative_to.  See clear_definition_cache.
+
   Args:
     name: Name of definition to find.  May be fully qualified or relative name.
     relative_to: Search for definition relative to message definition or module.
@@ -1860,6 +2814,15 @@ def find_definition(name, relative_to=None, importer=__import__):
     raise TypeError('relative_to must be None, Message definition or module.  '
                     'Found: %s' % relative_to)
 
+  if importer is __import__:
+    cache_key = (name, relative_to)
+    with _definition_cache_lock:
+      found = _definition_cache.get(cache_key)
+    if found is not None:
+      return found
+  else:
+    cache_key = None
+
   name_path = name.split('.')
 
   # Handle absolute path reference.
@@ -1914,6 +2877,8 @@ def find_definition(name, relative_to=None, importer=__import__):
   while True:
     found = search_path()
     if isinstance(found, type) and issubclass(found, (Enum, Message)):
+      if cache_key is not None:
+        _cache_definition(cache_key, found)
       return found
     else:
       # Find next relative_to to search against.
@@ -1947,3 +2912,418 @@ def find_definition(name, relative_to=None, importer=__import__):
               relative_to.__module__, '', '', [last_module_name])
           else:
             relative_to = parent
+
+
+# Maximum number of compiled field masks kept by _compile_field_mask.  Masks
+# often come from requests, so the cache must not grow without bounds.
+_MAX_COMPILED_FIELD_MASKS = 1000
+
+_compiled_field_masks = {}
+
+# Maximum number of encodings with field masks kept per frozen message by
+# cached_encoding.  Masks often come from requests, so a long-lived frozen
+# message must not keep one encoding for every mask clients send.
+_MAX_MASKED_ENCODINGS = 8
+
+
+def _compile_field_mask(message_type, paths):
+  """Compile paths of a field mask for a message type.
+
+  Compiled masks are cached per message type and paths.
+
+  Args:
+    message_type: Message class that mask is applied to.
+    paths: Tuple of paths of FieldMask, each a tuple of field names.
+
+  Returns:
+    Tuple of (field, mask) for every selected field of message_type, ordered
+    by field number, where mask is the compiled mask of the sub-message
+    fields selected or None if the whole value of field is selected.
+
+  Raises:
+    ValidationError if a path does not refer to a field of message_type, or
+      continues past a field that is not a message field.
+  """
+  key = message_type, paths
+  compiled = _compiled_field_masks.get(key)
+  if compiled is not None:
+    return compiled
+
+  selected = {}
+  for path in paths:
+    name, rest = path[0], path[1:]
+    try:
+      field = message_type.field_by_name(name)
+    except KeyError:
+      raise ValidationError('Message %s has no field %s' %
+                            (message_type.__name__, name))
+    if not rest:
+      selected[name] = None
+    elif not (isinstance(field, MessageField) and
+              issubclass(field.type, Message)):
+      raise ValidationError('Field %s of message %s has no fields' %
+                            (name, message_type.__name__))
+    elif selected.get(name, ()) is not None:
+      selected.setdefault(name, []).append(rest)
+
+  # Required fields are kept so that projected messages are initialized.
+  for field in message_type.all_fields():
+    if field.required:
+      selected[field.name] = None
+
+  compiled = []
+  for name, field_paths in six.iteritems(selected):
+    field = message_type.field_by_name(name)
+    if field_paths is not None:
+      field_paths = _compile_field_mask(field.type, tuple(field_paths))
+    compiled.append((field, field_paths))
+  compiled = tuple(sorted(compiled, key=lambda item: item[0].number))
+
+  if len(_compiled_field_masks) >= _MAX_COMPILED_FIELD_MASKS:
+    _compiled_field_masks.clear()
+  _compiled_field_masks[key] = compiled
+  return compiled
+
+
+def _project_message(message, compiled):
+  """Copy fields of message selected by a compiled field mask."""
+  projected = type(message)()
+  tags = message._Message__tags
+  projected_tags = projected._Message__tags
+  for field, field_mask in compiled:
+    value = tags.get(field.number)
+    if value is None:
+      continue
+    if field_mask is not None:
+      if not field.repeated:
+        value = _project_message(value, field_mask)
+      else:
+        field.__set__(projected, [_project_message(item, field_mask)
+                                  for item in value])
+        continue
+    projected_tags[field.number] = value
+  return projected
+
+
+class FieldMask(object):
+  """Selection of fields of a message used to encode only part of it.
+
+  A field mask is a set of paths of field names separated by periods, such
+  as 'name' or 'items.price', written as a comma separated string like
+  'name,items.price'.  Selecting a message field selects all of its fields,
+  while a path continuing in to a message field, or in to each message of a
+  repeated message field, selects only those of its fields.  Required fields
+  are always selected, so that messages projected by a mask stay initialized
+  and can be decoded by clients expecting the full message type.
+
+  Protocols take field masks to encode partial messages:
+
+    protojson.encode_message(order, field_mask='symbol,lots.price')
+
+  Field masks compare equal when they have the same paths.
+  """
+
+  def __init__(self, paths):
+    """Constructor.
+
+    Args:
+      paths: Comma separated string of paths, or sequence of paths.
+
+    Raises:
+      ValidationError if a path has empty field names.
+    """
+    if isinstance(paths, six.string_types):
+      paths = paths.split(',')
+    parsed = set()
+    for path in paths:
+      path = path.strip()
+      if not path:
+        continue
+      names = tuple(path.split('.'))
+      if not all(names):
+        raise ValidationError('Invalid field mask path: %r' % path)
+      parsed.add(names)
+    self.__paths = tuple(sorted(parsed))
+
+  @property
+  def paths(self):
+    """Sorted tuple of paths of mask, each a tuple of field names."""
+    return self.__paths
+
+  def validate(self, message_type):
+    """Check that all paths of mask refer to fields of a message type.
+
+    Args:
+      message_type: Message class that mask is applied to.
+
+    Raises:
+      ValidationError if a path does not refer to a field of message_type.
+    """
+    _compile_field_mask(message_type, self.__paths)
+
+  def project(self, message):
+    """Copy fields of a message selected by mask.
+
+    Values of selected fields are shared with message rather than copied, so
+    the projected message should not be changed.
+
+    Args:
+      message: Message instance to project.
+
+    Returns:
+      New instance of the type of message with only the fields selected by
+      mask set.  Unrecognized fields are not copied.
+
+    Raises:
+      ValidationError if a path does not refer to a field of message.
+    """
+    return _project_message(message,
+                            _compile_field_mask(type(message), self.__paths))
+
+  def __eq__(self, other):
+    if not isinstance(other, FieldMask):
+      return NotImplemented
+    return self.__paths == other.__paths
+
+  def __ne__(self, other):
+    if not isinstance(other, FieldMask):
+      return NotImplemented
+    return self.__paths != other.__paths
+
+  def __hash__(self):
+    return hash(self.__paths)
+
+  def __str__(self):
+    return ','.join('.'.join(path) for path in self.__paths)
+
+  def __repr__(self):
+    return 'FieldMask(%r)' % str(self)
+
+
+def cached_encoding(message, key, encoder, field_mask=None):
+  """Encode message, reusing the previous encoding of frozen messages.
+
+  Frozen messages never change, so protocols keep their encoded form on the
+  message instead of encoding it again.  Messages that are not frozen are
+  always encoded.
+
+    def encode_message(message, field_mask=None):
+      return messages.cached_encoding(message, 'protobuf', _encode_message,
+                                      field_mask)
+
+  Args:
+    message: Message instance to encode.
+    key: Hashable key identifying the protocol and its options.
+    encoder: Function taking message and returning its encoded form.
+    field_mask: FieldMask, or paths of a FieldMask, selecting the fields of
+      message to encode.  Encoder is given the projected message.  Frozen
+      messages keep encodings for a small number of field masks, discarding
+      all of them when more masks are used.
+
+  Returns:
+    Encoded form of message as returned by encoder.
+  """
+  if field_mask is not None:
+    if not isinstance(field_mask, FieldMask):
+      field_mask = FieldMask(field_mask)
+    key = key, field_mask
+    encode_message = encoder
+    encoder = lambda message: encode_message(field_mask.project(message))
+
+  if not (isinstance(message, Message) and message._Message__frozen):
+    return encoder(message)
+  if field_mask is None:
+    encodings = message._Message__encodings
+  else:
+    encodings = message._Message__masked_encodings
+  try:
+    return encodings[key]
+  except KeyError:
+    encoded = encoder(message)
+    if field_mask is not None and len(encodings) >= _MAX_MASKED_ENCODINGS:
+      encodings.clear()
+    encodings[key] = encoded
+    return encoded
+
+
+_diff_types = {}
+
+
+def diff_type(message_type):
+  """Get the message class of diffs between messages of a type.
+
+  Diff classes are created the first time they are needed and are named
+  after the definition name of message_type within its package, so the diff
+  class of Outer.Inner is OuterInnerDiff.  They are added to the module of
+  message_type unless it already has an attribute of that name, so that
+  find_definition resolves their definition names.  Diff classes have two
+  fields:
+
+    values: Message of message_type with the fields that were set or
+      changed, and all required fields so that it stays initialized.  Unset
+      if no field was set or changed.
+    cleared: Numbers of the fields that were cleared.
+
+  Diffs are messages, so protocols encode and decode them like any other
+  message:
+
+    encoded = protojson.encode_message(messages.diff_messages(old, new))
+    diff = protojson.decode_message(messages.diff_type(Order), encoded)
+
+  Args:
+    message_type: Message class that diffs are of.
+
+  Returns:
+    Message class of diffs between instances of message_type.
+  """
+  try:
+    return _diff_types[message_type]
+  except KeyError:
+    pass
+  if not (isinstance(message_type, type) and
+          issubclass(message_type, Message)):
+    raise TypeError('Expected Message class, found %r' % (message_type,))
+  name = message_type.definition_name()
+  package = message_type.definition_package()
+  if package:
+    name = name[len(package) + 1:]
+  name = str('%sDiff' % name.replace('.', ''))
+  definition = _MessageClass(name, (Message,), {
+    '__module__': message_type.__module__,
+    'values': MessageField(message_type, 1),
+    'cleared': IntegerField(2, repeated=True),
+  })
+  definition = _diff_types.setdefault(message_type, definition)
+  module = sys.modules.get(message_type.__module__)
+  if module is not None and getattr(module, name, None) is None:
+    setattr(module, name, definition)
+  return definition
+
+
+def _assigned_tags(message):
+  """Map number of every field that is set on message to its value."""
+  tags = message._Message__tags
+  return dict((number, value) for number, value in six.iteritems(tags)
+              if value is not None and not
+              (isinstance(value, (list, array.array, MessageBatch)) and
+               not value))
+
+
+def diff_messages(old, new):
+  """Compute the changes turning a message in to another.
+
+  Fields of new that are not set in old or have a different value are set
+  in the diff, sub-messages and repeated fields as a whole, and fields of
+  old that are not set in new are cleared.  Unrecognized fields are not
+  compared.
+
+    diff = messages.diff_messages(snapshot, current)
+    messages.apply_diff(client_copy_of_snapshot, diff)
+
+  Args:
+    old: Message instance to compute changes from.
+    new: Message instance of the same type to compute changes to.
+
+  Returns:
+    Instance of diff_type(type(new)) with the changes.  Values are shared
+    with new rather than copied.
+
+  Raises:
+    TypeError if old and new are not messages of the same type.
+  """
+  message_type = type(new)
+  if type(old) is not message_type or not isinstance(new, Message):
+    raise TypeError('Expected messages of the same type, found %s and %s' %
+                    (type(old).__name__, message_type.__name__))
+  old_tags = _assigned_tags(old)
+  new_tags = _assigned_tags(new)
+
+  changed = {}
+  for number, value in six.iteritems(new_tags):
+    if old_tags.get(number) != value:
+      changed[number] = value
+
+  diff = diff_type(message_type)()
+  diff.cleared = sorted(number for number in old_tags
+                        if number not in new_tags)
+  if changed:
+    for field in message_type.all_fields():
+      if field.required and field.number in new_tags:
+        changed[field.number] = new_tags[field.number]
+    values = message_type()
+    values._Message__tags.update(changed)
+    diff.values = values
+  return diff
+
+
+def apply_diff(message, diff):
+  """Apply changes computed by diff_messages to a message.
+
+  Sub-messages of diff are assigned to message rather than copied, like
+  other assignments of message fields.  Numbers of cleared fields that
+  message has no field for are ignored, as are unrecognized fields of the
+  values of diff, so that diffs from newer versions of a message type still
+  apply.
+
+  Args:
+    message: Message instance to change.
+    diff: Instance of diff_type(type(message)).
+
+  Raises:
+    TypeError if diff is not a diff of messages of the type of message.
+    FrozenMessageError if message is frozen.
+  """
+  message_type = type(message)
+  if type(diff) is not diff_type(message_type):
+    raise TypeError('Expected diff of %s, found %s' %
+                    (message_type.__name__, type(diff).__name__))
+  for number in diff.cleared:
+    try:
+      field = message_type.field_by_number(number)
+    except KeyError:
+      continue
+    message.reset(field.name)
+  if diff.values is not None:
+    for number, value in six.iteritems(_assigned_tags(diff.values)):
+      setattr(message, message_type.field_by_number(number).name, value)
+
+
+def resolve_definitions(definition):
+  """Resolve all message and enum types referred to by name at once.
+
+  Message and enum fields whose type is given by name normally find their
+  type the first time it is needed.  Call this once a module has finished
+  loading to resolve all of them together, for example at the end of the
+  module:
+
+    messages.resolve_definitions(sys.modules[__name__])
+
+  Args:
+    definition: Module or Message definition.  Types of the fields of all
+      Message definitions it contains, including nested ones, are resolved.
+      For a module, only Message definitions defined in the module itself are
+      resolved.
+
+  Raises:
+    DefinitionNotFoundError if a type can not be found.
+    FieldDefinitionError if a type is not of the kind its field requires.
+  """
+  if isinstance(definition, types.ModuleType):
+    pending = [value for value in six.itervalues(vars(definition))
+               if (isinstance(value, type) and
+                   issubclass(value, Message) and
+                   value.__module__ == definition.__name__)]
+  else:
+    pending = [definition]
+
+  seen = set()
+  while pending:
+    message_type = pending.pop()
+    if message_type in seen:
+      continue
+    seen.add(message_type)
+    for field in message_type.all_fields():
+      if isinstance(field, (MessageField, EnumField)):
+        field.type
+    for name in getattr(message_type, '__messages__', ()):
+      pending.append(getattr(message_type, name))
@@ -21,6 +21,8 @@ import six
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
+import array
+import copy
 import pickle
 import re
 import sys
@@ -126,6 +128,32 @@ class EnumTest(test_util.TestCase):
     self.assertRaises(TypeError, Color, 100)
     self.assertRaises(TypeError, Color, 10.0)
 
+  def testConstructorReturnsSingletons(self):
+    """Test that casting returns the enum values themselves."""
+    self.assertTrue(Color.RED is Color('RED'))
+    self.assertTrue(Color.RED is Color(u'RED'))
+    self.assertTrue(Color.RED is Color(20))
+    self.assertTrue(Color.RED is Color(Color.RED))
+
+  def testConstructorNumberLikeValues(self):
+    """Test that only integers are looked up by number."""
+    self.assertRaises(TypeError, Color, 20.0)
+    self.assertRaises(TypeError, Color, '20')
+
+    class Flag(messages.Enum):
+      OFF = 0
+      ON = 1
+
+    self.assertTrue(Flag.ON is Flag(True))
+    self.assertRaises(TypeError, Flag, 1.0)
+
+  def testConstructorOtherEnum(self):
+    """Test that values of other enums are not cast."""
+    class OtherColor(messages.Enum):
+      RED = 20
+
+    self.assertRaises(TypeError, Color, OtherColor.RED)
+
   def testLen(self):
     """Test that len function works to count enums."""
     self.assertEquals(7, len(Color))
@@ -495,6 +523,354 @@ class FieldListTest(test_util.TestCase):
     self.assertTrue(unpickled.field.repeated)
 
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+class Series(messages.Message):
+
+  times = messages.IntegerField(1, repeated=True, array=True)
+  values = messages.FloatField(2, repeated=True, array=True)
+  counts = messages.IntegerField(3, repeated=True, array=True,
+                                 variant=messages.Variant.UINT32)
+
+
+class FieldArrayTest(test_util.TestCase):
+
+  def setUp(self):
+    self.integer_field = messages.IntegerField(1, repeated=True, array=True)
+    self.float_field = messages.FloatField(1, repeated=True, array=True)
+
+  def testConstructor(self):
+    self.assertEquals([1, 2, 3],
+                      messages.FieldArray(self.integer_field, [1, 2, 3]))
+    self.assertEquals([1, 2, 3],
+                      messages.FieldArray(self.integer_field, (1, 2, 3)))
+    self.assertEquals([], messages.FieldArray(self.integer_field, []))
+    self.assertEquals([1.0, 2.5],
+                      messages.FieldArray(self.float_field, [1, 2.5]))
+    self.assertEquals('d', messages.FieldArray(self.float_field).typecode)
+    self.assertTrue(self.integer_field is
+                    messages.FieldArray(self.integer_field).field)
+
+  def testConstructorFromArray(self):
+    values = messages.FieldArray(self.float_field,
+                                 array.array('f', [1.5, 2.5]))
+    self.assertEquals([1.5, 2.5], values)
+    self.assertEquals([1.5, 2.5],
+                      messages.FieldArray(self.float_field, values))
+    self.assertFalse(values is messages.FieldArray(self.float_field, values))
+
+  def testNotArrayField(self):
+    self.assertRaisesWithRegexpMatch(
+      messages.FieldDefinitionError,
+      'FieldArray may only accept array fields',
+      messages.FieldArray, messages.IntegerField(1, repeated=True), [])
+
+  def testInvalidValues(self):
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, self.integer_field, [1, '2'])
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, self.integer_field, [1.5])
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, self.integer_field, [None])
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, self.float_field, ['1.5'])
+    self.assertRaisesWithRegexpMatch(
+      messages.ValidationError,
+      'Field IntegerField is repeated. Found: 123',
+      messages.FieldArray, self.integer_field, '123')
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, self.integer_field, 3)
+
+  def testOutOfRange(self):
+    int32_field = messages.IntegerField(1, repeated=True, array=True,
+                                        variant=messages.Variant.INT32)
+    uint32_field = messages.IntegerField(1, repeated=True, array=True,
+                                         variant=messages.Variant.UINT32)
+    messages.FieldArray(int32_field, [2 ** 31 - 1, -2 ** 31])
+    messages.FieldArray(uint32_field, [2 ** 32 - 1])
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, int32_field, [2 ** 31])
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, uint32_field, [-1])
+    self.assertRaises(messages.ValidationError,
+                      messages.FieldArray, self.integer_field, [2 ** 63])
+
+  def testMutation(self):
+    values = messages.FieldArray(self.integer_field, [1, 2])
+    values.append(3)
+    values.extend([4, 5])
+    values.insert(0, 0)
+    values += [6]
+    values[0] = 10
+    values[1:3] = [11, 12]
+    self.assertEquals([10, 11, 12, 3, 4, 5, 6], values)
+
+    self.assertRaises(messages.ValidationError, values.append, '7')
+    self.assertRaises(messages.ValidationError, values.extend, [7, '8'])
+    self.assertRaises(messages.ValidationError, values.insert, 0, None)
+    self.assertRaises(messages.ValidationError, values.__setitem__, 0, 1.5)
+    self.assertRaises(messages.ValidationError,
+                      values.__setitem__, slice(0, 1), ['1'])
+    self.assertEquals([10, 11, 12, 3, 4, 5, 6], values)
+
+  def testEquality(self):
+    values = messages.FieldArray(self.integer_field, [1, 2])
+    self.assertEquals([1, 2], values)
+    self.assertEquals(values, (1, 2))
+    self.assertNotEquals([1, 3], values)
+    self.assertNotEquals(values, [1])
+    self.assertEquals(messages.FieldArray(self.integer_field, [1, 2]), values)
+
+  def testMessage(self):
+    series = Series(times=[1, 2], values=[0.5])
+    self.assertTrue(isinstance(series.times, messages.FieldArray))
+    self.assertEquals([1, 2], series.times)
+    self.assertEquals([0.5], series.values)
+    self.assertEquals([], series.counts)
+    self.assertEquals(Series(times=[1, 2], values=[0.5]), series)
+
+    series.reset('times')
+    self.assertTrue(isinstance(series.times, messages.FieldArray))
+    self.assertEquals([], series.times)
+    self.assertRaises(messages.ValidationError,
+                      setattr, series, 'counts', [-1])
+
+  def testCopyValuesToList(self):
+    class ListSeries(messages.Message):
+      times = messages.IntegerField(1, repeated=True)
+
+    series = ListSeries(times=Series(times=[1, 2]).times)
+    self.assertEquals([1, 2], series.times)
+    self.assertTrue(isinstance(series.times, messages.FieldList))
+
+  def testPickle(self):
+    series = Series(times=[1, 2], values=[0.5])
+    unpickled = pickle.loads(pickle.dumps(series))
+    self.assertEquals(series, unpickled)
+    self.assertTrue(Series.times is unpickled.times.field)
+
+  def testCopy(self):
+    series = Series(times=[1, 2])
+    copied = copy.deepcopy(series)
+    self.assertEquals(series, copied)
+    self.assertFalse(series.times is copied.times)
+    self.assertTrue(Series.times is copied.times.field)
+
+  def testFreeze(self):
+    series = Series(times=[1, 2]).freeze()
+    self.assertRaises(messages.FrozenMessageError, series.times.append, 3)
+    self.assertRaises(messages.FrozenMessageError, series.times.extend, [3])
+    self.assertRaises(messages.FrozenMessageError,
+                      series.times.__setitem__, 0, 3)
+    self.assertEquals(hash(series), hash(Series(times=[1, 2]).freeze()))
+
+  def testFieldDefinition(self):
+    self.assertFalse(messages.IntegerField(1, repeated=True).array)
+    self.assertRaisesWithRegexpMatch(
+      messages.FieldDefinitionError,
+      'Only repeated fields may be stored in arrays',
+      messages.IntegerField, 1, array=True)
+    self.assertRaisesWithRegexpMatch(
+      messages.FieldDefinitionError,
+      'Fields of variant STRING may not be stored in arrays',
+      messages.StringField, 1, repeated=True, array=True)
+    self.assertRaises(messages.FieldDefinitionError,
+                      messages.BooleanField, 1, repeated=True, array=True)
+
+  if numpy is not None:
+
+    def testNumPy(self):
+      self.assertEquals([1, 2, 3],
+                        messages.FieldArray(self.integer_field,
+                                            numpy.arange(1, 4)))
+      self.assertEquals([0.5, 1.0],
+                        messages.FieldArray(self.float_field,
+                                            numpy.array([0.5, 1.0])))
+      self.assertRaises(messages.ValidationError,
+                        messages.FieldArray, self.integer_field,
+                        numpy.array([0.5]))
+      self.assertRaises(messages.ValidationError,
+                        messages.FieldArray, self.integer_field,
+                        numpy.zeros((2, 2), dtype=int))
+      self.assertRaises(messages.ValidationError,
+                        messages.FieldArray, Series.counts,
+                        numpy.array([-1, 1]))
+
+
+class Sample(messages.Message):
+
+  name = messages.StringField(1, required=True)
+  value = messages.FloatField(2)
+  labels = messages.StringField(3, repeated=True)
+
+
+class Samples(messages.Message):
+
+  samples = messages.MessageField(Sample, 1, repeated=True, batch=True)
+
+
+class MessageBatchTest(test_util.TestCase):
+
+  def setUp(self):
+    self.sample1 = Sample(name=u'a', value=0.5, labels=[u'x'])
+    self.sample2 = Sample(name=u'b')
+
+  def testConstructor(self):
+    batch = messages.MessageBatch(Sample, [self.sample1, {'name': u'b'}])
+    self.assertEquals(Sample, batch.message_type)
+    self.assertEquals(2, len(batch))
+    self.assertEquals((u'a', u'b'), batch.column('name'))
+    self.assertEquals((0.5, None), batch.column('value'))
+    self.assertEquals(([u'x'], []), batch.column('labels'))
+    self.assertEquals([self.sample1, self.sample2], batch)
+    self.assertEquals([self.sample1, self.sample2], list(batch))
+    self.assertEquals([], messages.MessageBatch(Sample))
+
+  def testConstructorInvalidValues(self):
+    self.assertRaises(messages.ValidationError,
+                      messages.MessageBatch, Sample, [Samples()])
+    self.assertRaises(messages.ValidationError,
+                      messages.MessageBatch, Sample, [None])
+    self.assertRaises(AttributeError,
+                      messages.MessageBatch, Sample, [{'unknown': 1}])
+
+  def testFromColumns(self):
+    batch = messages.MessageBatch.from_columns(
+      Sample, {'name': [u'a', u'b'],
+               'value': [0.5, None],
+               'labels': [[u'x'], None],
+              })
+    self.assertEquals([self.sample1, self.sample2], batch)
+    self.assertEquals([Sample(), Sample()],
+                      messages.MessageBatch.from_columns(Sample, {}, 2))
+    self.assertEquals([], messages.MessageBatch.from_columns(Sample, {}))
+
+  def testFromColumnsInvalid(self):
+    self.assertRaisesWithRegexpMatch(
+      AttributeError,
+      'Message Sample has no field unknown',
+      messages.MessageBatch.from_columns, Sample, {'unknown': [1]})
+    self.assertRaises(messages.ValidationError,
+                      messages.MessageBatch.from_columns,
+                      Sample, {'name': [u'a'], 'value': [1.0, 2.0]})
+    self.assertRaises(messages.ValidationError,
+                      messages.MessageBatch.from_columns,
+                      Sample, {'value': [1.0]}, 2)
+    self.assertRaises(messages.ValidationError,
+                      messages.MessageBatch.from_columns,
+                      Sample, {'value': ['not a float']})
+
+  def testIndexing(self):
+    batch = messages.MessageBatch(Sample, [self.sample1, self.sample2])
+    self.assertEquals(self.sample1, batch[0])
+    self.assertEquals(self.sample2, batch[-1])
+    self.assertTrue(batch[0].is_frozen())
+    self.assertRaises(IndexError, batch.__getitem__, 2)
+    self.assertRaises(IndexError, batch.__getitem__, -3)
+
+    sliced = batch[1:]
+    self.assertTrue(isinstance(sliced, messages.MessageBatch))
+    self.assertEquals([self.sample2], sliced)
+    self.assertEquals((u'b',), sliced.column('name'))
+    self.assertEquals([], batch[5:])
+
+  def testValuesFrozen(self):
+    batch = messages.MessageBatch(Sample, [self.sample1])
+    self.assertRaises(messages.FrozenMessageError,
+                      batch.column('labels')[0].append, u'y')
+    self.assertRaises(messages.FrozenMessageError,
+                      setattr, batch[0], 'name', u'c')
+    self.sample1.name = u'c'
+    self.assertEquals((u'a',), batch.column('name'))
+
+  def testEquality(self):
+    batch = messages.MessageBatch(Sample, [self.sample1, self.sample2])
+    self.assertEquals(batch, (self.sample1, self.sample2))
+    self.assertEquals(messages.MessageBatch(Sample,
+                                            [self.sample1, self.sample2]),
+                      batch)
+    self.assertNotEquals(batch, [self.sample1])
+    self.assertNotEquals(batch, [self.sample2, self.sample1])
+    self.assertNotEquals(messages.MessageBatch(Sample, [self.sample1]), batch)
+    self.assertEquals(hash((self.sample1.freeze(), self.sample2.freeze())),
+                      hash(batch))
+
+  def testCheckInitialized(self):
+    messages.MessageBatch(Sample, [self.sample1]).check_initialized()
+    batch = messages.MessageBatch(Sample, [self.sample1, Sample()])
+    self.assertRaisesWithRegexpMatch(
+      messages.ValidationError,
+      'Message Sample is missing required field name',
+      batch.check_initialized)
+    self.assertFalse(Samples(samples=batch).is_initialized())
+
+  def testField(self):
+    samples = Samples()
+    self.assertTrue(isinstance(samples.samples, messages.MessageBatch))
+    self.assertEquals([], samples.samples)
+
+    samples.samples = [self.sample1, {'name': u'b'}]
+    self.assertTrue(isinstance(samples.samples, messages.MessageBatch))
+    self.assertEquals([self.sample1, self.sample2], samples.samples)
+    self.assertEquals(Samples(samples=[self.sample1, self.sample2]), samples)
+
+    batch = messages.MessageBatch(Sample, [self.sample2])
+    samples.samples = batch
+    self.assertTrue(batch is samples.samples)
+
+    samples.reset('samples')
+    self.assertEquals([], samples.samples)
+
+  def testFieldInvalidValues(self):
+    samples = Samples()
+    self.assertRaisesWithRegexpMatch(
+      messages.ValidationError,
+      'Field samples is repeated. Found: 10',
+      setattr, samples, 'samples', 10)
+    self.assertRaises(messages.ValidationError,
+                      setattr, samples, 'samples', self.sample1)
+    self.assertRaises(messages.ValidationError,
+                      setattr, samples, 'samples', None)
+    self.assertRaisesWithRegexpMatch(
+      messages.ValidationError,
+      'Expected batch of Sample for field samples, found batch of Samples',
+      setattr, samples, 'samples', messages.MessageBatch(Samples))
+
+  def testFieldDefinition(self):
+    self.assertFalse(messages.MessageField(Sample, 1, repeated=True).batch)
+    self.assertRaisesWithRegexpMatch(
+      messages.FieldDefinitionError,
+      'Only repeated fields may be batched',
+      messages.MessageField, Sample, 1, batch=True)
+    self.assertRaisesWithRegexpMatch(
+      messages.FieldDefinitionError,
+      'Fields of type DateTimeField may not be batched',
+      message_types.DateTimeField, 1, repeated=True, batch=True)
+
+  def testFreeze(self):
+    samples = Samples(samples=[self.sample1]).freeze()
+    self.assertEquals(hash(Samples(samples=[self.sample1]).freeze()),
+                      hash(samples))
+
+  def testPickle(self):
+    samples = Samples(samples=[self.sample1, self.sample2])
+    unpickled = pickle.loads(pickle.dumps(samples))
+    self.assertEquals(samples, unpickled)
+    self.assertTrue(isinstance(unpickled.samples, messages.MessageBatch))
+
+  def testCopy(self):
+    samples = Samples(samples=[self.sample1])
+    self.assertEquals(samples, copy.deepcopy(samples))
+
+  def testRepr(self):
+    self.assertEquals('MessageBatch(Sample, [])',
+                      repr(messages.MessageBatch(Sample)))
+
+
 class FieldTest(test_util.TestCase):
 
   def ActionOnAllFieldClasses(self, action):
@@ -554,6 +930,62 @@ class FieldTest(test_util.TestCase):
                         repeated=True)
     self.ActionOnAllFieldClasses(action)
 
+  def testPacked(self):
+    """Test packed repeated fields."""
+    self.assertFalse(messages.IntegerField(1, repeated=True).packed)
+    self.assertTrue(messages.IntegerField(1, repeated=True, packed=True).packed)
+    self.assertTrue(messages.EnumField(descriptor.FieldDescriptor.Label, 1,
+                                       repeated=True, packed=True).packed)
+    self.assertRaisesWithRegexpMatch(messages.FieldDefinitionError,
+                                     'Only repeated fields may be packed',
+                                     messages.IntegerField, 1, packed=True)
+    self.assertRaisesWithRegexpMatch(
+      messages.FieldDefinitionError,
+      'Fields of variant STRING may not be packed',
+      messages.StringField, 1, repeated=True, packed=True)
+    self.assertRaises(messages.FieldDefinitionError,
+                      messages.BytesField, 1, repeated=True, packed=True)
+
+  def testIntern(self):
+    """Test interning of values of string fields."""
+    field = messages.StringField(1, interned=True, required=True)
+    self.assertTrue(field.interned)
+    self.assertTrue(field.required)
+    value = u''.join([u'val', u'ue'])
+    self.assertTrue(value is field.intern_value(value))
+    self.assertTrue(value is field.intern_value(u''.join([u'va', u'lue'])))
+    self.assertEquals(b'value', field.intern_value(b'value'))
+
+    field = messages.StringField(1)
+    self.assertFalse(field.interned)
+    self.assertFalse(value is field.intern_value(u''.join([u'va', u'lue'])))
+
+  def testInternLongValues(self):
+    """Test that values longer than MAX_INTERNED_STRING_LENGTH are copied."""
+    field = messages.StringField(1, interned=True)
+    length = messages.MAX_INTERNED_STRING_LENGTH
+    value = u'x' * length
+    self.assertTrue(value is field.intern_value(value))
+    self.assertTrue(value is field.intern_value(u'x' * length))
+    value = u'x' * (length + 1)
+    self.assertTrue(value is field.intern_value(value))
+    self.assertFalse(value is field.intern_value(u'x' * (length + 1)))
+
+  def testInternBounded(self):
+    """Test that fields keep the MAX_INTERNED_STRINGS latest used values."""
+    field = messages.StringField(1, interned=True)
+    interned = [field.intern_value(u'value%d' % index)
+                for index in range(messages.MAX_INTERNED_STRINGS)]
+    # Using value0 makes value1 the least recently used value.
+    self.assertTrue(interned[0] is field.intern_value(u'value%d' % 0))
+
+    value = u'value%d' % messages.MAX_INTERNED_STRINGS
+    self.assertTrue(value is field.intern_value(value))
+    self.assertTrue(value is field.intern_value(
+      u'value%d' % messages.MAX_INTERNED_STRINGS))
+    self.assertTrue(interned[0] is field.intern_value(u'value%d' % 0))
+    self.assertFalse(interned[1] is field.intern_value(u'value%d' % 1))
+
   def testInvalidVariant(self):
     """Test field with invalid variants."""
     def action(field_class):
@@ -2101,6 +2533,573 @@ class FindDefinitionUnicodeTests(test_util.TestCase):
                         None).__name__)
 
 
+class Node(messages.Message):
+
+  children = messages.MessageField('Node', 1, repeated=True)
+  value = messages.IntegerField(2)
+
+
+class RequiredNode(messages.Message):
+
+  children = messages.MessageField('RequiredNode', 1, repeated=True)
+  value = messages.IntegerField(2, required=True)
+
+
+class CheckInitializedPlanTest(test_util.TestCase):
+  """Test plans used by Message.check_initialized."""
+
+  def testNoRequiredFields(self):
+    class Leaf(messages.Message):
+      value = messages.IntegerField(1)
+
+    class Tree(messages.Message):
+      leaf = messages.MessageField(Leaf, 1)
+      leaves = messages.MessageField(Leaf, 2, repeated=True)
+
+    Tree(leaf=Leaf(), leaves=[Leaf()]).check_initialized()
+    self.assertEquals(((), ()), Tree._check_initialized_plan)
+    self.assertEquals(((), ()), Leaf._check_initialized_plan)
+
+  def testIndirectRequiredFields(self):
+    class Leaf(messages.Message):
+      value = messages.IntegerField(1, required=True)
+
+    class Branch(messages.Message):
+      leaf = messages.MessageField(Leaf, 1)
+      leaf_count = messages.IntegerField(2)
+
+    class Tree(messages.Message):
+      branches = messages.MessageField(Branch, 1, repeated=True)
+      name = messages.StringField(2)
+
+    tree = Tree(branches=[Branch(leaf=Leaf(value=1))])
+    tree.check_initialized()
+    self.assertEquals(((), (('branches', Tree.branches),)),
+                      Tree._check_initialized_plan)
+    self.assertEquals(((), (('leaf', Branch.leaf),)),
+                      Branch._check_initialized_plan)
+    self.assertEquals((('value',), ()), Leaf._check_initialized_plan)
+
+    tree.branches.append(Branch(leaf=Leaf()))
+    self.assertRaisesWithRegexpMatch(
+      messages.ValidationError,
+      'Message Leaf is missing required field value',
+      tree.check_initialized)
+
+  def testRecursive(self):
+    Node(children=[Node(children=[Node()])]).check_initialized()
+    self.assertEquals(((), ()), Node._check_initialized_plan)
+
+    node = RequiredNode(value=1, children=[RequiredNode()])
+    self.assertRaises(messages.ValidationError, node.check_initialized)
+    node.children[0].value = 2
+    node.check_initialized()
+
+  def testUnresolvedDefinition(self):
+    class Forward(messages.Message):
+      later = messages.MessageField('NotDefinedYet', 1)
+      value = messages.IntegerField(2, required=True)
+
+    self.assertRaises(messages.ValidationError, Forward().check_initialized)
+    Forward(value=1).check_initialized()
+    self.assertFalse('_check_initialized_plan' in Forward.__dict__)
+
+
+class FrozenMessageTest(test_util.TestCase):
+  """Test frozen messages."""
+
+  def setUp(self):
+    self.leaf = Node(value=2)
+    self.node = Node(value=1, children=[self.leaf])
+
+  def testFreeze(self):
+    self.assertFalse(self.node.is_frozen())
+    self.assertTrue(self.node is self.node.freeze())
+    self.assertTrue(self.node.is_frozen())
+    self.assertTrue(self.leaf.is_frozen())
+    self.assertEquals([Node(value=2)], self.node.children)
+    self.assertTrue(self.node.freeze().is_frozen())
+
+  def testAssign(self):
+    self.node.freeze()
+    self.assertRaises(messages.FrozenMessageError,
+                      setattr, self.node, 'value', 3)
+    self.assertRaises(messages.FrozenMessageError,
+                      setattr, self.leaf, 'value', 3)
+    self.assertRaises(messages.FrozenMessageError,
+                      setattr, self.node, 'children', [])
+    self.assertRaises(AttributeError, setattr, self.node, 'other', 3)
+    self.assertRaises(messages.FrozenMessageError, self.node.reset, 'value')
+    self.assertRaises(messages.FrozenMessageError,
+                      self.node.set_unrecognized_field,
+                      'unknown', 1, messages.Variant.INT64)
+    self.assertEquals(1, self.node.value)
+
+  def testRepeatedField(self):
+    self.node.freeze()
+    children = self.node.children
+    self.assertTrue(isinstance(children, messages.FieldList))
+    self.assertRaises(messages.FrozenMessageError, children.append, Node())
+    self.assertRaises(messages.FrozenMessageError, children.extend, [Node()])
+    self.assertRaises(messages.FrozenMessageError, children.insert, 0, Node())
+    self.assertRaises(messages.FrozenMessageError, children.pop)
+    self.assertRaises(messages.FrozenMessageError, children.remove, self.leaf)
+    self.assertRaises(messages.FrozenMessageError, children.sort)
+    self.assertRaises(messages.FrozenMessageError,
+                      children.__setitem__, 0, Node())
+    self.assertRaises(messages.FrozenMessageError, children.__delitem__, 0)
+    self.assertRaises(messages.FrozenMessageError,
+                      children.__setitem__, slice(0, 1), [])
+    self.assertEquals([self.leaf], children)
+
+  def testUnfrozenHash(self):
+    if six.PY2:
+      # Messages that are not frozen are hashed by identity on Python 2.
+      self.assertEquals(2, len(set([Node(), Node()])))
+      self.assertEquals(object.__hash__(self.node), hash(self.node))
+    else:
+      self.assertRaises(TypeError, hash, self.node)
+
+  def testHash(self):
+    self.node.freeze()
+    other = Node(value=1, children=[Node(value=2)]).freeze()
+    self.assertEquals(hash(self.node), hash(other))
+    self.assertEquals(hash(self.node), hash(self.node))
+    results = {self.node: u'result'}
+    self.assertEquals(u'result', results[other])
+    self.assertFalse(Node(value=1).freeze() in results)
+
+  def testEquality(self):
+    frozen = Node(value=1, children=[Node(value=2)]).freeze()
+    self.assertEquals(self.node, frozen)
+    self.assertEquals(frozen, self.node)
+
+  def testPickle(self):
+    self.node.freeze()
+    unpickled = pickle.loads(pickle.dumps(self.node))
+    self.assertEquals(self.node, unpickled)
+    self.assertTrue(unpickled.is_frozen())
+    self.assertEquals(Node.children, unpickled.children.field)
+    self.assertRaises(messages.FrozenMessageError,
+                      unpickled.children.append, Node())
+
+  def testCachedEncoding(self):
+    calls = []
+    def encoder(message):
+      calls.append(message)
+      return b'encoded'
+
+    self.assertEquals(b'encoded',
+                      messages.cached_encoding(self.node, 'key', encoder))
+    self.assertEquals(b'encoded',
+                      messages.cached_encoding(self.node, 'key', encoder))
+    self.assertEquals(2, len(calls))
+
+    self.node.freeze()
+    del calls[:]
+    self.assertEquals(b'encoded',
+                      messages.cached_encoding(self.node, 'key', encoder))
+    self.assertEquals(b'encoded',
+                      messages.cached_encoding(self.node, 'key', encoder))
+    self.assertEquals(b'encoded',
+                      messages.cached_encoding(self.node, 'other', encoder))
+    self.assertEquals(2, len(calls))
+
+
+class Order(messages.Message):
+
+  symbol = messages.StringField(1, required=True)
+  quantity = messages.IntegerField(2)
+  lot = messages.MessageField(Sample, 3)
+  lots = messages.MessageField(Sample, 4, repeated=True)
+  samples = messages.MessageField(Samples, 5)
+
+
+class Trade(messages.Message):
+
+  class Leg(messages.Message):
+
+    symbol = messages.StringField(1)
+
+  legs = messages.MessageField(Leg, 1, repeated=True)
+
+
+class Quote(messages.Message):
+
+  class Leg(messages.Message):
+
+    price = messages.FloatField(1)
+
+  legs = messages.MessageField(Leg, 1, repeated=True)
+
+
+class FieldMaskTest(test_util.TestCase):
+  """Test field masks."""
+
+  def setUp(self):
+    self.order = Order(symbol=u'ABC',
+                       quantity=10,
+                       lot=Sample(name=u'a', value=0.5, labels=[u'x']),
+                       lots=[Sample(name=u'b', value=1.5),
+                             Sample(name=u'c', value=2.5)])
+
+  def testPaths(self):
+    self.assertEquals((('lot', 'value'), ('quantity',)),
+                      messages.FieldMask('quantity, lot.value,,').paths)
+    self.assertEquals((('lot', 'value'), ('quantity',)),
+                      messages.FieldMask(['quantity', 'lot.value',
+                                          'quantity']).paths)
+    self.assertEquals((), messages.FieldMask('').paths)
+
+  def testInvalidPath(self):
+    self.assertRaisesWithRegexpMatch(messages.ValidationError,
+                                     "Invalid field mask path: 'lot..value'",
+                                     messages.FieldMask, 'lot..value')
+
+  def testEquality(self):
+    mask = messages.FieldMask('quantity,lot.value')
+    self.assertEquals(mask, messages.FieldMask(['lot.value', 'quantity']))
+    self.assertEquals(hash(mask),
+                      hash(messages.FieldMask(['lot.value', 'quantity'])))
+    self.assertNotEquals(mask, messages.FieldMask('quantity'))
+    self.assertNotEquals(mask, 'quantity,lot.value')
+
+  def testStr(self):
+    mask = messages.FieldMask('quantity,lot.value')
+    self.assertEquals('lot.value,quantity', str(mask))
+    self.assertEquals("FieldMask('lot.value,quantity')", repr(mask))
+
+  def testValidate(self):
+    messages.FieldMask('quantity,lot.value').validate(Order)
+    self.assertRaisesWithRegexpMatch(messages.ValidationError,
+                                     'Message Order has no field unknown',
+                                     messages.FieldMask('unknown').validate,
+                                     Order)
+    self.assertRaisesWithRegexpMatch(messages.ValidationError,
+                                     'Message Sample has no field unknown',
+                                     messages.FieldMask('lot.unknown').validate,
+                                     Order)
+    self.assertRaisesWithRegexpMatch(
+      messages.ValidationError,
+      'Field quantity of message Order has no fields',
+      messages.FieldMask('quantity.value').validate, Order)
+
+  def testProject(self):
+    projected = messages.FieldMask('quantity').project(self.order)
+    self.assertEquals(Order(symbol=u'ABC', quantity=10), projected)
+    projected.check_initialized()
+
+  def testProjectMessageField(self):
+    self.assertEquals(Order(symbol=u'ABC', lot=self.order.lot),
+                      messages.FieldMask('lot').project(self.order))
+    self.assertEquals(Order(symbol=u'ABC', lot=Sample(name=u'a', value=0.5)),
+                      messages.FieldMask('lot.value').project(self.order))
+    self.assertEquals(Order(symbol=u'ABC', lot=self.order.lot),
+                      messages.FieldMask('lot,lot.value').project(self.order))
+
+  def testProjectRepeatedField(self):
+    self.assertEquals(Order(symbol=u'ABC', lots=[Sample(name=u'b'),
+                                                 Sample(name=u'c')]),
+                      messages.FieldMask('lots.name').project(self.order))
+
+  def testProjectBatch(self):
+    self.order.samples = Samples(samples=[Sample(name=u'a', labels=[u'x'])])
+    projected = messages.FieldMask('samples.samples.labels').project(
+      self.order)
+    self.assertTrue(isinstance(projected.samples.samples,
+                               messages.MessageBatch))
+    self.assertEquals(
+      Order(symbol=u'ABC',
+            samples=Samples(samples=[Sample(name=u'a', labels=[u'x'])])),
+      projected)
+
+  def testProjectUnset(self):
+    self.assertEquals(Order(symbol=u'ABC'),
+                      messages.FieldMask('samples.samples').project(
+                        Order(symbol=u'ABC')))
+
+  def testProjectDoesNotChangeMessage(self):
+    messages.FieldMask('lots.name').project(self.order)
+    self.assertEquals(1.5, self.order.lots[0].value)
+
+  def testCachedEncoding(self):
+    calls = []
+    def encoder(message):
+      calls.append(message)
+      return message.quantity
+
+    self.order.freeze()
+    self.assertEquals(10, messages.cached_encoding(self.order, 'key', encoder,
+                                                   'quantity'))
+    self.assertEquals(10, messages.cached_encoding(
+      self.order, 'key', encoder, messages.FieldMask(['quantity'])))
+    self.assertEquals(None, messages.cached_encoding(self.order, 'key',
+                                                     encoder, 'lot'))
+    self.assertEquals(10, messages.cached_encoding(self.order, 'key',
+                                                   encoder))
+    self.assertEquals([Order(symbol=u'ABC', quantity=10),
+                       Order(symbol=u'ABC', lot=self.order.lot),
+                       self.order],
+                      calls)
+
+  def testCachedEncodingBoundedMasks(self):
+    """Test that frozen messages keep encodings for few field masks."""
+    calls = []
+    def encoder(message):
+      calls.append(message)
+      return message.quantity
+
+    self.order.freeze()
+    messages.cached_encoding(self.order, 'key', encoder)
+    masks = ['quantity', 'lot', 'lots', 'lot.name', 'lot.value', 'lots.name',
+             'lots.value', 'samples', 'samples.samples']
+    for mask in masks:
+      messages.cached_encoding(self.order, 'key', encoder, mask)
+    self.assertEquals(1 + len(masks), len(calls))
+
+    # Using more masks than are kept discarded the older masked encodings,
+    # but not the encoding of the whole message.
+    messages.cached_encoding(self.order, 'key', encoder, masks[-1])
+    messages.cached_encoding(self.order, 'key', encoder)
+    self.assertEquals(1 + len(masks), len(calls))
+    messages.cached_encoding(self.order, 'key', encoder, masks[0])
+    self.assertEquals(2 + len(masks), len(calls))
+
+
+class DiffTest(test_util.TestCase):
+  """Test diffs between messages."""
+
+  def setUp(self):
+    self.old = Order(symbol=u'ABC',
+                     quantity=10,
+                     lot=Sample(name=u'a', value=0.5),
+                     lots=[Sample(name=u'b')])
+
+  def testDiffType(self):
+    order_diff = messages.diff_type(Order)
+    self.assertTrue(order_diff is messages.diff_type(Order))
+    self.assertEquals('OrderDiff', order_diff.__name__)
+    self.assertEquals(Order, order_diff.values.type)
+    self.assertTrue(order_diff.cleared.repeated)
+    self.assertRaises(TypeError, messages.diff_type, Sample())
+    module = sys.modules[__name__]
+    self.assertTrue(order_diff is
+                    messages.find_definition('OrderDiff', module))
+
+  def testNestedDiffType(self):
+    trade_leg_diff = messages.diff_type(Trade.Leg)
+    quote_leg_diff = messages.diff_type(Quote.Leg)
+    self.assertEquals('TradeLegDiff', trade_leg_diff.__name__)
+    self.assertEquals('QuoteLegDiff', quote_leg_diff.__name__)
+    self.assertEquals(Trade.Leg, trade_leg_diff.values.type)
+    self.assertEquals(Quote.Leg, quote_leg_diff.values.type)
+    module = sys.modules[__name__]
+    self.assertTrue(trade_leg_diff is
+                    messages.find_definition('TradeLegDiff', module))
+    self.assertTrue(quote_leg_diff is
+                    messages.find_definition('QuoteLegDiff', module))
+
+    diff = messages.diff_messages(Trade.Leg(symbol=u'ABC'),
+                                  Trade.Leg(symbol=u'XYZ'))
+    self.assertEquals(trade_leg_diff(values=Trade.Leg(symbol=u'XYZ')), diff)
+
+  def testNoChanges(self):
+    diff = messages.diff_messages(self.old, Order(symbol=u'ABC',
+                                                  quantity=10,
+                                                  lot=Sample(name=u'a',
+                                                             value=0.5),
+                                                  lots=[Sample(name=u'b')]))
+    self.assertEquals(messages.diff_type(Order)(), diff)
+    diff.check_initialized()
+
+  def testSet(self):
+    new = Order(symbol=u'ABC', quantity=20, lot=Sample(name=u'a', value=0.5),
+                lots=[Sample(name=u'b')],
+                samples=Samples(samples=[Sample(name=u'c')]))
+    diff = messages.diff_messages(self.old, new)
+    self.assertEquals(
+      messages.diff_type(Order)(values=Order(symbol=u'ABC', quantity=20,
+                                             samples=new.samples)),
+      diff)
+    diff.check_initialized()
+
+  def testReplaceRepeated(self):
+    new = Order(symbol=u'ABC', quantity=10, lot=Sample(name=u'a', value=0.5),
+                lots=[Sample(name=u'b'), Sample(name=u'c')])
+    self.assertEquals(
+      messages.diff_type(Order)(values=Order(symbol=u'ABC', lots=new.lots)),
+      messages.diff_messages(self.old, new))
+
+  def testClear(self):
+    new = Order(symbol=u'ABC', lots=[])
+    self.assertEquals(messages.diff_type(Order)(cleared=[2, 3, 4]),
+                      messages.diff_messages(self.old, new))
+
+  def testDifferentTypes(self):
+    self.assertRaisesWithRegexpMatch(
+      TypeError, 'Expected messages of the same type, found Order and Sample',
+      messages.diff_messages, self.old, Sample())
+
+  def testApply(self):
+    new = Order(symbol=u'XYZ', quantity=20, lot=Sample(name=u'a', value=1.5),
+                samples=Samples(samples=[Sample(name=u'c')]))
+    diff = messages.diff_messages(self.old, new)
+    messages.apply_diff(self.old, diff)
+    self.assertEquals(new, self.old)
+    self.assertEquals([], self.old.lots)
+
+  def testApplyCopiesRepeated(self):
+    new = Order(symbol=u'ABC', lots=[Sample(name=u'c')])
+    messages.apply_diff(self.old, messages.diff_messages(self.old, new))
+    self.old.lots.append(Sample(name=u'd'))
+    self.assertEquals([Sample(name=u'c')], new.lots)
+
+  def testApplyUnknownFields(self):
+    diff = messages.diff_type(Order)(cleared=[2, 100])
+    messages.apply_diff(self.old, diff)
+    self.assertEquals(None, self.old.quantity)
+
+  def testApplyFrozen(self):
+    diff = messages.diff_type(Order)(cleared=[2])
+    self.assertRaises(messages.FrozenMessageError,
+                      messages.apply_diff, self.old.freeze(), diff)
+
+  def testApplyWrongType(self):
+    self.assertRaisesWithRegexpMatch(
+      TypeError, 'Expected diff of Order, found SampleDiff',
+      messages.apply_diff, self.old, messages.diff_type(Sample)())
+
+
+class DefinitionCacheTest(test_util.TestCase):
+  """Test caching of definitions found by find_definition."""
+
+  MODULE_NAME = 'protorpc_definition_cache_test_module'
+
+  def setUp(self):
+    self.module = types.ModuleType(self.MODULE_NAME)
+    sys.modules[self.MODULE_NAME] = self.module
+
+  def tearDown(self):
+    del sys.modules[self.MODULE_NAME]
+    messages.clear_definition_cache()
+
+  def DefineMessage(self, name, **fields):
+    fields['__module__'] = self.MODULE_NAME
+    message_type = type(name, (messages.Message,), fields)
+    setattr(self.module, name, message_type)
+    return message_type
+
+  def testCached(self):
+    first = self.DefineMessage('First')
+    second = self.DefineMessage('Second')
+    self.assertEquals(first, messages.find_definition('First', self.module))
+
+    # Replacing a definition without defining a new class is not noticed.
+    self.module.First = second
+    self.assertEquals(first, messages.find_definition('First', self.module))
+
+    messages.clear_definition_cache()
+    self.assertEquals(second, messages.find_definition('First', self.module))
+
+  def testNewDefinitionClearsCache(self):
+    self.DefineMessage('Redefined')
+    self.assertEquals(self.module.Redefined,
+                      messages.find_definition('Redefined', self.module))
+    redefined = self.DefineMessage('Redefined')
+    self.assertEquals(redefined,
+                      messages.find_definition('Redefined', self.module))
+
+  def testUnrelatedDefinitionKeepsCache(self):
+    first = self.DefineMessage('First')
+    second = self.DefineMessage('Second')
+    self.assertEquals(first, messages.find_definition('First', self.module))
+    self.assertEquals(first,
+                      messages.find_definition('.%s.First' % self.MODULE_NAME))
+
+    # Cached definitions survive definitions of classes with other names.
+    self.module.First = second
+    self.DefineMessage('Unrelated')
+    self.assertEquals(first, messages.find_definition('First', self.module))
+    self.assertEquals(first,
+                      messages.find_definition('.%s.First' % self.MODULE_NAME))
+
+    # Defining a class with the same name forgets all names mentioning it.
+    type('First', (messages.Message,), {})
+    self.assertEquals(second, messages.find_definition('First', self.module))
+    self.assertEquals(second,
+                      messages.find_definition('.%s.First' % self.MODULE_NAME))
+
+  def testCacheBounded(self):
+    first = self.DefineMessage('First')
+    second = self.DefineMessage('Second')
+    original_max = messages._MAX_CACHED_DEFINITIONS
+    messages._MAX_CACHED_DEFINITIONS = 2
+    try:
+      self.assertEquals(first, messages.find_definition('First', self.module))
+      self.assertEquals(second,
+                        messages.find_definition('Second', self.module))
+      self.module.First = second
+      self.assertEquals(first, messages.find_definition('First', self.module))
+
+      # Caching a third definition discards the full cache.
+      self.DefineMessage('Third')
+      messages.find_definition('Third', self.module)
+      self.assertEquals(second, messages.find_definition('First', self.module))
+    finally:
+      messages._MAX_CACHED_DEFINITIONS = original_max
+
+  def testNestedDefinitionClearsCache(self):
+    outer = self.DefineMessage(
+      'Outer', Inner=type('Inner', (messages.Message,), {}))
+    self.assertEquals(outer.Inner,
+                      messages.find_definition('Outer.Inner', self.module))
+    new_outer = self.DefineMessage(
+      'Outer', Inner=type('Other', (messages.Message,), {}))
+    self.assertEquals(new_outer.Inner,
+                      messages.find_definition('Outer.Inner', self.module))
+
+  def testNotFoundNotCached(self):
+    self.assertRaises(messages.DefinitionNotFoundError,
+                      messages.find_definition, 'Later', self.module)
+    self.module.Later = message_types.VoidMessage
+    self.assertEquals(message_types.VoidMessage,
+                      messages.find_definition('Later', self.module))
+
+  def testResolveDefinitions(self):
+    class Color(messages.Enum):
+      RED = 1
+    self.module.Color = Color
+    outer = self.DefineMessage(
+      'Outer',
+      Inner=type('Inner', (messages.Message,),
+                 {'__module__': self.MODULE_NAME,
+                  'color': messages.EnumField('Color', 1),
+                 }),
+      inner=messages.MessageField('Outer.Inner', 1),
+      other=messages.MessageField('Other', 2))
+    self.assertRaisesWithRegexpMatch(messages.DefinitionNotFoundError,
+                                     'Could not find definition for Other',
+                                     messages.resolve_definitions, self.module)
+
+    other = self.DefineMessage('Other')
+    messages.resolve_definitions(self.module)
+    self.assertEquals(outer.Inner, outer.inner.type)
+    self.assertEquals(other, outer.other.type)
+    self.assertEquals(Color, outer.Inner.color.type)
+
+  def testResolveDefinitionsOfMessage(self):
+    message_type = self.DefineMessage(
+      'WithBadField', field=messages.MessageField('DoesNotExist', 1))
+    self.assertRaises(messages.DefinitionNotFoundError,
+                      messages.resolve_definitions, message_type)
+
+  def testResolveDefinitionsIgnoresImported(self):
+    self.module.Imported = type(
+      'Imported', (messages.Message,),
+      {'field': messages.MessageField('DoesNotExist', 1)})
+    messages.resolve_definitions(self.module)
+
+
 def main():
   unittest.main()
 
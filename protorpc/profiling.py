@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Sampling profiler for remote method calls.
+
+A Profiler profiles a sample of the remote method calls handled by a server
+as well as calls that take longer than a latency threshold, and keeps the
+resulting profiles in a bounded ProfileBuffer.  Profiles are retrieved
+through a ProfileService.  The simplest way to set this up is passing
+profiler_path to wsgi.service.service_mappings:
+
+  application = service.service_mappings(
+      [('/my/service', MyService)],
+      profiler=profiling.Profiler(sample_rate=0.01, latency_threshold=0.5),
+      profiler_path='/protorpc/profiles')
+
+Calls are profiled in two ways:
+
+  Sampled calls are run under cProfile.  Their profiles list the functions
+  with the largest cumulative time.
+
+  Calls that are still running after the latency threshold has passed have
+  the stack of the thread running them sampled at regular intervals until
+  they end.  Their profiles list the most frequently seen call stacks.  This
+  is cheap enough to be done for every call since calls that end before the
+  threshold are never sampled.
+"""
+
+import collections
+import cProfile
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import timeit
+import traceback
+
+import six
+
+from . import message_types
+from . import messages
+from . import remote
+from . import util
+
+__all__ = [
+  'DEFAULT_LATENCY_THRESHOLD',
+  'DEFAULT_MAX_FUNCTIONS',
+  'DEFAULT_MAX_PROFILES',
+  'DEFAULT_SAMPLE_INTERVAL',
+
+  'FunctionStats',
+  'GetProfilesRequest',
+  'GetProfilesResponse',
+  'Profile',
+  'ProfileBuffer',
+  'ProfileService',
+  'Profiler',
+  'StackSample',
+  'middleware',
+]
+
+
+# Seconds after which a call is considered slow.
+DEFAULT_LATENCY_THRESHOLD = 1.0
+
+# Seconds between two samples of the stack of a slow call.
+DEFAULT_SAMPLE_INTERVAL = 0.01
+
+# Number of profiles kept by a ProfileBuffer.
+DEFAULT_MAX_PROFILES = 100
+
+# Number of functions or stacks kept in a single profile.
+DEFAULT_MAX_FUNCTIONS = 25
+
+# Maximum number of frames kept of a sampled stack, innermost first.
+_MAX_STACK_DEPTH = 50
+
+_RPC_PATH_PATTERN = re.compile(r'^(.+)\.([^./]+)$')
+
+
+class FunctionStats(messages.Message):
+  """Statistics of a function collected by cProfile.
+
+  Fields:
+    function: Location and name of function as 'filename:line(name)'.
+    call_count: Number of times the function was called.
+    total_time: Seconds spent in the function itself.
+    cumulative_time: Seconds spent in the function and the functions it
+      called.
+  """
+
+  function = messages.StringField(1, required=True)
+  call_count = messages.IntegerField(2)
+  total_time = messages.FloatField(3)
+  cumulative_time = messages.FloatField(4)
+
+
+class StackSample(messages.Message):
+  """Call stack seen while sampling a slow call.
+
+  Fields:
+    frames: Frames of the stack as 'filename:line(name)', outermost first.
+    count: Number of times the stack was seen.
+  """
+
+  frames = messages.StringField(1, repeated=True)
+  count = messages.IntegerField(2)
+
+
+class Profile(messages.Message):
+  """Profile of a single remote method call.
+
+  Fields:
+    service_path: Path of service that was called.
+    method_name: Name of remote method that was called.
+    reason: Why the call was profiled.
+    start_time: Time the call started, in seconds since the epoch.
+    duration: Seconds it took to handle the call.
+    functions: For sampled calls, the functions with the largest cumulative
+      time, largest first.
+    stacks: For slow calls, the most frequently seen call stacks, most
+      frequent first.
+  """
+
+  class Reason(messages.Enum):
+    """Why a call was profiled.
+
+    SAMPLED: Call was chosen to be run under cProfile.
+    SLOW: Call took longer than the latency threshold.
+    """
+
+    SAMPLED = 1
+    SLOW = 2
+
+  service_path = messages.StringField(1, required=True)
+  method_name = messages.StringField(2, required=True)
+  reason = messages.EnumField(Reason, 3, required=True)
+  start_time = messages.FloatField(4)
+  duration = messages.FloatField(5)
+  functions = messages.MessageField(FunctionStats, 6, repeated=True)
+  stacks = messages.MessageField(StackSample, 7, repeated=True)
+
+
+class GetProfilesRequest(messages.Message):
+  """Request for profiles.
+
+  Fields:
+    service_path: Only get profiles of calls to this service.
+    method_name: Only get profiles of calls to this remote method.
+    limit: Maximum number of profiles to get.
+  """
+
+  service_path = messages.StringField(1)
+  method_name = messages.StringField(2)
+  limit = messages.IntegerField(3)
+
+
+class GetProfilesResponse(messages.Message):
+  """Profiles matching a GetProfilesRequest.
+
+  Fields:
+    profiles: Matching profiles, most recent first.
+  """
+
+  profiles = messages.MessageField(Profile, 1, repeated=True)
+
+
+class ProfileBuffer(object):
+  """Thread-safe ring buffer of the most recent profiles."""
+
+  def __init__(self, max_profiles=DEFAULT_MAX_PROFILES):
+    """Constructor.
+
+    Args:
+      max_profiles: Number of profiles to keep.  When full, adding a profile
+        discards the oldest one.
+    """
+    self.__lock = threading.Lock()
+    self.__profiles = collections.deque(maxlen=max_profiles)
+
+  def __len__(self):
+    return len(self.__profiles)
+
+  def add(self, profile):
+    """Add a profile.
+
+    Args:
+      profile: Profile to add.
+    """
+    with self.__lock:
+      self.__profiles.append(profile)
+
+  @util.positional(1)
+  def get_profiles(self, service_path=None, method_name=None, limit=None):
+    """Get profiles.
+
+    Args:
+      service_path: Only get profiles of calls to this service.
+      method_name: Only get profiles of calls to this remote method.
+      limit: Maximum number of profiles to get.
+
+    Returns:
+      List of matching profiles, most recent first.
+    """
+    with self.__lock:
+      profiles = list(self.__profiles)
+    result = []
+    for profile in reversed(profiles):
+      if limit is not None and len(result) >= limit:
+        break
+      if service_path is not None and profile.service_path != service_path:
+        continue
+      if method_name is not None and profile.method_name != method_name:
+        continue
+      result.append(profile)
+    return result
+
+  def clear(self):
+    """Discard all profiles."""
+    with self.__lock:
+      self.__profiles.clear()
+
+
+def _format_function(filename, line, name):
+  return u'%s:%d(%s)' % (filename, line, name)
+
+
+class _SlowCall(object):
+  """Stack samples of a call being watched by the _StackSampler."""
+
+  def __init__(self, thread_id, threshold):
+    self.thread_id = thread_id
+    self.deadline = timeit.default_timer() + threshold
+    self.stacks = {}
+
+
+class _StackSampler(object):
+  """Samples the stacks of calls running longer than a threshold.
+
+  A single background thread checks all watched calls.  It runs only while
+  there are calls being watched.
+  """
+
+  def __init__(self, interval):
+    self.__interval = interval
+    self.__lock = threading.Lock()
+    self.__calls = {}
+    self.__thread = None
+
+  def watch(self, threshold):
+    """Start watching the call running on the current thread.
+
+    Args:
+      threshold: Seconds after which the stack of the call is sampled.
+
+    Returns:
+      _SlowCall collecting the stacks of the call.
+    """
+    slow_call = _SlowCall(threading.current_thread().ident, threshold)
+    with self.__lock:
+      self.__calls[id(slow_call)] = slow_call
+      if self.__thread is None:
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='protorpc-stack-sampler')
+        self.__thread.daemon = True
+        self.__thread.start()
+    return slow_call
+
+  def unwatch(self, slow_call):
+    """Stop watching a call.
+
+    Args:
+      slow_call: _SlowCall returned by watch.
+
+    Returns:
+      Dictionary mapping each stack sampled for the call to the number of
+      times it was seen.  No more stacks are recorded once it is returned.
+    """
+    with self.__lock:
+      self.__calls.pop(id(slow_call), None)
+      return dict(slow_call.stacks)
+
+  def __run(self):
+    while True:
+      time.sleep(self.__interval)
+      with self.__lock:
+        if not self.__calls:
+          self.__thread = None
+          return
+        now = timeit.default_timer()
+        calls = [slow_call for slow_call in six.itervalues(self.__calls)
+                 if slow_call.deadline <= now]
+      if not calls:
+        continue
+      frames = sys._current_frames()
+      for slow_call in calls:
+        frame = frames.get(slow_call.thread_id)
+        if frame is None:
+          continue
+        stack = tuple(_format_function(filename, line, name)
+                      for filename, line, name, unused_text
+                      in traceback.extract_stack(frame, _MAX_STACK_DEPTH))
+        with self.__lock:
+          # The call may have finished while its stack was extracted.
+          if self.__calls.get(id(slow_call)) is slow_call:
+            slow_call.stacks[stack] = slow_call.stacks.get(stack, 0) + 1
+      del frames
+
+
+class Profiler(object):
+  """Profiles a sample of calls as well as slow calls.
+
+  Profiles are added to the profile buffer of the profiler.
+  """
+
+  @util.positional(1)
+  def __init__(self,
+               profile_buffer=None,
+               sample_rate=0.0,
+               latency_threshold=DEFAULT_LATENCY_THRESHOLD,
+               sample_interval=DEFAULT_SAMPLE_INTERVAL,
+               max_functions=DEFAULT_MAX_FUNCTIONS,
+               random_function=random.random):
+    """Constructor.
+
+    Args:
+      profile_buffer: ProfileBuffer to add profiles to.  A new one is created
+        if None.
+      sample_rate: Fraction of calls, between 0 and 1, to run under cProfile.
+      latency_threshold: Seconds after which the stack of a call is sampled.
+        If None, slow calls are not profiled.
+      sample_interval: Seconds between two samples of the stack of a slow
+        call.
+      max_functions: Number of functions or stacks kept in a profile.
+      random_function: Function returning a random float in [0, 1) used to
+        choose calls to run under cProfile.
+    """
+    if profile_buffer is None:
+      profile_buffer = ProfileBuffer()
+    self.__profile_buffer = profile_buffer
+    self.__sample_rate = sample_rate
+    self.__latency_threshold = latency_threshold
+    self.__max_functions = max_functions
+    self.__random = random_function
+    if latency_threshold is not None:
+      self.__sampler = _StackSampler(sample_interval)
+
+  @property
+  def profile_buffer(self):
+    return self.__profile_buffer
+
+  @property
+  def sample_rate(self):
+    return self.__sample_rate
+
+  @property
+  def latency_threshold(self):
+    return self.__latency_threshold
+
+  def __function_stats(self, profile):
+    """Get statistics of the functions with the largest cumulative time.
+
+    Args:
+      profile: cProfile.Profile that profiled a call.
+
+    Returns:
+      List of FunctionStats.
+    """
+    stats = pstats.Stats(profile).stats
+    functions = sorted(six.iteritems(stats),
+                       key=lambda item: item[1][3],
+                       reverse=True)[:self.__max_functions]
+    return [FunctionStats(function=_format_function(*function),
+                          call_count=call_count,
+                          total_time=total_time,
+                          cumulative_time=cumulative_time)
+            for function, (unused_primitive_call_count, call_count,
+                           total_time, cumulative_time, unused_callers)
+            in functions]
+
+  def __stack_samples(self, stacks):
+    """Get the most frequently seen stacks.
+
+    Args:
+      stacks: Dictionary mapping stack to the number of times it was seen.
+
+    Returns:
+      List of StackSample.
+    """
+    stacks = sorted(six.iteritems(stacks),
+                    key=lambda item: item[1],
+                    reverse=True)[:self.__max_functions]
+    return [StackSample(frames=list(stack), count=count)
+            for stack, count in stacks]
+
+  def profile(self, service_path, method_name, function, *args, **kwargs):
+    """Call a function handling a remote method call, profiling it if needed.
+
+    Args:
+      service_path: Path of service that is called.
+      method_name: Name of remote method that is called.
+      function: Function to call.
+      args: Positional arguments to call function with.
+      kwargs: Keyword arguments to call function with.
+
+    Returns:
+      Result of calling function.
+    """
+    sampled = self.__sample_rate > 0 and self.__random() < self.__sample_rate
+    slow_call = None
+    profile = None
+    if sampled:
+      profile = cProfile.Profile()
+    elif self.__latency_threshold is not None:
+      slow_call = self.__sampler.watch(self.__latency_threshold)
+
+    start_time = time.time()
+    start = timeit.default_timer()
+    try:
+      if profile is not None:
+        return profile.runcall(function, *args, **kwargs)
+      return function(*args, **kwargs)
+    finally:
+      duration = timeit.default_timer() - start
+      stacks = None
+      if slow_call is not None:
+        stacks = self.__sampler.unwatch(slow_call)
+      if profile is not None or stacks:
+        result = Profile(service_path=six.text_type(service_path),
+                         method_name=six.text_type(method_name),
+                         start_time=start_time,
+                         duration=duration)
+        if profile is not None:
+          result.reason = Profile.Reason.SAMPLED
+          result.functions = self.__function_stats(profile)
+        else:
+          result.reason = Profile.Reason.SLOW
+          result.stacks = self.__stack_samples(stacks)
+        self.__profile_buffer.add(result)
+
+
+def middleware(application, profiler):
+  """WSGI middleware profiling remote method calls.
+
+  Requests whose path does not look like a service path followed by '.' and
+  a method name are passed on without being profiled.  Only the call of the
+  application is profiled, not the sending of its response.
+
+  Args:
+    application: WSGI application serving ProtoRPC services.
+    profiler: Profiler to profile calls with.
+
+  Returns:
+    WSGI application.
+  """
+  def profiling_middleware(environ, start_response):
+    """Actual WSGI application function."""
+    match = _RPC_PATH_PATTERN.match(environ.get('PATH_INFO', ''))
+    if match is None:
+      return application(environ, start_response)
+    service_path, method_name = match.groups()
+    return profiler.profile(service_path, method_name,
+                            application, environ, start_response)
+  return profiling_middleware
+
+
+class ProfileService(remote.Service):
+  """Service for retrieving the profiles of a ProfileBuffer."""
+
+  def __init__(self, profile_buffer):
+    """Constructor.
+
+    Args:
+      profile_buffer: ProfileBuffer to serve profiles of.
+    """
+    self.__profile_buffer = profile_buffer
+
+  @property
+  def profile_buffer(self):
+    return self.__profile_buffer
+
+  @remote.method(GetProfilesRequest, GetProfilesResponse)
+  def get_profiles(self, request):
+    """Get the most recent profiles."""
+    return GetProfilesResponse(profiles=self.__profile_buffer.get_profiles(
+      service_path=request.service_path,
+      method_name=request.method_name,
+      limit=request.limit))
+
+  @remote.method(message_types.VoidMessage, message_types.VoidMessage)
+  def clear_profiles(self, request):
+    """Discard all profiles."""
+    self.__profile_buffer.clear()
+    return message_types.VoidMessage()
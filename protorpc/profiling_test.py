@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for protorpc.profiling."""
+
+import threading
+import time
+import traceback
+import unittest
+
+from protorpc import message_types
+from protorpc import profiling
+from protorpc import test_util
+
+
+class ModuleInterfaceTest(test_util.ModuleInterfaceTest,
+                          test_util.TestCase):
+
+  MODULE = profiling
+
+
+def new_profile(service_path=u'/my/service', method_name=u'method'):
+  return profiling.Profile(service_path=service_path,
+                           method_name=method_name,
+                           reason=profiling.Profile.Reason.SAMPLED)
+
+
+def slow_function(seconds):
+  time.sleep(seconds)
+  return 'slow'
+
+
+def fast_function():
+  return 'fast'
+
+
+class ProfileBufferTest(test_util.TestCase):
+
+  def setUp(self):
+    self.profile_buffer = profiling.ProfileBuffer(max_profiles=3)
+
+  def testRingBuffer(self):
+    profiles = [new_profile(method_name=u'method%d' % i) for i in range(5)]
+    for profile in profiles:
+      self.profile_buffer.add(profile)
+    self.assertEquals(3, len(self.profile_buffer))
+    self.assertEquals(list(reversed(profiles[2:])),
+                      self.profile_buffer.get_profiles())
+
+  def testFilter(self):
+    profile1 = new_profile()
+    profile2 = new_profile(method_name=u'other')
+    profile3 = new_profile(service_path=u'/other')
+    for profile in (profile1, profile2, profile3):
+      self.profile_buffer.add(profile)
+    self.assertEquals([profile1],
+                      self.profile_buffer.get_profiles(
+                        service_path=u'/my/service', method_name=u'method'))
+    self.assertEquals([profile2, profile1],
+                      self.profile_buffer.get_profiles(
+                        service_path=u'/my/service'))
+    self.assertEquals([profile3, profile2],
+                      self.profile_buffer.get_profiles(limit=2))
+
+  def testClear(self):
+    self.profile_buffer.add(new_profile())
+    self.profile_buffer.clear()
+    self.assertEquals([], self.profile_buffer.get_profiles())
+
+
+class ProfilerTest(test_util.TestCase):
+
+  def setUp(self):
+    self.profile_buffer = profiling.ProfileBuffer()
+
+  def testSampled(self):
+    profiler = profiling.Profiler(profile_buffer=self.profile_buffer,
+                                  sample_rate=0.5,
+                                  latency_threshold=None,
+                                  random_function=lambda: 0.25)
+    self.assertEquals('fast', profiler.profile('/my/service', 'method',
+                                               fast_function))
+    [profile] = self.profile_buffer.get_profiles()
+    self.assertEquals(u'/my/service', profile.service_path)
+    self.assertEquals(u'method', profile.method_name)
+    self.assertEquals(profiling.Profile.Reason.SAMPLED, profile.reason)
+    self.assertEquals([], profile.stacks)
+    self.assertTrue([stats for stats in profile.functions
+                     if stats.function.endswith('(fast_function)')])
+    profile.check_initialized()
+
+  def testNotSampled(self):
+    profiler = profiling.Profiler(profile_buffer=self.profile_buffer,
+                                  sample_rate=0.5,
+                                  random_function=lambda: 0.75)
+    profiler.profile('/my/service', 'method', fast_function)
+    self.assertEquals([], self.profile_buffer.get_profiles())
+
+  def testSlow(self):
+    profiler = profiling.Profiler(profile_buffer=self.profile_buffer,
+                                  latency_threshold=0.05,
+                                  sample_interval=0.005)
+    self.assertEquals('slow', profiler.profile('/my/service', 'method',
+                                               slow_function, 0.3))
+    [profile] = self.profile_buffer.get_profiles()
+    self.assertEquals(profiling.Profile.Reason.SLOW, profile.reason)
+    self.assertTrue(profile.duration >= 0.3)
+    self.assertEquals([], profile.functions)
+    stack = profile.stacks[0]
+    self.assertTrue(stack.count > 1)
+    self.assertTrue(stack.frames[-1].endswith('(slow_function)'))
+    profile.check_initialized()
+
+  def testError(self):
+    profiler = profiling.Profiler(profile_buffer=self.profile_buffer,
+                                  sample_rate=1.0)
+    self.assertRaises(ZeroDivisionError,
+                      profiler.profile, '/my/service', 'method',
+                      lambda: 1 / 0)
+    self.assertEquals(1, len(self.profile_buffer))
+
+
+class StackSamplerTest(test_util.TestCase):
+
+  def tearDown(self):
+    profiling.traceback = traceback
+
+  def testUnwatchedWhileSampling(self):
+    """Test that no stack is recorded once a call is no longer watched."""
+    sampler = profiling._StackSampler(0.005)
+    sampled = threading.Event()
+
+    class UnwatchingTraceback(object):
+
+      @staticmethod
+      def extract_stack(frame, limit):
+        sampler.unwatch(slow_call)
+        sampled.set()
+        return traceback.extract_stack(frame, limit)
+
+    profiling.traceback = UnwatchingTraceback
+    slow_call = sampler.watch(0)
+    self.assertTrue(sampled.wait(5))
+    deadline = time.time() + 5
+    while sampler._StackSampler__thread is not None and time.time() < deadline:
+      time.sleep(0.005)
+    self.assertEquals({}, slow_call.stacks)
+
+
+class MiddlewareTest(test_util.TestCase):
+
+  def setUp(self):
+    self.profile_buffer = profiling.ProfileBuffer()
+    profiler = profiling.Profiler(profile_buffer=self.profile_buffer,
+                                  sample_rate=1.0)
+    def application(environ, start_response):
+      start_response('200 OK', [])
+      return [b'content']
+    self.application = profiling.middleware(application, profiler)
+
+  def DoRequest(self, path):
+    return self.application({'PATH_INFO': path}, lambda *args: None)
+
+  def testProfiled(self):
+    self.assertEquals([b'content'], self.DoRequest('/my/service.method'))
+    [profile] = self.profile_buffer.get_profiles()
+    self.assertEquals(u'/my/service', profile.service_path)
+    self.assertEquals(u'method', profile.method_name)
+
+  def testNotRpc(self):
+    self.assertEquals([b'content'], self.DoRequest('/my/service'))
+    self.assertEquals([b'content'], self.DoRequest('/my.dir/service'))
+    self.assertEquals([], self.profile_buffer.get_profiles())
+
+
+class ProfileServiceTest(test_util.TestCase):
+
+  def setUp(self):
+    self.profile_buffer = profiling.ProfileBuffer()
+    self.service = profiling.ProfileService(self.profile_buffer)
+
+  def testGetProfiles(self):
+    profile1 = new_profile()
+    profile2 = new_profile(method_name=u'other')
+    self.profile_buffer.add(profile1)
+    self.profile_buffer.add(profile2)
+    self.assertEquals(
+      profiling.GetProfilesResponse(profiles=[profile2, profile1]),
+      self.service.get_profiles(profiling.GetProfilesRequest()))
+    self.assertEquals(
+      profiling.GetProfilesResponse(profiles=[profile1]),
+      self.service.get_profiles(profiling.GetProfilesRequest(
+        method_name=u'method')))
+
+  def testClearProfiles(self):
+    self.profile_buffer.add(new_profile())
+    self.service.clear_profiles(message_types.VoidMessage())
+    self.assertEquals(0, len(self.profile_buffer))
+
+
+def main():
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
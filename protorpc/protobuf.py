@@ -27,6 +27,8 @@ Public Exceptions:
 Public Functions:
   encode_message: Encodes a message in to a protocol buffer string.
   decode_message: Decode from a protocol buffer string to a message.
+  byte_size: Size of the protocol buffer encoding of a message.
+  register_codec: Register compiled codec for a message type.
 """
 import six
 
@@ -34,6 +36,7 @@ __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
 import array
+import sys
 
 from . import message_types
 from . import messages
@@ -43,8 +46,10 @@ from .google_imports import ProtocolBuffer
 
 __all__ = ['ALTERNATIVE_CONTENT_TYPES',
            'CONTENT_TYPE',
+           'byte_size',
            'encode_message',
            'decode_message',
+           'register_codec',
           ]
 
 CONTENT_TYPE = 'application/octet-stream'
@@ -88,6 +93,52 @@ class _Encoder(ProtocolBuffer.Encoder):
     self.putPrefixedString(encode_message(value))
 
 
+  def encode_packed(self, variant, values):
+    """Encode values of a packed repeated field as one prefixed string.
+
+    Args:
+      variant: Variant of the field.
+      values: List or array of values to encode.
+    """
+    typecode = _PACKED_ARRAY_TYPECODES.get(variant)
+    if typecode is not None:
+      # Fixed size values are converted all at once.
+      packed_array = array.array(typecode, values)
+      if sys.byteorder == 'big':
+        packed_array.byteswap()
+      self.putVarInt32(len(packed_array) * packed_array.itemsize)
+      self.buffer().fromstring(packed_array.tostring())
+      return
+
+    packed_encoder = _Encoder()
+    field_encoder = _VARIANT_TO_ENCODER_MAP[variant]
+    for value in values:
+      field_encoder(packed_encoder, value)
+    packed_buffer = packed_encoder.buffer()
+    self.putVarInt32(len(packed_buffer))
+    self.buffer().extend(packed_buffer)
+
+  def encode_batch(self, tag, batch):
+    """Encode messages of a MessageBatch straight from its columns.
+
+    Args:
+      tag: Encoded tag of the field, written before every message.
+      batch: MessageBatch instance to encode.
+    """
+    fields = sorted(batch.message_type.all_fields(),
+                    key=lambda field: field.number)
+    columns = [(field, batch.column(field.name)) for field in fields]
+    for index in range(len(batch)):
+      row_encoder = _Encoder()
+      for field, column in columns:
+        value = column[index]
+        if value is not None:
+          _encode_field(row_encoder, field, value)
+      row_buffer = row_encoder.buffer()
+      self.putVarInt32(tag)
+      self.putVarInt32(len(row_buffer))
+      self.buffer().extend(row_buffer)
+
   def encode_unicode_string(self, value):
     """Helper to properly pb encode unicode strings to UTF-8.
 
@@ -123,6 +174,37 @@ class _Decoder(ProtocolBuffer.Decoder):
     """
     return self.getPrefixedString().decode('UTF-8')
 
+  def decode_packed(self, variant):
+    """Decode values of a packed repeated field.
+
+    Args:
+      variant: Variant of the field.
+
+    Returns:
+      List of values encoded in the next prefixed string in stream.
+    """
+    length = self.getVarInt32()
+    start = self.pos()
+    self.skip(length)
+
+    typecode = _PACKED_ARRAY_TYPECODES.get(variant)
+    if typecode is not None:
+      # Fixed size values are converted all at once.
+      values = array.array(typecode)
+      if length % values.itemsize:
+        raise ProtocolBuffer.ProtocolBufferDecodeError('truncated')
+      values.fromstring(self.buffer()[start:start + length].tostring())
+      if sys.byteorder == 'big':
+        values.byteswap()
+      return values.tolist()
+
+    packed_decoder = _Decoder(self.buffer(), start, start + length)
+    field_decoder = _VARIANT_TO_DECODER_MAP[variant]
+    values = []
+    while packed_decoder.avail() > 0:
+      values.append(field_decoder(packed_decoder))
+    return values
+
   def decode_boolean(self):
     """Decode a boolean value.
 
@@ -218,21 +300,96 @@ _VARIANT_TO_DECODER_MAP = {
 }
 
 
-def encode_message(message):
+# Maps fixed size variants to array type codes of the same wire format.  Used
+# to convert packed values all at once.
+_PACKED_ARRAY_TYPECODES = {
+    messages.Variant.DOUBLE: 'd',
+    messages.Variant.FLOAT: 'f',
+}
+
+
+# Maps message types to (encoder, decoder) of compiled codecs.
+_codecs = {}
+
+
+def register_codec(message_type, encoder, decoder):
+  """Register compiled codec for a message type.
+
+  Compiled codecs, such as those written by generate_python, take the place
+  of the reflective encoding and decoding for a single message type.  Either
+  function may decline a message, in which case the reflective implementation
+  is used.
+
+  Args:
+    message_type: Message class handled by codec.
+    encoder: Function taking (message, encoder) that writes the fields of an
+      initialized message to the protocol buffer encoder and returns True.
+      Returns False without writing anything if message can not be encoded.
+    decoder: Function taking a protocol buffer decoder positioned at the
+      start of the encoded message that returns a new instance of
+      message_type.  Returns None if the encoded message can not be decoded,
+      for example because it contains unrecognized fields.
+  """
+  if not (isinstance(message_type, type) and
+          issubclass(message_type, messages.Message)):
+    raise TypeError('Expected Message class, found %r' % (message_type,))
+  _codecs[message_type] = encoder, decoder
+
+
+def byte_size(message):
+  """Get size of the protocol buffer encoding of a message.
+
+  The size is computed without encoding the message.  Sizes of frozen
+  messages, and of their frozen sub-messages, are cached.
+
+  Args:
+    message: Message instance to get encoded size of.
+
+  Returns:
+    Number of bytes of the protocol buffer encoding of message.
+
+  Raises:
+    messages.ValidationError if message is not initialized.
+  """
+  message.check_initialized()
+  return _message_size(message, {})
+
+
+def encode_message(message, field_mask=None):
   """Encode Message instance to protocol buffer.
 
   Args:
     Message instance to encode in to protocol buffer.
+    field_mask: messages.FieldMask, or its paths, selecting the fields of
+      message to encode.  All fields are encoded if None.
 
   Returns:
     String encoding of Message instance in protocol buffer format.
 
   Raises:
-    messages.ValidationError if message is not initialized.
+    messages.ValidationError if message is not initialized, or field_mask
+      does not refer to fields of message.
+  """
+  return messages.cached_encoding(message, 'protobuf', _encode_message,
+                                  field_mask)
+
+
+def _encode_message(message):
+  """Encode Message instance to protocol buffer without using the cache.
+
+  Args:
+    Message instance to encode in to protocol buffer.
+
+  Returns:
+    String encoding of Message instance in protocol buffer format.
   """
   message.check_initialized()
   encoder = _Encoder()
 
+  codec = _codecs.get(type(message))
+  if codec is not None and codec[0](message, encoder):
+    return encoder.buffer().tostring()
+
   # Get all fields, from the known fields we parsed and the unknown fields
   # we saved.  Note which ones were known, so we can process them differently.
   all_fields = [(field.number, field) for field in message.all_fields()]
@@ -244,34 +401,59 @@ def encode_message(message):
     if field:
       # Known field.
       value = message.get_assigned_value(field.name)
-      if value is None:
-        continue
-      variant = field.variant
-      repeated = field.repeated
-    else:
-      # Unrecognized field.
-      value, variant = message.get_unrecognized_field_info(field_num)
-      if not isinstance(variant, messages.Variant):
-        continue
-      repeated = isinstance(value, (list, tuple))
-
+      if value is not None:
+        _encode_field(encoder, field, value)
+      continue
+
+    # Unrecognized field.
+    value, variant = message.get_unrecognized_field_info(field_num)
+    if not isinstance(variant, messages.Variant):
+      continue
+    if not isinstance(value, (list, tuple)):
+      value = [value]
     tag = ((field_num << _WIRE_TYPE_BITS) | _VARIANT_TO_WIRE_TYPE[variant])
-
-    # Write value to wire.
-    if repeated:
-      values = value
-    else:
-      values = [value]
-    for next in values:
+    field_encoder = _VARIANT_TO_ENCODER_MAP[variant]
+    for next in value:
       encoder.putVarInt32(tag)
-      if isinstance(field, messages.MessageField):
-        next = field.value_to_message(next)
-      field_encoder = _VARIANT_TO_ENCODER_MAP[variant]
       field_encoder(encoder, next)
 
   return encoder.buffer().tostring()
 
 
+def _encode_field(encoder, field, value):
+  """Encode value of a known field.
+
+  Args:
+    encoder: _Encoder to write value to.
+    field: Field of value.
+    value: Assigned value of field, not None.
+  """
+  variant = field.variant
+  if field.packed:
+    if value:
+      encoder.putVarInt32((field.number << _WIRE_TYPE_BITS) | _Encoder.STRING)
+      encoder.encode_packed(variant, value)
+    return
+
+  tag = ((field.number << _WIRE_TYPE_BITS) | _VARIANT_TO_WIRE_TYPE[variant])
+
+  if isinstance(value, messages.MessageBatch):
+    encoder.encode_batch(tag, value)
+    return
+
+  # Write value to wire.
+  if field.repeated:
+    values = value
+  else:
+    values = [value]
+  field_encoder = _VARIANT_TO_ENCODER_MAP[variant]
+  for next in values:
+    encoder.putVarInt32(tag)
+    if isinstance(field, messages.MessageField):
+      next = field.value_to_message(next)
+    field_encoder(encoder, next)
+
+
 def decode_message(message_type, encoded_message):
   """Decode protocol buffer to Message instance.
 
@@ -287,73 +469,327 @@ def decode_message(message_type, encoded_message):
       wire format for a field.
     messages.ValidationError if merged message is not initialized.
   """
-  message = message_type()
   message_array = array.array('B')
   message_array.fromstring(encoded_message)
   try:
+    codec = _codecs.get(message_type)
+    if codec is not None:
+      message = codec[1](_Decoder(message_array, 0, len(message_array)))
+      if message is not None:
+        message.check_initialized()
+        return message
+
+    message = message_type()
     decoder = _Decoder(message_array, 0, len(message_array))
+    batch_rows = None
 
     while decoder.avail() > 0:
-      # Decode tag and variant information.
-      encoded_tag = decoder.getVarInt32()
-      tag = encoded_tag >> _WIRE_TYPE_BITS
-      wire_type = encoded_tag & _WIRE_TYPE_MASK
-      try:
-        found_wire_type_decoder = _WIRE_TYPE_TO_DECODER_MAP[wire_type]
-      except:
-        raise messages.DecodeError('No such wire type %d' % wire_type)
-
-      if tag < 1:
-        raise messages.DecodeError('Invalid tag value %d' % tag)
+      tag, wire_type = _decode_tag(decoder)
 
       try:
         field = message.field_by_number(tag)
       except KeyError:
-        # Unexpected tags are ok.
-        field = None
-        wire_type_decoder = found_wire_type_decoder
-      else:
-        expected_wire_type = _VARIANT_TO_WIRE_TYPE[field.variant]
-        if expected_wire_type != wire_type:
-          raise messages.DecodeError('Expected wire type %s but found %s' % (
-              _WIRE_TYPE_NAME[expected_wire_type],
-              _WIRE_TYPE_NAME[wire_type]))
-
-        wire_type_decoder = _VARIANT_TO_DECODER_MAP[field.variant]
-
-      value = wire_type_decoder(decoder)
-
-      # Save unknown fields and skip additional processing.
-      if not field:
-        # When saving this, save it under the tag number (which should
-        # be unique), and set the variant and value so we know how to
-        # interpret the value later.
+        # Unexpected tags are ok.  When saving this, save it under the tag
+        # number (which should be unique), and set the variant and value so
+        # we know how to interpret the value later.
+        value = _WIRE_TYPE_TO_DECODER_MAP[wire_type](decoder)
         variant = _WIRE_TYPE_TO_VARIANT_MAP.get(wire_type)
         if variant:
           message.set_unrecognized_field(tag, value, variant)
         continue
 
-      # Special case Enum and Message types.
-      if isinstance(field, messages.EnumField):
-        try:
-          value = field.type(value)
-        except TypeError:
-          raise messages.DecodeError('Invalid enum value %s' % value)
-      elif isinstance(field, messages.MessageField):
-        value = decode_message(field.message_type, value)
-        value = field.value_from_message(value)
+      if (isinstance(field, messages.MessageField) and field.batch and
+          wire_type == _Encoder.STRING):
+        # Messages of batched fields are decoded in to columns at the end.
+        if batch_rows is None:
+          batch_rows = {}
+        length = decoder.getVarInt32()
+        start = decoder.pos()
+        decoder.skip(length)
+        batch_rows.setdefault(field, []).append((start, start + length))
+        continue
+
+      values = _decode_field(decoder, field, wire_type)
 
       # Merge value in to message.
       if field.repeated:
-        values = getattr(message, field.name)
-        if values is None:
-          setattr(message, field.name, [value])
+        existing_values = getattr(message, field.name)
+        if existing_values is None:
+          setattr(message, field.name, values)
         else:
-          values.append(value)
+          existing_values.extend(values)
       else:
-        setattr(message, field.name, value)
+        setattr(message, field.name, values[-1])
+
+    if batch_rows is not None:
+      for field, rows in six.iteritems(batch_rows):
+        setattr(message, field.name,
+                _decode_batch(message_array, field.message_type, rows))
   except ProtocolBuffer.ProtocolBufferDecodeError as err:
     raise messages.DecodeError('Decoding error: %s' % str(err))
 
   message.check_initialized()
   return message
+
+
+def _decode_tag(decoder):
+  """Decode tag and variant information.
+
+  Args:
+    decoder: _Decoder positioned at the start of a field.
+
+  Returns:
+    Tuple (tag, wire_type) of the field number and wire type.
+
+  Raises:
+    DecodeError if the wire type or tag is not valid.
+  """
+  encoded_tag = decoder.getVarInt32()
+  tag = encoded_tag >> _WIRE_TYPE_BITS
+  wire_type = encoded_tag & _WIRE_TYPE_MASK
+  if wire_type not in _WIRE_TYPE_TO_DECODER_MAP:
+    raise messages.DecodeError('No such wire type %d' % wire_type)
+
+  if tag < 1:
+    raise messages.DecodeError('Invalid tag value %d' % tag)
+  return tag, wire_type
+
+
+def _decode_field(decoder, field, wire_type):
+  """Decode values of a known field.
+
+  Args:
+    decoder: _Decoder positioned at the value of field.
+    field: Field that is decoded.
+    wire_type: Wire type the value was encoded with.
+
+  Returns:
+    List of decoded values, which has more than one value only for packed
+    values of repeated fields.
+
+  Raises:
+    DecodeError if the wire type does not match the field or values are not
+      valid.
+  """
+  expected_wire_type = _VARIANT_TO_WIRE_TYPE[field.variant]
+  if expected_wire_type != wire_type:
+    if wire_type == _Encoder.STRING and field.repeated:
+      # Packed values are accepted for all repeated numeric fields.
+      values = decoder.decode_packed(field.variant)
+      if isinstance(field, messages.EnumField):
+        try:
+          values = [field.type(value) for value in values]
+        except TypeError:
+          raise messages.DecodeError('Invalid enum value in %s' % values)
+      return values
+    raise messages.DecodeError('Expected wire type %s but found %s' % (
+        _WIRE_TYPE_NAME[expected_wire_type],
+        _WIRE_TYPE_NAME[wire_type]))
+
+  value = _VARIANT_TO_DECODER_MAP[field.variant](decoder)
+
+  # Special case Enum and Message types.
+  if isinstance(field, messages.EnumField):
+    try:
+      value = field.type(value)
+    except TypeError:
+      raise messages.DecodeError('Invalid enum value %s' % value)
+  elif isinstance(field, messages.MessageField):
+    value = decode_message(field.message_type, value)
+    value = field.value_from_message(value)
+  elif isinstance(field, messages.StringField) and field.interned:
+    value = field.intern_value(value)
+  return [value]
+
+
+def _decode_batch(message_array, message_type, rows):
+  """Decode messages of a batched field straight in to columns.
+
+  Unrecognized fields of the messages are skipped.
+
+  Args:
+    message_array: Array containing encoded messages.
+    message_type: Message class of batch.
+    rows: List of (start, end) positions of encoded messages in
+      message_array.
+
+  Returns:
+    MessageBatch of decoded messages.
+  """
+  fields = {}
+  columns = {}
+  for field in message_type.all_fields():
+    fields[field.number] = field
+    columns[field.name] = [None] * len(rows)
+
+  for index, (start, end) in enumerate(rows):
+    decoder = _Decoder(message_array, start, end)
+    while decoder.avail() > 0:
+      tag, wire_type = _decode_tag(decoder)
+      field = fields.get(tag)
+      if field is None:
+        _WIRE_TYPE_TO_DECODER_MAP[wire_type](decoder)
+        continue
+
+      values = _decode_field(decoder, field, wire_type)
+      column = columns[field.name]
+      if not field.repeated:
+        column[index] = values[-1]
+      elif column[index] is None:
+        column[index] = values
+      else:
+        column[index].extend(values)
+
+  return messages.MessageBatch.from_columns(message_type, columns,
+                                            len(rows))
+
+
+# Size in bytes of values of fixed size variants.
+_FIXED_SIZES = {
+    messages.Variant.DOUBLE: 8,
+    messages.Variant.FLOAT: 4,
+    messages.Variant.BOOL: 1,
+}
+
+
+def _varint_size(value):
+  """Size of value encoded as a varint."""
+  if value < 0:
+    # Negative values are sign extended to 64 bits.
+    return 10
+  size = 1
+  while value > 0x7f:
+    value >>= 7
+    size += 1
+  return size
+
+
+def _value_size(variant, value, sizes):
+  """Size of a single encoded value, not including its tag.
+
+  Args:
+    variant: Variant of value.
+    value: Value to get size of.
+    sizes: Dictionary of message sizes, see _message_size.
+
+  Returns:
+    Size of value in bytes.
+  """
+  size = _FIXED_SIZES.get(variant)
+  if size is not None:
+    return size
+  if variant == messages.Variant.MESSAGE:
+    size = _message_size(value, sizes)
+  elif variant in (messages.Variant.STRING, messages.Variant.BYTES):
+    if isinstance(value, six.text_type):
+      value = value.encode('utf-8')
+    size = len(value)
+  elif variant == messages.Variant.ENUM:
+    return _varint_size(value.number)
+  elif variant in (messages.Variant.INT64,
+                   messages.Variant.INT32,
+                   messages.Variant.UINT64):
+    return _varint_size(value)
+  else:
+    # Same variants as _Encoder.no_encoding.
+    raise NotImplementedError()
+  return _varint_size(size) + size
+
+
+def _field_size(field, value, sizes):
+  """Size of the encoded value of a known field, including tags.
+
+  Args:
+    field: Field of value.
+    value: Assigned value of field, not None.
+    sizes: Dictionary of message sizes, see _message_size.
+
+  Returns:
+    Size of encoded field in bytes.
+  """
+  variant = field.variant
+  tag_size = _varint_size(field.number << _WIRE_TYPE_BITS)
+  if field.packed:
+    if not value:
+      return 0
+    size = sum(_value_size(variant, item, sizes) for item in value)
+    return tag_size + _varint_size(size) + size
+
+  if isinstance(value, messages.MessageBatch):
+    row_sizes = _batch_sizes(value, sizes)
+    return sum(tag_size + _varint_size(size) + size for size in row_sizes)
+
+  if not field.repeated:
+    value = [value]
+  size = 0
+  is_message_field = isinstance(field, messages.MessageField)
+  for item in value:
+    if is_message_field:
+      item = field.value_to_message(item)
+    size += tag_size + _value_size(variant, item, sizes)
+  return size
+
+
+def _message_size(message, sizes):
+  """Size of an encoded message, not including its tag or length.
+
+  Args:
+    message: Message instance to get size of.
+    sizes: Dictionary mapping the ids of messages and batches to tuples
+      (message or batch, size) for all messages and batches sized so far.
+      The messages are kept so their ids are not reused while sizes is in
+      use.
+
+  Returns:
+    Size of encoded message in bytes.
+  """
+  entry = sizes.get(id(message))
+  if entry is not None:
+    return entry[1]
+
+  def compute_size(message):
+    size = 0
+    for field in message.all_fields():
+      value = message.get_assigned_value(field.name)
+      if value is not None:
+        size += _field_size(field, value, sizes)
+
+    for key in message.all_unrecognized_fields():
+      if not isinstance(key, six.integer_types):
+        continue
+      value, variant = message.get_unrecognized_field_info(key)
+      if not isinstance(variant, messages.Variant):
+        continue
+      if not isinstance(value, (list, tuple)):
+        value = [value]
+      tag_size = _varint_size(key << _WIRE_TYPE_BITS)
+      for item in value:
+        size += tag_size + _value_size(variant, item, sizes)
+    return size
+
+  size = messages.cached_encoding(message, _message_size, compute_size)
+  sizes[id(message)] = message, size
+  return size
+
+
+def _batch_sizes(batch, sizes):
+  """Sizes of the encoded messages of a MessageBatch.
+
+  Args:
+    batch: MessageBatch to get sizes of.
+    sizes: Dictionary of message sizes, see _message_size.
+
+  Returns:
+    List of sizes of encoded messages of batch in bytes.
+  """
+  entry = sizes.get(id(batch))
+  if entry is not None:
+    return entry[1]
+
+  row_sizes = [0] * len(batch)
+  for field in batch.message_type.all_fields():
+    for index, value in enumerate(batch.column(field.name)):
+      if value is not None:
+        row_sizes[index] += _field_size(field, value, sizes)
+  sizes[id(batch)] = batch, row_sizes
+  return row_sizes
@@ -21,6 +21,7 @@ __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
 import datetime
+import struct
 import unittest
 
 from protorpc import message_types
@@ -247,6 +248,182 @@ class EncodeMessageTest(test_util.TestCase,
         chr(3))
     self.assertEquals(encoded, expected)
 
+  def testEncodePackedField(self):
+    """Test that packed fields are encoded as a single value."""
+    class PackedMessage(messages.Message):
+      integers = messages.IntegerField(1, repeated=True, packed=True)
+      colors = messages.EnumField(test_util.OptionalMessage.SimpleEnum, 2,
+                                  repeated=True, packed=True)
+
+    message = PackedMessage(integers=[1, 300],
+                            colors=[test_util.OptionalMessage.SimpleEnum.VAL2])
+    encoded = protobuf.encode_message(message)
+    self.assertEquals(b'\x0a\x03\x01\xac\x02\x12\x01\x02', encoded)
+    self.assertEquals(message,
+                      protobuf.decode_message(PackedMessage, encoded))
+    self.assertEquals(b'', protobuf.encode_message(PackedMessage()))
+
+  def testDecodePackedValues(self):
+    """Test that packed values are accepted for unpacked fields."""
+    class UnpackedMessage(messages.Message):
+      integers = messages.IntegerField(1, repeated=True)
+
+    self.assertEquals(UnpackedMessage(integers=[1, 300, 2]),
+                      protobuf.decode_message(UnpackedMessage,
+                                              b'\x0a\x03\x01\xac\x02'
+                                              b'\x08\x02'))
+
+  def testPackedFloatingPointFields(self):
+    """Test that packed floating point values are converted at once."""
+    class Series(messages.Message):
+      doubles = messages.FloatField(1, repeated=True, array=True, packed=True)
+      floats = messages.FloatField(2, repeated=True, packed=True,
+                                   variant=messages.Variant.FLOAT)
+
+    series = Series(doubles=[0.5, -2.0], floats=[1.5])
+    encoded = protobuf.encode_message(series)
+    self.assertEquals(b'\x0a\x10' + struct.pack('<2d', 0.5, -2.0) +
+                      b'\x12\x04' + struct.pack('<f', 1.5),
+                      encoded)
+    decoded = protobuf.decode_message(Series, encoded)
+    self.assertEquals(series, decoded)
+    self.assertTrue(isinstance(decoded.doubles, messages.FieldArray))
+
+  def testDecodeTruncatedPackedDoubles(self):
+    """Test that packed fixed size values must fill the whole value."""
+    class Series(messages.Message):
+      doubles = messages.FloatField(1, repeated=True, packed=True)
+
+    self.assertRaises(messages.DecodeError,
+                      protobuf.decode_message, Series,
+                      b'\x0a\x03\x00\x00\x00')
+
+  def testBatchField(self):
+    """Test that batched fields are encoded like other repeated fields."""
+    class Batched(messages.Message):
+      values = messages.MessageField(test_util.OptionalMessage, 1,
+                                     repeated=True, batch=True)
+
+    class Repeated(messages.Message):
+      values = messages.MessageField(test_util.OptionalMessage, 1,
+                                     repeated=True)
+
+    values = [test_util.OptionalMessage(int64_value=10,
+                                        string_value=u'a string'),
+              test_util.OptionalMessage(),
+              test_util.OptionalMessage(
+                enum_value=test_util.OptionalMessage.SimpleEnum.VAL2),
+             ]
+    encoded = protobuf.encode_message(Batched(values=values))
+    self.assertEquals(protobuf.encode_message(Repeated(values=values)),
+                      encoded)
+
+    decoded = protobuf.decode_message(Batched, encoded)
+    self.assertTrue(isinstance(decoded.values, messages.MessageBatch))
+    self.assertEquals(values, decoded.values)
+    self.assertEquals((10, None, None), decoded.values.column('int64_value'))
+
+  def testFieldMask(self):
+    """Test encoding of the fields selected by a field mask."""
+    message = test_util.OptionalMessage(int64_value=10,
+                                        string_value=u'a string',
+                                        bool_value=True)
+    self.assertEquals(
+      protobuf.encode_message(test_util.OptionalMessage(int64_value=10,
+                                                        bool_value=True)),
+      protobuf.encode_message(message,
+                              field_mask='int64_value,bool_value'))
+    self.assertEquals(
+      b'', protobuf.encode_message(message.freeze(), field_mask='enum_value'))
+    self.assertRaises(messages.ValidationError,
+                      protobuf.encode_message, message,
+                      field_mask='int64_value.value')
+
+  def testDiff(self):
+    """Test encoding and decoding of diffs between messages."""
+    old = test_util.OptionalMessage(int64_value=10, string_value=u'a string')
+    new = test_util.OptionalMessage(int64_value=20, bool_value=True)
+    diff = messages.diff_messages(old, new)
+    decoded = protobuf.decode_message(
+      messages.diff_type(test_util.OptionalMessage),
+      protobuf.encode_message(diff))
+    self.assertEquals(diff, decoded)
+    messages.apply_diff(old, decoded)
+    self.assertEquals(new, old)
+
+  def testInternedStringField(self):
+    """Test that values of interned string fields are shared."""
+    class Interned(messages.Message):
+      codes = messages.StringField(1, repeated=True, interned=True)
+
+    encoded = protobuf.encode_message(Interned(codes=[u'US', u'US']))
+    decoded = protobuf.decode_message(Interned, encoded)
+    self.assertEquals([u'US', u'US'], decoded.codes)
+    self.assertTrue(decoded.codes[0] is decoded.codes[1])
+    self.assertTrue(decoded.codes[0] is
+                    protobuf.decode_message(Interned, encoded).codes[0])
+
+  def testByteSize(self):
+    """Test that byte_size is the size of the encoded message."""
+    class Sized(messages.Message):
+      optional = messages.MessageField(test_util.OptionalMessage, 1)
+      repeated = messages.MessageField(test_util.RepeatedMessage, 2,
+                                       repeated=True)
+      packed = messages.IntegerField(3, repeated=True, packed=True,
+                                     variant=messages.Variant.INT32)
+      batched = messages.MessageField(test_util.OptionalMessage, 4,
+                                      repeated=True, batch=True)
+      times = message_types.DateTimeField(5, repeated=True)
+
+    optional = test_util.OptionalMessage(
+      double_value=1.5, float_value=2.5, int64_value=-20,
+      bool_value=True, string_value=u'\u2603' * 100, bytes_value=b'abc',
+      enum_value=test_util.OptionalMessage.SimpleEnum.VAL2)
+    sized = Sized(optional=optional,
+                  repeated=[test_util.RepeatedMessage(int64_value=[1, 2**40]),
+                            test_util.RepeatedMessage()],
+                  packed=[-1, 0, 300],
+                  batched=[optional, test_util.OptionalMessage()],
+                  times=[datetime.datetime(2010, 1, 1)])
+    sized.set_unrecognized_field(1000, [u'a', u'b'], messages.Variant.STRING)
+    for message in (sized, Sized(), optional):
+      self.assertEquals(len(protobuf.encode_message(message)),
+                        protobuf.byte_size(message))
+
+  def testByteSizeFrozen(self):
+    """Test byte_size of frozen messages, shared sub-messages included."""
+    nested = test_util.NestedMessage(a_value=u'a value')
+    message = test_util.HasNestedMessage(nested=nested,
+                                         repeated_nested=[nested, nested])
+    size = len(protobuf.encode_message(message))
+    self.assertEquals(size, protobuf.byte_size(message.freeze()))
+    self.assertEquals(size, protobuf.byte_size(message))
+
+  def testByteSizeNotInitialized(self):
+    """Test that byte_size requires initialized messages."""
+    self.assertRaises(messages.ValidationError,
+                      protobuf.byte_size, test_util.NestedMessage())
+
+  def testDecodeBatchFieldNotInitialized(self):
+    """Test that messages of batched fields are checked."""
+    class Batched(messages.Message):
+      values = messages.MessageField(test_util.HasNestedMessage, 1,
+                                     repeated=True, batch=True)
+
+    self.assertRaises(messages.ValidationError,
+                      protobuf.decode_message, Batched,
+                      b'\x0a\x00\x0a\x02\x0a\x00')
+
+  def testDecodeInvalidPackedEnum(self):
+    """Test that invalid packed enum values generate an error."""
+    class PackedMessage(messages.Message):
+      colors = messages.EnumField(test_util.OptionalMessage.SimpleEnum, 1,
+                                  repeated=True, packed=True)
+
+    self.assertRaises(messages.DecodeError,
+                      protobuf.decode_message, PackedMessage,
+                      b'\x0a\x02\x01\x64')
+
   def testProtobufDecodeDateTimeMessage(self):
     """Test what happens when decoding a DateTimeMessage."""
 
@@ -291,6 +468,58 @@ class EncodeMessageTest(test_util.TestCase,
       self.assertEquals(my_encoded, encoded)
 
 
+
+class CodecMessage(messages.Message):
+
+  value = messages.IntegerField(1)
+
+
+class CompiledCodecTest(test_util.TestCase):
+  """Tests for compiled codecs."""
+
+  def setUp(self):
+    self.calls = []
+    protobuf.register_codec(CodecMessage, self.Encode, self.Decode)
+
+  def tearDown(self):
+    protobuf._codecs.pop(CodecMessage, None)
+
+  def Encode(self, message, encoder):
+    self.calls.append('encode')
+    if message.value < 0:
+      return False
+    encoder.putVarInt32(8)
+    encoder.putVarInt64(message.value + 1)
+    return True
+
+  def Decode(self, decoder):
+    self.calls.append('decode')
+    decoder.getVarInt32()
+    value = decoder.getVarInt64()
+    if value < 0:
+      return None
+    return CodecMessage(value=value * 10)
+
+  def testEncode(self):
+    self.assertEquals(b'\x08\x02',
+                      protobuf.encode_message(CodecMessage(value=1)))
+    self.assertEquals(['encode'], self.calls)
+
+  def testDecode(self):
+    self.assertEquals(CodecMessage(value=10),
+                      protobuf.decode_message(CodecMessage, b'\x08\x01'))
+    self.assertEquals(['decode'], self.calls)
+
+  def testDecline(self):
+    encoded = protobuf.encode_message(CodecMessage(value=-1))
+    self.assertEquals(CodecMessage(value=-1),
+                      protobuf.decode_message(CodecMessage, encoded))
+    self.assertEquals(['encode', 'decode'], self.calls)
+
+  def testRegisterNonMessage(self):
+    self.assertRaises(TypeError, protobuf.register_codec, object,
+                      self.Encode, self.Decode)
+
 def main():
   unittest.main()
 
@@ -43,6 +43,7 @@ __all__ = [
     'encode_message',
     'decode_message',
     'ProtoJson',
+    'register_codec',
 ]
 
 
@@ -82,6 +83,64 @@ def _load_json_module():
 json = _load_json_module()
 
 
+# Maps message types to (encoder, decoder) of compiled codecs.
+_codecs = {}
+
+# Maps ProtoJson classes to whether they may use compiled codecs.
+_compiled_codec_protocols = {}
+
+
+def register_codec(message_type, encoder, decoder):
+  """Register compiled codec for a message type.
+
+  Compiled codecs, such as those written by generate_python, take the place
+  of the reflective conversion between messages and JSON objects for a single
+  message type.  They implement the field encoding of ProtoJson, so they are
+  not used by sub-classes of ProtoJson that override encode_field or
+  decode_field.  Either function may decline a message, in which case the
+  reflective implementation is used.
+
+  Args:
+    message_type: Message class handled by codec.
+    encoder: Function taking (protocol, message) that returns a dictionary
+      that can be serialized by MessageJSONEncoder, or None if message can
+      not be encoded.
+    decoder: Function taking (protocol, dictionary) that returns a new
+      instance of message_type, or None if dictionary can not be decoded,
+      for example because it contains unrecognized fields.
+  """
+  if not (isinstance(message_type, type) and
+          issubclass(message_type, messages.Message)):
+    raise TypeError('Expected Message class, found %r' % (message_type,))
+  _codecs[message_type] = encoder, decoder
+
+
+def _get_codec(protocol, message_type):
+  """Get compiled codec for a message type usable by a protocol.
+
+  Args:
+    protocol: ProtoJson instance.
+    message_type: Message class to find codec for.
+
+  Returns:
+    Tuple (encoder, decoder) if compiled codec is usable, else None.
+  """
+  codec = _codecs.get(message_type)
+  if codec is None:
+    return None
+
+  protocol_class = type(protocol)
+  try:
+    usable = _compiled_codec_protocols[protocol_class]
+  except KeyError:
+    usable = (protocol_class.encode_field == ProtoJson.encode_field and
+              protocol_class.decode_field == ProtoJson.decode_field)
+    _compiled_codec_protocols[protocol_class] = usable
+  if usable:
+    return codec
+  return None
+
+
 # TODO: Rename this to MessageJsonEncoder.
 class MessageJSONEncoder(json.JSONEncoder):
   """Message JSON encoder class.
@@ -111,7 +170,26 @@ class MessageJSONEncoder(json.JSONEncoder):
     if six.PY3 and isinstance(value, bytes):
       return value.decode('utf8')
 
+    if isinstance(value, messages.FieldArray):
+      return value.tolist()
+
+    if isinstance(value, messages.MessageBatch):
+      # Encode batches column by column without creating their messages.
+      result = [{} for _ in range(len(value))]
+      for field in value.message_type.all_fields():
+        for row, item in zip(result, value.column(field.name)):
+          if item not in (None, [], ()):
+            row[field.name] = self.__protojson_protocol.encode_field(
+                field, item)
+      return result
+
     if isinstance(value, messages.Message):
+      codec = _get_codec(self.__protojson_protocol, type(value))
+      if codec is not None:
+        result = codec[0](self.__protojson_protocol, value)
+        if result is not None:
+          return result
+
       result = {}
       for field in value.all_fields():
         item = value.get_assigned_value(field.name)
@@ -168,17 +246,32 @@ class ProtoJson(object):
         value = value.isoformat()
     return value
 
-  def encode_message(self, message):
+  def encode_message(self, message, field_mask=None):
     """Encode Message instance to JSON string.
 
     Args:
       Message instance to encode in to JSON string.
+      field_mask: messages.FieldMask, or its paths, selecting the fields of
+        message to encode.  All fields are encoded if None.
 
     Returns:
       String encoding of Message instance in protocol JSON format.
 
     Raises:
-      messages.ValidationError if message is not initialized.
+      messages.ValidationError if message is not initialized, or field_mask
+        does not refer to fields of message.
+    """
+    return messages.cached_encoding(message, self, self.__encode_message,
+                                    field_mask)
+
+  def __encode_message(self, message):
+    """Encode Message instance to JSON string without using the cache.
+
+    Args:
+      Message instance to encode in to JSON string.
+
+    Returns:
+      String encoding of Message instance in protocol JSON format.
     """
     message.check_initialized()
 
@@ -246,6 +339,12 @@ class ProtoJson(object):
       dictionary: Dictionary to extract information from.  Dictionary
         is as parsed from JSON.  Nested objects will also be dictionaries.
     """
+    codec = _get_codec(self, message_type)
+    if codec is not None:
+      message = codec[1](self, dictionary)
+      if message is not None:
+        return message
+
     message = message_type()
     for key, value in six.iteritems(dictionary):
       if value is None:
@@ -275,6 +374,10 @@ class ProtoJson(object):
       else:
         value = [value]
 
+      if isinstance(field, messages.MessageField) and field.batch:
+        setattr(message, field.name, self.__decode_batch(field.type, value))
+        continue
+
       valid_value = []
       for item in value:
         valid_value.append(self.decode_field(field, item))
@@ -286,6 +389,41 @@ class ProtoJson(object):
         setattr(message, field.name, valid_value[-1])
     return message
 
+  def __decode_batch(self, message_type, dictionaries):
+    """Decode list of dictionaries straight in to columns of a batch.
+
+    Unrecognized fields of the dictionaries are skipped.
+
+    Args:
+      message_type: Message class of batch.
+      dictionaries: List of dictionaries as parsed from JSON.
+
+    Returns:
+      MessageBatch of decoded messages.
+    """
+    fields = dict((field.name, field) for field in message_type.all_fields())
+    columns = {}
+    for index, dictionary in enumerate(dictionaries):
+      for key, value in six.iteritems(dictionary):
+        field = fields.get(key)
+        if field is None or value is None:
+          continue
+
+        # Normalize values in to a list.
+        if isinstance(value, list):
+          if not value:
+            continue
+        else:
+          value = [value]
+
+        valid_value = [self.decode_field(field, item) for item in value]
+        column = columns.get(key)
+        if column is None:
+          column = columns[key] = [None] * len(dictionaries)
+        column[index] = valid_value if field.repeated else valid_value[-1]
+    return messages.MessageBatch.from_columns(message_type, columns,
+                                              len(dictionaries))
+
   def decode_field(self, field, value):
     """Decode a JSON value to a python value.
 
@@ -318,6 +456,9 @@ class ProtoJson(object):
           issubclass(field.type, messages.Message)):
       return self.__decode_dictionary(field.type, value)
 
+    elif isinstance(field, messages.StringField) and field.interned:
+      return field.intern_value(value)
+
     elif (isinstance(field, messages.FloatField) and
           isinstance(value, (six.integer_types, six.string_types))):
       try:
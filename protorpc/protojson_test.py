@@ -255,6 +255,91 @@ class ProtojsonTest(test_util.TestCase,
                       protojson.decode_message(MyMessage,
                                                '{"a_repeated": []}'))
 
+  def testArrayField(self):
+    """Test encoding and decoding of fields stored in arrays."""
+    class Series(messages.Message):
+      times = messages.IntegerField(1, repeated=True, array=True)
+      values = messages.FloatField(2, repeated=True, array=True)
+
+    series = Series(times=[1, 2])
+    encoded = protojson.encode_message(series)
+    self.CompareEncoded('{"times": [1, 2]}', encoded)
+    decoded = protojson.decode_message(Series, encoded)
+    self.assertEquals(series, decoded)
+    self.assertTrue(isinstance(decoded.times, messages.FieldArray))
+
+  def testBatchField(self):
+    """Test encoding and decoding of batched message fields."""
+    class Batched(messages.Message):
+      values = messages.MessageField(MyMessage, 1, repeated=True,
+                                     batch=True)
+
+    batched = Batched(values=[MyMessage(an_integer=1,
+                                        a_repeated=[2, 3],
+                                        an_enum=MyMessage.Color.RED),
+                              MyMessage(a_string=u'a string')])
+    encoded = protojson.encode_message(batched)
+    self.CompareEncoded('{"values": [{"an_integer": 1, "a_repeated": [2, 3],'
+                        '             "an_enum": "RED"},'
+                        '            {"a_string": "a string"}]}',
+                        encoded)
+    decoded = protojson.decode_message(Batched, encoded)
+    self.assertEquals(batched, decoded)
+    self.assertTrue(isinstance(decoded.values, messages.MessageBatch))
+
+    decoded = protojson.decode_message(
+      Batched, '{"values": [{"an_integer": "4", "unknown": 1}, {}]}')
+    self.assertEquals([MyMessage(an_integer=4), MyMessage()],
+                      decoded.values)
+
+  def testFieldMask(self):
+    """Test encoding of the fields selected by a field mask."""
+    message = test_util.HasNestedMessage(
+      nested=test_util.NestedMessage(a_value=u'a'),
+      repeated_nested=[test_util.NestedMessage(a_value=u'b')])
+    self.CompareEncoded('{"nested": {"a_value": "a"}}',
+                        protojson.encode_message(message, field_mask='nested'))
+    self.CompareEncoded('{}', protojson.encode_message(message, field_mask=''))
+    self.assertRaises(messages.ValidationError,
+                      protojson.encode_message, message, field_mask='unknown')
+
+    message.freeze()
+    encoded = protojson.encode_message(message, field_mask='repeated_nested')
+    self.CompareEncoded('{"repeated_nested": [{"a_value": "b"}]}', encoded)
+    self.assertTrue(encoded is
+                    protojson.encode_message(message,
+                                             field_mask='repeated_nested'))
+    self.assertFalse(encoded is protojson.encode_message(message))
+
+  def testDiff(self):
+    """Test encoding and decoding of diffs between messages."""
+    old = test_util.HasNestedMessage(
+      nested=test_util.NestedMessage(a_value=u'a'),
+      repeated_nested=[test_util.NestedMessage(a_value=u'b')])
+    new = test_util.HasNestedMessage(
+      nested=test_util.NestedMessage(a_value=u'c'))
+    encoded = protojson.encode_message(messages.diff_messages(old, new))
+    self.CompareEncoded('{"values": {"nested": {"a_value": "c"}},'
+                        ' "cleared": [2]}', encoded)
+    diff = protojson.decode_message(
+      messages.diff_type(test_util.HasNestedMessage), encoded)
+    messages.apply_diff(old, diff)
+    self.assertEquals(new, old)
+
+  def testInternedStringField(self):
+    """Test that values of interned string fields are shared."""
+    class Interned(messages.Message):
+      codes = messages.StringField(1, repeated=True, interned=True)
+      name = messages.StringField(2)
+
+    decoded = protojson.decode_message(
+      Interned, '{"codes": ["US", "US"], "name": "US"}')
+    self.assertEquals([u'US', u'US'], decoded.codes)
+    self.assertTrue(decoded.codes[0] is decoded.codes[1])
+    self.assertTrue(decoded.codes[0] is protojson.decode_message(
+      Interned, '{"codes": ["US"]}').codes[0])
+    self.assertFalse(decoded.codes[0] is decoded.name)
+
   def testNotJSON(self):
     """Test error when string is not valid JSON."""
     self.assertRaises(ValueError,
@@ -451,6 +536,76 @@ class CustomProtoJsonTest(test_util.TestCase):
     self.assertTrue(instance is protojson.ProtoJson.get_default())
 
 
+class CodecMessage(messages.Message):
+
+  value = messages.StringField(1)
+
+
+class CompiledCodecTest(test_util.TestCase):
+  """Tests for compiled codecs."""
+
+  def setUp(self):
+    self.calls = []
+    protojson.register_codec(CodecMessage, self.Encode, self.Decode)
+
+  def tearDown(self):
+    protojson._codecs.pop(CodecMessage, None)
+
+  def Encode(self, protocol, message):
+    self.calls.append('encode')
+    if message.value == u'decline':
+      return None
+    return {'value': u'compiled'}
+
+  def Decode(self, protocol, dictionary):
+    self.calls.append('decode')
+    if dictionary.get('value') == u'decline':
+      return None
+    return CodecMessage(value=u'compiled')
+
+  def testEncode(self):
+    self.assertEquals('{"value": "compiled"}',
+                      protojson.encode_message(CodecMessage(value=u'x')))
+    self.assertEquals(['encode'], self.calls)
+
+  def testDecode(self):
+    self.assertEquals(CodecMessage(value=u'compiled'),
+                      protojson.decode_message(CodecMessage,
+                                               '{"value": "x"}'))
+    self.assertEquals(['decode'], self.calls)
+
+  def testDecline(self):
+    self.assertEquals('{"value": "decline"}',
+                      protojson.encode_message(CodecMessage(value=u'decline')))
+    self.assertEquals(CodecMessage(value=u'decline'),
+                      protojson.decode_message(CodecMessage,
+                                               '{"value": "decline"}'))
+    self.assertEquals(['encode', 'decode'], self.calls)
+
+  def testCustomProtocol(self):
+    protocol = CustomProtoJson()
+    self.assertEquals('{"value": "{encoded}x"}',
+                      protocol.encode_message(CodecMessage(value=u'x')))
+    self.assertEquals(CodecMessage(value=u'{decoded}x'),
+                      protocol.decode_message(CodecMessage,
+                                              '{"value": "x"}'))
+    self.assertEquals([], self.calls)
+
+  def testFrozenMessageEncodedOnce(self):
+    message = CodecMessage(value=u'x').freeze()
+    protocol = CustomProtoJson()
+    for unused_index in range(2):
+      self.assertEquals('{"value": "compiled"}',
+                        protojson.encode_message(message))
+      self.assertEquals('{"value": "{encoded}x"}',
+                        protocol.encode_message(message))
+    self.assertEquals(['encode'], self.calls)
+
+  def testRegisterNonMessage(self):
+    self.assertRaises(TypeError, protojson.register_codec, object,
+                      self.Encode, self.Decode)
+
+
 class InvalidJsonModule(object):
   pass
 
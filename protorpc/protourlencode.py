@@ -138,6 +138,11 @@ class URLEncodedRequestBuilder(object):
     # dicontiguous ranges of indexes are ignored.
     self.__checked_indexes = set([()])
 
+    # Messages of batched repeated fields are collected in lists, keyed by
+    # the path of the parent message and the field name, because messages
+    # stored in a MessageBatch can no longer be changed.  See finish.
+    self.__batch_rows = {}
+
   def make_path(self, parameter_name):
     """Parse a parameter name and build a full path to a message value.
 
@@ -266,7 +271,11 @@ class URLEncodedRequestBuilder(object):
       return True
 
     parent = self.__messages.get(parent_path, None)
-    value_list = getattr(parent, name, None)
+    batch_rows = self.__batch_rows.get((parent_path, name))
+    if batch_rows is not None:
+      value_list = batch_rows[2]
+    else:
+      value_list = getattr(parent, name, None)
     # If the list does not exist then the index should be 0.  Since it is
     # not, path is not valid.
     if not value_list:
@@ -340,6 +349,10 @@ class URLEncodedRequestBuilder(object):
         self.__messages[next_path] = next_message
         if not field.repeated:
           setattr(parent, field.name, next_message)
+        elif field.batch:
+          self.__batch_rows.setdefault((parent_path, name),
+                                       (parent, field, []))[2].append(
+                                           next_message)
         else:
           list_value = getattr(parent, field.name, None)
           if list_value is None:
@@ -352,6 +365,19 @@ class URLEncodedRequestBuilder(object):
 
     return parent
 
+  def finish(self):
+    """Assign collected messages to batched repeated fields.
+
+    Must be called once all parameters are added when the message has
+    repeated message fields defined with batch=True.
+    """
+    # Inner batches are assigned before the messages containing them.
+    for (parent_path, _), (parent, field, rows) in sorted(
+        six.iteritems(self.__batch_rows),
+        key=lambda item: len(item[0][0]), reverse=True):
+      setattr(parent, field.name, rows)
+    self.__batch_rows = {}
+
   def add_parameter(self, parameter, values):
     """Add a single parameter.
 
@@ -434,7 +460,7 @@ class URLEncodedRequestBuilder(object):
       self.__get_or_create_path(path)
       return True
     elif isinstance(field, messages.StringField):
-      converted_value = value.decode('utf-8')
+      converted_value = field.intern_value(value.decode('utf-8'))
     elif isinstance(field, messages.BooleanField):
       converted_value = value.lower() == 'true' and True or False
     else:
@@ -461,19 +487,26 @@ class URLEncodedRequestBuilder(object):
 
 
 @util.positional(1)
-def encode_message(message, prefix=''):
+def encode_message(message, prefix='', field_mask=None):
   """Encode Message instance to url-encoded string.
 
   Args:
     message: Message instance to encode in to url-encoded string.
     prefix: Prefix to append to field names of contained values.
+    field_mask: messages.FieldMask, or its paths, selecting the fields of
+      message to encode.  All fields are encoded if None.
 
   Returns:
     String encoding of Message in URL encoded format.
 
   Raises:
-    messages.ValidationError if message is not initialized.
+    messages.ValidationError if message is not initialized, or field_mask
+      does not refer to fields of message.
   """
+  if field_mask is not None:
+    if not isinstance(field_mask, messages.FieldMask):
+      field_mask = messages.FieldMask(field_mask)
+    message = field_mask.project(message)
   message.check_initialized()
 
   parameters = []
@@ -559,5 +592,6 @@ def decode_message(message_type, encoded_message, **kwargs):
     # Save off any unknown values, so they're still accessible.
     if not added:
       message.set_unrecognized_field(argument, values, messages.Variant.STRING)
+  builder.finish()
   message.check_initialized()
   return message
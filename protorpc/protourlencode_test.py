@@ -163,6 +163,31 @@ class URLEncodedRequestBuilderTest(test_util.TestCase):
     self.assertEquals('a string',
                       message.sub_message.sub_messages[1].string_value)
 
+  def testAddParameter_BatchedMessages(self):
+    class Batched(messages.Message):
+      sub_messages = messages.MessageField(test_util.OptionalMessage, 1,
+                                           repeated=True, batch=True)
+
+    message = Batched()
+    builder = protourlencode.URLEncodedRequestBuilder(message)
+    self.assertTrue(builder.add_parameter('sub_messages-0.int64_value',
+                                          ['10']))
+    self.assertTrue(builder.add_parameter('sub_messages-0.string_value',
+                                          ['a string']))
+    self.assertTrue(builder.add_parameter('sub_messages-1.int64_value',
+                                          ['20']))
+    self.assertFalse(builder.add_parameter('sub_messages-3.int64_value',
+                                           ['30']))
+    self.assertEquals([], message.sub_messages)
+
+    builder.finish()
+    self.assertTrue(isinstance(message.sub_messages, messages.MessageBatch))
+    self.assertEquals([test_util.OptionalMessage(int64_value=10,
+                                                 string_value=u'a string'),
+                       test_util.OptionalMessage(int64_value=20),
+                      ],
+                      message.sub_messages)
+
   def testAddParameter_RepeatedValues(self):
     message = test_util.RepeatedMessage()
     builder = protourlencode.URLEncodedRequestBuilder(message, prefix='pre.')
@@ -356,6 +381,46 @@ class ProtourlencodeConformanceTest(test_util.TestCase,
     self.assertEquals((['400', 'test', '123.456'], messages.Variant.STRING),
                       decoded2.get_unrecognized_field_info('repeated'))
 
+  def testBatchedMessages(self):
+    class Inner(messages.Message):
+      value = messages.IntegerField(1)
+
+    class Item(messages.Message):
+      inners = messages.MessageField(Inner, 1, repeated=True, batch=True)
+
+    class Items(messages.Message):
+      items = messages.MessageField(Item, 1, repeated=True, batch=True)
+
+    items = Items(items=[Item(inners=[Inner(value=1), Inner(value=2)]),
+                         Item()])
+    encoded = protourlencode.encode_message(items)
+    self.assertEquals(
+      'items-0.inners-0.value=1&items-0.inners-1.value=2', encoded)
+    self.assertEquals(Items(items=[Item(inners=[Inner(value=1),
+                                                Inner(value=2)])]),
+                      protourlencode.decode_message(Items, encoded))
+
+  def testFieldMask(self):
+    message = test_util.HasNestedMessage(
+      nested=test_util.NestedMessage(a_value=u'a'),
+      repeated_nested=[test_util.NestedMessage(a_value=u'b')])
+    self.assertEquals('nested.a_value=a',
+                      protourlencode.encode_message(message,
+                                                    field_mask='nested'))
+    self.assertEquals('pre.repeated_nested-0.a_value=b',
+                      protourlencode.encode_message(
+                        message, prefix='pre.',
+                        field_mask='repeated_nested.a_value'))
+
+  def testInternedStringField(self):
+    class Interned(messages.Message):
+      codes = messages.StringField(1, repeated=True, interned=True)
+
+    decoded = protourlencode.decode_message(Interned,
+                                            'codes-0=US&codes-1=US')
+    self.assertEquals([u'US', u'US'], decoded.codes)
+    self.assertTrue(decoded.codes[0] is decoded.codes[1])
+
   def testDecodeInvalidDateTime(self):
 
     class MyMessage(messages.Message):
@@ -29,9 +29,16 @@ The registry is also able to resolve the full descriptor.FileSet necessary to
 describe the service and all required data-types (messages and enums).
 
 A configured registry is itself a remote service and should reference itself.
+
+File-sets are computed once per process for every combination of requested
+service names.  Their encodings are cached per protocol as well and served
+with an ETag, so that clients can revalidate them cheaply.
 """
 
+import collections
+import hashlib
 import sys
+import threading
 
 from . import descriptor
 from . import messages
@@ -102,6 +109,90 @@ class GetFileSetResponse(messages.Message):
   file_set = messages.MessageField(descriptor.FileSet, 1, required=True)
 
 
+# Maximum number of file-sets kept by the process-wide file-set cache.
+_MAX_CACHED_FILE_SETS = 128
+
+
+class _CachedFileSet(object):
+  """Response of a file-set request together with its encodings."""
+
+  def __init__(self, response):
+    """Constructor.
+
+    Args:
+      response: GetFileSetResponse to cache.  Must not be modified after
+        being cached.
+    """
+    self.response = response
+    self.__lock = threading.Lock()
+    self.__encodings = {}
+
+  def encode(self, protocol):
+    """Get encoding of response.
+
+    Args:
+      protocol: remote.ProtocolConfig to encode response with.
+
+    Returns:
+      Tuple (encoded_response, etag).
+    """
+    with self.__lock:
+      encoding = self.__encodings.get(protocol.protocol)
+    if encoding is None:
+      encoded_response = protocol.encode_message(self.response)
+      if not isinstance(encoded_response, bytes):
+        etag_content = encoded_response.encode('utf-8')
+      else:
+        etag_content = encoded_response
+      encoding = (encoded_response,
+                  'W/"%s"' % hashlib.sha1(etag_content).hexdigest())
+      with self.__lock:
+        self.__encodings[protocol.protocol] = encoding
+    return encoding
+
+
+class _FileSetCache(object):
+  """Thread-safe, size-bounded cache of _CachedFileSet.
+
+  Least recently used file-sets are discarded first.
+  """
+
+  def __init__(self, max_size=_MAX_CACHED_FILE_SETS):
+    self.__max_size = max_size
+    self.__lock = threading.Lock()
+    self.__file_sets = collections.OrderedDict()
+
+  def get(self, key, describe):
+    """Get cached file-set, computing it if necessary.
+
+    Args:
+      key: Hashable key identifying the file-set.
+      describe: Function returning the descriptor.FileSet for key.
+
+    Returns:
+      _CachedFileSet for key.
+    """
+    with self.__lock:
+      cached = self.__file_sets.pop(key, None)
+      if cached is not None:
+        self.__file_sets[key] = cached
+        return cached
+    cached = _CachedFileSet(GetFileSetResponse(file_set=describe()))
+    with self.__lock:
+      self.__file_sets[key] = cached
+      while len(self.__file_sets) > self.__max_size:
+        self.__file_sets.popitem(last=False)
+    return cached
+
+  def clear(self):
+    """Discard all cached file-sets."""
+    with self.__lock:
+      self.__file_sets.clear()
+
+
+_file_set_cache = _FileSetCache()
+
+
 class RegistryService(remote.Service):
   """Registry service.
 
@@ -109,6 +200,11 @@ class RegistryService(remote.Service):
   necessary to use contined services.
 
   On an HTTP based server, the name is the URL path to the service.
+
+  File-sets drawn from sys.modules are cached for the whole process, keyed by
+  the requested names and the service classes they are registered to, so
+  that modifying the registry invalidates them.  A module reload creates new
+  service classes and is therefore seen as well.
   """
 
   @util.positional(2)
@@ -127,6 +223,8 @@ class RegistryService(remote.Service):
     #   __definition_to_modules: Mapping of definition types to set of modules
     #     that they refer to.  This cache is used to make repeated look-ups
     #     faster and to prevent circular references from causing endless loops.
+    #   __cached_file_set: _CachedFileSet returned by the last call to
+    #     get_file_set.
 
     self.__registry = registry
     if modules is None:
@@ -134,6 +232,7 @@ class RegistryService(remote.Service):
     self.__modules = modules
     # This cache will only last for a single request.
     self.__definition_to_modules = {}
+    self.__cached_file_set = None
 
   def __find_modules_for_message(self, message_type):
     """Find modules referred to by a message type.
@@ -232,9 +331,47 @@ class RegistryService(remote.Service):
 
     return response
 
+  def __get_cached_file_set(self, names):
+    """Get cached file-set for named services.
+
+    Args:
+      names: List of names to get file-set for.
+
+    Returns:
+      _CachedFileSet for names.
+    """
+    names = sorted(set(names))
+    key = tuple((name, self.__registry[name]) for name in names)
+    describe = lambda: self.__describe_file_set(names)
+    if self.__modules is not sys.modules:
+      # Only file-sets drawn from sys.modules are shared between requests.
+      return _CachedFileSet(GetFileSetResponse(file_set=describe()))
+    return _file_set_cache.get(key, describe)
+
   @remote.method(GetFileSetRequest, GetFileSetResponse)
   def get_file_set(self, request):
-    """Get file-set for registered servies."""
-    response = GetFileSetResponse()
-    response.file_set = self.__describe_file_set(request.names)
-    return response
+    """Get file-set for registered servies.
+
+    The response is shared with other requests for the same services and
+    must not be modified.
+    """
+    self.__cached_file_set = self.__get_cached_file_set(request.names)
+    return self.__cached_file_set.response
+
+  def get_encoded_response(self, response, protocol):
+    """Get cached encoding of a response.
+
+    Used by the server to avoid re-encoding file-sets.
+
+    Args:
+      response: Response returned by a remote method of this service.
+      protocol: remote.ProtocolConfig to encode response with.
+
+    Returns:
+      Tuple (encoded_response, etag) if response is a cached file-set, else
+      None.
+    """
+    cached = self.__cached_file_set
+    if cached is not None and cached.response is response:
+      return cached.encode(protocol)
+    return None
@@ -26,6 +26,8 @@ import unittest
 from protorpc import descriptor
 from protorpc import message_types
 from protorpc import messages
+from protorpc import protobuf
+from protorpc import protojson
 from protorpc import registry
 from protorpc import remote
 from protorpc import test_util
@@ -116,6 +118,75 @@ class RegistryServiceTest(test_util.TestCase):
     self.assertIterEqual(expected_file_set.files, response.file_set.files)
 
 
+class CachedFileSetTest(test_util.TestCase):
+
+  def setUp(self):
+    registry._file_set_cache.clear()
+    self.registry = {'my-service1': MyService1}
+    self.request = registry.GetFileSetRequest(names=[u'my-service1'])
+
+  def GetFileSet(self, **kwargs):
+    registry_service = registry.RegistryService(self.registry, **kwargs)
+    return registry_service, registry_service.get_file_set(self.request)
+
+  def testSharedBetweenInstances(self):
+    unused_service, response1 = self.GetFileSet()
+    unused_service, response2 = self.GetFileSet()
+    self.assertTrue(response1 is response2)
+
+  def testNameOrder(self):
+    self.registry['my-service2'] = MyService2
+    self.request.names = [u'my-service1', u'my-service2']
+    unused_service, response1 = self.GetFileSet()
+    self.request.names = [u'my-service2', u'my-service1', u'my-service2']
+    unused_service, response2 = self.GetFileSet()
+    self.assertTrue(response1 is response2)
+
+  def testRegistryModified(self):
+    unused_service, response1 = self.GetFileSet()
+    self.registry['my-service1'] = MyService2
+    unused_service, response2 = self.GetFileSet()
+    self.assertFalse(response1 is response2)
+    self.assertNotEquals(response1, response2)
+
+  def testCustomModules(self):
+    modules = {__name__: sys.modules[__name__],
+               test_util.__name__: test_util,
+              }
+    unused_service, response1 = self.GetFileSet(modules=modules)
+    unused_service, response2 = self.GetFileSet(modules=modules)
+    self.assertFalse(response1 is response2)
+    self.assertEquals(response1, response2)
+
+  def testGetEncodedResponse(self):
+    self.registry = {'my-service2': MyService2}
+    self.request.names = [u'my-service2']
+    registry_service, response = self.GetFileSet()
+    protocols = remote.Protocols.new_default()
+    json_config = protocols.lookup_by_name('protojson')
+    protobuf_config = protocols.lookup_by_name('protobuf')
+
+    encoded, etag = registry_service.get_encoded_response(response,
+                                                          json_config)
+    self.assertEquals(protojson.encode_message(response), encoded)
+    self.assertEquals((encoded, etag),
+                      registry_service.get_encoded_response(response,
+                                                            json_config))
+
+    encoded, protobuf_etag = registry_service.get_encoded_response(
+      response, protobuf_config)
+    self.assertEquals(protobuf.encode_message(response), encoded)
+    self.assertNotEquals(etag, protobuf_etag)
+
+  def testGetEncodedResponseNotCached(self):
+    registry_service, unused_response = self.GetFileSet()
+    protocol = remote.Protocols.new_default().lookup_by_name('protojson')
+    self.assertEquals(
+      None,
+      registry_service.get_encoded_response(registry.GetFileSetResponse(),
+                                            protocol))
+
+
 def main():
   unittest.main()
 
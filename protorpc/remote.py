@@ -99,6 +99,14 @@ make an asynchronous call, do:
 
   rpc = my_service.async.do_something(request)
   response = rpc.get_response()
+
+On Python 3.5 and later a Service subclass also has a CoroutineStub class
+whose methods are coroutines.  Used with a transport whose RPCs are awaitable,
+such as aio_transport.AsyncioHttpTransport, many calls can be in flight at
+once without a thread per call:
+
+  my_service = MyService.CoroutineStub(AsyncioHttpTransport('<my URL>'))
+  response = await my_service.do_something(request)
 """
 
 from __future__ import with_statement
@@ -112,12 +120,21 @@ import sys
 import threading
 from wsgiref import headers as wsgi_headers
 
+from . import compression
 from . import message_types
 from . import messages
 from . import protobuf
 from . import protojson
 from . import util
 
+if sys.version_info >= (3, 5):
+  from . import _coroutines
+  _is_coroutine_function = _coroutines.is_coroutine_function
+else:
+  # Native coroutines are not available before Python 3.5.
+  _coroutines = None
+  _is_coroutine_function = lambda function: False
+
 
 __all__ = [
     'ApplicationError',
@@ -315,6 +332,11 @@ class _RemoteMethodInfo(object):
     """Original undecorated method."""
     return self.__method
 
+  @property
+  def is_coroutine(self):
+    """True if the remote method is declared with 'async def'."""
+    return _is_coroutine_function(self.__method)
+
   @property
   def request_type(self):
     """Expected request type for remote method."""
@@ -338,6 +360,10 @@ def method(request_type=message_types.VoidMessage,
            response_type=message_types.VoidMessage):
   """Method decorator for creating remote methods.
 
+  The decorated method may be a native coroutine ('async def') on Python 3.5
+  and later.  In that case the resulting remote method is also a coroutine
+  function and request and response types are checked around the await.
+
   Args:
     request_type: Message type of expected request.
     response_type: Message type of expected response.
@@ -383,28 +409,8 @@ def method(request_type=message_types.VoidMessage,
         or is the Message class itself.
     """
 
-    @functools.wraps(method)
-    def invoke_remote_method(service_instance, request):
-      """Function used to replace original method.
-
-      Invoke wrapped remote method.  Checks to ensure that request and
-      response objects are the correct types.
-
-      Does not check whether messages are initialized.
-
-      Args:
-        service_instance: The service object whose method is being invoked.
-          This is passed to 'self' during the invocation of the original
-          method.
-        request: Request message.
-
-      Returns:
-        Results of calling wrapped remote method.
-
-      Raises:
-        RequestError: Request object is not of the correct type.
-        ServerError: Response object is not of the correct type.
-      """
+    def check_request(service_instance, request):
+      """Raise RequestError if request is not of the expected type."""
       if not isinstance(request, remote_method_info.request_type):
         raise RequestError('Method %s.%s expected request type %s, '
                            'received %s' %
@@ -412,7 +418,9 @@ def method(request_type=message_types.VoidMessage,
                             method.__name__,
                             remote_method_info.request_type,
                             type(request)))
-      response = method(service_instance, request)
+
+    def check_response(service_instance, response):
+      """Raise ServerError if response is not of the expected type."""
       if not isinstance(response, remote_method_info.response_type):
         raise ServerError('Method %s.%s expected response type %s, '
                           'sent %s' %
@@ -420,7 +428,37 @@ def method(request_type=message_types.VoidMessage,
                            method.__name__,
                            remote_method_info.response_type,
                            type(response)))
-      return response
+
+    if _is_coroutine_function(method):
+      invoke_remote_method = _coroutines.new_coroutine_remote_method(
+        method, check_request, check_response)
+    else:
+      @functools.wraps(method)
+      def invoke_remote_method(service_instance, request):
+        """Function used to replace original method.
+
+        Invoke wrapped remote method.  Checks to ensure that request and
+        response objects are the correct types.
+
+        Does not check whether messages are initialized.
+
+        Args:
+          service_instance: The service object whose method is being invoked.
+            This is passed to 'self' during the invocation of the original
+            method.
+          request: Request message.
+
+        Returns:
+          Results of calling wrapped remote method.
+
+        Raises:
+          RequestError: Request object is not of the correct type.
+          ServerError: Response object is not of the correct type.
+        """
+        check_request(service_instance, request)
+        response = method(service_instance, request)
+        check_response(service_instance, response)
+        return response
 
     remote_method_info = _RemoteMethodInfo(method,
                                            request_type,
@@ -583,6 +621,22 @@ class _ServiceClass(type):
     sync_method.remote = async_method.remote
     return sync_method
 
+  def __create_coroutine_methods(cls, async_methods):
+    """Construct a dictionary of coroutine methods based on remote methods.
+
+    Args:
+      async_methods: Dictionary of async methods to delegate calls to.
+
+    Returns:
+      Dictionary of coroutine methods with assocaited RemoteInfo objects.
+      Results added to CoroutineStub subclass.
+    """
+    coroutine_methods = {}
+    for method_name, async_method in async_methods.items():
+      coroutine_methods[method_name] = _coroutines.new_coroutine_stub_method(
+        async_method)
+    return coroutine_methods
+
   def __create_async_methods(cls, remote_methods):
     """Construct a dictionary of asynchronous methods based on remote methods.
 
@@ -694,6 +748,13 @@ class _ServiceClass(type):
 
       cls.Stub = type('Stub', (StubBase, cls), stub_attributes)
 
+      # Build coroutine stub class where native coroutines are available.
+      if _coroutines is not None:
+        stub_attributes = {'Service': cls}
+        stub_attributes.update(cls.__create_coroutine_methods(async_methods))
+        cls.CoroutineStub = type('CoroutineStub', (StubBase, cls),
+                                 stub_attributes)
+
   @staticmethod
   def all_remote_methods(cls):
     """Get all remote methods of service.
@@ -1034,13 +1095,26 @@ class ProtocolConfig(object):
       duplicates.  Overrides ALTERNATIVE_CONTENT_TYPE defined on protocol.
     content_types: A list of all content-types supported by configuration.
       Combination of default content-type and alternatives.
+    content_encodings: Content codings, such as 'gzip', that servers accept
+      for requests and may compress responses with, in order of preference.
+      HTTP transports ask for responses in these codings.
+    compression_threshold: Size in bytes below which bodies are sent
+      uncompressed.
+    request_encoding: Content coding HTTP transports compress requests with,
+      or None to send requests uncompressed.
+    max_decompressed_size: Size in bytes compressed request bodies may
+      expand to before servers reject them.
   """
 
   def __init__(self,
                protocol,
                name,
                default_content_type=None,
-               alternative_content_types=None):
+               alternative_content_types=None,
+               content_encodings=None,
+               compression_threshold=None,
+               request_encoding=None,
+               max_decompressed_size=None):
     """Constructor.
 
     Args:
@@ -1051,9 +1125,24 @@ class ProtocolConfig(object):
       alternative_content_types:  A list of content-types.  If none provided,
         it will check protocol.ALTERNATIVE_CONTENT_TYPES.  If that attribute
         does not exist, will be an empty tuple.
+      content_encodings: A list of content codings from
+        compression.SUPPORTED_ENCODINGS.  If none provided, all supported
+        codings are used.  An empty list disables compression.
+      compression_threshold: Size in bytes below which bodies are not
+        compressed.  If none provided, uses
+        compression.DEFAULT_COMPRESSION_THRESHOLD.
+      request_encoding: Content coding of content_encodings that HTTP
+        transports compress requests with.  Requests are not compressed by
+        default since servers predating content-encoding support can not
+        decode them.
+      max_decompressed_size: Size in bytes compressed request bodies may
+        expand to.  Servers answer larger requests with 413 Request Entity
+        Too Large.  If none provided, uses
+        compression.DEFAULT_MAX_DECOMPRESSED_SIZE.
 
     Raises:
-      ServiceConfigurationError if there are any duplicate content-types.
+      ServiceConfigurationError if there are any duplicate content-types, or
+      unsupported content codings.
     """
     self.__protocol = protocol
     self.__name = name
@@ -1076,6 +1165,30 @@ class ProtocolConfig(object):
           'Duplicate content-type %s' % content_type)
       previous_type = content_type
 
+    if content_encodings is None:
+      content_encodings = compression.SUPPORTED_ENCODINGS
+    self.__content_encodings = tuple(
+      encoding.lower() for encoding in content_encodings)
+    for encoding in self.__content_encodings:
+      if encoding not in compression.SUPPORTED_ENCODINGS:
+        raise ServiceConfigurationError(
+          'Unsupported content encoding %s' % encoding)
+
+    if compression_threshold is None:
+      compression_threshold = compression.DEFAULT_COMPRESSION_THRESHOLD
+    self.__compression_threshold = compression_threshold
+
+    if (request_encoding is not None and
+        request_encoding not in self.__content_encodings):
+      raise ServiceConfigurationError(
+        'Request encoding %s is not one of the content encodings' %
+        request_encoding)
+    self.__request_encoding = request_encoding
+
+    if max_decompressed_size is None:
+      max_decompressed_size = compression.DEFAULT_MAX_DECOMPRESSED_SIZE
+    self.__max_decompressed_size = max_decompressed_size
+
   @property
   def protocol(self):
     return self.__protocol
@@ -1096,16 +1209,38 @@ class ProtocolConfig(object):
   def content_types(self):
     return self.__content_types
 
-  def encode_message(self, message):
+  @property
+  def content_encodings(self):
+    return self.__content_encodings
+
+  @property
+  def compression_threshold(self):
+    return self.__compression_threshold
+
+  @property
+  def request_encoding(self):
+    return self.__request_encoding
+
+  @property
+  def max_decompressed_size(self):
+    return self.__max_decompressed_size
+
+  def encode_message(self, message, field_mask=None):
     """Encode message.
 
     Args:
       message: Message instance to encode.
+      field_mask: messages.FieldMask selecting the fields of message to
+        encode, or None to encode all fields.  Only passed on to the
+        protocol when not None, so protocols without field mask support
+        keep working.
 
     Returns:
       String encoding of Message instance encoded in protocol's format.
     """
-    return self.__protocol.encode_message(message)
+    if field_mask is None:
+      return self.__protocol.encode_message(message)
+    return self.__protocol.encode_message(message, field_mask=field_mask)
 
   def decode_message(self, message_type, encoded_message):
     """Decode buffer to Message instance.
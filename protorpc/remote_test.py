@@ -25,6 +25,7 @@ import types
 import unittest
 from wsgiref import headers
 
+from protorpc import compression
 from protorpc import descriptor
 from protorpc import message_types
 from protorpc import messages
@@ -805,6 +806,43 @@ class ProtocolConfigTest(test_util.TestCase):
                       'text/plain',
                       ('text/html', 'text/html'))
 
+  def testContentEncodingDefaults(self):
+    config = remote.ProtocolConfig(protojson, 'proto2')
+    self.assertEquals(('gzip', 'deflate'), config.content_encodings)
+    self.assertEquals(compression.DEFAULT_COMPRESSION_THRESHOLD,
+                      config.compression_threshold)
+    self.assertEquals(None, config.request_encoding)
+    self.assertEquals(compression.DEFAULT_MAX_DECOMPRESSED_SIZE,
+                      config.max_decompressed_size)
+
+  def testContentEncodings(self):
+    config = remote.ProtocolConfig(protojson, 'proto2',
+                                   content_encodings=['Deflate'],
+                                   compression_threshold=0,
+                                   request_encoding='deflate',
+                                   max_decompressed_size=100)
+    self.assertEquals(('deflate',), config.content_encodings)
+    self.assertEquals(0, config.compression_threshold)
+    self.assertEquals('deflate', config.request_encoding)
+    self.assertEquals(100, config.max_decompressed_size)
+
+  def testBadContentEncodings(self):
+    self.assertRaisesWithRegexpMatch(remote.ServiceConfigurationError,
+                                     'Unsupported content encoding br',
+                                     remote.ProtocolConfig,
+                                     protojson,
+                                     'json',
+                                     content_encodings=['gzip', 'br'])
+
+    self.assertRaisesWithRegexpMatch(
+      remote.ServiceConfigurationError,
+      'Request encoding gzip is not one of the content encodings',
+      remote.ProtocolConfig,
+      protojson,
+      'json',
+      content_encodings=(),
+      request_encoding='gzip')
+
   def testEncodeMessage(self):
     config = remote.ProtocolConfig(protojson, 'proto2')
     encoded_message = config.encode_message(
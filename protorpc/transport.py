@@ -24,12 +24,16 @@ Includes HTTP transport built over urllib2.
 """
 
 import six.moves.http_client
+import errno
 import logging
 import os
 import socket
 import sys
-import urlparse
+import threading
+import time
+from six.moves.urllib import parse as urlparse
 
+from . import compression
 from . import messages
 from . import protobuf
 from . import remote
@@ -37,19 +41,37 @@ from . import util
 import six
 
 __all__ = [
+  'DEFAULT_IDLE_TIMEOUT',
+  'DEFAULT_MAX_IDLE_PER_HOST',
   'RpcStateError',
+  'RpcTimeoutError',
 
+  'ConnectionPool',
   'HttpTransport',
   'LocalTransport',
   'Rpc',
   'Transport',
+  'as_completed',
+  'wait_all',
+  'wait_any',
 ]
 
 
+# Seconds an idle keep-alive connection may stay in a ConnectionPool.
+DEFAULT_IDLE_TIMEOUT = 30
+
+# Number of idle keep-alive connections kept by a ConnectionPool per host.
+DEFAULT_MAX_IDLE_PER_HOST = 10
+
+
 class RpcStateError(messages.Error):
   """Raised when trying to put RPC in to an invalid state."""
 
 
+class RpcTimeoutError(messages.Error):
+  """Raised when RPCs do not complete within the time waited for them."""
+
+
 class Rpc(object):
   """Represents a client side RPC.
 
@@ -69,6 +91,8 @@ class Rpc(object):
     self.__state = remote.RpcState.RUNNING
     self.__error_message = None
     self.__error_name = None
+    self.__wait_lock = threading.Lock()
+    self.__wait_error = None
 
   @property
   def request(self):
@@ -100,14 +124,43 @@ class Rpc(object):
     return self.__error_name
 
   def wait(self):
-    """Wait for an RPC to finish."""
-    if self.__state == remote.RpcState.RUNNING:
-      self._wait_impl()
+    """Wait for an RPC to finish.
+
+    Waiting is thread-safe.  If waiting fails with an error, the same error is
+    raised again by every later wait instead of waiting again.
+    """
+    with self.__wait_lock:
+      if self.__wait_error is not None:
+        six.reraise(*self.__wait_error)
+      if self.__state == remote.RpcState.RUNNING:
+        try:
+          self._wait_impl()
+        except Exception:
+          self.__wait_error = sys.exc_info()
+          raise
 
   def _wait_impl(self):
     """Implementation for wait()."""
     raise NotImplementedError()
 
+  @classmethod
+  def _wait_in_background(cls, rpcs, notify):
+    """Wait for running RPCs of this class without blocking the caller.
+
+    Used by as_completed.  The default waits for each RPC on its own daemon
+    thread.  Sub-classes that can wait for many RPCs at once override it.
+
+    Args:
+      rpcs: List of running instances of this class.
+      notify: Function to call for each RPC once it is complete, with the RPC
+        and None, or with the RPC and the exc_info of an error that kept it
+        from completing.
+    """
+    for rpc in rpcs:
+      thread = threading.Thread(target=_wait_and_notify, args=(rpc, notify))
+      thread.daemon = True
+      thread.start()
+
   def __check_status(self):
     error_class = remote.RpcError.from_state(self.__state)
     if error_class is not None:
@@ -139,6 +192,141 @@ class Rpc(object):
     self.__set_state(status.state, status.error_message, status.error_name)
 
 
+def _is_complete(rpc):
+  """Check whether RPC has a result or waiting for it failed for good.
+
+  Args:
+    rpc: Rpc instance to check.
+
+  Returns:
+    True if rpc is no longer running, or if waiting for it failed with an
+    error that later waits raise again.
+  """
+  return (rpc.state != remote.RpcState.RUNNING or
+          rpc._Rpc__wait_error is not None)
+
+
+def _wait_and_notify(rpc, notify):
+  """Wait for RPC and notify once it is complete.
+
+  Args:
+    rpc: Rpc instance to wait for.
+    notify: Function called with rpc and None once rpc is complete, or with
+      rpc and the exc_info of the error that kept it from completing.
+  """
+  try:
+    rpc.wait()
+  except Exception:
+    if not _is_complete(rpc):
+      notify(rpc, sys.exc_info())
+      return
+    # The error is raised again when the RPC is used.
+  notify(rpc, None)
+
+
+def as_completed(rpcs, timeout=None):
+  """Iterate over RPCs as they complete.
+
+  RPCs that are still running are waited for concurrently, each kind of RPC
+  the way its class waits in the background: HTTP RPCs each on their own
+  thread, so that their responses are read at the same time, and asyncio RPCs
+  on their event loop.  RPCs whose wait failed are also considered complete.
+  The error is raised when their response is used.
+
+  Example:
+    rpcs = [stub.async.get_weather(city=city) for city in cities]
+    for rpc in transport.as_completed(rpcs, timeout=10):
+      display(rpc.response)
+
+  All RPCs are waited for from the same moment, so timeout is a single
+  deadline for the whole wait rather than a timeout per RPC: any RPC that
+  takes longer than timeout also makes the wait expire.  RPCs can not be
+  cancelled, so expiring raises an error instead of completing the slow RPCs.
+
+  Args:
+    rpcs: Iterable of Rpc instances.
+    timeout: Maximum number of seconds to wait for all RPCs to complete, or
+      None to wait without limit.
+
+  Yields:
+    Rpc instances from rpcs in the order that they complete.
+
+  Raises:
+    RpcTimeoutError: When not all RPCs complete within timeout.  RPCs that are
+      still running continue to be waited for in the background.
+    RpcStateError: When RPCs may not be waited for, such as asyncio RPCs whose
+      event loop is already running.  Other errors that keep an RPC from
+      completing are raised as well.
+  """
+  rpcs = list(rpcs)
+  if timeout is not None:
+    deadline = time.time() + timeout
+  completed = six.moves.queue.Queue()
+  notify = lambda rpc, exc_info: completed.put((rpc, exc_info))
+
+  running = {}
+  for rpc in rpcs:
+    if rpc.state == remote.RpcState.RUNNING:
+      running.setdefault(type(rpc), []).append(rpc)
+    else:
+      notify(rpc, None)
+  for rpc_class, class_rpcs in six.iteritems(running):
+    rpc_class._wait_in_background(class_rpcs, notify)
+
+  for index in range(len(rpcs)):
+    if timeout is None:
+      rpc, exc_info = completed.get()
+    else:
+      try:
+        rpc, exc_info = completed.get(timeout=max(deadline - time.time(), 0))
+      except six.moves.queue.Empty:
+        raise RpcTimeoutError(
+          '%d of %d RPCs did not complete within %s seconds' %
+          (len(rpcs) - index, len(rpcs), timeout))
+    if exc_info is not None:
+      six.reraise(*exc_info)
+    yield rpc
+
+
+def wait_all(rpcs, timeout=None):
+  """Wait for all RPCs to complete.
+
+  Args:
+    rpcs: Iterable of Rpc instances.
+    timeout: Maximum number of seconds to wait, or None to wait without limit.
+
+  Returns:
+    List of rpcs in their original order.
+
+  Raises:
+    RpcTimeoutError: When not all RPCs complete within timeout.
+  """
+  rpcs = list(rpcs)
+  for unused_rpc in as_completed(rpcs, timeout=timeout):
+    pass
+  return rpcs
+
+
+def wait_any(rpcs, timeout=None):
+  """Wait for any one of the RPCs to complete.
+
+  Args:
+    rpcs: Non-empty iterable of Rpc instances.
+    timeout: Maximum number of seconds to wait, or None to wait without limit.
+
+  Returns:
+    First Rpc of rpcs to complete.
+
+  Raises:
+    RpcTimeoutError: When no RPC completes within timeout.
+    ValueError: When rpcs is empty.
+  """
+  rpcs = list(rpcs)
+  if not rpcs:
+    raise ValueError('Must wait for at least one RPC')
+  return next(as_completed(rpcs, timeout=timeout))
+
+
 class Transport(object):
   """Transport base class.
 
@@ -214,13 +402,175 @@ class Transport(object):
     raise NotImplementedError()
 
 
+class ConnectionPool(object):
+  """Thread-safe pool of idle keep-alive HTTP connections.
+
+  Connections are pooled per scheme, host and port.  A connection is taken out
+  of the pool for the duration of a single request and response and is put
+  back once the response has been read completely, unless the server asked
+  for the connection to be closed.
+
+  Getting a connection never blocks.  When no idle connection is available a
+  new one is created, so any number of RPCs may be in flight at once.  Only
+  the number of idle connections kept per host is bounded; connections
+  released beyond that bound are closed.  Idle connections that have not been
+  used for longer than the idle timeout are closed instead of being reused.
+  """
+
+  __default_pool = None
+  __lock = threading.Lock()
+
+  @util.positional(1)
+  def __init__(self,
+               max_idle_per_host=DEFAULT_MAX_IDLE_PER_HOST,
+               idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Constructor.
+
+    Args:
+      max_idle_per_host: Maximum number of idle connections kept per host.
+        Use 0 to disable keep-alive altogether.
+      idle_timeout: Number of seconds after which an idle connection is no
+        longer reused.
+    """
+    self.__max_idle_per_host = max_idle_per_host
+    self.__idle_timeout = idle_timeout
+    # Map (scheme, host, port) -> list of (release time, connection) pairs
+    # with the most recently released connection last.
+    self.__idle_connections = {}
+    self.__idle_lock = threading.Lock()
+
+  @property
+  def max_idle_per_host(self):
+    """Maximum number of idle connections kept per host."""
+    return self.__max_idle_per_host
+
+  @property
+  def idle_timeout(self):
+    """Number of seconds after which an idle connection is not reused."""
+    return self.__idle_timeout
+
+  def new_connection(self, url):
+    """Create a new connection that is not taken from the pool.
+
+    Args:
+      url: Parsed URL the connection is for.
+
+    Returns:
+      New HTTPConnection or HTTPSConnection to host of url.
+    """
+    if url.scheme == 'https':
+      connection_type = six.moves.http_client.HTTPSConnection
+    else:
+      connection_type = six.moves.http_client.HTTPConnection
+    return connection_type(url.hostname, url.port)
+
+  def get_connection(self, url):
+    """Get connection for a request, reusing an idle one if possible.
+
+    Args:
+      url: Parsed URL the connection is for.
+
+    Returns:
+      Tuple (connection, reused):
+        connection: HTTPConnection or HTTPSConnection to host of url.
+        reused: True if connection was previously used.  Reused connections
+          may have been closed by the server in the meantime.
+    """
+    key = (url.scheme, url.hostname, url.port)
+    now = time.time()
+    connection = None
+    expired = []
+    with self.__idle_lock:
+      idle_connections = self.__idle_connections.get(key)
+      while idle_connections:
+        release_time, idle_connection = idle_connections.pop()
+        if now - release_time < self.__idle_timeout:
+          connection = idle_connection
+          break
+        expired.append(idle_connection)
+
+    for expired_connection in expired:
+      expired_connection.close()
+
+    if connection is None:
+      return self.new_connection(url), False
+    return connection, True
+
+  def release_connection(self, url, connection):
+    """Return a connection whose response was completely read to the pool.
+
+    Args:
+      url: Parsed URL the connection was acquired for.
+      connection: Connection to return.  It is closed if the pool for its host
+        is already full.
+    """
+    key = (url.scheme, url.hostname, url.port)
+    with self.__idle_lock:
+      idle_connections = self.__idle_connections.setdefault(key, [])
+      if len(idle_connections) < self.__max_idle_per_host:
+        idle_connections.append((time.time(), connection))
+        return
+    connection.close()
+
+  def close(self):
+    """Close all idle connections."""
+    with self.__idle_lock:
+      idle_connections = self.__idle_connections
+      self.__idle_connections = {}
+    for connections in six.itervalues(idle_connections):
+      for unused_release_time, connection in connections:
+        connection.close()
+
+  @classmethod
+  def get_default(cls):
+    """Get the global default ConnectionPool instance.
+
+    Returns:
+      Current global default ConnectionPool instance.
+    """
+    default_pool = cls.__default_pool
+    if default_pool is None:
+      with cls.__lock:
+        default_pool = cls.__default_pool
+        if default_pool is None:
+          default_pool = cls()
+          cls.__default_pool = default_pool
+    return default_pool
+
+  @classmethod
+  def set_default(cls, connection_pool):
+    """Set the global default ConnectionPool instance.
+
+    Args:
+      connection_pool: A ConnectionPool instance.
+
+    Raises:
+      TypeError: If connection_pool is not an instance of ConnectionPool.
+    """
+    if not isinstance(connection_pool, ConnectionPool):
+      raise TypeError(
+        'Expected value of type "ConnectionPool", found %r' % connection_pool)
+    with cls.__lock:
+      cls.__default_pool = connection_pool
+
+
 class HttpTransport(Transport):
-  """Transport for communicating with HTTP servers."""
+  """Transport for communicating with HTTP servers.
+
+  Connections are kept alive between RPCs in a ConnectionPool.  When sending
+  a request over a reused connection fails because the server has closed it
+  in the meantime, the request is retried once on a new connection.
+
+  Responses are requested in the content codings of the protocol
+  configuration and requests are compressed with its request encoding, see
+  remote.ProtocolConfig.
+  """
 
   @util.positional(2)
   def __init__(self,
                service_url,
-               protocol=protobuf):
+               protocol=protobuf,
+               connection_pool=None):
     """Constructor.
 
     Args:
@@ -228,11 +578,24 @@ class HttpTransport(Transport):
         the transport will go to this URL.
       protocol: The protocol implementation.  Must implement encode_message and
         decode_message.  Can also be an instance of remote.ProtocolConfig.
+      connection_pool: ConnectionPool to take connections from.  Defaults to
+        the global default ConnectionPool.
     """
     super(HttpTransport, self).__init__(protocol=protocol)
     self.__service_url = service_url
+    self.__connection_pool = connection_pool or ConnectionPool.get_default()
+
+  @property
+  def service_url(self):
+    """URL where the service is located."""
+    return self.__service_url
 
-  def __get_rpc_status(self, response, content):
+  @property
+  def connection_pool(self):
+    """ConnectionPool used by this transport."""
+    return self.__connection_pool
+
+  def _get_rpc_status(self, response, content):
     """Get RPC status from HTTP response.
 
     Args:
@@ -269,7 +632,78 @@ class HttpTransport(Transport):
                             error_message='HTTP Error %s: %s' % (
                               response.status, content or 'Unknown Error'))
 
-  def __set_response(self, remote_info, connection, rpc):
+  def _encode_request(self, request):
+    """Encode request message for sending over HTTP.
+
+    Args:
+      request: Request message to encode.
+
+    Returns:
+      Tuple (encoded_request, headers):
+        encoded_request: Encoded request message as bytes, compressed if the
+          protocol configuration asks for it.
+        headers: Dictionary of HTTP headers to send the request with.
+    """
+    protocol_config = self.protocol_config
+    encoded_request = self.protocol.encode_message(request)
+    if isinstance(encoded_request, six.text_type):
+      encoded_request = encoded_request.encode('utf-8')
+    headers = {'Content-type': protocol_config.default_content_type}
+    if protocol_config.content_encodings:
+      headers['Accept-encoding'] = ', '.join(protocol_config.content_encodings)
+    request_encoding = protocol_config.request_encoding
+    if (request_encoding and
+        len(encoded_request) >= protocol_config.compression_threshold):
+      encoded_request = compression.compress(encoded_request, request_encoding)
+      headers['Content-encoding'] = request_encoding
+    headers['Content-length'] = len(encoded_request)
+    return encoded_request, headers
+
+  def _read_content(self, response):
+    """Read and decompress content of HTTP response.
+
+    Args:
+      response: HTTPResponse whose content has not been read yet.
+
+    Returns:
+      Decompressed content.
+
+    Raises:
+      ServerError if the content can not be decompressed.
+    """
+    content_encoding = (response.getheader('content-encoding') or
+                        compression.IDENTITY).strip().lower()
+    if content_encoding == compression.IDENTITY:
+      return response.read()
+    try:
+      return compression.decompress_stream(response, content_encoding)
+    except compression.Error as err:
+      raise remote.ServerError('Unable to decode response content: %s' % err)
+
+  @staticmethod
+  def _is_stale_connection_error(error):
+    """Check whether a reused connection was closed before the request arrived.
+
+    Only errors raised before any byte of a response arrived qualify.
+    Timeouts never do: the server may still be processing the request, so
+    sending it again could run the remote method twice.
+
+    Args:
+      error: Exception raised by HTTPConnection.getresponse.
+
+    Returns:
+      True if the request may safely be sent again on a new connection.
+    """
+    if isinstance(error, socket.timeout):
+      return False
+    if isinstance(error, six.moves.http_client.BadStatusLine):
+      # Raised when the connection was closed without a status line,
+      # including RemoteDisconnected on Python 3.
+      return True
+    return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+  def __set_response(self, remote_info, url, encoded_request, headers,
+                     connection, reused, rpc):
     """Set response on RPC.
 
     Sets response or status from HTTP request.  Implements the wait method of
@@ -277,23 +711,42 @@ class HttpTransport(Transport):
 
     Args:
       remote_info: Remote info for invoked RPC.
+      url: Parsed URL request was sent to.
+      encoded_request: Encoded request message, used to retry the request.
+      headers: HTTP headers of request, used to retry the request.
       connection: HTTPConnection that is making request.
+      reused: True if connection was reused from the connection pool.
       rpc: Rpc instance.
     """
+    keep_alive = False
     try:
-      response = connection.getresponse()
-
-      content = response.read()
+      try:
+        response = connection.getresponse()
+      except (six.moves.http_client.BadStatusLine, socket.error) as err:
+        if not (reused and self._is_stale_connection_error(err)):
+          raise
+        # The server closed the idle connection.  Retry once on a new one.
+        connection.close()
+        connection = self.__connection_pool.new_connection(url)
+        self._send_http_request(connection, url.path, encoded_request,
+                                headers)
+        response = connection.getresponse()
+
+      content = self._read_content(response)
+      keep_alive = not response.will_close
 
       if response.status == six.moves.http_client.OK:
         response = self.protocol.decode_message(remote_info.response_type,
                                                 content)
         rpc.set_response(response)
       else:
-        status = self.__get_rpc_status(response, content)
+        status = self._get_rpc_status(response, content)
         rpc.set_status(status)
     finally:
-      connection.close()
+      if keep_alive:
+        self.__connection_pool.release_connection(url, connection)
+      else:
+        connection.close()
 
   def _start_rpc(self, remote_info, request):
     """Start a remote procedure call.
@@ -306,16 +759,23 @@ class HttpTransport(Transport):
       An Rpc instance initialized with a Request.
     """
     method_url = '%s.%s' % (self.__service_url, remote_info.method.__name__)
-    encoded_request = self.protocol.encode_message(request)
+    encoded_request, headers = self._encode_request(request)
 
     url = urlparse.urlparse(method_url)
-    if url.scheme == 'https':
-      connection_type = six.moves.http_client.HTTPSConnection
-    else:
-      connection_type = six.moves.http_client.HTTPConnection
-    connection = connection_type(url.hostname, url.port)
+    connection, reused = self.__connection_pool.get_connection(url)
     try:
-      self._send_http_request(connection, url.path, encoded_request)
+      try:
+        self._send_http_request(connection, url.path, encoded_request,
+                                headers)
+      except (six.moves.http_client.HTTPException, socket.error):
+        if not reused:
+          raise
+        # The server closed the idle connection.  Retry once on a new one.
+        connection.close()
+        connection = self.__connection_pool.new_connection(url)
+        reused = False
+        self._send_http_request(connection, url.path, encoded_request,
+                                headers)
       rpc = Rpc(request)
     except remote.RpcError:
       # Pass through all ProtoRPC errors
@@ -331,18 +791,16 @@ class HttpTransport(Transport):
       raise remote.NetworkError('Error communicating with HTTP server',
                                 err)
     else:
-      wait_impl = lambda: self.__set_response(remote_info, connection, rpc)
+      wait_impl = lambda: self.__set_response(remote_info, url,
+                                              encoded_request, headers,
+                                              connection, reused, rpc)
       rpc._wait_impl = wait_impl
 
       return rpc
 
-  def _send_http_request(self, connection, http_path, encoded_request):
-    connection.request(
-        'POST',
-        http_path,
-        encoded_request,
-        headers={'Content-type': self.protocol_config.default_content_type,
-                 'Content-length': len(encoded_request)})
+  def _send_http_request(self, connection, http_path, encoded_request,
+                         headers):
+    connection.request('POST', http_path, encoded_request, headers=headers)
 
 
 class LocalTransport(Transport):
@@ -19,8 +19,11 @@ import errno
 import six.moves.http_client
 import os
 import socket
+import threading
+import time
 import unittest
 
+from protorpc import compression
 from protorpc import messages
 from protorpc import protobuf
 from protorpc import protojson
@@ -29,6 +32,9 @@ from protorpc import test_util
 from protorpc import transport
 from protorpc import webapp_test_util
 from protorpc.wsgi import util as wsgi_util
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import parse as urlparse
 
 import mox
 
@@ -147,12 +153,102 @@ class RpcTest(test_util.TestCase):
       self.rpc.set_response,
       self.response)
 
+  def testWaitErrorIsKept(self):
+    rpc = DelayedRpc(0, error=remote.NetworkError('Lost connection'))
+    self.assertRaises(remote.NetworkError, rpc.wait)
+    self.assertRaises(remote.NetworkError, rpc.wait)
+    self.assertEquals(1, rpc.wait_count)
+
   def testSetUninitializedStatus(self):
     self.assertRaises(messages.ValidationError,
                       self.rpc.set_status,
                       remote.RpcStatus())
 
 
+class DelayedRpc(transport.Rpc):
+  """Rpc that completes after a delay when waited on."""
+
+  def __init__(self, delay, error=None):
+    super(DelayedRpc, self).__init__(Message(value=u'request'))
+    self.delay = delay
+    self.error = error
+    self.wait_count = 0
+
+  def _wait_impl(self):
+    self.wait_count += 1
+    time.sleep(self.delay)
+    if self.error:
+      raise self.error
+    self.set_response(Message(value=u'response'))
+
+
+class WaitTest(test_util.TestCase):
+
+  def testAsCompleted(self):
+    rpcs = [DelayedRpc(0.2), DelayedRpc(0), DelayedRpc(0.1)]
+    self.assertEquals([rpcs[1], rpcs[2], rpcs[0]],
+                      list(transport.as_completed(rpcs)))
+
+  def testAsCompletedWaitsConcurrently(self):
+    rpcs = [DelayedRpc(0.2) for _ in range(5)]
+    start = time.time()
+    self.assertEquals(5, len(list(transport.as_completed(rpcs))))
+    self.assertLess(time.time() - start, 0.6)
+
+  def testAsCompletedAlreadyComplete(self):
+    rpc = DelayedRpc(0)
+    rpc.wait()
+    self.assertEquals([rpc], list(transport.as_completed([rpc])))
+    self.assertEquals(1, rpc.wait_count)
+
+  def testAsCompletedError(self):
+    rpc = DelayedRpc(0, error=remote.NetworkError('Lost connection'))
+    self.assertEquals([rpc], list(transport.as_completed([rpc])))
+    self.assertRaisesWithRegexpMatch(remote.NetworkError,
+                                     'Lost connection',
+                                     getattr, rpc, 'response')
+    self.assertEquals(1, rpc.wait_count)
+
+  def testAsCompletedTimeout(self):
+    rpcs = [DelayedRpc(0), DelayedRpc(1)]
+    completed = transport.as_completed(rpcs, timeout=0.1)
+    self.assertEquals(rpcs[0], next(completed))
+    self.assertRaisesWithRegexpMatch(
+      transport.RpcTimeoutError,
+      '1 of 2 RPCs did not complete within 0.1 seconds',
+      next, completed)
+
+  def testAsCompletedNotCompleted(self):
+    class NotWaitableRpc(DelayedRpc):
+      def wait(self):
+        raise transport.RpcStateError('May not wait')
+
+    rpcs = [DelayedRpc(0), NotWaitableRpc(0)]
+    self.assertRaisesWithRegexpMatch(transport.RpcStateError,
+                                     'May not wait',
+                                     transport.wait_all, rpcs, timeout=1)
+
+  def testWaitAll(self):
+    rpcs = [DelayedRpc(0.1), DelayedRpc(0)]
+    self.assertEquals(rpcs, transport.wait_all(iter(rpcs)))
+    self.assertEquals([remote.RpcState.OK] * 2, [rpc.state for rpc in rpcs])
+
+  def testWaitAllTimeout(self):
+    self.assertRaises(transport.RpcTimeoutError,
+                      transport.wait_all, [DelayedRpc(1)], timeout=0.05)
+
+  def testWaitAny(self):
+    rpcs = [DelayedRpc(1), DelayedRpc(0)]
+    self.assertEquals(rpcs[1], transport.wait_any(rpcs))
+
+  def testWaitAnyTimeout(self):
+    self.assertRaises(transport.RpcTimeoutError,
+                      transport.wait_any, [DelayedRpc(1)], timeout=0.05)
+
+  def testWaitAnyEmpty(self):
+    self.assertRaises(ValueError, transport.wait_any, [])
+
+
 class TransportTest(test_util.TestCase):
 
   def setUp(self):
@@ -393,6 +489,234 @@ class HttpTransportTest(webapp_test_util.WebServerTestBase):
     self.assertEquals(Message(), rpc.response)
 
 
+class FakeConnection(object):
+
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class ConnectionPoolTest(test_util.TestCase):
+
+  def setUp(self):
+    self.original_http_connection = six.moves.http_client.HTTPConnection
+    six.moves.http_client.HTTPConnection = FakeConnection
+    self.pool = transport.ConnectionPool(max_idle_per_host=2)
+    self.url = urlparse.urlparse('http://localhost:8080/service.method')
+
+  def tearDown(self):
+    six.moves.http_client.HTTPConnection = self.original_http_connection
+
+  def testNewConnection(self):
+    connection, reused = self.pool.get_connection(self.url)
+    self.assertFalse(reused)
+    self.assertEquals('localhost', connection.host)
+    self.assertEquals(8080, connection.port)
+
+  def testReuseConnection(self):
+    connection, unused_reused = self.pool.get_connection(self.url)
+    self.pool.release_connection(self.url, connection)
+
+    reused_connection, reused = self.pool.get_connection(self.url)
+    self.assertTrue(reused)
+    self.assertTrue(connection is reused_connection)
+    self.assertFalse(connection.closed)
+
+    connection, reused = self.pool.get_connection(self.url)
+    self.assertFalse(reused)
+    self.assertFalse(connection is reused_connection)
+
+  def testPooledPerHost(self):
+    connection, unused_reused = self.pool.get_connection(self.url)
+    self.pool.release_connection(self.url, connection)
+
+    other_url = urlparse.urlparse('http://localhost:8081/service.method')
+    other_connection, reused = self.pool.get_connection(other_url)
+    self.assertFalse(reused)
+    self.assertEquals(8081, other_connection.port)
+
+  def testMaxIdlePerHost(self):
+    connections = [self.pool.get_connection(self.url)[0] for _ in range(3)]
+    for connection in connections:
+      self.pool.release_connection(self.url, connection)
+    self.assertEquals([False, False, True],
+                      [connection.closed for connection in connections])
+
+  def testIdleTimeout(self):
+    self.pool = transport.ConnectionPool(idle_timeout=0)
+    connection, unused_reused = self.pool.get_connection(self.url)
+    self.pool.release_connection(self.url, connection)
+
+    new_connection, reused = self.pool.get_connection(self.url)
+    self.assertFalse(reused)
+    self.assertTrue(connection.closed)
+    self.assertFalse(new_connection is connection)
+
+  def testClose(self):
+    connection, unused_reused = self.pool.get_connection(self.url)
+    self.pool.release_connection(self.url, connection)
+    self.pool.close()
+    self.assertTrue(connection.closed)
+    self.assertFalse(self.pool.get_connection(self.url)[1])
+
+  def testDefault(self):
+    original_default = transport.ConnectionPool.get_default()
+    try:
+      self.assertTrue(isinstance(original_default, transport.ConnectionPool))
+      self.assertTrue(original_default is
+                      transport.ConnectionPool.get_default())
+      transport.ConnectionPool.set_default(self.pool)
+      self.assertTrue(self.pool is transport.ConnectionPool.get_default())
+      self.assertTrue(
+        self.pool is transport.HttpTransport('http://x').connection_pool)
+      self.assertRaises(TypeError, transport.ConnectionPool.set_default, None)
+    finally:
+      transport.ConnectionPool.set_default(original_default)
+
+
+class KeepAliveServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handler responding with the same content on HTTP/1.1 connections."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers['content-length']))
+    self.server.client_ports.append(self.client_address[1])
+    time.sleep(self.server.response_delay)
+    self.server.accept_encodings.append(self.headers.get('accept-encoding'))
+    content = self.server.content
+    self.send_response(200)
+    self.send_header('content-type', 'application/json')
+    if self.server.content_encoding:
+      if self.server.content_encoding in compression.SUPPORTED_ENCODINGS:
+        content = compression.compress(content, self.server.content_encoding)
+      self.send_header('content-encoding', self.server.content_encoding)
+    self.send_header('content-length', str(len(content)))
+    if self.server.connection_close_header:
+      self.send_header('connection', 'close')
+    self.end_headers()
+    self.wfile.write(content)
+    # Simulates a server that drops idle connections without notice.
+    self.close_connection = (self.server.drop_connections or
+                             self.server.connection_close_header)
+
+  def log_message(self, *args):
+    pass
+
+
+class HttpTransportKeepAliveTest(test_util.TestCase):
+
+  def setUp(self):
+    self.server = KeepAliveServer(('localhost', 0), KeepAliveHandler)
+    self.server.client_ports = []
+    self.server.accept_encodings = []
+    self.server.content_encoding = None
+    self.server.drop_connections = False
+    self.server.connection_close_header = False
+    self.server.response_delay = 0
+    self.server.content = protojson.encode_message(
+      Message(value=u'The response value')).encode('utf-8')
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+
+    self.pool = transport.ConnectionPool()
+    self.transport = transport.HttpTransport(
+      'http://localhost:%d/my/service' % self.server.server_address[1],
+      protocol=protojson,
+      connection_pool=self.pool)
+
+  def tearDown(self):
+    self.pool.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def call(self):
+    rpc = self.transport.send_rpc(my_method.remote,
+                                  Message(value=u'The request value'))
+    self.assertEquals(Message(value=u'The response value'), rpc.response)
+
+  def testConnectionReused(self):
+    for _ in range(3):
+      self.call()
+    self.assertEquals(3, len(self.server.client_ports))
+    self.assertEquals(1, len(set(self.server.client_ports)))
+
+  def testConcurrentRpcs(self):
+    rpcs = [self.transport.send_rpc(my_method.remote,
+                                    Message(value=u'The request value'))
+            for _ in range(3)]
+    for rpc in rpcs:
+      self.assertEquals(Message(value=u'The response value'), rpc.response)
+    self.assertEquals(3, len(set(self.server.client_ports)))
+
+    # All connections were returned to the pool and are reused.
+    for _ in range(3):
+      self.call()
+    self.assertEquals(3, len(set(self.server.client_ports)))
+
+  def testWaitAll(self):
+    rpcs = [self.transport.send_rpc(my_method.remote,
+                                    Message(value=u'The request value'))
+            for _ in range(3)]
+    for rpc in transport.wait_all(rpcs, timeout=10):
+      self.assertEquals(Message(value=u'The response value'), rpc.response)
+
+  def testServerClosesConnection(self):
+    self.server.connection_close_header = True
+    self.call()
+    self.call()
+    self.assertEquals(2, len(set(self.server.client_ports)))
+
+  def testStaleConnectionRetried(self):
+    self.server.drop_connections = True
+    for _ in range(3):
+      self.call()
+    self.assertEquals(3, len(set(self.server.client_ports)))
+
+  def testTimeoutNotRetried(self):
+    original_timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(0.2)
+    try:
+      self.call()
+      self.server.response_delay = 1
+      rpc = self.transport.send_rpc(my_method.remote,
+                                    Message(value=u'The request value'))
+      self.assertRaises(socket.timeout, rpc.wait)
+    finally:
+      socket.setdefaulttimeout(original_timeout)
+    # The request that timed out on the reused connection was not sent again.
+    self.assertEquals(2, len(self.server.client_ports))
+    self.assertEquals(1, len(set(self.server.client_ports)))
+
+  def testCompressedResponse(self):
+    self.server.content_encoding = 'gzip'
+    self.call()
+    self.server.content_encoding = 'deflate'
+    self.call()
+    self.assertEquals(['gzip, deflate'] * 2, self.server.accept_encodings)
+    # The compressed content was read completely.
+    self.assertEquals(1, len(set(self.server.client_ports)))
+
+  def testUnsupportedResponseEncoding(self):
+    self.server.content_encoding = 'br'
+    rpc = self.transport.send_rpc(my_method.remote,
+                                  Message(value=u'The request value'))
+    self.assertRaisesWithRegexpMatch(
+      remote.ServerError,
+      'Unable to decode response content: Unsupported content encoding: br',
+      getattr, rpc, 'response')
+
+
 class SimpleRequest(messages.Message):
 
   content = messages.StringField(1)
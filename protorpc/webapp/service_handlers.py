@@ -95,6 +95,7 @@ import logging
 
 from .google_imports import webapp
 from .google_imports import webapp_util
+from .. import instrumentation as rpc_instrumentation
 from .. import messages
 from .. import protobuf
 from .. import protojson
@@ -287,14 +288,17 @@ class ServiceHandlerFactory(object):
         [ServiceHandlerFactory.default(StockService).mapping('/stocks')])
   """
 
-  def __init__(self, service_factory):
+  def __init__(self, service_factory, instrumentation=None):
     """Constructor.
 
     Args:
       service_factory: Service factory to instantiate and provide to
         service handler.
+      instrumentation: instrumentation.Instrumentation that service handlers
+        report calls to.  If None, calls are not measured.
     """
     self.__service_factory = service_factory
+    self.__instrumentation = instrumentation
     self.__request_mappers = []
 
   def all_request_mappers(self):
@@ -318,6 +322,11 @@ class ServiceHandlerFactory(object):
     """Service factory associated with this factory."""
     return self.__service_factory
 
+  @property
+  def instrumentation(self):
+    """Instrumentation that service handlers report calls to."""
+    return self.__instrumentation
+
   @staticmethod
   def __check_path(path):
     """Check a path parameter.
@@ -351,7 +360,7 @@ class ServiceHandlerFactory(object):
     return service_url_pattern, self
 
   @classmethod
-  def default(cls, service_factory, parameter_prefix=''):
+  def default(cls, service_factory, parameter_prefix='', instrumentation=None):
     """Convenience method to map default factory configuration to application.
 
     Creates a standardized default service factory configuration that pre-maps
@@ -366,11 +375,13 @@ class ServiceHandlerFactory(object):
         path-name.  Defaults to 'method'.
       parameter_prefix: If provided, all the parameters in the form are
         expected to begin with that prefix by the URLEncodedRPCMapper.
+      instrumentation: instrumentation.Instrumentation that service handlers
+        report calls to.
 
     Returns:
       Mapping from service URL to service handler factory.
     """
-    factory = cls(service_factory)
+    factory = cls(service_factory, instrumentation=instrumentation)
 
     factory.add_request_mapper(ProtobufRPCMapper())
     factory.add_request_mapper(JSONRPCMapper())
@@ -407,6 +418,7 @@ class ServiceHandler(webapp.RequestHandler):
     """
     self.__factory = factory
     self.__service = service
+    self.__timer = None
 
   @property
   def service(self):
@@ -461,6 +473,7 @@ class ServiceHandler(webapp.RequestHandler):
                    error_message,
                    mapper,
                    error_name=None):
+    self.__timer.record.state = status_state
     status = remote.RpcStatus(state=status_state,
                               error_message=error_message,
                               error_name=error_name)
@@ -517,10 +530,35 @@ class ServiceHandler(webapp.RequestHandler):
     request for that protocol or the service object does not support the
     requested RPC method, will return error code 400 in the response.
 
+    When the factory of the handler has an instrumentation, the call is
+    reported to it once the response has been built.  The response is sent
+    by webapp after the handler returns, so there is no WRITE phase.
+
+    Args:
+      http_method: HTTP method of request.
+      service_path: Service path derived from request URL.
+      remote_method: Sub-path after service path has been matched.
+    """
+    timer = self.__timer = rpc_instrumentation.RpcTimer(
+      self.__factory.instrumentation, service_path, remote_method)
+    try:
+      self.__handle(http_method, service_path, remote_method, timer)
+    finally:
+      if self.__factory.instrumentation is not None:
+        timer.record.request_size = len(self.request.body or '')
+        timer.record.response_size = len(self.response.out.getvalue())
+        status = getattr(self.response, 'status_int', self.response.status)
+        timer.set_http_status(status)
+        timer.finish()
+
+  def __handle(self, http_method, service_path, remote_method, timer):
+    """Implementation of handle.
+
     Args:
       http_method: HTTP method of request.
       service_path: Service path derived from request URL.
       remote_method: Sub-path after service path has been matched.
+      timer: instrumentation.RpcTimer of call.
     """
     self.response.headers['x-content-type-options'] = 'nosniff'
     if not remote_method and http_method == 'GET':
@@ -551,6 +589,7 @@ class ServiceHandler(webapp.RequestHandler):
           service_path=service_path,
           headers=list(self.__headers(content_type)))
       state_initializer(request_state)
+    timer.lap(rpc_instrumentation.INITIALIZE_REQUEST_STATE)
 
     if not content_type:
       self.__send_simple_error(400, 'Invalid RPC request: missing content-type')
@@ -559,6 +598,7 @@ class ServiceHandler(webapp.RequestHandler):
     # Search for mapper to mediate request.
     for mapper in self.__factory.all_request_mappers():
       if content_type in mapper.content_types:
+        timer.record.protocol = mapper.default_content_type
         break
     else:
       if http_method == 'GET':
@@ -589,8 +629,10 @@ class ServiceHandler(webapp.RequestHandler):
             'Unrecognized RPC method: %s' % remote_method,
             mapper)
           return
+        timer.lap(rpc_instrumentation.ROUTE)
 
         request = mapper.build_request(self, method_info.request_type)
+        timer.lap(rpc_instrumentation.DECODE)
       except (RequestError, messages.DecodeError) as err:
         self.__send_error(400,
                           remote.RpcState.REQUEST_ERROR,
@@ -600,6 +642,7 @@ class ServiceHandler(webapp.RequestHandler):
 
       try:
         response = method(request)
+        timer.lap(rpc_instrumentation.METHOD)
       except remote.ApplicationError as err:
         self.__send_error(400,
                           remote.RpcState.APPLICATION_ERROR,
@@ -609,6 +652,7 @@ class ServiceHandler(webapp.RequestHandler):
         return
 
       mapper.build_response(self, response)
+      timer.lap(rpc_instrumentation.ENCODE)
     except Exception as err:
       logging.error('An unexpected error occured when handling RPC: %s',
                     err, exc_info=1)
@@ -696,6 +740,7 @@ class URLEncodedRPCMapper(RPCMapper):
         builder.add_parameter(argument, values)
       except messages.DecodeError as err:
         raise RequestError(str(err))
+    builder.finish()
     return request
 
 
@@ -728,7 +773,8 @@ class JSONRPCMapper(RPCMapper):
 
 
 def service_mapping(services,
-                    registry_path=DEFAULT_REGISTRY_PATH):
+                    registry_path=DEFAULT_REGISTRY_PATH,
+                    instrumentation=None):
   """Create a services mapping for use with webapp.
 
   Creates basic default configuration and registration for ProtoRPC services.
@@ -771,6 +817,8 @@ def service_mapping(services,
       the service.
     registry_path: Path to give to registry service.  Use None to disable
       registry service.
+    instrumentation: instrumentation.Instrumentation to report every call
+      handled by the mapped services to.
 
   Returns:
     List of tuples defining a mapping of request handlers compatible with a
@@ -813,7 +861,8 @@ def service_mapping(services,
       paths.add(path)
 
     # Create service mapping for webapp.
-    new_mapping = ServiceHandlerFactory.default(service).mapping(path)
+    new_mapping = ServiceHandlerFactory.default(
+      service, instrumentation=instrumentation).mapping(path)
     mapping.append(new_mapping)
 
     # Update registry with service class.
@@ -823,12 +872,15 @@ def service_mapping(services,
 
 
 def run_services(services,
-                 registry_path=DEFAULT_REGISTRY_PATH):
+                 registry_path=DEFAULT_REGISTRY_PATH,
+                 instrumentation=None):
   """Handle CGI request using service mapping.
 
   Args:
     Same as service_mapping.
   """
-  mappings = service_mapping(services, registry_path=registry_path)
+  mappings = service_mapping(services,
+                             registry_path=registry_path,
+                             instrumentation=instrumentation)
   application = webapp.WSGIApplication(mappings)
   webapp_util.run_wsgi_app(application)
@@ -28,6 +28,7 @@ import sys
 import unittest
 import urllib
 
+from protorpc import instrumentation
 from protorpc import messages
 from protorpc import protobuf
 from protorpc import protojson
@@ -792,6 +793,65 @@ class MissingContentTypeTests(ServiceHandlerTest):
     return environment
 
 
+class ListInstrumentation(instrumentation.Instrumentation):
+  """Instrumentation keeping all records in a list."""
+
+  def __init__(self):
+    self.records = []
+
+  def record(self, rpc_record):
+    self.records.append(rpc_record)
+
+
+class InstrumentationTest(webapp_test_util.RequestHandlerTestBase):
+  """Test instrumentation of calls handled by the ServiceHandler."""
+
+  def setUp(self):
+    self.instrumentation = ListInstrumentation()
+    super(InstrumentationTest, self).setUp()
+
+  def CreateRequestHandler(self):
+    factory = service_handlers.ServiceHandlerFactory.default(
+      Service, instrumentation=self.instrumentation)
+    return factory()
+
+  def DoJsonRequest(self, method_name, content):
+    self.ResetHandler({'REQUEST_METHOD': 'POST',
+                       'CONTENT_TYPE': 'application/json',
+                       'CONTENT_LENGTH': str(len(content)),
+                       'wsgi.input': cStringIO.StringIO(content),
+                      })
+    self.handler.handle('POST', '/my_service', method_name)
+    [record] = self.instrumentation.records
+    return record
+
+  def testRecord(self):
+    record = self.DoJsonRequest('method1', '{"integer_field": 1}')
+    self.assertEquals('/my_service', record.service_path)
+    self.assertEquals('method1', record.method_name)
+    self.assertEquals('application/json', record.protocol)
+    self.assertEquals(remote.RpcState.OK, record.state)
+    self.assertEquals(sorted([instrumentation.INITIALIZE_REQUEST_STATE,
+                              instrumentation.ROUTE,
+                              instrumentation.DECODE,
+                              instrumentation.METHOD,
+                              instrumentation.ENCODE,
+                             ]),
+                      sorted(record.timings))
+    self.assertEquals(20, record.request_size)
+    self.assertEquals(len(self.handler.response.out.getvalue()),
+                      record.response_size)
+
+  def testMethodNotFound(self):
+    record = self.DoJsonRequest('not_remote', '{}')
+    self.assertEquals(remote.RpcState.METHOD_NOT_FOUND_ERROR, record.state)
+    self.assertFalse(instrumentation.METHOD in record.timings)
+
+  def testRequestError(self):
+    record = self.DoJsonRequest('method1', '{"integer_field": "a"}')
+    self.assertEquals(remote.RpcState.REQUEST_ERROR, record.state)
+
+
 class RPCMapperTestBase(test_util.TestCase):
 
   def setUp(self):
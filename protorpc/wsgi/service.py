@@ -29,10 +29,15 @@ __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 import cgi
 import six.moves.http_client
+import six.moves.urllib.parse
 import logging
 import re
 
+from .. import batch
+from .. import compression
+from .. import instrumentation as rpc_instrumentation
 from .. import messages
+from .. import profiling
 from .. import registry
 from .. import remote
 from .. import util
@@ -52,11 +57,74 @@ _HTTP_UNSUPPORTED_MEDIA_TYPE = wsgi_util.error(six.moves.http_client.UNSUPPORTED
 
 DEFAULT_REGISTRY_PATH = '/protorpc'
 
+# Request header and query parameter selecting the fields of responses.
+_FIELD_MASK_HEADER = 'HTTP_X_FIELD_MASK'
+_FIELD_MASK_PARAMETER = 'fields'
+
+
+class _InstrumentedBody(object):
+  """WSGI response body that times how long it takes to write it.
+
+  The call is reported to the instrumentation when the server closes the
+  body after having sent it.
+  """
+
+  def __init__(self, body, timer):
+    """Constructor.
+
+    Args:
+      body: Iterable WSGI response body to send.
+      timer: instrumentation.RpcTimer of call.
+    """
+    self.__body = body
+    self.__timer = timer
+
+  def __iter__(self):
+    record = self.__timer.record
+    for chunk in self.__body:
+      record.response_size += len(chunk)
+      yield chunk
+
+  def close(self):
+    try:
+      close = getattr(self.__body, 'close', None)
+      if close is not None:
+        close()
+    finally:
+      self.__timer.finish(rpc_instrumentation.WRITE)
+
+
+def _get_field_mask(environ):
+  """Get field mask selecting the fields of the response of a request.
+
+  Args:
+    environ: WSGI environment of request.
+
+  Returns:
+    messages.FieldMask from the X-Field-Mask header, or else from the fields
+    query parameter.  None if the request has neither.
+
+  Raises:
+    messages.ValidationError if the field mask is not valid.
+  """
+  paths = environ.get(_FIELD_MASK_HEADER)
+  if paths is None:
+    query = six.moves.urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+    if _FIELD_MASK_PARAMETER not in query:
+      return None
+    paths = ','.join(query[_FIELD_MASK_PARAMETER])
+  return messages.FieldMask(paths)
+
 
 @util.positional(2)
-def service_mapping(service_factory, service_path=r'.*', protocols=None):
+def service_mapping(service_factory, service_path=r'.*', protocols=None,
+                    instrumentation=None):
   """WSGI application that handles a single ProtoRPC service mapping.
 
+  Requests may ask for part of the response with a field mask, see
+  messages.FieldMask, in the X-Field-Mask header or the fields query
+  parameter, for example '/my_service.my_method?fields=name,items.price'.
+
   Args:
     service_factory: Service factory for creating instances of service request
       handlers.  Either callable that takes no parameters and returns a service
@@ -65,6 +133,9 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
       that do not have matching paths will cause a 404 (Not Found) response.
     protocols: remote.Protocols instance that configures supported protocols
       on server.
+    instrumentation: instrumentation.Instrumentation that every request
+      matching service_path is reported to.  If None, requests are not
+      measured.
   """
   service_class = getattr(service_factory, 'service_class', service_factory)
   remote_methods = service_class.all_remote_methods()
@@ -78,13 +149,41 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
     service_path = path_match.group(1)
     method_name = path_match.group(2)
 
+    timer = rpc_instrumentation.RpcTimer(instrumentation,
+                                         service_path,
+                                         method_name)
+    if instrumentation is None:
+      return handle_rpc(environ, start_response, service_path, method_name,
+                        timer)
+
+    def timed_start_response(status, response_headers, *args):
+      timer.set_http_status(int(status.split(' ', 1)[0]))
+      return start_response(status, response_headers, *args)
+
+    return _InstrumentedBody(
+      handle_rpc(environ, timed_start_response, service_path, method_name,
+                 timer),
+      timer)
+
+  def handle_rpc(environ, start_response, service_path, method_name, timer):
+    """Handle request for a remote method.
+
+    Args:
+      environ: WSGI environment of request.
+      start_response: WSGI start_response function.
+      service_path: Path of service that request was sent to.
+      method_name: Name of remote method requested.
+      timer: instrumentation.RpcTimer of call.
+
+    Returns:
+      WSGI response body.
+    """
     content_type = environ.get('CONTENT_TYPE')
     if not content_type:
       content_type = environ.get('HTTP_CONTENT_TYPE')
     if not content_type:
       return _HTTP_BAD_REQUEST(environ, start_response)
 
-    # TODO(rafek): Handle alternate encodings.
     content_type = cgi.parse_header(content_type)[0]
 
     request_method = environ['REQUEST_METHOD']
@@ -109,6 +208,13 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
       protocol = local_protocols.lookup_by_content_type(content_type)
     except KeyError:
       return _HTTP_UNSUPPORTED_MEDIA_TYPE(environ,start_response)
+    timer.record.protocol = protocol.name
+
+    content_encoding = environ.get('HTTP_CONTENT_ENCODING',
+                                   compression.IDENTITY).strip().lower()
+    if (content_encoding != compression.IDENTITY and
+        content_encoding not in protocol.content_encodings):
+      return _HTTP_UNSUPPORTED_MEDIA_TYPE(environ,start_response)
 
     def send_rpc_error(status_code, state, message, error_name=None):
       """Helper function to send an RpcStatus message as response.
@@ -125,6 +231,7 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
         List containing encoded content response using the same content-type as
         the request.
       """
+      timer.record.state = state
       status = remote.RpcStatus(state=state,
                                 error_message=message,
                                 error_name=error_name)
@@ -141,17 +248,43 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
                             remote.RpcState.METHOD_NOT_FOUND_ERROR,
                             'Unrecognized RPC method: %s' % method_name)
 
+    remote_info = method.remote
+    try:
+      field_mask = _get_field_mask(environ)
+      if field_mask is not None:
+        field_mask.validate(remote_info.response_type)
+    except messages.ValidationError as err:
+      return send_rpc_error(six.moves.http_client.BAD_REQUEST,
+                            remote.RpcState.REQUEST_ERROR,
+                            'Invalid field mask: %s' % err)
+
     content_length = int(environ.get('CONTENT_LENGTH') or '0')
+    timer.record.request_size = content_length
+    timer.lap(rpc_instrumentation.ROUTE)
 
-    remote_info = method.remote
     try:
-      request = protocol.decode_message(
-        remote_info.request_type, environ['wsgi.input'].read(content_length))
-    except (messages.ValidationError, messages.DecodeError) as err:
+      if content_encoding == compression.IDENTITY:
+        content = environ['wsgi.input'].read(content_length)
+      else:
+        content = compression.decompress_stream(
+          environ['wsgi.input'],
+          content_encoding,
+          length=content_length,
+          max_size=protocol.max_decompressed_size)
+      request = protocol.decode_message(remote_info.request_type, content)
+    except compression.ContentTooLargeError as err:
+      return send_rpc_error(
+        six.moves.http_client.REQUEST_ENTITY_TOO_LARGE,
+        remote.RpcState.REQUEST_ERROR,
+        'Error parsing ProtoRPC request (%s)' % err)
+    except (messages.ValidationError,
+            messages.DecodeError,
+            compression.DecompressionError) as err:
       return send_rpc_error(six.moves.http_client.BAD_REQUEST,
                             remote.RpcState.REQUEST_ERROR,
                             'Error parsing ProtoRPC request '
                             '(Unable to parse request content: %s)' % err)
+    timer.lap(rpc_instrumentation.DECODE)
 
     instance = service_factory()
 
@@ -163,9 +296,9 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
       if server_port:
         server_port = int(server_port)
 
-      headers = []
+      headers = [('content-type', content_type)]
       for name, value in six.iteritems(environ):
-        if name.startswith('HTTP_'):
+        if name.startswith('HTTP_') and name != 'HTTP_CONTENT_TYPE':
           headers.append((name[len('HTTP_'):].lower().replace('_', '-'), value))
       request_state = remote.HttpRequestState(
         remote_host=environ.get('REMOTE_HOST', None),
@@ -177,10 +310,23 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
         headers=headers)
 
       initialize_request_state(request_state)
+    timer.lap(rpc_instrumentation.INITIALIZE_REQUEST_STATE)
 
     try:
       response = method(instance, request)
-      encoded_response = protocol.encode_message(response)
+      timer.lap(rpc_instrumentation.METHOD)
+      # Services may keep encodings of responses they return repeatedly.  If
+      # so, get_encoded_response returns a tuple (encoded_response, etag).
+      # Those are encodings of whole responses, so not used with field masks.
+      cached_encoding = None
+      get_encoded_response = getattr(instance, 'get_encoded_response', None)
+      if get_encoded_response and field_mask is None:
+        cached_encoding = get_encoded_response(response, protocol)
+      if cached_encoding is None:
+        encoded_response = protocol.encode_message(response, field_mask)
+        etag = None
+      else:
+        encoded_response, etag = cached_encoding
     except remote.ApplicationError as err:
       return send_rpc_error(six.moves.http_client.BAD_REQUEST,
                             remote.RpcState.APPLICATION_ERROR,
@@ -195,16 +341,69 @@ def service_mapping(service_factory, service_path=r'.*', protocols=None):
                             'Internal Server Error')
 
     response_headers = [('content-type', content_type)]
+    response_body = [encoded_response]
+    if protocol.content_encodings:
+      response_headers.append(('vary', 'accept-encoding'))
+    if etag:
+      response_headers.append(('etag', etag))
+      if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+      if if_none_match and (
+          if_none_match.strip() == '*' or
+          etag in [tag.strip() for tag in if_none_match.split(',')]):
+        timer.lap(rpc_instrumentation.ENCODE)
+        start_response('%d %s' % (six.moves.http_client.NOT_MODIFIED,
+                                  six.moves.http_client.responses[
+                                    six.moves.http_client.NOT_MODIFIED]),
+                       response_headers[1:])
+        return []
+    if protocol.content_encodings:
+      response_encoding = compression.select_encoding(
+        environ.get('HTTP_ACCEPT_ENCODING'), protocol.content_encodings)
+      if (response_encoding and
+          len(encoded_response) >= protocol.compression_threshold):
+        response_headers.append(('content-encoding', response_encoding))
+        if len(encoded_response) >= compression.DEFAULT_STREAMING_THRESHOLD:
+          response_body = compression.compress_chunks(encoded_response,
+                                                      response_encoding)
+        else:
+          response_body = [compression.compress(encoded_response,
+                                                response_encoding)]
+    timer.lap(rpc_instrumentation.ENCODE)
+
     start_response('%d %s' % (six.moves.http_client.OK, six.moves.http_client.responses[six.moves.http_client.OK],),
                    response_headers)
-    return [encoded_response]
+    return response_body
 
   # Return WSGI application.
   return protorpc_service_app
 
 
+def _instrumentation_dump_mapping(instrumentation, path):
+  """WSGI application serving the dump of an instrumentation at a path.
+
+  Args:
+    instrumentation: Instrumentation with a dump method.
+    path: Path to serve dump at.
+
+  Returns:
+    WSGI application serving dump at path and a 404 (Not Found) response for
+    all other paths.
+  """
+  dump_app = rpc_instrumentation.dump_application(instrumentation)
+
+  def instrumentation_dump_mapping_app(environ, start_response):
+    """Actual WSGI application function."""
+    if environ['PATH_INFO'] != path:
+      return _HTTP_NOT_FOUND(environ, start_response)
+    return dump_app(environ, start_response)
+  return instrumentation_dump_mapping_app
+
+
 @util.positional(1)
-def service_mappings(services, registry_path=DEFAULT_REGISTRY_PATH):
+def service_mappings(services, registry_path=DEFAULT_REGISTRY_PATH,
+                     batch_path=None, batch_max_workers=1,
+                     instrumentation=None, instrumentation_path=None,
+                     profiler=None, profiler_path=None):
   """Create multiple service mappings with optional RegistryService.
 
   Use this function to create single WSGI application that maps to
@@ -230,17 +429,42 @@ def service_mappings(services, registry_path=DEFAULT_REGISTRY_PATH):
       service_factory: A service class or service instance factory.
     registry_path: A string to change where the registry is mapped (the default
       location is '/protorpc').  When None, no registry is created or mounted.
+    batch_path: A string where a batch.BatchService able to call all services
+      is mapped, for example '/protorpc/batch'.  When None (the default), no
+      batch service is created or mounted.
+    batch_max_workers: Maximum number of calls of a batch that the batch
+      service executes concurrently.
+    instrumentation: instrumentation.Instrumentation that calls of all
+      services are reported to.  If None and instrumentation_path is set, a
+      new instrumentation.HistogramInstrumentation is used.
+    instrumentation_path: A string where a text dump of the instrumentation
+      is served, for example '/protorpc/stats'.  The instrumentation must
+      have a dump method.  When None (the default), no dump is served.
+    profiler: profiling.Profiler that profiles calls of all services.  If None
+      and profiler_path is set, a new profiling.Profiler profiling calls
+      slower than profiling.DEFAULT_LATENCY_THRESHOLD is used.
+    profiler_path: A string where a profiling.ProfileService serving the
+      profiles of the profiler is mapped, for example '/protorpc/profiles'.
+      When None (the default), no profile service is created or mounted.
 
   Returns:
     WSGI application that serves ProtoRPC services on their respective URLs
-    plus optional RegistryService.
+    plus optional RegistryService, BatchService, instrumentation dump and
+    ProfileService.
   """
   if isinstance(services, dict):
     services = six.iteritems(services)
 
+  if instrumentation is None and instrumentation_path:
+    instrumentation = rpc_instrumentation.HistogramInstrumentation()
+
+  if profiler is None and profiler_path:
+    profiler = profiling.Profiler()
+
   final_mapping = []
   paths = set()
   registry_map = {} if registry_path else None
+  batch_map = {} if batch_path else None
 
   for service_path, service_factory in services:
     try:
@@ -258,10 +482,35 @@ def service_mappings(services, registry_path=DEFAULT_REGISTRY_PATH):
     if registry_map is not None:
       registry_map[service_path] = service_class
 
-    final_mapping.append(service_mapping(service_factory, service_path))
+    if batch_map is not None:
+      batch_map[service_path] = service_factory
+
+    final_mapping.append(service_mapping(service_factory, service_path,
+                                         instrumentation=instrumentation))
 
   if registry_map is not None:
     final_mapping.append(service_mapping(
-      registry.RegistryService.new_factory(registry_map), registry_path))
+      registry.RegistryService.new_factory(registry_map), registry_path,
+      instrumentation=instrumentation))
 
-  return wsgi_util.first_found(final_mapping)
+  if batch_map is not None:
+    final_mapping.append(service_mapping(
+      batch.BatchService.new_factory(batch_map,
+                                     max_workers=batch_max_workers),
+      batch_path,
+      instrumentation=instrumentation))
+
+  if instrumentation_path:
+    final_mapping.append(_instrumentation_dump_mapping(instrumentation,
+                                                       instrumentation_path))
+
+  application = wsgi_util.first_found(final_mapping)
+  if profiler is not None:
+    application = profiling.middleware(application, profiler)
+    if profiler_path:
+      application = wsgi_util.first_found([
+        service_mapping(
+          profiling.ProfileService.new_factory(profiler.profile_buffer),
+          profiler_path),
+        application])
+  return application
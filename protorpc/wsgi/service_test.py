@@ -20,10 +20,17 @@
 __author__ = 'rafek@google.com (Rafe Kaplan)'
 
 
+import threading
+import time
 import unittest
 
+import six
 
+from protorpc import compression
 from protorpc import end2end_test
+from protorpc import instrumentation
+from protorpc import message_types
+from protorpc import profiling
 from protorpc import protojson
 from protorpc import remote
 from protorpc import registry
@@ -197,6 +204,381 @@ class ProtoServiceMappingsTest(ServiceMappingTest):
     self.assertEquals('other-service', response.string_value)
 
 
+class ContentEncodingTest(webapp_test_util.WebServerTestBase):
+
+  def setUp(self):
+    self.request_encodings = []
+    self.response_headers = []
+    super(ContentEncodingTest, self).setUp()
+    self.stub = webapp_test_util.TestService.Stub(self.connection)
+
+  def CreateWsgiApplication(self):
+    """Create WSGI application recording content-encoding headers."""
+    application = service.service_mapping(webapp_test_util.TestService,
+                                          '/my/service')
+
+    def recording_application(environ, start_response):
+      self.request_encodings.append(environ.get('HTTP_CONTENT_ENCODING'))
+      def recording_start_response(status, headers, *args):
+        self.response_headers.append(dict(headers))
+        return start_response(status, headers, *args)
+      return application(environ, recording_start_response)
+    return recording_application
+
+  def CreateTransport(self, service_url, protocol=protojson):
+    """Create transport compressing all requests with gzip."""
+    return transport.HttpTransport(
+      service_url,
+      protocol=remote.ProtocolConfig(protocol, 'protojson',
+                                     compression_threshold=0,
+                                     request_encoding='gzip'))
+
+  def testSmallResponse(self):
+    response = self.stub.optional_message(string_value=u'small')
+    self.assertEquals(u'+small', response.string_value)
+    self.assertEquals(['gzip'], self.request_encodings)
+    [headers] = self.response_headers
+    self.assertEquals('accept-encoding', headers['vary'])
+    self.assertFalse('content-encoding' in headers)
+
+  def testLargeResponse(self):
+    value = u'x' * 10000
+    response = self.stub.optional_message(string_value=value)
+    self.assertEquals(u'+' + value, response.string_value)
+    [headers] = self.response_headers
+    self.assertEquals('gzip', headers['content-encoding'])
+
+  def testStreamedResponse(self):
+    value = u'x' * compression.DEFAULT_STREAMING_THRESHOLD
+    response = self.stub.optional_message(string_value=value)
+    self.assertEquals(u'+' + value, response.string_value)
+    [headers] = self.response_headers
+    self.assertEquals('gzip', headers['content-encoding'])
+
+  def testNoCompression(self):
+    self.connection = transport.HttpTransport(
+      self.service_url,
+      protocol=remote.ProtocolConfig(protojson, 'protojson',
+                                     content_encodings=()))
+    self.stub = webapp_test_util.TestService.Stub(self.connection)
+    value = u'x' * 10000
+    response = self.stub.optional_message(string_value=value)
+    self.assertEquals(u'+' + value, response.string_value)
+    self.assertEquals([None], self.request_encodings)
+    [headers] = self.response_headers
+    self.assertFalse('content-encoding' in headers)
+
+  def DoRequest(self, content, content_encoding):
+    environ = webapp_test_util.GetDefaultEnvironment()
+    environ.update({'REQUEST_METHOD': 'POST',
+                    'PATH_INFO': '/my/service.optional_message',
+                    'CONTENT_TYPE': 'application/json',
+                    'CONTENT_LENGTH': str(len(content)),
+                    'HTTP_CONTENT_ENCODING': content_encoding,
+                    'wsgi.input': six.BytesIO(content),
+                   })
+    statuses = []
+    def start_response(status, headers, *args):
+      statuses.append(status)
+    content = b''.join(self.application(environ, start_response))
+    return statuses[0], content
+
+  def testUnsupportedContentEncoding(self):
+    status, unused_content = self.DoRequest(b'{}', 'br')
+    self.assertEquals('415 Unsupported Media Type', status)
+
+  def testInvalidCompressedContent(self):
+    status, content = self.DoRequest(b'{}', 'gzip')
+    self.assertEquals('400 Bad Request', status)
+    self.assertEquals(
+      remote.RpcState.REQUEST_ERROR,
+      protojson.decode_message(remote.RpcStatus, content).state)
+
+  def testDecompressedContentTooLarge(self):
+    protocols = remote.Protocols()
+    protocols.add_protocol(protojson, 'protojson', max_decompressed_size=100)
+    self.application = service.service_mapping(webapp_test_util.TestService,
+                                                '/my/service',
+                                                protocols=protocols)
+    status, unused_content = self.DoRequest(
+      compression.compress(b' ' * 50 + b'{}', 'gzip'), 'gzip')
+    self.assertEquals('200 OK', status)
+
+    status, content = self.DoRequest(
+      compression.compress(b' ' * 1000 + b'{}', 'gzip'), 'gzip')
+    self.assertEquals('413 Request Entity Too Large', status)
+    self.assertEquals(
+      remote.RpcState.REQUEST_ERROR,
+      protojson.decode_message(remote.RpcStatus, content).state)
+
+
+class RecordingInstrumentation(instrumentation.HistogramInstrumentation):
+  """Histogram instrumentation also keeping all records.
+
+  Calls are recorded after the response has been sent, so tests wait for
+  records to arrive before checking them.
+  """
+
+  def __init__(self):
+    super(RecordingInstrumentation, self).__init__()
+    self.records = []
+    self.condition = threading.Condition()
+
+  def record(self, rpc_record):
+    super(RecordingInstrumentation, self).record(rpc_record)
+    with self.condition:
+      self.records.append(rpc_record)
+      self.condition.notify_all()
+
+  def wait_for_records(self, count):
+    deadline = time.time() + 5
+    with self.condition:
+      while len(self.records) < count and time.time() < deadline:
+        self.condition.wait(deadline - time.time())
+      return list(self.records)
+
+
+class CachedEncodingService(remote.Service):
+  """Service keeping the encoding of its response."""
+
+  @remote.method(message_types.VoidMessage, message_types.VoidMessage)
+  def cached(self, request):
+    return CACHED_RESPONSE
+
+  @remote.method(message_types.VoidMessage, message_types.VoidMessage)
+  def not_cached(self, request):
+    return message_types.VoidMessage()
+
+  def get_encoded_response(self, response, protocol):
+    if response is CACHED_RESPONSE:
+      return b'{}', 'W/"cached"'
+    return None
+
+
+CACHED_RESPONSE = message_types.VoidMessage()
+
+
+class CachedEncodingTest(test_util.TestCase):
+
+  def setUp(self):
+    self.application = service.service_mapping(CachedEncodingService,
+                                                '/my/service')
+
+  def DoRequest(self, method_name, if_none_match=None):
+    environ = webapp_test_util.GetDefaultEnvironment()
+    environ.update({'REQUEST_METHOD': 'POST',
+                    'PATH_INFO': '/my/service.' + method_name,
+                    'CONTENT_TYPE': 'application/json',
+                    'CONTENT_LENGTH': '2',
+                    'wsgi.input': six.BytesIO(b'{}'),
+                   })
+    if if_none_match:
+      environ['HTTP_IF_NONE_MATCH'] = if_none_match
+    responses = []
+    def start_response(status, headers, *args):
+      responses.append((status, dict(headers)))
+    content = b''.join(self.application(environ, start_response))
+    [(status, headers)] = responses
+    return status, headers, content
+
+  def testETag(self):
+    status, headers, content = self.DoRequest('cached')
+    self.assertEquals('200 OK', status)
+    self.assertEquals('W/"cached"', headers['etag'])
+    self.assertEquals(b'{}', content)
+
+  def testNoETag(self):
+    status, headers, unused_content = self.DoRequest('not_cached')
+    self.assertEquals('200 OK', status)
+    self.assertFalse('etag' in headers)
+
+  def testNotModified(self):
+    for if_none_match in ('W/"cached"', '"other", W/"cached"', '*'):
+      status, headers, content = self.DoRequest('cached', if_none_match)
+      self.assertEquals('304 Not Modified', status)
+      self.assertEquals('W/"cached"', headers['etag'])
+      self.assertFalse('content-type' in headers)
+      self.assertEquals(b'', content)
+
+  def testModified(self):
+    status, unused_headers, content = self.DoRequest('cached', 'W/"other"')
+    self.assertEquals('200 OK', status)
+    self.assertEquals(b'{}', content)
+
+
+MASKED_RESPONSE = test_util.HasNestedMessage(
+  nested=test_util.NestedMessage(a_value=u'a'),
+  repeated_nested=[test_util.NestedMessage(a_value=u'b')])
+
+
+class FieldMaskService(remote.Service):
+  """Service returning a response to request parts of."""
+
+  @remote.method(message_types.VoidMessage, test_util.HasNestedMessage)
+  def get(self, request):
+    return MASKED_RESPONSE
+
+  def get_encoded_response(self, response, protocol):
+    return b'{}', 'W/"cached"'
+
+
+class FieldMaskTest(test_util.TestCase):
+
+  def setUp(self):
+    self.application = service.service_mapping(FieldMaskService,
+                                                '/my/service')
+
+  def DoRequest(self, query_string='', field_mask_header=None):
+    environ = webapp_test_util.GetDefaultEnvironment()
+    environ.update({'REQUEST_METHOD': 'POST',
+                    'PATH_INFO': '/my/service.get',
+                    'QUERY_STRING': query_string,
+                    'CONTENT_TYPE': 'application/json',
+                    'CONTENT_LENGTH': '2',
+                    'wsgi.input': six.BytesIO(b'{}'),
+                   })
+    if field_mask_header is not None:
+      environ['HTTP_X_FIELD_MASK'] = field_mask_header
+    responses = []
+    def start_response(status, headers, *args):
+      responses.append((status, dict(headers)))
+    content = b''.join(self.application(environ, start_response))
+    [(status, headers)] = responses
+    return status, headers, content
+
+  def testNoFieldMask(self):
+    status, headers, content = self.DoRequest()
+    self.assertEquals('200 OK', status)
+    self.assertEquals('W/"cached"', headers['etag'])
+    self.assertEquals(b'{}', content)
+
+  def testQueryParameter(self):
+    status, headers, content = self.DoRequest('fields=nested')
+    self.assertEquals('200 OK', status)
+    self.assertFalse('etag' in headers)
+    self.assertEquals(
+      test_util.HasNestedMessage(nested=MASKED_RESPONSE.nested),
+      protojson.decode_message(test_util.HasNestedMessage, content))
+
+  def testRepeatedQueryParameter(self):
+    unused_status, unused_headers, content = self.DoRequest(
+      'fields=nested&fields=repeated_nested.a_value')
+    self.assertEquals(
+      MASKED_RESPONSE,
+      protojson.decode_message(test_util.HasNestedMessage, content))
+
+  def testHeader(self):
+    unused_status, unused_headers, content = self.DoRequest(
+      'fields=nested', 'repeated_nested')
+    self.assertEquals(
+      test_util.HasNestedMessage(
+        repeated_nested=MASKED_RESPONSE.repeated_nested),
+      protojson.decode_message(test_util.HasNestedMessage, content))
+
+  def testInvalidFieldMask(self):
+    for query_string in ('fields=unknown', 'fields=nested..a_value'):
+      status, unused_headers, content = self.DoRequest(query_string)
+      self.assertEquals('400 Bad Request', status)
+      self.assertEquals(
+        remote.RpcState.REQUEST_ERROR,
+        protojson.decode_message(remote.RpcStatus, content).state)
+
+
+class InstrumentationTest(webapp_test_util.WebServerTestBase):
+
+  def setUp(self):
+    self.instrumentation = RecordingInstrumentation()
+    super(InstrumentationTest, self).setUp()
+    self.stub = webapp_test_util.TestService.Stub(self.connection)
+
+  def CreateWsgiApplication(self):
+    return service.service_mappings(
+      [('/my/service', webapp_test_util.TestService)],
+      instrumentation=self.instrumentation,
+      instrumentation_path='/protorpc/stats')
+
+  def testRecord(self):
+    value = u'x' * 5000
+    self.stub.optional_message(string_value=value)
+    [record] = self.instrumentation.wait_for_records(1)
+    self.assertEquals('/my/service', record.service_path)
+    self.assertEquals('optional_message', record.method_name)
+    self.assertEquals('protojson', record.protocol)
+    self.assertEquals(remote.RpcState.OK, record.state)
+    self.assertEquals(sorted(instrumentation.PHASES), sorted(record.timings))
+    self.assertTrue(record.request_size > 5000)
+    self.assertTrue(record.response_size > 0)
+    self.assertTrue(record.total_time >= sum(record.timings.values()) - 1e-9)
+
+  def testApplicationError(self):
+    self.assertRaises(remote.ApplicationError,
+                      self.stub.raise_application_error)
+    [record] = self.instrumentation.wait_for_records(1)
+    self.assertEquals(remote.RpcState.APPLICATION_ERROR, record.state)
+    self.assertTrue(instrumentation.DECODE in record.timings)
+
+  def testServerError(self):
+    self.assertRaises(remote.ServerError, self.stub.raise_unexpected_error)
+    [record] = self.instrumentation.wait_for_records(1)
+    self.assertEquals(remote.RpcState.SERVER_ERROR, record.state)
+
+  def testMethodNotFound(self):
+    stub = webapp_test_util.AlternateService.Stub(self.connection)
+    self.assertRaises(remote.MethodNotFoundError, stub.does_not_exist)
+    [record] = self.instrumentation.wait_for_records(1)
+    self.assertEquals('does_not_exist', record.method_name)
+    self.assertEquals(remote.RpcState.METHOD_NOT_FOUND_ERROR, record.state)
+    self.assertFalse(instrumentation.METHOD in record.timings)
+
+  def testDump(self):
+    self.stub.optional_message()
+    self.instrumentation.wait_for_records(1)
+    content = six.moves.urllib.request.urlopen(
+      self.make_service_url('/protorpc/stats')).read()
+    self.assertTrue(b'/my/service.optional_message' in content)
+    self.assertTrue(b'states: OK=1' in content)
+
+
+class ProfilerTest(webapp_test_util.WebServerTestBase):
+
+  def setUp(self):
+    self.profiler = profiling.Profiler(sample_rate=1.0)
+    super(ProfilerTest, self).setUp()
+    self.stub = webapp_test_util.TestService.Stub(self.connection)
+    self.profile_service = profiling.ProfileService.Stub(
+      self.CreateTransport(self.make_service_url('/protorpc/profiles')))
+
+  def CreateWsgiApplication(self):
+    return service.service_mappings(
+      [('/my/service', webapp_test_util.TestService)],
+      profiler=self.profiler,
+      profiler_path='/protorpc/profiles')
+
+  def testGetProfiles(self):
+    self.stub.optional_message(string_value=u'hello')
+    self.stub.init_parameter()
+    response = self.profile_service.get_profiles()
+    self.assertEquals([u'init_parameter', u'optional_message'],
+                      [profile.method_name for profile in response.profiles])
+    self.assertEquals([u'/my/service'] * 2,
+                      [profile.service_path for profile in response.profiles])
+    self.assertTrue(response.profiles[0].functions)
+
+  def testProfileServiceNotProfiled(self):
+    self.profile_service.get_profiles()
+    self.profile_service.clear_profiles()
+    self.assertEquals([], self.profile_service.get_profiles().profiles)
+
+  def testDefaultProfiler(self):
+    application = service.service_mappings(
+      [('/my/service', webapp_test_util.TestService)],
+      profiler_path='/protorpc/profiles')
+    self.ResetServer(application)
+    self.profile_service = profiling.ProfileService.Stub(
+      self.CreateTransport(self.make_service_url('/protorpc/profiles')))
+    self.assertEquals([], self.profile_service.get_profiles().profiles)
+
+
 def main():
   unittest.main()
 